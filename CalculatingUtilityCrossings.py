@@ -25,21 +25,26 @@
 #      and snLateralLine), and the swPipes layer for stormwater are copied to
 #      this local geodatabase. 
 #      
-# 3).  A text field ("Type") is added to each of the layers and populated with
-#      a text string identifying the utility and subtype (lateral, gravity,
-#      force).
+# 3).  While they are copied, only the fields named in the field maps in
+#      crossings/fieldmap.py are written, under their final names, together with
+#      a text field ("UtilType") identifying the utility and subtype (lateral,
+#      gravity, force).
 #
-# 4).  The three sanitary sewer line layers are merged together (snLines) and 
-#      unnecessary attribute fields are eliminated.  The three water line layers 
-#      are merged together (wnPipes) and unnecessary attribute fields are eliminated.
+# 4).  The three sanitary sewer line layers are merged together (snPipes).  The
+#      three water line layers are merged together (wnPipes).
 #
 # 5).  The X and Y coordinates of the start of each pipe segment is calculated for
 #      snLines and swPipes.  Coordinates are in NAD83Feet and NAVD88
 #
+# 5a). The storm, sewer and water pipes are checked for placeholder and missing inverts and
+#      diameters, inverse slopes and zero lengths (crossings/quality.py).  Each pipe gets a QA
+#      flags field and a QA report is written next to the geodatabase.
+#
 # 6).  Intersect the swPipes and snLines layers.  Add X,Y coordinates, calculate length of swPipe and
 #      snLine for each point, and invert of each pipe at intersection based on
 #      pipe length and slope of pipe segment.  Calculate vertical distance between
-#      swPipe and snLine based on inverts at intersection and pipe diameters.
+#      swPipe and snLine based on inverts at intersection and pipe diameters.  Optionally, estimate
+#      how likely the pipes are to intersect given the errors in the inverts, diameters and locations.
 #
 # 7).  Intersect the wnPipes and snLines layers.  Since water pipe layer does not include inverts, 
 #      vertical distance between pipes can not be calculated.  
@@ -47,7 +52,15 @@
 # 8).  Intersect the wnPipes and swPipes layers.  Since water pipe layer does not include inverts, 
 #      vertical distance between pipes can not be calculated.
 #
-# 9).  Merge three point feature classes together.
+# 9).  Write the three point feature classes into AllIntersections, which has one fixed set of
+#      fields (crossings/output.py).  Fields a crossing type does not have are left empty.
+#
+# 10). Optionally, find storm, sewer and water pipes passing within NearMissFeet of each other.
+#
+# 11). Publish AllIntersections to a GeoPackage for the crossing query service (crossings/query.py).
+#
+# 12). Compare AllIntersections with the previous run's and write the crossings added, removed or
+#      changed to a changeset GeoPackage (crossings/diff.py).
 
 #-----------------------------------------------------------------------------
 #
@@ -57,7 +70,8 @@
 #
 # 2).  A database connection to the server where the data is stored.
 #
-# 
+# 3).  NumPy (installed with ArcGIS) and the "crossings" folder next to this script for
+#      the native crossing engine.
 #
 # -----------------------------------------------------------------------------
 # INPUT(S):
@@ -82,6 +96,15 @@
 #
 # cmd /c C:\TEMP\Crossings\CalculatingUtilityCrossings.py >> Crossings_LOG.txt 2>&1
 #
+# The date and folder of a run, and the number of workers, can be given on the command line:
+#
+# CalculatingUtilityCrossings.py run --date 20240102 --dir D:/Crossings --workers 4
+# CalculatingUtilityCrossings.py stages      (list the steps, their inputs and outputs)
+# CalculatingUtilityCrossings.py evict       (only remove old stage cache entries)
+#
+# Importing the script has no side effects: the geoprocessor is created, and NumPy and the crossing
+# engine are loaded, the first time a step uses them (see crossings/lazy.py).
+#
 # -----------------------------------------------------------------------------
 # HISTORY:
 #
@@ -97,34 +120,259 @@
 # ==============================================================================
 #
 
-# Import system modules
-import sys, string, os, arcgisscripting, time, shutil
-
+from __future__ import print_function
 
-# Create the Geoprocessor object
-gp = arcgisscripting.create(10.1)
+# Import system modules
+import sys, os, time, shutil, json, argparse
 
-# Load required toolboxes...
-#gp.AddToolbox("C:/Program Files/ArcGIS/ArcToolbox/Toolboxes/Conversion Tools.tbx")
-#gp.AddToolbox("C:/Program Files/ArcGIS/ArcToolbox/Toolboxes/Data Management Tools.tbx")
+# Import the native crossing engine (crossings folder next to this script).  The scheduler, cache and
+# tracing only need the standard library; the other modules are loaded when a step first uses them.
+from crossings.cache import SourceHash, StageCache
+from crossings.lazy import LazyModule, LazyObject
+from crossings.scheduler import Scheduler, Stage
+from crossings.tracing import Tracer
 
-today=time.strftime("%Y%m%d", time.localtime())
+allpairs, arcgis, columnar, diff, fieldmap, geometry, gpkg, incremental, nearmiss, outofcore, output, quality, \
+    sources, tiling, uncertainty, vertsep = [LazyModule("crossings." + name) for name in (
+        "allpairs", "arcgis", "columnar", "diff", "fieldmap", "geometry", "gpkg", "incremental", "nearmiss",
+        "outofcore", "output", "quality", "sources", "tiling", "uncertainty", "vertsep")]
 
 def LogMessage( message):
-    print time.strftime ("%Y-%m-%dT%H:%M:%S ", time.localtime()) + message
-    return
-
-# Set workspace
-gp.Workspace="C:/TEMP/Crossings/Crossings" + today + ".gdb"
-
+    print(time.strftime ("%Y-%m-%dT%H:%M:%S ", time.localtime()) + message)
+    return
+
+# Process: Read the command line into the CROSSINGS_DATE, CROSSINGS_DIR and CROSSINGS_WORKERS environment
+# variables.  The settings below are read from them, and worker processes inherit them, so every process of
+# a run uses the same date and folder even when the run goes past midnight.
+def ParseArguments(argv):
+    parser = argparse.ArgumentParser(description="Find the storm, sewer and water pipe crossings.")
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "stages", "evict"])
+    parser.add_argument("--date", help="run date as YYYYMMDD (default today)")
+    parser.add_argument("--dir", help="crossings folder (default C:/TEMP/Crossings)")
+    parser.add_argument("--workers", type=int, help="worker processes")
+    args = parser.parse_args(argv)
+    for name, value in (("CROSSINGS_DATE", args.date), ("CROSSINGS_DIR", args.dir),
+                        ("CROSSINGS_WORKERS", args.workers)):
+        if value is not None:
+            os.environ[name] = str(value)
+    return args
+
+# The worker processes import this script again; only the main process reads the command line.
+if __name__ == "__main__":
+    arguments = ParseArguments(sys.argv[1:])
+
+today = os.environ.get("CROSSINGS_DATE") or time.strftime("%Y%m%d", time.localtime())
 
 # variables...
-CrossingsDIR = "C:/TEMP/Crossings"
+CrossingsDIR = os.environ.get("CROSSINGS_DIR") or "C:/TEMP/Crossings"
+
+# The geodatabase of this run, the geoprocessor's workspace.
+CrossingsGDB = CrossingsDIR + "/Crossings" + today + ".gdb"
+
+# Process: Create the Geoprocessor object the first time a step uses gp.  A rerun on the same day writes
+# into the same geodatabase, so existing outputs are replaced.
+def CreateGeoprocessor():
+    import arcgisscripting
+    geoprocessor = arcgisscripting.create(10.1)
+    # Load required toolboxes...
+    #geoprocessor.AddToolbox("C:/Program Files/ArcGIS/ArcToolbox/Toolboxes/Conversion Tools.tbx")
+    #geoprocessor.AddToolbox("C:/Program Files/ArcGIS/ArcToolbox/Toolboxes/Data Management Tools.tbx")
+    geoprocessor.Workspace = CrossingsGDB
+    geoprocessor.OverwriteOutput = 1
+    return geoprocessor
+
+gp = LazyObject(CreateGeoprocessor)
+
+# "native" finds pipe crossings with the grid-indexed engine in crossings/engine.py,
+# "arcgis" uses gp.Intersect_analysis.  Both produce the same point feature classes.
+IntersectEngine = "native"
+
+# The utility pairs to intersect: (first pipe feature class, second pipe feature class, output, InterType).
+# With the native engine every pair comes out of one shared index over all the listed pipe classes, so
+# another utility (gas, electric, telecom) is added here with its pairs instead of as new steps.  The
+# SWSSIntersect pair also gets the storm/sewer vertical separation.
+UtilityPairs = [
+    ("snPipes", "swPipes", "SWSSIntersect", "Sewer-Storm"),
+    ("wnPipes", "swPipes", "SWWIntersect", "Water-Storm"),
+    ("snPipes", "wnPipes", "SSWIntersect", "Sewer-Water")]
+
+# "full" intersects every pipe on every run.  "incremental" keeps the last run's pipe edit dates
+# and crossings in CrossingStorePath and only recomputes crossings for pipes added, modified or
+# deleted since then (see crossings/incremental.py).  Only the intersect is incremental; every other
+# step still runs over the whole network.  A pipe class added to UtilityPairs needs its key fields in
+# incremental.PIPE_KEYS.
+CrossingsMode = "full"
+CrossingStorePath = CrossingsDIR + "/CrossingStore.gpkg"
+
+# For networks too large to intersect in one call: with TileMaxPipes above 0 the area is split into
+# quadtree tiles of at most that many pipes and the tiles of all three pairs are intersected on TileWorkers
+# processes (None: one per core), see crossings/tiling.py.  The output is the same.  Native engine only.
+TileMaxPipes = 0
+TileWorkers = None
+
+# For pipe pairs too large to intersect in memory: with OutOfCoreBudgetMB above 0 the pairs are intersected
+# one at a time within about that much resident memory (see crossings/outofcore.py).  Pipes are streamed
+# from the column files in Morton-ordered tiles and the crossings are spilled to OutOfCoreSpillDIR as they
+# are found.  The log reports each pair's peak memory.  Needs IntermediateFormat = "columnar".  This is not
+# a ceiling for the run, only for the intersect step: CalcUpstreamXY, ValidatePipes, SSSWVertSep and
+# NearMisses still load whole layers, so the machine needs room for the largest pipe layer (and
+# SWSSIntersect) in memory regardless.
+OutOfCoreBudgetMB = 0
+OutOfCoreSpillDIR = CrossingsDIR + "/Crossings" + today + "_spill"
+
+# "columnar" keeps the pipes (once their upstream X,Y is calculated) and the crossings as memory-mapped
+# column files in ColumnarDIR (see crossings/columnar.py).  Later steps map those files instead of
+# re-reading the geodatabase, and only AllIntersections is written back to it.  "gdb" keeps every step in
+# the geodatabase.  Columnar intermediates need IntersectEngine = "native".
+IntermediateFormat = "columnar"
+ColumnarDIR = CrossingsDIR + "/Crossings" + today + "_columns"
+Columnar = IntermediateFormat == "columnar" and IntersectEngine == "native"
+store = LazyObject(lambda: columnar.ColumnarStore(ColumnarDIR))
+
+# Where the seven pipe classes are read from (see crossings/sources.py).  "sde" reads each class from
+# SourceWorkspace at the path given in SourceClasses; change these to match your database.  "gpkg" reads
+# tables of the same names from SourceGeoPackage instead, a local stand-in such as the network written by
+# "python -m crossings.synthetic", so the extraction can be run and tuned offline.  Pipes are fetched
+# SourceBatchSize at a time.
+SourceBackend = "sde"
+SourceWorkspace = "Database Connections\\Connection to durham-gis.sde"
+SourceClasses = {
+    "swPipes": "gis_data.A1.StormWater\\gis_data.A1.swPipes",
+    "snGravity": "gis_data.A1.SewerSystem\\gis_data.A1.snGravityMain",
+    "snLateral": "gis_data.A1.SewerSystem\\gis_data.A1.snLateralLine",
+    "snForce": "gis_data.A1.SewerSystem\\gis_data.A1.snForceMain",
+    "wnGravity": "gis_data.A1.WaterSystem\\gis_data.A1.wnGravityMain",
+    "wnLateral": "gis_data.A1.WaterSystem\\gis_data.A1.wnLateralLine",
+    "wnWaterMain": "gis_data.A1.WaterSystem\\gis_data.A1.wnWaterMain"}
+SourceGeoPackage = CrossingsDIR + "/SourceStandIn.gpkg"
+SourceBatchSize = 10000
+
+# Each class is read as pages of SourceBatchSize pipes (ranges of OBJECTID), SourceWorkers pages at a time,
+# and written to the geodatabase in OBJECTID order.  SourceConnections caps the queries one process has
+# in flight across all the classes it copies; the copy steps run on up to Workers processes at once.
+# SourceWorkers only applies to "gpkg".  Extraction from SDE is not parallel within a class: arcpy cursors
+# are not thread-safe, so with the "sde" backend each class is read one batch at a time, and the only
+# parallelism is the seven classes being copied at once by the Workers processes.
+SourceWorkers = 4
+SourceConnections = 8
+
+# Process: A new reader of the pipe classes from SourceBackend.
+def OpenSource():
+    if SourceBackend == "gpkg":
+        return sources.GeoPackageSource(SourceGeoPackage, SourceBatchSize, SourceConnections)
+    return sources.ArcSource(SourceWorkspace, SourceClasses, SourceBatchSize, SourceConnections)
+
+# Process: The source reader of this process, opened on first use and reused by every class it copies.
+_sources = []
+def Sources():
+    if not _sources:
+        _sources.append(OpenSource())
+    return _sources[0]
+
+# After the pipes are loaded every storm, sewer and water pipe is checked once by the rules in
+# crossings/quality.py.  The problems found are kept per pipe as bits of the SWQAFlags, SnQAFlags and
+# WnQAFlags fields, which the vertical separation uses to leave out placeholder inverts, and the pipes
+# caught by each rule are counted per utility in QAReportFile and the log.
+QAReportFile = CrossingsDIR + "/Crossings" + today + "_qa.json"
+
+# Near-miss search (crossings/nearmiss.py): with NearMissFeet above 0, every storm/sewer, storm/water and
+# sewer/water segment pair that passes within that horizontal distance without crossing is written to
+# SWSSNearMiss, SWWNearMiss and SSWNearMiss with the distance and the closest point on each pipe, and for
+# storm/sewer the inverts and vertical separation at those points.  Native engine only.
+NearMissFeet = 0
+
+# Each run ends by writing AllIntersections to QueryGeoPackage, which the crossing query service
+# ("python -m crossings.query", see crossings/query.py) watches and reloads without a restart.
+# "" skips this step.
+QueryGeoPackage = CrossingsDIR + "/AllIntersections.gpkg"
+
+# With UncertaintySamples above 0 the vertical separation at every storm/sewer crossing is recomputed for
+# that many random errors in the inverts, diameters and crossing positions (crossings/uncertainty.py, standard
+# errors in InvertErrorFeet, DiameterErrorInches and LocationErrorFeet).  PConflict is the share of samples in
+# which the pipes intersect, and VertSepLo/VertSepHi hold the middle 90% of the vertical separations.
+UncertaintySamples = 0
+InvertErrorFeet = 0.1
+DiameterErrorInches = 0.5
+LocationErrorFeet = 1.0
+
+# AllIntersections is compared with the one in the latest earlier Crossings<YYYYMMDD>.gdb in CrossingsDIR
+# (see crossings/diff.py).  Crossings are matched by InterType, the facility IDs of their pipes and their
+# location, and those added, removed, or with a new VertSep, CrossTy or PipeInter are written to the Changes
+# table of ChangesetFile, for consumers that apply the changes instead of reloading AllIntersections.
+# "" skips this step.
+ChangesetFile = CrossingsDIR + "/Crossings" + today + "_changes.gpkg"
+
+# Number of worker processes used to run independent steps at the same time.  1 runs every step
+# in this process, one after another.
+Workers = int(os.environ.get("CROSSINGS_WORKERS") or 3)
+
+# Every step's wall time, CPU time, peak memory and row counts are appended to this file as one JSON
+# object per line, and a summary table ends the log.  Set CROSSINGS_PROFILE=cprofile (and optionally
+# CROSSINGS_PROFILE_STAGES=SSSWVertSep,...) before the run to profile steps (see crossings/tracing.py).
+TraceFile = CrossingsDIR + "/Crossings" + today + "_trace.jsonl"
+
+# Process: Row count of a dataset, for the trace.  Columnar layers are counted from their schema.  A
+# feature class is only counted when this process already has the geoprocessor (the step itself used
+# it), so tracing never creates one in a worker or adds a GetCount per dataset to steps that do not
+# touch the geodatabase.  Anything else (such as "GDB") counts as None.
+def RowCount(name):
+    if Columnar and store.Exists(name):
+        return store.Count(name)
+    if not gp.Loaded() or not gp.Exists(name):
+        return None
+    return int(gp.GetCount_management(name).GetOutput(0))
+
+# The feature classes each finished step writes are copied to CacheDIR under a hash of the step's code,
+# its inputs and CacheParameters (see crossings/cache.py), together with a hash of this script and the
+# crossings package and a fingerprint of every source class (see CacheFingerprint).  Rerunning after a
+# failure skips the steps that already finished today and resumes at the first one that did not; a
+# change to a setting, to the code or to the source data runs the steps it affects again.  Entries older
+# than CacheMaxAgeDays are removed, then the oldest ones until the cache is under CacheMaxSizeMB.
+CacheDIR = CrossingsDIR + "/StageCache"
+CacheParameters = (today, SourceBackend, SourceWorkspace, sorted(SourceClasses.items()), SourceGeoPackage,
+                   IntersectEngine, UtilityPairs, CrossingsMode, IntermediateFormat, TileMaxPipes, OutOfCoreBudgetMB,
+                   NearMissFeet, UncertaintySamples, InvertErrorFeet, DiameterErrorInches, LocationErrorFeet)
+CacheMaxAgeDays = 3
+CacheMaxSizeMB = 20000
+
+# Process: The cache parameters that are not settings: a hash of the code the steps run and, for each
+# source class, its row count, highest object ID and latest MODIFYDATE.  A reader of its own is used so
+# no connection is left open in the processes the workers are forked from.
+def CacheFingerprint():
+    scriptDIR = os.path.dirname(os.path.abspath(__file__))
+    code = SourceHash([os.path.abspath(__file__), os.path.join(scriptDIR, "crossings")])
+    reader = OpenSource()
+    try:
+        data = [(className, reader.Fingerprint(className)) for className in sorted(SourceClasses)]
+    finally:
+        reader.Close()
+    return (code, data)
+
+# Process: Save feature classes (and their columnar copies) to a stage cache entry, and restore them
+# from one.
+def SaveDatasets(datasets, folder):
+    gp.CreateFileGDB_management(folder, "Cache")
+    for name in datasets:
+        if gp.Exists(name):
+            gp.Copy_management(name, folder + "/Cache.gdb/" + name)
+        if Columnar and store.Exists(name):
+            shutil.copytree(store.Path(name), folder + "/Columns/" + name)
+
+def RestoreDatasets(datasets, folder):
+    for name in datasets:
+        if gp.Exists(folder + "/Cache.gdb/" + name):
+            if gp.Exists(name):
+                gp.Delete_management(name)
+            gp.Copy_management(folder + "/Cache.gdb/" + name, name)
+        if os.path.isdir(folder + "/Columns/" + name):
+            store.Delete(name)
+            shutil.copytree(folder + "/Columns/" + name, store.Path(name))
 
 def  MakeBuildDirectory():
 
     LogMessage(" MakeBuildDirectory..." )
-    os.mkdir(CrossingsDIR)
+    if not os.path.isdir(CrossingsDIR):
+        os.makedirs(CrossingsDIR)
     os.chdir(CrossingsDIR)
     LogMessage(" MakeBuildDirectory Complete.")
     return
@@ -134,161 +382,34 @@ def MakeGDB():
     LogMessage(" Geodatabase creation...")
     FileGDBName="Crossings" + today
     OutputLocation=CrossingsDIR
-        
+
+    if gp.Exists(OutputLocation + "/" + FileGDBName + ".gdb"):
+        LogMessage(" Geodatabase already exists")
+        return
     gp.CreateFileGDB_management(OutputLocation, FileGDBName)
     LogMessage(" Geodatabase created")
     return
 
-# Process: Download stormwater pipe files.  Change "SDEFC" to match the path to your feature class.
-def CopySWFC():  
-    SDEFC = "Database Connections\\Connection to durham-gis.sde\\gis_data.A1.StormWater\\gis_data.A1.swPipes"
-    
-    LogMessage(" Copy stormwater pipes start...")
-    tempEnvironment6 = gp.outputZFlag
-    gp.outputZFlag = "Disabled"
-    tempEnvironment11 = gp.outputMFlag
-    gp.outputMFlag = "Disabled"
-    gp.CopyFeatures_management(SDEFC, "swPipes")
-    gp.outputZFlag = tempEnvironment6
-    gp.outputMFlag = tempEnvironment11
-    LogMessage(" Copy stormwater pipes complete.")
-    
-    return
+# Process: Download one pipe class (swPipes, snGravity, ...) from the source into the geodatabase.
+# The reader fetches pages of SourceBatchSize pipes (SourceWorkers at a time from a GeoPackage, one at a
+# time from SDE) with only the fields named in the class's field map in crossings/fieldmap.py, written
+# under their final names.
+def CopyPipeClass(className):
 
-# Process: Add and calculate several fields.  Attributes deleted as the last step need to match those found
-# in your feature class.
-def AddCalcSWFields():
-        
-    LogMessage(" Add and populate swPipes field...")
-    gp.AddField_management("swPipes", "SWFID", "TEXT", "", "", "20", "Stormwater FacID", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("swPipes", "SWFID", "[FACILITYID]", "", "")
-    gp.AddField_management("swPipes", "UtilType", "TEXT", "", "", "20", "Utility Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("swPipes", "UtilType", "\"Storm\"", "", "")
-    gp.AddField_management("swPipes", "SWDiam", "SHORT", "5", "", "", "Stormwater Diameter", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("swPipes", "SWDiam", "[DIAMETER]", "", "")
-    gp.AddField_management("swPipes", "SWLength", "DOUBLE", "38", "", "", "Storm Pipe Length", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("swPipes", "SWLength", "[Shape_Length]", "", "")
-    gp.AddField_management("swPipes", "SWUpinvert", "DOUBLE", "38", "", "", "Stormwater Upstream Invert", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("swPipes", "SWUpinvert", "[INVERTUS]", "", "")
-    gp.AddField_management("swPipes", "SWDninvert", "DOUBLE", "38", "", "", "Stormwater Downstream Invert", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("swPipes", "SWDninvert", "[INVERTDS]", "", "")
-    gp.AddField_management("swPipes", "SWMaterial", "TEXT", "", "", "30", "Stormwater Material", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("swPipes", "SWMaterial", "[MATERIAL]", "", "")
-##    decided to calculate slope fields to eliminate one area of possible error and inconsistency 
-##    gp.AddField_management("swPipes", "SWslope", "DOUBLE", "38", "", "", "Stormwater Slope(%)", "NULLABLE", "NON_REQUIRED", "")
-##    gp.CalculateField_management("swPipes", "SWslope", "[PSLOPE]", "", "")
-##    gp.AddField_management("swPipes", "SWslope", "DOUBLE", "38", "", "", "Stormwater Slope Calculated(%)", "NULLABLE", "NON_REQUIRED", "")
-##    gp.CalculateField_management("swPipes", "SWslope", "(([SWUpinvert]-[SWDninvert])/[SWLength])*100", "", "")
-    gp.DeleteField_management("swPipes", "LEGACYID;FACILITYID;LOCATION;INSTALLYEAR;DEPTHUS;DEPTHDS;HEIGHT;INVERTUS;INVERTDS;DIAMETER;\
-        WIDTH;COMMENT;SRCATTDATE;SRCCOMMENT;CREATEDATE;MODIFYDATE;EDITEDBY;ENABLED;MATERIAL;FORM;STATUS;SRCAGENCY;SRCATT;SRCUSDEPTH;\
-        SRCDSDEPTH;TYPE;PSLOPE;ADMINAREA;CONDDATE;USCOND;USCONTENTS;USOBS;DSCOND;DSCONTENTS;DSOBS;CONDCMT;PROJECT_ID;DATEBUILT;TEMP_ID")
-    LogMessage(" Stormwater updated." )
-    return
+    LogMessage(" Copy %s start..." % className)
+    reader = Sources()
+    if SourceWorkers > 1 and not reader.threadSafe:
+        LogMessage(" %s is read one batch at a time; SourceWorkers does not apply to %s" % (className,
+                                                                                          SourceBackend))
+    fieldMap = fieldmap.FIELD_MAPS[className]
+    arcgis.CreateLineFeatureClass(gp, className, fieldMap.Fields(), reader.SpatialReference(className))
+    count = 0
+    for batch in sources.Extract(reader, className, fieldMap, workers=SourceWorkers):
+        count += arcgis.AppendPipes(gp, batch, className)
+    LogMessage(" Copy %s complete, %d pipes." % (className, count))
 
-# Process: Download snGravity pipe files.  Change "SDEFC" to match the path to your feature class.
-def CopySGFC():  
-    SDEFC = "Database Connections\\Connection to durham-gis.sde\\gis_data.A1.SewerSystem\\gis_data.A1.snGravityMain"
-        
-    LogMessage(" Copy snGravity Start...")
-    tempEnvironment6 = gp.outputZFlag
-    gp.outputZFlag = "Disabled"
-    tempEnvironment11 = gp.outputMFlag
-    gp.outputMFlag = "Disabled"
-    gp.CopyFeatures_management(SDEFC, "snGravity")
-    gp.outputZFlag = tempEnvironment6
-    gp.outputMFlag = tempEnvironment11
-    LogMessage(" Copy snGravity Complete.")
-    
-    return
-
-# Process: Add and calculate several fields.  Attributes deleted as the last step need to match those found
-# in your feature class.
-def AddCalcSGFields():
-            
-    LogMessage(" Add and populate snGravity field...")
-    gp.AddField_management("snGravity", "UtilType", "TEXT", "", "", "20", "Utility Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snGravity", "UtilType", "\"snGravity\"", "", "")
-    gp.AddField_management("snGravity", "SnMaterial", "TEXT", "", "", "30", "Sewer Material", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snGravity", "SnMaterial", "[MATERIAL]", "", "")
-    LogMessage(" Delete fields...")
-    gp.DeleteField_management("snGravity", "ENABLED;ADMINISTRATIVEAREA;INSTALLDATE;OPERATIONALAREA;LIFECYCLESTATUS;WORKORDERID;\
-        FLOWMEASUREMENTID;WATERTYPE;MATERIAL;EXTERIORCOATING;JOINTTYPE1;JOINTTYPE2;LININGTYPE;PIPECLASS;ROUGHNESS;BARRELCOUNT;\
-        CROSSSECTIONSHAPE;MEASUREMENT1;MEASUREMENT2;NOMINALDIAMETER;BATCH;OWNER;RECORDEDLENGTH;LEGACYID;ITEMDESCRIPTION;\
-        CONVPHASE;FROMMH;TOMH;TEMPID;BADSPAN;EASEMENTNUMBER;CREATEDATE;MODIFYDATE;EDITEDBY;HPL;NOTES;RELINEDATE;TEMP_ID;CID;\
-        LOCATION;INSTALLYEAR;DEPTHUS;DEPTHDS;HEIGHT;WIDTH;COMMENT;SRCATTDATE;SRCCOMMENT;FORM;SRCAGENCY;SRCATT;SRCUSDEPTH;\
-        SRCDSDEPTH;TYPE;ADMINAREA;CONDDATE;USCOND;USCONTENTS;USOBS;DSCOND;DSCONTENTS;DSOBS;CONDCMT;PROJECT_ID;DATEBUILT")
-    LogMessage(" snGravity updated." )
-
-    return
-
-# Process: Download snLateral pipe files.  Change "SDEFC" to match the path to your feature class.
-def CopySLFC():  
-    SDEFC = "Database Connections\\Connection to durham-gis.sde\\gis_data.A1.SewerSystem\\gis_data.A1.snLateralLine"
-        
-    LogMessage(" Copy snLateral Start...")
-    tempEnvironment6 = gp.outputZFlag
-    gp.outputZFlag = "Disabled"
-    tempEnvironment11 = gp.outputMFlag
-    gp.outputMFlag = "Disabled"
-    gp.CopyFeatures_management(SDEFC, "snLateral")
-    gp.outputZFlag = tempEnvironment6
-    gp.outputMFlag = tempEnvironment11
-    LogMessage(" Copy snLateral Complete.")
-    
     return
 
-# Process: Add and calculate several fields.  Attributes deleted as the last step need to match those found
-# in your feature class.
-def AddCalcSLFields():
-        
-    LogMessage(" Add and populate snLateral field...")
-    gp.AddField_management("snLateral", "UtilType", "TEXT", "", "", "20", "Utility Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snLateral", "UtilType", "\"snLateral\"", "", "")
-    gp.AddField_management("snLateral", "SnMaterial", "TEXT", "", "", "30", "Sewer Material", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snLateral", "SnMaterial", "[MATERIAL]", "", "")
-    LogMessage(" Delete fields...")
-    gp.DeleteField_management("snLateral", "ENABLED;ADMINISTRATIVEAREA;INSTALLDATE;OPERATIONALAREA;LIFECYCLESTATUS;WORKORDERID;\
-        FLOWMEASUREMENTID;WATERTYPE;MATERIAL;LOCATIONDESCRIPTION;BATCH;RECORDEDLENGTH;OWNER;ITEMDESCRIPTION;STATIONING;LEGACYID;\
-        CONVPHASE;EASEMENTNUMBER;CREATEDATE;MODIFYDATE;EDITEDBY;TEMP_ID")
-    LogMessage(" snLateral updated.")
-    
-    return
-
-# Process: Download snForce pipe files.  Change "SDEFC" to match the path to your feature class.
-def CopySFFC():  
-    SDEFC = "Database Connections\\Connection to durham-gis.sde\\gis_data.A1.SewerSystem\\gis_data.A1.snForceMain"
-    
-    LogMessage(" Copy snForce Start...")
-    tempEnvironment6 = gp.outputZFlag
-    gp.outputZFlag = "Disabled"
-    tempEnvironment11 = gp.outputMFlag
-    gp.outputMFlag = "Disabled"
-    gp.CopyFeatures_management(SDEFC, "snForce")
-    gp.outputZFlag = tempEnvironment6
-    gp.outputMFlag = tempEnvironment11
-    LogMessage(" Copy snForce Complete.")
-    
-    return
-
-# Process: Add and calculate several fields.  Attributes deleted as the last step need to match those found
-# in your feature class.
-def AddCalcSFFields():
-
-    LogMessage(" Add and populate snForce field...")
-    gp.AddField_management("snForce", "UtilType", "TEXT", "", "", "20", "Utility Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snForce", "UtilType", "\"snForce\"", "", "")
-    gp.AddField_management("snForce", "SnMaterial", "TEXT", "", "", "30", "Sewer Material", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snForce", "SnMaterial", "[MATERIAL]", "", "")
-    LogMessage(" Delete fields...")
-    gp.DeleteField_management("snForce", "ENABLED;ADMINISTRATIVEAREA;INSTALLDATE;OPERATIONALAREA;LIFECYCLESTATUS;WORKORDERID;\
-        FLOWMEASUREMENTID;WATERTYPE;MATERIAL;EXTERIORCOATING;JOINTTYPE1;JOINTTYPE2;LININGTYPE;PIPECLASS;ROUGHNESS;DEPTH;\
-        GROUNDSURFACETYPE;PRESSURERATING;BATCH;ITEMDESCRIPTION;CONNECTED;OWNER;LEGACYID;CONVPHASE;EASEMENTNUMBER;CREATEDATE;\
-        MODIFYDATE;EDITEDBY;HPL;TEMP_ID;CID")
-    LogMessage(" snForce updated.")
-    
-    return
-
-
 # Process: Merge SS Pipes.
 def MergesnFC():
         
@@ -305,132 +426,6 @@ def MergesnFC():
     return
 
 
-# Process: Clean up sewer pipe attribute fields.
-def CleanupsnFC():
-        
-    LogMessage(" Clean up sewer pipe attribute fields...")
-    gp.AddField_management("snPipes", "SnFID", "TEXT", "", "", "20", "Sewer FacID", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snPipes", "SnFID", "[FACILITYID]", "", "")
-    gp.AddField_management("snPipes", "SnDiam", "SHORT", "5", "", "", "Sewer Diameter", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snPipes", "SnDiam", "[DIAMETER]", "", "")
-    gp.AddField_management("snPipes", "SnLength", "DOUBLE", "38", "", "", "Sewer Pipe Length", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snPipes", "SnLength", "[Shape_Length]", "", "")
-    gp.AddField_management("snPipes", "SnUpinvert", "DOUBLE", "38", "", "", "Sewer Upstream Invert", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snPipes", "SnUpinvert", "[UPSTREAMINVERT]", "", "")
-    gp.AddField_management("snPipes", "SnDninvert", "DOUBLE", "38", "", "", "Sewer Downstream Invert", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("snPipes", "SnDninvert", "[DOWNSTREAMINVERT]", "", "")
-##    decided to calculate slope fields to eliminate one area of possible error and inconsistency 
-##    gp.AddField_management("SnPipes", "Snslope", "DOUBLE", "38", "", "", "Sewer Slope(%)", "NULLABLE", "NON_REQUIRED", "")
-##    gp.CalculateField_management("snPipes", "Snslope", "[SLOPE]", "", "")
-##    gp.AddField_management("SnPipes", "Snslope", "DOUBLE", "38", "", "", "Sewer Slope Calculated(%)", "NULLABLE", "NON_REQUIRED", "")
-##    gp.CalculateField_management("snPipes", "Snslope", "(([SnUpinvert]-[SnDninvert])/[SnLength])*100", "", "")
-    gp.DeleteField_management("snPipes","FACILITYID;UPSTREAMINVERT;DOWNSTREAMINVERT;SLOPE;DIAMETER")
-    LogMessage(" Sewer attribute fields updated." )
-
-    return
-
-# Process: Download wnGravity pipe files.  Change "SDEFC" to match the path to your feature class.
-def CopyWGFC():  
-    SDEFC = "Database Connections\\Connection to durham-gis.sde\\gis_data.A1.WaterSystem\\gis_data.A1.wnGravityMain"
-    
-    LogMessage(" Copy wnGravity start...")
-    tempEnvironment6 = gp.outputZFlag
-    gp.outputZFlag = "Disabled"
-    tempEnvironment11 = gp.outputMFlag
-    gp.outputMFlag = "Disabled"
-    gp.CopyFeatures_management(SDEFC, "wnGravity")
-    gp.outputZFlag = tempEnvironment6
-    gp.outputMFlag = tempEnvironment11
-    LogMessage(" Copy wnGravity complete.")
-    
-    return
-
-# Process: Add and calculate several fields.  Attributes deleted as the last step need to match those found
-# in your feature class.
-def AddCalcWGFields():
-        
-    LogMessage(" Add and populate wnGravity field...")
-    gp.AddField_management("wnGravity", "UtilType", "TEXT", "", "", "20", "Utility Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnGravity", "UtilType", "\"wnGravity\"", "", "")
-    gp.AddField_management("wnGravity", "WnMaterial", "TEXT", "", "", "30", "Water Material", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnGravity", "WnMaterial", "[MATERIAL]", "", "")
-    LogMessage(" Delete fields...")
-    gp.DeleteField_management("wnGravity", "ENABLED;ADMINISTRATIVEAREA;INSTALLDATE;OPERATIONALAREA;LIFECYCLESTATUS;WORKORDERID;\
-        FLOWMEASUREMENTID;WATERTYPE;MATERIAL;EXTERIORCOATING;JOINTTYPE1;JOINTTYPE2;LININGTYPE;PIPECLASS;ROUGHNESS;BARRELCOUNT;\
-        CROSSSECTIONSHAPE;MEASUREMENT1;MEASUREMENT2;NOMINALDIAMETER;BATCH;CONNECTED;OWNER;ITEMDESCRIPTION;CREATEDATE;MODIFYDATE;\
-        EDITEDBY;TEMP_ID")
-    LogMessage(" wnGravity updated." )
-
-    return
-
-# Process: Download wnLateral pipe files.  Change "SDEFC" to match the path to your feature class.
-def CopyWLFC():  
-    SDEFC = "Database Connections\\Connection to durham-gis.sde\\gis_data.A1.WaterSystem\\gis_data.A1.wnLateralLine"
-    
-    LogMessage(" Copy wnLateral start...")
-    tempEnvironment6 = gp.outputZFlag
-    gp.outputZFlag = "Disabled"
-    tempEnvironment11 = gp.outputMFlag
-    gp.outputMFlag = "Disabled"
-    gp.CopyFeatures_management(SDEFC, "wnLateral")
-    gp.outputZFlag = tempEnvironment6
-    gp.outputMFlag = tempEnvironment11
-    LogMessage(" Copy wnLateral complete.")
-    
-    return
-
-# Process: Add and calculate several fields.  Attributes deleted as the last step need to match those found
-# in your feature class.
-def AddCalcWLFields():
-    
-    LogMessage(" Add and populate wnLateral field...")
-    gp.AddField_management("wnLateral", "UtilType", "TEXT", "", "", "20", "Utility Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnLateral", "UtilType", "\"wnLateral\"", "", "")
-    gp.AddField_management("wnLateral", "WnMaterial", "TEXT", "", "", "30", "Water Material", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnLateral", "WnMaterial", "[MATERIAL]", "", "")
-    LogMessage(" Delete fields...")
-    gp.DeleteField_management("wnLateral","ENABLED;ADMINISTRATIVEAREA;INSTALLDATE;OPERATIONALAREA;LIFECYCLESTATUS;WORKORDERID;\
-        FLOWMEASUREMENTID;WATERTYPE;MATERIAL;LOCATIONDESCRIPTION;BATCH;CONNECTED;OWNER;ITEMDESCRIPTION;LEGACYID;CONVPHASE;\
-        EASEMENTNUMBER;CREATEDATE;MODIFYDATE;EDITEDBY;TEMP_ID")
-    LogMessage(" wnLateral updated." )
-    
-    return
-
-# Process: Download wnWaterMain pipe files.  Change "SDEFC" to match the path to your feature class.
-def CopyWMFC():  
-    SDEFC = "Database Connections\\Connection to durham-gis.sde\\gis_data.A1.WaterSystem\\gis_data.A1.wnWaterMain"
-
-    LogMessage(" Copy wnWaterMain start...")
-    tempEnvironment6 = gp.outputZFlag
-    gp.outputZFlag = "Disabled"
-    tempEnvironment11 = gp.outputMFlag
-    gp.outputMFlag = "Disabled"
-    gp.CopyFeatures_management(SDEFC, "wnWaterMain")
-    gp.outputZFlag = tempEnvironment6
-    gp.outputMFlag = tempEnvironment11
-    LogMessage(" Copy wnWaterMain complete.")
-    
-    return
-
-# Process: Add and calculate several fields.  Attributes deleted as the last step need to match those found
-# in your feature class.
-def AddCalcWMFields():
-    
-    LogMessage(" Add and populate field...")
-    gp.AddField_management("wnWaterMain", "UtilType", "TEXT", "", "", "20", "Utility Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnWaterMain", "UtilType", "\"wnMain\"", "", "")
-    gp.AddField_management("wnWaterMain", "WnMaterial", "TEXT", "", "", "30", "Water Material", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnWaterMain", "WnMaterial", "[MATERIAL]", "", "")
-    LogMessage(" Delete fields...")
-    gp.DeleteField_management("wnWaterMain","ENABLED;ADMINISTRATIVEAREA;INSTALLDATE;OPERATIONALAREA;LIFECYCLESTATUS;WORKORDERID;\
-        FLOWMEASUREMENTID;WATERTYPE;MATERIAL;EXTERIORCOATING;JOINTTYPE1;JOINTTYPE2;LININGTYPE;PIPECLASS;ROUGHNESS;DEPTH;\
-        GROUNDSURFACETYPE;PRESSURERATING;BATCH;CONNECTED;OWNER;ITEMDESCRIPTION;LEGACYID;CONVPHASE;EASEMENTNUMBER;CREATEDATE;\
-        MODIFYDATE;EDITEDBY;TEMP_ID;CID")
-    LogMessage( " wnWaterMain updated." )
-    
-    return
-
-
 # Process: Merge...
 def MergewnFC():
     
@@ -446,50 +441,36 @@ def MergewnFC():
 
     return
 
-# Process: Clean up water pipe attribute fields...
-def CleanupwnFC():
-        
-    LogMessage(" Clean up water pipe attribute fields...")
-    gp.AddField_management("wnPipes", "WnDiam", "SHORT", "5", "", "", "Water Diameter", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnPipes", "WnDiam", "[DIAMETER]", "", "")
-    gp.AddField_management("wnPipes", "WnUpinvert", "DOUBLE", "38", "", "", "Water Upstream Invert", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnPipes", "WnUpinvert", "[UPSTREAMINVERT]", "", "")
-    gp.AddField_management("wnPipes", "WnDninvert", "DOUBLE", "38", "", "", "Water Downstream Invert", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnPipes", "WnDninvert", "[DOWNSTREAMINVERT]", "", "")
-    gp.AddField_management("wnPipes", "Wnslope", "DOUBLE", "38", "", "", "Water Slope(%)", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnPipes", "Wnslope", "[SLOPE]", "", "")
-    gp.AddField_management("wnPipes", "WnFID", "TEXT", "", "", "20", "Water FacID", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("wnPipes", "WnFID", "[FACILITYID]", "", "")
-    gp.DeleteField_management("wnPipes","FACILITYID;UPSTREAMINVERT;DOWNSTREAMINVERT;SLOPE;DIAMETER")
-    LogMessage(" Water attribute fields updated." )
-
-    return
-
 #  Now for some fun--we calculate the upstream X,Y for the stormwater and sewer pipes so that we can calculate
 #  the invert for each pipe at the pipe crossing.  We do not calculate the invert for the water pipes because
 #  water is under pressure, which means there is no consistent slope along the pipe and the invert at the utility
 #  crossing can not be estimated.
 
-# Process: Calculate the upstream X,Y for swPipes.  
-def CalcSWXY():
+# Process: Calculate the upstream X,Y (first vertex of the first part) of every pipe.  The shapes are
+# read in one pass into coordinate arrays, the first vertices are picked out with array indexing and
+# both fields are written in a single ExtendTable call instead of an UpdateRow per pipe.  With columnar
+# intermediates the whole feature class is read once and stored with the two new columns instead.
+def CalcUpstreamXY(featureClass, xField, yField):
 
-    LogMessage(" Calculate SW X,Y...")
-    gp.AddField_management("swPipes", "SWUpX", "DOUBLE", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-    gp.AddField_management("swPipes", "SWUpY", "DOUBLE", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
+    if Columnar:
+        pipes = arcgis.ReadFeatureClass(gp, featureClass)
+        first = pipes.Endpoints()[0]
+        pipes.AddColumn(geometry.MakeField(xField, "DOUBLE"), first[:, 0])
+        pipes.AddColumn(geometry.MakeField(yField, "DOUBLE"), first[:, 1])
+        store.Write(pipes)
+        return len(pipes)
 
-    rows = gp.UpdateCursor("swPipes")
-    row = rows.Next()
-    
-    while row:
-        feature = row.shape
-        row.SWUpX = feature.FirstPoint.X
-        row.SWUpY = feature.FirstPoint.Y
-        rows.UpdateRow(row)
-        row = rows.Next()
+    pipes = arcgis.ReadGeometry(gp, featureClass)
+    first = pipes.Endpoints()[0]
+    arcgis.ExtendColumns(gp, featureClass, pipes.oids, {xField: first[:, 0], yField: first[:, 1]}, [xField, yField])
 
-    del row
-    del rows
+    return len(pipes)
 
+# Process: Calculate the upstream X,Y for swPipes.  
+def CalcSWXY():
+
+    LogMessage(" Calculate SW X,Y...")
+    CalcUpstreamXY("swPipes", "SWUpX", "SWUpY")
     LogMessage(" Calculate X,Y for swPipes complete.")
     
     return
@@ -498,93 +479,180 @@ def CalcSWXY():
 def CalcSSXY():
     
     LogMessage(" Calculate SS X,Y...")
-    gp.AddField_management("snPipes", "SSUpX", "DOUBLE", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-    gp.AddField_management("snPipes", "SSUpY", "DOUBLE", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-
-    rows = gp.UpdateCursor("snPipes")
-    row = rows.Next()
-    
-    while row:
-        feature = row.shape
-        row.SSUpX = feature.FirstPoint.X
-        row.SSUpY = feature.FirstPoint.Y
-        rows.UpdateRow(row)
-        row = rows.Next()
-
-    del row
-    del rows
-
+    CalcUpstreamXY("snPipes", "SSUpX", "SSUpY")
     LogMessage(" Calculate X,Y for SSPipes complete.")
     
     return
 
-
-
-# Process: Intersect SWSS...
-def IntersectSWSS():
-    
-    LogMessage(" Intersect sewer and storm pipes...")
-    tempEnvironment10 = gp.outputZFlag
-    gp.outputZFlag = "Disabled"
-    tempEnvironment17 = gp.outputMFlag
-    gp.outputMFlag = "Disabled"
-    gp.Intersect_analysis("snPipes; swPipes", "SWSSIntersect", "ALL", "", "POINT")
-    gp.outputZFlag = tempEnvironment10
-    gp.outputMFlag = tempEnvironment17
-    LogMessage(" Intersect SWSS complete")
-
-    return
-
-# Process: Add Intersection Type field and populate...
-def SWSSIntersectType():
-    gp.AddField_management("SWSSIntersect", "InterType", "TEXT", "", "", "50", "Intersection Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("SWSSIntersect", "InterType", "\"Sewer-Storm\"", "", "")
-    LogMessage(" Intersect type added")
-
-    return
-
-# Process: Intersect stormwater and water pipes.
-def IntersectSWW():
-        
-    LogMessage(" Intersect water and storm pipes...")
-    tempEnvironment10 = gp.outputZFlag
-    gp.outputZFlag = "Disabled"
-    tempEnvironment17 = gp.outputMFlag
-    gp.outputMFlag = "Disabled"
-    gp.Intersect_analysis("wnPipes; swPipes", "SWWIntersect", "ALL", "", "POINT")
-    gp.outputZFlag = tempEnvironment10
-    gp.outputMFlag = tempEnvironment17
-    LogMessage(" Intersect SWW complete")
-
-    return
-
-# Process: Add Intersection Type field and populate.
-def SWWIntersectType():
-    gp.AddField_management("SWWIntersect", "InterType", "TEXT", "", "", "50", "Intersection Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("SWWIntersect", "InterType", "\"Water-Storm\"", "", "")
-    LogMessage(" Intersect type added")
-
-    return
-# Process: Intersect sanitary sewer and water pipes.
-def IntersectSSW():
-        
-    LogMessage(" Intersect sewer and water pipes...")
+# Process: Store wnPipes as columns for the intersects (columnar intermediates only).
+def StoreWNPipes():
+
+    LogMessage(" Store water pipes as columns...")
+    store.Write(arcgis.ReadFeatureClass(gp, "wnPipes"))
+    LogMessage(" Water pipes stored.")
+
+    return
+
+# Process: Check the storm, sewer and water pipes (crossings/quality.py).  Every rule runs over the whole
+# layer at once and the pipe's QA flags field is added in one write per layer.  The pipes each rule caught
+# are logged and written to QAReportFile.
+def ValidatePipes():
+
+    LogMessage(" Validate pipes...")
+    report = []
+    for name in quality.UTILITIES:
+        pipes = store.Read(name) if Columnar else arcgis.ReadFeatureClass(gp, name)
+        flags = quality.ValidateLayer(pipes, name)
+        field = quality.FlagField(name)
+        if Columnar:
+            store.WriteColumns(name, [field], {field.name: flags})
+        else:
+            arcgis.ExtendColumns(gp, name, pipes.oids, {field.name: flags}, [field.name], "i2")
+        summary = quality.Summary(flags, name)
+        report.append(summary)
+        LogMessage(" QA " + quality.SummaryLine(summary))
+    with open(QAReportFile, "w") as reportFile:
+        json.dump(report, reportFile, indent=2)
+    LogMessage(" Pipe validation complete, report in %s" % QAReportFile)
+
+    return
+
+
+
+# Process: Intersect every pair in UtilityPairs with the native engine.  The segments of all the pipe
+# layers go into one grid index tagged by layer, and each pair joins only the cells of its two layers, so
+# a new utility adds its segments once instead of another overlay per pair (see crossings/allpairs.py).
+# Each output matches Intersect "ALL" and already has its InterType.
+def IntersectUtilities():
+
+    LogMessage(" Intersect %d utility pairs..." % len(UtilityPairs))
+    layers = {}
+    for name in allpairs.PairLayers(UtilityPairs):
+        layers[name] = store.Read(name) if Columnar else arcgis.ReadFeatureClass(gp, name)
+    results = allpairs.IntersectAllPairs(layers, UtilityPairs, exclude=incremental.DATE_FIELDS)
+    spatialReference = gp.Describe(UtilityPairs[0][0]).SpatialReference
+    for points in results:
+        if Columnar:
+            store.Write(points)
+        else:
+            arcgis.WritePointFeatureClass(gp, points, points.name, spatialReference)
+        LogMessage(" %s: %d crossings" % (points.name, len(points)))
+    LogMessage(" Intersect complete")
+
+    return
+
+# Process: Find the pipes of two feature classes passing within NearMissFeet of each other.  "sewer" says
+# which of the two is the sewer for the storm/sewer vertical separation ("first", "second" or None).
+def NearMisses(firstFC, secondFC, outFC, sewer=None):
+
+    LogMessage(" Near misses of %s and %s within %s ft..." % (firstFC, secondFC, NearMissFeet))
+    if Columnar:
+        first, second = store.Read(firstFC), store.Read(secondFC)
+    else:
+        first, second = arcgis.ReadFeatureClass(gp, firstFC), arcgis.ReadFeatureClass(gp, secondFC)
+    points = nearmiss.NearMissTable(first, second, outFC, NearMissFeet, sewer, exclude=incremental.DATE_FIELDS)
+    if Columnar:
+        store.Write(points)
+    else:
+        arcgis.WritePointFeatureClass(gp, points, outFC, gp.Describe(firstFC).SpatialReference)
+    LogMessage(" %d near misses found" % len(points))
+
+    return
+
+# Process: Intersect all three pipe pairs tile by tile on a pool of worker processes.  This step runs in
+# the main process, which starts the pool.
+def TiledIntersects():
+
+    LogMessage(" Tiled intersect of sewer, storm and water pipes...")
+    layers = {}
+    for name in allpairs.PairLayers(UtilityPairs):
+        layers[name] = store.Path(name) if Columnar else arcgis.ReadFeatureClass(gp, name)
+    pairs = [(first, second, outFC) for first, second, outFC, interType in UtilityPairs]
+    results = tiling.TiledIntersectLayers(layers, pairs, maxPipes=TileMaxPipes, workers=TileWorkers,
+                                          exclude=incremental.DATE_FIELDS)
+    spatialReference = gp.Describe("snPipes").SpatialReference
+    for points in results:
+        if Columnar:
+            store.Write(points)
+        else:
+            arcgis.WritePointFeatureClass(gp, points, points.name, spatialReference)
+        LogMessage(" %s: %d crossings" % (points.name, len(points)))
+    LogMessage(" Tiled intersect complete")
+
+    return
+
+# Process: Intersect every pair in UtilityPairs out of core, one pair at a time, within OutOfCoreBudgetMB
+# of memory.  This step runs in the main process so no other stage shares the budget.
+def OutOfCoreIntersects():
+
+    LogMessage(" Out-of-core intersect of sewer, storm and water pipes within %d MB..." % OutOfCoreBudgetMB)
+    for firstName, secondName, outName, interType in UtilityPairs:
+        points, stats = outofcore.OutOfCoreIntersect(store.Path(firstName), store.Path(secondName), outName,
+                                                     OutOfCoreBudgetMB, OutOfCoreSpillDIR,
+                                                     exclude=incremental.DATE_FIELDS,
+                                                     log=lambda message: LogMessage(" " + message))
+        store.Write(points)
+        LogMessage(" %s: %d crossings, %d tiles, %.1f MB spilled, peak memory %.0f MB" % (outName,
+            stats["crossings"], stats["tiles"], stats["spillMB"], stats["peakRssMB"]))
+    shutil.rmtree(OutOfCoreSpillDIR, ignore_errors=True)
+    LogMessage(" Out-of-core intersect complete")
+
+    return
+
+# Process: Intersect one pair of pipe feature classes with gp.Intersect_analysis (IntersectEngine =
+# "arcgis").
+def IntersectPair(firstFC, secondFC, outFC):
+
+    LogMessage(" Intersect %s and %s..." % (firstFC, secondFC))
     tempEnvironment10 = gp.outputZFlag
     gp.outputZFlag = "Disabled"
     tempEnvironment17 = gp.outputMFlag
     gp.outputMFlag = "Disabled"
-    gp.Intersect_analysis("snPipes; wnPipes", "SSWIntersect", "ALL", "", "POINT")
+    gp.Intersect_analysis("%s; %s" % (firstFC, secondFC), outFC, "ALL", "", "POINT")
+    gp.DeleteField_management(outFC, "CREATEDATE;MODIFYDATE;CREATEDATE_1;MODIFYDATE_1")
     gp.outputZFlag = tempEnvironment10
     gp.outputMFlag = tempEnvironment17
-    LogMessage(" Intersect SSW complete")
-
-    return
-
-# Process: Add Intersection Type field and populate.
-def SSWIntersectType():
-    gp.AddField_management("SSWIntersect", "InterType", "TEXT", "", "", "50", "Intersection Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("SSWIntersect", "InterType", "\"Sewer-Water\"", "", "")
-    LogMessage(" Intersect type added")
+    LogMessage(" Intersect %s complete" % outFC)
+
+    return
+
+# Process: Intersect every pair in UtilityPairs incrementally.  CREATEDATE and MODIFYDATE are kept on the
+# pipe feature classes for this; they are left out of the crossing outputs.  Only this step is incremental:
+# the copies, merges, XY and validation before it and the vertical separation, uncertainty and
+# AllIntersections after it still process the whole network.
+def IncrementalIntersects():
+
+    pairs = [(first, second, outFC) for first, second, outFC, interType in UtilityPairs]
+    names = allpairs.PairLayers(UtilityPairs)
+    LogMessage(" Incremental intersect of %d utility pairs..." % len(pairs))
+    layers = {}
+    for name in names:
+        layers[name] = store.Read(name) if Columnar else arcgis.ReadFeatureClass(gp, name)
+    crossingStore = incremental.CrossingStore(CrossingStorePath)
+    results, counts = incremental.UpdateCrossings(crossingStore, layers, pairs)
+    for name in names:
+        LogMessage(" %s: %d added, %d modified, %d deleted, %d without a usable key" % (name,
+            counts[name]["added"], counts[name]["modified"], counts[name]["deleted"], counts[name]["untracked"]))
+    for name, points in results.items():
+        if Columnar:
+            store.Write(points, name)
+        else:
+            arcgis.WritePointFeatureClass(gp, points, name, gp.Describe(names[0]).SpatialReference)
+        LogMessage(" %s: %d crossings" % (name, len(points)))
+    LogMessage(" Incremental intersect complete")
+
+    return
+
+# Process: Add the Intersection Type field to a crossing feature class and fill it with "interType".
+def AddInterType(featureClass, interType):
+    if Columnar:
+        field = geometry.MakeField("InterType", "TEXT", 50, "Intersection Type")
+        store.WriteColumns(featureClass, [field], {"InterType": [interType] * store.Count(featureClass)})
+    else:
+        gp.AddField_management(featureClass, "InterType", "TEXT", "", "", "50", "Intersection Type", "NULLABLE",
+                               "NON_REQUIRED", "")
+        gp.CalculateField_management(featureClass, "InterType", "\"%s\"" % interType, "", "")
+    LogMessage(" Intersect type added to %s" % featureClass)
 
     return
 
@@ -593,245 +661,274 @@ def SSWIntersectType():
 # 1. Delete numeric values that will result in bad data.  So zeros and -9999, which are both placeholders, are deleted.
 # 2. Calculate the XY at the pipe intersection.
 # 3. Calculate the slope for the stormwater and sewer pipes based on data from the original pipe files.
-# 4. Calculate the distance between the starting XY of each pipe and the XY of the pipe intersection.
+# 4. Calculate the distance along each pipe from its starting XY to the XY of the pipe intersection.  The native
+#    intersect engines store it with each crossing; for gp.Intersect_analysis output each crossing is located on
+#    its pipes.
 # 5. Using the distance calculated in #4 and the slope calculated in #3, calculate the pipe invert at the intersection.
 # 6. Calculate the vertical separation between the pipes, taking into account the pipe diameter.
 # 7. Calculate which utility is above the other--is storm above sewer or sewer above storm.
 # 8. Calculate if the sewer pipe actually runs through the storm pipe.
 # 9. Clean up the data where there are missing values.
+# All of these steps are computed together from the table's columns (see crossings/vertsep.py)
+# and each row is written back once.
 
 def SSSWVertSep():
 
-    LogMessage(" Change zero values to NULL")
-
-    gp.MakeFeatureLayer_management("SWSSIntersect", "SWSSIntersect_Layer3", "", "", "")
-
-    gp.SelectLayerByAttribute("SWSSIntersect_Layer3", "NEW_SELECTION", "SnUpinvert=0")
-
-    gp.CalculateField_management("SWSSIntersect_Layer3", "SnUpinvert", "NULL", "", "")
-
-    gp.SelectLayerByAttribute("SWSSIntersect_Layer3", "NEW_SELECTION", "SnDninvert=0")
-
-    gp.CalculateField_management("SWSSIntersect_Layer3", "SnDninvert", "NULL", "", "")
-
-    gp.SelectLayerByAttribute("SWSSIntersect_Layer3", "NEW_SELECTION", "SWUpinvert=0 OR SWUpinvert=-9999")
-
-    gp.CalculateField_management("SWSSIntersect_Layer3", "SWUpinvert", "NULL", "", "")
-
-    gp.SelectLayerByAttribute("SWSSIntersect_Layer3", "NEW_SELECTION", "SWDninvert=0 OR SWDninvert=-9999")
-
-    gp.CalculateField_management("SWSSIntersect_Layer3", "SWDninvert", "NULL", "", "")
-
-    LogMessage(" Change -9999 values in stormwater pipe diameters to zero")
-
-    gp.SelectLayerByAttribute("SWSSIntersect_Layer3", "NEW_SELECTION", "SWDiam=-9999")
-
-    gp.CalculateField_management("SWSSIntersect_Layer3", "SWDiam", "0", "", "")
-    
+    if Columnar:
+        LogMessage(" Map SS-SW intersections and the sewer and storm pipes")
+        points = store.Read("SWSSIntersect")
+        if all(name in points.columns for name in vertsep.CHAINAGE_FIELDS):
+            vertsep.AddVerticalSeparation(points)
+        else:
+            vertsep.AddVerticalSeparation(points, store.Read("snPipes"), store.Read("swPipes"))
+        store.WriteColumns("SWSSIntersect", vertsep.OUTPUT_FIELDS,
+                           dict((field.name, points.columns[field.name]) for field in vertsep.OUTPUT_FIELDS))
+        LogMessage(" Vertical separation calculation complete")
+        return
 
-    LogMessage(" Calculate X,Y")
+    LogMessage(" Add vertical separation fields")
 
-    LogMessage(" Calculating X,Y at SS-SW intersection")
+    arcgis.AddFields(gp, "SWSSIntersect", vertsep.DERIVED_FIELDS)
 
-    gp.AddXY_management("SWSSIntersect")
+    LogMessage(" Read SS-SW intersection attributes")
 
-    LogMessage(" Make feature layer")
+    existing = [field.name for field in arcgis.ListFields(gp, "SWSSIntersect")]
+    qaFields = tuple(name for name in vertsep.QA_FIELDS if name in existing)
+    chainage = all(name in existing for name in vertsep.CHAINAGE_FIELDS)
+    oids, columns = arcgis.ReadColumns(gp, "SWSSIntersect", vertsep.INPUT_FIELDS + vertsep.PIPE_ID_FIELDS + qaFields +
+                                       (vertsep.CHAINAGE_FIELDS if chainage else ()), withXY=True)
 
-    gp.MakeFeatureLayer_management("SWSSIntersect", "SWSSIntersect_Layer", "", "", "")
+    if chainage:
+        lengths = tuple(columns[name] for name in vertsep.CHAINAGE_FIELDS)
+    else:
+        LogMessage(" Measure crossings along the sewer and storm pipes")
+        lengths = vertsep.AlongPipeLengths(columns, arcgis.ReadGeometry(gp, "snPipes"),
+                                           arcgis.ReadGeometry(gp, "swPipes"))
 
-    LogMessage(" Calculating pipe slopes")
-    gp.AddField_management("SWSSIntersect_Layer", "Snslope", "DOUBLE", "38", "", "", "Sewer Slope Calculated(%)", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("SWSSIntersect_Layer", "Snslope", "(([SnUpinvert]-[SnDninvert])/[SnLength])*100", "", "")
-    gp.AddField_management("SWSSIntersect_Layer", "SWslope", "DOUBLE", "38", "", "", "Stormwater Slope Calculated(%)", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("SWSSIntersect_Layer", "SWslope", "(([SWUpinvert]-[SWDninvert])/[SWLength])*100", "", "")
+    LogMessage(" Calculate slopes, inverts, vertical separation and crossing type")
 
-    LogMessage(" Calculating pipe lengths for SS-SW intersection")
+    derived = vertsep.VerticalSeparation(columns, lengths)
 
-    gp.AddField_management("SWSSIntersect_Layer", "SS_Length", "DOUBLE", "", "", "", "Sewer Pipe Length", "NULLABLE", "NON_REQUIRED", "")
-    gp.AddField_management("SWSSIntersect_Layer", "SW_Length", "DOUBLE", "", "", "", "Storm Pipe Length", "NULLABLE", "NON_REQUIRED", "")
-    gp.CalculateField_management("SWSSIntersect_Layer", "SS_Length", "Sqr (( [SSUpX]- [POINT_X])^2+( [SSUpY]- [POINT_Y])^2  )", "", "")
-    gp.CalculateField_management("SWSSIntersect_Layer", "SW_Length", "Sqr (( [SWUpX]- [POINT_X])^2+( [SWUpY]- [POINT_Y])^2  )", "", "")
+    LogMessage(" Write SS-SW intersection attributes")
 
-    LogMessage(" Pipe lengths calculated for SS-SW intersections")
-
-    gp.AddField_management("SWSSIntersect_Layer", "SS_Invert", "DOUBLE", "", "", "", "Sewer Invert", "NULLABLE", "NON_REQUIRED", "")
-    gp.AddField_management("SWSSIntersect_Layer", "SW_Invert", "DOUBLE", "", "", "", "Storm Invert", "NULLABLE", "NON_REQUIRED", "")
-    gp.AddField_management("SWSSIntersect_Layer", "CrossTy", "TEXT", "", "", "30", "Crossing Type", "NULLABLE", "NON_REQUIRED", "")
-    gp.AddField_management("SWSSIntersect_Layer", "VertSep", "DOUBLE", "", "", "", "Vertical Separation", "NULLABLE", "NON_REQUIRED", "")
-    gp.AddField_management("SWSSIntersect_Layer", "PipeInter", "TEXT", "", "", "20", "Do Pipes Intersect", "NULLABLE", "NON_REQUIRED", "")
-    
-    LogMessage(" Calculate inverts")
-
-    gp.CalculateField_management("SWSSIntersect_Layer", "SS_Invert", "[SnUpinvert]-( [Snslope]/100* [SS_Length])", "", "")
-    gp.CalculateField_management("SWSSIntersect_Layer", "SW_Invert", "[SWUpinvert]-( [SWslope]/100* [SW_Length])", "", "")
-
-    
-# Calculate vertical separation
-
-    LogMessage(" Calculate vertical separation")
-
-    gp.SelectLayerByAttribute("SWSSIntersect_Layer", "NEW_SELECTION", "SW_Invert > SS_Invert")
-
-    gp.CalculateField_management("SWSSIntersect_Layer", "VertSep", "[SW_Invert]- ([SS_Invert]+([SnDiam]/12))", "", "")
-
-    gp.SelectLayerByAttribute("SWSSIntersect_Layer", "NEW_SELECTION", "SS_Invert > SW_Invert")
-
-    gp.CalculateField_management("SWSSIntersect_Layer", "VertSep", "[SS_Invert]- ([SW_Invert]+([SWDiam]/12))", "", "")
+    arcgis.UpdateColumns(gp, "SWSSIntersect", oids, derived, vertsep.OUTPUT_FIELDS)
 
     LogMessage(" Vertical separation calculation complete")
 
-# Calculate crossing type
-
-    LogMessage(" Calculate crossing type")
-
-    gp.SelectLayerByAttribute("SWSSIntersect_Layer", "NEW_SELECTION", "SW_Invert > SS_Invert")
-
-    gp.CalculateField_management("SWSSIntersect_Layer", "CrossTy", "\"Storm over Sewer\"", "", "")
-
-    gp.SelectLayerByAttribute("SWSSIntersect_Layer", "NEW_SELECTION", "SW_Invert < SS_Invert")
-
-    gp.CalculateField_management("SWSSIntersect_Layer", "CrossTy", "\"Sewer over Storm\"", "", "")
-
-    gp.SelectLayerByAttribute("SWSSIntersect_Layer", "NEW_SELECTION", "VertSep > 20")
-
-    gp.CalculateField_management("SWSSIntersect_Layer", "CrossTy", "\"Bad Data?\"", "", "")
-
-    LogMessage (" Crossing type calculation complete")
-    
-  # Calculate whether pipes intersect
-
-    gp.SelectLayerByAttribute ("SWSSIntersect_Layer", "NEW_SELECTION", "VertSep < 0")
-
-    gp.CalculateField_management("SWSSIntersect_Layer", "PipeInter", "\"Yes\"", "", "")
-
-    gp.SelectLayerByAttribute ("SWSSIntersect_Layer", "NEW_SELECTION", "VertSep > 0")
-
-    gp.CalculateField_management("SWSSIntersect_Layer", "PipeInter", "\"No\"", "", "")
-
-  # Clean up the data files for those crossings where data is missing
-  
-    gp.MakeFeatureLayer_management("SWSSIntersect", "SWSSIntersect_Layer2", "\"CrossTy\" IS NULL", "", "")
-
-    gp.SelectLayerByAttribute ("SWSSIntersect_Layer2", "NEW_SELECTION", "SS_Invert IS NULL AND SW_Invert IS NULL")
-
-    gp.CalculateField_management("SWSSIntersect_Layer2", "CrossTy", "\"Sewer and Storm Missing\"", "", "")
-
-    gp.SelectLayerByAttribute ("SWSSIntersect_Layer2", "NEW_SELECTION", "SS_Invert IS NULL AND SW_Invert IS NOT NULL")
-
-    gp.CalculateField_management("SWSSIntersect_Layer2", "CrossTy", "\"Sewer Data Missing\"", "", "")
-
-    gp.SelectLayerByAttribute ("SWSSIntersect_Layer2", "NEW_SELECTION", "SW_Invert IS NULL AND SS_Invert IS NOT NULL")
-
-    gp.CalculateField_management("SWSSIntersect_Layer2", "CrossTy", "\"Storm Data Missing\"", "", "")
-
     return
 
-    
-# Process: Merge the 3 feature classes into one point file.
-def Merge3Intersects():
-    
-    LogMessage(" Merge feature classes...")
-    tempEnvironment6 = gp.outputZFlag
-    gp.outputZFlag = "Disabled"
-    tempEnvironment11 = gp.outputMFlag
-    gp.outputMFlag = "Disabled"
-    gp.Merge_management("SWWIntersect; SSWIntersect; SWSSIntersect", "AllIntersections", "")
-    gp.outputZFlag = tempEnvironment6
-    gp.outputMFlag = tempEnvironment11
-    LogMessage(" Feature classes merged.")
 
-    return
+# Process: Probability that the pipes intersect, and bounds on VertSep, at every storm/sewer crossing.
+def SSSWUncertainty():
 
-def FinalCleanup():
-
-    LogMessage(" Delete duplicate fields.")
-    gp.DeleteField_management("AllIntersections", "SUBTYPE;UtilType;FID_swPipes;UtilType_1;FID_wnPipes;SUBTYPE_1;FID_snPipes_1;\
-        SUBTYPE_12;UtilType_12;SnFID_1;SnDiam_1;SnLength_1;SnUpinvert_1;SnDninvert_1;SSUpX_1;SSUpY_1;FID_swPipes_1;SWFID_1;\
-        UtilType_12_13;SWDiam_1;SWLength_1;SWUpinvert_1;SWDninvert_1;SWUpX_1;SWUpY_1;InterType_1;POINT_X_1;POINT_Y_1;Snslope_1;\
-        SWslope_1;SS_Length_1;SW_Length_1;SS_Invert_1;SW_Invert_1;CrossTy_1;VertSep_1;FID_wnPipes_1;SUBTYPE_12_13;WnDiam_1;\
-        WnUpinvert_1;WnDninvert_1;Wnslope_1;WnFID_1;FID_snPipes_12;SUBTYPE_12_13_14;UtilType_12_13_14;SnFID_12;SnDiam_12;\
-        SnLength_12;SnUpinvert_12;SnDninvert_12;SSUpX_12;SSUpY_12;FID_swPipes_12;SWFID_12;UtilType_12_13_14_15;SWDiam_12;\
-        SWLength_12;SWUpinvert_12;SWDninvert_12;SWUpX_12;SWUpY_12;InterType_12;POINT_X_12;POINT_Y_12;Snslope_12;SWslope_12;\
-        SS_Length_12;SW_Length_12;SS_Invert_12;SW_Invert_12;CrossTy_12;VertSep_12;FID_wnPipes_12;SUBTYPE_12_13_14_15;WnDiam_12;\
-        WnUpinvert_12;WnDninvert_12;Wnslope_12;WnFID_12;FID_snPipes_12_13;SUBTYPE_12_13_14_15_16;UtilType_12_13_14_15_16;\
-        SnFID_12_13;SnDiam_12_13;SnLength_12_13;SnUpinvert_12_13;SnDninvert_12_13;SSUpX_12_13;SSUpY_12_13;FID_swPipes_12_13;\
-        SWFID_12_13;UtilType_12_13_14_15_16_17;SWDiam_12_13;SWLength_12_13;SWUpinvert_12_13;SWDninvert_12_13;SWUpX_12_13;SWUpY_12_13;\
-        InterType_12_13;POINT_X_12_13;POINT_Y_12_13;Snslope_12_13;SWslope_12_13;SS_Length_12_13;SW_Length_12_13;SS_Invert_12_13;\
-        SW_Invert_12_13;CrossTy_12_13;VertSep_12_13;FID_wnPipes_12_13;SUBTYPE_12_13_14_15_16_17;WnDiam_12_13;WnUpinvert_12_13;\
-        WnDninvert_12_13;Wnslope_12_13;WnFID_12_13;WnMaterial_1;SWMaterial_1;SnMaterial_1;WnMaterial_12;SWMaterial_12;SnMaterial_12;\
-        WnMaterial_12_13;SWMaterial_12_13;SnMaterial_12_13;PipeInter_1;PipeInter_12;PipeInter_12_13")
-    LogMessage(" Duplicate fields deleted.")
+    LogMessage(" Estimate vertical separation uncertainty, %d samples..." % UncertaintySamples)
+    errors = uncertainty.Uncertainty(InvertErrorFeet, DiameterErrorInches, LocationErrorFeet)
+    if Columnar:
+        points = store.Read("SWSSIntersect", uncertainty.INPUT_FIELDS)
+        columns = dict((name, points.columns[name]) for name in uncertainty.INPUT_FIELDS)
+    else:
+        arcgis.AddFields(gp, "SWSSIntersect", uncertainty.UNCERTAINTY_FIELDS)
+        oids, columns = arcgis.ReadColumns(gp, "SWSSIntersect", uncertainty.INPUT_FIELDS)
+    derived = uncertainty.VertSepUncertainty(columns, UncertaintySamples, errors)
+    if Columnar:
+        store.WriteColumns("SWSSIntersect", uncertainty.UNCERTAINTY_FIELDS, derived)
+    else:
+        arcgis.UpdateColumns(gp, "SWSSIntersect", oids, derived, uncertainty.UNCERTAINTY_FIELDS)
+    conflicts = derived["PConflict"] >= 0.5
+    LogMessage(" %d of %d crossings more likely than not to intersect" % (conflicts.sum(), len(conflicts)))
+    LogMessage(" Uncertainty estimate complete")
 
     return
 
-
-# Call the functions.  Remember after you build the directory once you do not need to build it again.
-
-MakeBuildDirectory()
-
-MakeGDB()
-
-CopySWFC()
-
-AddCalcSWFields()
-
-CopySGFC()
-
-AddCalcSGFields()
-
-CopySLFC()
-
-AddCalcSLFields()
-
-CopySFFC()
-
-AddCalcSFFields()
-
-MergesnFC()
-
-CleanupsnFC()
-
-CopyWGFC()
-
-AddCalcWGFields()
-
-CopyWLFC()
-
-AddCalcWLFields()
-
-CopyWMFC()
     
-AddCalcWMFields()
-
-MergewnFC()
-
-CleanupwnFC()
-
-CalcSWXY()
-
-CalcSSXY()
-
-IntersectSWSS()
-
-SWSSIntersectType()
-
-IntersectSWW()
-
-SWWIntersectType()
-
-IntersectSSW()
-
-SSWIntersectType()
-
-SSSWVertSep()
-
-Merge3Intersects()
-
-FinalCleanup()
-
-del gp
-
-
-
-
-
+# Process: Create the empty AllIntersections feature class with the fixed set of fields in crossings/output.py.
+# Each crossing type is then appended to it as soon as it is done, and fields a type does not have stay empty,
+# so there is no merge and no duplicate fields to delete.
+def CreateAllIntersections():
+
+    LogMessage(" Create AllIntersections...")
+    arcgis.CreatePointFeatureClass(gp, "AllIntersections", output.ALL_INTERSECTIONS_FIELDS,
+                                   gp.Describe("snPipes").SpatialReference)
+    LogMessage(" AllIntersections created.")
+
+    return
+
+# Process: Append one crossing feature class to AllIntersections.
+def AppendIntersections(featureClass):
+
+    LogMessage(" Append %s to AllIntersections..." % featureClass)
+    if Columnar:
+        writer = output.CrossingWriter(arcgis.PointSink(gp, "AllIntersections", output.ALL_INTERSECTIONS_FIELDS,
+                                                        create=False))
+        count = writer.Write(store.Read(featureClass))
+        writer.Close()
+    else:
+        count = arcgis.AppendFeatures(gp, featureClass, "AllIntersections", output.ALL_INTERSECTIONS_FIELDS)
+    LogMessage(" %d crossings appended." % count)
+
+    return
+
+
+# Process: Write AllIntersections to QueryGeoPackage for the query service.  The file is written beside
+# the old one and renamed over it, so the service never reads a half-written file.
+def PublishIntersections():
+
+    LogMessage(" Publish AllIntersections to %s..." % QueryGeoPackage)
+    partial = QueryGeoPackage + ".partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+    writer = output.CrossingWriter(output.GeoPackageSink(partial))
+    if Columnar:
+        for featureClass in ["SWWIntersect", "SSWIntersect", "SWSSIntersect"]:
+            writer.Write(store.Read(featureClass))
+    else:
+        writer.Write(arcgis.ReadPointFeatureClass(gp, "AllIntersections", output.ALL_INTERSECTIONS_FIELDS))
+    count = writer.Close()
+    if os.path.exists(QueryGeoPackage):
+        os.remove(QueryGeoPackage)
+    os.rename(partial, QueryGeoPackage)
+    LogMessage(" %d crossings published." % count)
+
+    return
+
+
+# Process: The geodatabase of the latest earlier run that has AllIntersections, or None.
+def PreviousRun():
+    runs = []
+    for name in os.listdir(CrossingsDIR):
+        date = name[len("Crossings"):-len(".gdb")]
+        if name.startswith("Crossings") and name.endswith(".gdb") and len(date) == 8 and date.isdigit():
+            if date < today and gp.Exists(CrossingsDIR + "/" + name + "/AllIntersections"):
+                runs.append(name)
+    if not runs:
+        return None
+    return CrossingsDIR + "/" + max(runs)
+
+# Process: Write the changes to AllIntersections since the previous run to ChangesetFile.
+def DiffIntersections():
+
+    previous = PreviousRun()
+    if previous is None:
+        LogMessage(" No earlier run to compare AllIntersections with.")
+        return
+    LogMessage(" Compare AllIntersections with %s..." % previous)
+    old = arcgis.ReadPointFeatureClass(gp, previous + "/AllIntersections", output.ALL_INTERSECTIONS_FIELDS)
+    new = arcgis.ReadPointFeatureClass(gp, "AllIntersections", output.ALL_INTERSECTIONS_FIELDS)
+    changes, summary = diff.DiffCrossings(old, new)
+    if os.path.exists(ChangesetFile):
+        os.remove(ChangesetFile)
+    gpkg.WriteGeoPackage(ChangesetFile, changes, "Changes")
+    LogMessage(" %d crossings added, %d removed, %d changed, written to %s." %
+               (summary["added"], summary["removed"], summary["changed"], ChangesetFile))
+
+    return
+
+
+# Call the functions.  The directory and geodatabase are only created when they do not exist yet.
+# Each step is declared as a stage with the feature classes it reads and writes.  The scheduler
+# starts a stage as soon as the stages it depends on are done, so the storm, sewer and water
+# branches and the three intersects run at the same time on separate workers.
+
+def PipelineStages():
+
+    stages = [
+        Stage(MakeBuildDirectory, [], ["CrossingsDIR"], cacheable=False),
+        Stage(MakeGDB, ["CrossingsDIR"], ["GDB"], cacheable=False),
+        Stage(CopyPipeClass, ["GDB"], ["swPipes"], ["swPipes"], "CopySWFC"),
+        Stage(CopyPipeClass, ["GDB"], ["snGravity"], ["snGravity"], "CopySGFC"),
+        Stage(CopyPipeClass, ["GDB"], ["snLateral"], ["snLateral"], "CopySLFC"),
+        Stage(CopyPipeClass, ["GDB"], ["snForce"], ["snForce"], "CopySFFC"),
+        Stage(MergesnFC, ["snGravity", "snLateral", "snForce"], ["snPipes"]),
+        Stage(CopyPipeClass, ["GDB"], ["wnGravity"], ["wnGravity"], "CopyWGFC"),
+        Stage(CopyPipeClass, ["GDB"], ["wnLateral"], ["wnLateral"], "CopyWLFC"),
+        Stage(CopyPipeClass, ["GDB"], ["wnWaterMain"], ["wnWaterMain"], "CopyWMFC"),
+        Stage(MergewnFC, ["wnGravity", "wnLateral", "wnWaterMain"], ["wnPipes"]),
+        Stage(CalcSWXY, ["swPipes"], ["swPipes"]),
+        Stage(CalcSSXY, ["snPipes"], ["snPipes"])]
+
+    if Columnar:
+        stages += [Stage(StoreWNPipes, ["wnPipes"], ["wnPipes"])]
+
+    stages += [Stage(ValidatePipes, ["swPipes", "snPipes", "wnPipes"], ["swPipes", "snPipes", "wnPipes"])]
+
+    pipeClasses = allpairs.PairLayers(UtilityPairs)
+    outputs = [outFC for first, second, outFC, interType in UtilityPairs]
+    typed = False
+    if CrossingsMode == "incremental":
+        stages += [
+            Stage(IncrementalIntersects, pipeClasses, outputs)]
+    elif OutOfCoreBudgetMB and Columnar:
+        stages += [Stage(OutOfCoreIntersects, pipeClasses, outputs, local=True)]
+    elif TileMaxPipes and IntersectEngine == "native":
+        stages += [Stage(TiledIntersects, pipeClasses, outputs, local=True)]
+    elif IntersectEngine == "native":
+        stages += [Stage(IntersectUtilities, pipeClasses, outputs)]
+        typed = True
+    else:
+        stages += [Stage(IntersectPair, [first, second], [outFC], [first, second, outFC],
+                         "Intersect" + outFC.replace("Intersect", ""))
+                   for first, second, outFC, interType in UtilityPairs]
+
+    if NearMissFeet and IntersectEngine == "native":
+        stages += [
+            Stage(NearMisses, ["snPipes", "swPipes"], ["SWSSNearMiss"],
+                  ["snPipes", "swPipes", "SWSSNearMiss", "first"], "NearMissSWSS"),
+            Stage(NearMisses, ["wnPipes", "swPipes"], ["SWWNearMiss"], ["wnPipes", "swPipes", "SWWNearMiss"],
+                  "NearMissSWW"),
+            Stage(NearMisses, ["snPipes", "wnPipes"], ["SSWNearMiss"], ["snPipes", "wnPipes", "SSWNearMiss"],
+                  "NearMissSSW")]
+
+    if not typed:
+        stages += [Stage(AddInterType, [outFC], [outFC], [outFC, interType],
+                         outFC.replace("Intersect", "IntersectType"))
+                   for first, second, outFC, interType in UtilityPairs]
+
+    # SWSSIntersect is appended last, after its vertical separation.
+    stages += [
+        Stage(SSSWVertSep, ["SWSSIntersect", "snPipes", "swPipes"], ["SWSSIntersect"])]
+    if UncertaintySamples:
+        stages += [Stage(SSSWUncertainty, ["SWSSIntersect"], ["SWSSIntersect"])]
+    stages += [Stage(CreateAllIntersections, ["snPipes"], ["AllIntersections"])]
+    stages += [Stage(AppendIntersections, [outFC], ["AllIntersections"], [outFC],
+                     "Append" + outFC.replace("Intersect", ""))
+               for outFC in sorted(outputs, key=lambda name: name == "SWSSIntersect")]
+
+    if QueryGeoPackage:
+        stages += [Stage(PublishIntersections, ["AllIntersections"], ["QueryGeoPackage"], cacheable=False)]
+
+    if ChangesetFile:
+        stages += [Stage(DiffIntersections, ["AllIntersections"], ["ChangesetFile"], cacheable=False)]
+
+    return stages
+
+
+# Process: List the steps of the pipeline with the datasets they read and write.
+def ListStages():
+    for stage in PipelineStages():
+        print("%-28s %s -> %s" % (stage.name, ", ".join(stage.inputs), ", ".join(stage.outputs)))
+
+
+# The worker processes import this script again, so only the main process runs the pipeline.
+if __name__ == "__main__":
+
+    if arguments.command == "stages":
+        ListStages()
+        sys.exit(0)
+
+    cache = StageCache(CacheDIR, SaveDatasets, RestoreDatasets, CacheParameters, CacheMaxAgeDays, CacheMaxSizeMB)
+    for key in cache.Evict():
+        LogMessage(" Removed cache entry %s" % key)
+    if arguments.command == "evict":
+        sys.exit(0)
+    cache.params = CacheParameters + CacheFingerprint()
+
+    tracer = Tracer.FromEnvironment(TraceFile, RowCount)
+
+    scheduler = Scheduler(PipelineStages(), Workers, LogMessage, tracer, cache)
+
+    scheduler.Run()
+
+    for line in scheduler.Report() + tracer.SummaryLines():
+        LogMessage(line)
+
+    del gp
@@ -0,0 +1,42 @@
+#
+# -----------------------------------------------------------------------------
+#                                 crossings
+#
+# PURPOSE:
+#
+# Native (no ArcGIS) building blocks for CalculatingUtilityCrossings.py.  Pipe
+# layers are read from a shapefile, a GeoPackage or built in memory, and the
+# crossing points between two layers are found with a grid-indexed segment
+# intersection instead of gp.Intersect_analysis.
+#
+#   geometry.py      array-backed pipe and point layers, cached per-pipe arrays, WKB
+#   shapefile.py     polyline shapefile reader
+#   gpkg.py          GeoPackage reader and writer
+#   fieldmap.py      per-source field maps applied while pipes are copied
+#   sources.py       batched source readers (SDE or a local GeoPackage stand-in)
+#   quality.py       ingest-time pipe data checks as per-pipe flag bits, QA summary
+#   spatialindex.py  uniform grid for candidate pairs
+#   engine.py        segment intersection engine
+#   allpairs.py      crossings of any number of utility pairs from one shared index
+#   tiling.py        tiled crossings on a process pool, border de-duplication
+#   outofcore.py     crossings within a memory budget, Morton-ordered tiles spilled to disk
+#   incremental.py   crossing store and incremental recompute from MODIFYDATE
+#   nearmiss.py      pipes passing within a horizontal distance, closest approach
+#   expressions.py   CalculateField (VB) expressions compiled to one NumPy function
+#   vertsep.py       single-pass vertical separation at storm/sewer crossings
+#   uncertainty.py   Monte Carlo probability of conflict and VertSep bounds per crossing
+#   output.py        fixed AllIntersections schema and streaming crossing writer
+#   diff.py          day-over-day crossing changeset keyed by facility IDs and location
+#   query.py         indexed crossing lookups, hot-swapped, over a local HTTP endpoint
+#   scheduler.py     stage graph run over a process pool, critical path report
+#   tracing.py       per-stage timing/memory spans as JSON lines, optional profiling
+#   cache.py         content-hash stage cache, resume after a failed run, eviction
+#   columnar.py      memory-mapped column files for the intermediate layers
+#   synthetic.py     synthetic utility network generator
+#   benchmark.py     per-stage timings on synthetic networks, as JSON
+#   arcgis.py        geoprocessor <-> native layer conversion
+#   lazy.py          stand-ins that import modules / create objects on first use
+#   __main__.py      python -m crossings <tool> command line
+#
+# ==============================================================================
+#
@@ -0,0 +1,56 @@
+#
+# -----------------------------------------------------------------------------
+#                                 __main__.py
+#
+# PURPOSE:
+#
+# One command line for the crossing tools:
+#
+#   python -m crossings <tool> [arguments]
+#
+# Only the tool that is asked for is imported, so listing the tools or
+# starting one does not load the others (or NumPy, for the tools that do not
+# need it).  Each tool can also be run as python -m crossings.<tool>.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# None beyond the Python standard library.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import importlib
+import sys
+
+TOOLS = [("synthetic", "write a synthetic utility network to a GeoPackage"),
+         ("benchmark", "time the pipeline stages on synthetic networks"),
+         ("sources", "time batched extraction from a source stand-in"),
+         ("outofcore", "intersect two columnar pipe layers within a memory budget"),
+         ("diff", "changeset between the crossings of two runs"),
+         ("uncertainty", "time the VertSep uncertainty estimate"),
+         ("query", "serve crossing lookups over HTTP")]
+
+
+def Usage():
+    lines = ["usage: python -m crossings <tool> [arguments]", "", "tools:"]
+    lines += ["  %-12s %s" % tool for tool in TOOLS]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    names = [name for name, description in TOOLS]
+    if not argv or argv[0] in ("-h", "--help"):
+        print(Usage())
+        return 0
+    if argv[0] not in names:
+        print(Usage(), file=sys.stderr)
+        return 2
+    return importlib.import_module("crossings." + argv[0]).main(argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#
+# -----------------------------------------------------------------------------
+#                                 allpairs.py
+#
+# PURPOSE:
+#
+# Crossings of any number of utility layers, for any list of layer pairs, from
+# one shared index.  The segments of every layer are put in one box set with
+# the layer's number as a tag and bucketed into one grid.  Each requested pair
+# then joins only the grid entries of its two tags, so adding a utility (gas,
+# electric, telecom) adds its segments to the index once instead of another
+# overlay per pair, and the candidates tested are only the nearby segment
+# pairs of utilities that were asked for.
+#
+# A pair is (first layer, second layer, output name, InterType).  Each output
+# is the same point layer engine.IntersectLayers gives for its two layers,
+# with InterType added:
+#
+#   pairs = [UtilityPair("snPipes", "swPipes", "SWSSIntersect", "Sewer-Storm"),
+#            UtilityPair("wnPipes", "swPipes", "SWWIntersect", "Water-Storm")]
+#   for points in IntersectAllPairs(layers, pairs):
+#       ...
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+
+import numpy as np
+
+from crossings.engine import XY_TOLERANCE, CrossingLayer, Crossings, IntersectSegments, UniqueCrossings
+from crossings.output import INTER_TYPE
+from crossings.spatialindex import TaggedOverlappingPairs
+
+UtilityPair = collections.namedtuple("UtilityPair", "first second output interType")
+
+# The storm, sewer and water pairs of CalculatingUtilityCrossings.py.
+DEFAULT_PAIRS = (
+    UtilityPair("snPipes", "swPipes", "SWSSIntersect", "Sewer-Storm"),
+    UtilityPair("wnPipes", "swPipes", "SWWIntersect", "Water-Storm"),
+    UtilityPair("snPipes", "wnPipes", "SSWIntersect", "Sewer-Water"))
+
+
+# Process: Layer names used by "pairs", in the order first seen.
+def PairLayers(pairs):
+    names = []
+    for pair in [UtilityPair(*pair) for pair in pairs]:
+        for name in (pair.first, pair.second):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+# Process: Crossings of every pair in "pairs" of the layers in "layers" (a
+# dict of PipeLayers by name).  Returns one Crossings per pair, each the same
+# as engine.FindCrossings on that pair's two layers.
+def FindAllCrossings(layers, pairs, tolerance=XY_TOLERANCE, cellSize=None):
+    pairs = [UtilityPair(*pair) for pair in pairs]
+    for pair in pairs:
+        if pair.first == pair.second:
+            raise ValueError("%s is paired with itself" % pair.first)
+    names = PairLayers(pairs)
+    segments = [layers[name].Segments() for name in names]
+    boxes = np.concatenate([layers[name].SegmentBoxes() for name in names] or [np.zeros((0, 4))])
+    counts = [len(start) for start, pipes in segments]
+    tags = np.repeat(np.arange(len(names), dtype=np.int64), counts)
+    base = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    tagPairs = [(names.index(pair.first), names.index(pair.second)) for pair in pairs]
+    candA, candB, which = TaggedOverlappingPairs(boxes, tags, tagPairs, cellSize)
+
+    results = []
+    for index, (tagA, tagB) in enumerate(tagPairs):
+        mine = which == index
+        startA, pipesA = segments[tagA]
+        startB, pipesB = segments[tagB]
+        localA = candA[mine] - base[tagA]
+        localB = candB[mine] - base[tagB]
+        a = startA[localA]
+        b = startB[localB]
+        first, second = layers[names[tagA]], layers[names[tagB]]
+        hit, x, y, t, u = IntersectSegments(first.coords, a, second.coords, b, tolerance)
+        crossings = Crossings(x, y, pipesA[localA][hit], pipesB[localB][hit], a[hit], b[hit], t, u)
+        results.append(UniqueCrossings(crossings, tolerance))
+    return results
+
+
+# Process: Crossing point layers of every pair, in the order of "pairs", each
+# with the pair's InterType.
+def IntersectAllPairs(layers, pairs, tolerance=XY_TOLERANCE, cellSize=None, exclude=()):
+    pairs = [UtilityPair(*pair) for pair in pairs]
+    outputs = []
+    for pair, crossings in zip(pairs, FindAllCrossings(layers, pairs, tolerance, cellSize)):
+        points = CrossingLayer(crossings, layers[pair.first], layers[pair.second], pair.output, exclude)
+        points.AddColumn(INTER_TYPE, [pair.interType] * len(points))
+        outputs.append(points)
+    return outputs
@@ -0,0 +1,306 @@
+#
+# -----------------------------------------------------------------------------
+#                                 arcgis.py
+#
+# PURPOSE:
+#
+# Move feature classes between the geoprocessor and the native layers in
+# geometry.py.  Only used when the crossing engine runs inside the ArcGIS
+# scheduled task; nothing in here is needed on Linux.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  ArcMap 10.1 or higher (a geoprocessor object created by arcgisscripting).
+#      ReadFeatureClass, ReadGeometry, ReadPointFeatureClass, ReadColumns,
+#      ExtendColumns and AppendPipes also use the arcpy.da module.
+#
+# 2).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import numpy as np
+
+from crossings.geometry import ColumnArray, LineWKB, MakeField, PipeLayerFromWKB, PipeParts, PointLayer
+
+# gp.ListFields type names mapped to the AddField_management types.
+FIELD_TYPES = {"String": "TEXT", "SmallInteger": "SHORT", "Integer": "LONG", "Single": "FLOAT",
+               "Double": "DOUBLE", "Date": "DATE"}
+
+
+# Process: Attribute fields of a feature class, skipping the object ID, shape
+# and the Shape_Length/Shape_Area fields the geodatabase maintains itself.
+def ListFields(gp, featureClass):
+    fields = []
+    for field in gp.ListFields(featureClass):
+        if field.type not in FIELD_TYPES or field.name.lower() in ("shape_length", "shape_area"):
+            continue
+        fields.append(MakeField(field.name, FIELD_TYPES[field.type], field.length, field.aliasName))
+    return fields
+
+
+# Process: Read a line feature class into a PipeLayer in one arcpy.da cursor
+# pass.  Shapes are fetched as WKB and decoded into the flat coordinate arrays
+# together, so no geometry object is built per row.
+def ReadFeatureClass(gp, featureClass, name=None):
+    import arcpy
+    fields = ListFields(gp, featureClass)
+    oids = []
+    blobs = []
+    values = [[] for field in fields]
+    with arcpy.da.SearchCursor(_Path(gp, featureClass), ["OID@", "SHAPE@WKB"] + [f.name for f in fields]) as rows:
+        for row in rows:
+            oids.append(row[0])
+            blobs.append(row[1])
+            for column, value in zip(values, row[2:]):
+                column.append(value)
+    columns = dict((field.name, column) for field, column in zip(fields, values))
+    return PipeLayerFromWKB(name or featureClass, blobs, fields, columns, oids)
+
+
+# arcpy.da does not see gp.Workspace, so feature classes are passed to it by
+# full path.
+def _Path(gp, table):
+    if os.path.isabs(table) or table.lower().startswith("database connections"):
+        return table
+    return os.path.join(gp.Workspace, table)
+
+
+# Process: Read the geometry of a line feature class in bulk.  One arcpy.da
+# cursor pass fetches only the object ID and the shape as WKB, and the blobs
+# are decoded straight into the flat coordinate and offset arrays of a
+# PipeLayer (no attributes).
+def ReadGeometry(gp, featureClass, name=None):
+    import arcpy
+    oids = []
+    blobs = []
+    with arcpy.da.SearchCursor(_Path(gp, featureClass), ["OID@", "SHAPE@WKB"]) as rows:
+        for oid, blob in rows:
+            oids.append(oid)
+            blobs.append(blob)
+    return PipeLayerFromWKB(name or featureClass, blobs, oids=oids)
+
+
+# Process: Add new DOUBLE columns to a table in one call.  "columns" maps each
+# new field name to an array of values in the order of "oids".  A "dtype" of
+# "i2" (int16) adds SHORT fields instead.  Fields the table already has (a
+# rerun) are overwritten with UpdateColumns, as ExtendTable cannot add them.
+def ExtendColumns(gp, table, oids, columns, names, dtype=np.float64):
+    import arcpy
+    existing = set(field.name.lower() for field in gp.ListFields(table))
+    fieldType = "SHORT" if np.dtype(dtype).kind in "iu" else "DOUBLE"
+    present = [MakeField(name, fieldType) for name in names if name.lower() in existing]
+    if present:
+        UpdateColumns(gp, table, oids, columns, present)
+    names = [name for name in names if name.lower() not in existing]
+    if not names:
+        return
+    array = np.empty(len(oids), dtype=[("JOINOID", np.int32)] + [(name, dtype) for name in names])
+    array["JOINOID"] = oids
+    for name in names:
+        array[name] = columns[name]
+    arcpy.da.ExtendTable(_Path(gp, table), gp.Describe(table).OIDFieldName, array, "JOINOID", False)
+
+
+def _Value(value, fieldType):
+    if isinstance(value, (float, np.floating)):
+        if value != value:
+            return None
+        if fieldType in ("SHORT", "LONG"):
+            return int(value)
+        return float(value)
+    return value
+
+
+# Process: Read a point feature class into a PointLayer in one arcpy.da
+# cursor pass.  Of "fields", those the feature class has are read.
+def ReadPointFeatureClass(gp, featureClass, fields, name=None):
+    import arcpy
+    available = set(field.name.lower() for field in gp.ListFields(featureClass))
+    fields = [field for field in fields if field.name.lower() in available]
+    oids, xs, ys = [], [], []
+    values = [[] for field in fields]
+    with arcpy.da.SearchCursor(_Path(gp, featureClass), ["OID@", "SHAPE@XY"] + [f.name for f in fields]) as rows:
+        for row in rows:
+            oids.append(row[0])
+            x, y = row[1] if row[1] else (None, None)
+            xs.append(np.nan if x is None else x)
+            ys.append(np.nan if y is None else y)
+            for column, value in zip(values, row[2:]):
+                column.append(value)
+    columns = dict((field.name, column) for field, column in zip(fields, values))
+    return PointLayer(name or featureClass, xs, ys, fields, columns, oids)
+
+
+# Process: Create an empty point feature class with "fields" in the current
+# workspace, replacing any feature class of that name.
+def CreatePointFeatureClass(gp, featureClass, fields, spatialReference=""):
+    if gp.Exists(featureClass):
+        gp.Delete_management(featureClass)
+    gp.CreateFeatureclass_management(gp.Workspace, featureClass, "POINT", "", "DISABLED", "DISABLED",
+                                     spatialReference)
+    for field in fields:
+        length = field.length if field.type == "TEXT" else ""
+        gp.AddField_management(featureClass, field.name, field.type, "", "", length or "",
+                               field.alias, "NULLABLE", "NON_REQUIRED", "")
+    return featureClass
+
+
+# Process: Create an empty line feature class with "fields" in the current
+# workspace, replacing any feature class of that name.
+def CreateLineFeatureClass(gp, featureClass, fields, spatialReference=""):
+    if gp.Exists(featureClass):
+        gp.Delete_management(featureClass)
+    gp.CreateFeatureclass_management(gp.Workspace, featureClass, "POLYLINE", "", "DISABLED", "DISABLED",
+                                     spatialReference)
+    AddFields(gp, featureClass, fields)
+    return featureClass
+
+
+# Process: Insert the pipes of a PipeLayer into an existing line feature
+# class with one arcpy.da cursor, the shapes passed as WKB.  Only the layer's
+# fields are set.  Returns the number of pipes inserted.
+def AppendPipes(gp, layer, featureClass):
+    import arcpy
+    names = [field.name for field in layer.fields]
+    columns = [(field.type, layer.columns[field.name]) for field in layer.fields]
+    with arcpy.da.InsertCursor(_Path(gp, featureClass), ["SHAPE@WKB"] + names) as rows:
+        for i in range(len(layer)):
+            shape = bytearray(LineWKB(PipeParts(layer, i)))
+            rows.insertRow([shape] + [_Value(column[i], fieldType) for fieldType, column in columns])
+    return len(layer)
+
+
+# Process: Insert the points of a PointLayer into an existing feature class.
+# Only the layer's fields are set.  Returns the number of points inserted.
+def AppendPoints(gp, layer, featureClass):
+    rows = gp.InsertCursor(featureClass)
+    point = gp.CreateObject("Point")
+    columns = [(field.name, field.type, layer.columns[field.name]) for field in layer.fields]
+    for i in range(len(layer)):
+        row = rows.NewRow()
+        point.X = float(layer.x[i])
+        point.Y = float(layer.y[i])
+        row.shape = point
+        for name, fieldType, column in columns:
+            value = _Value(column[i], fieldType)
+            if value is not None:
+                row.SetValue(name, value)
+        rows.InsertRow(row)
+    del rows
+    return len(layer)
+
+
+# Process: Write a PointLayer to a new point feature class in the current
+# workspace.
+def WritePointFeatureClass(gp, layer, featureClass, spatialReference=""):
+    CreatePointFeatureClass(gp, featureClass, layer.fields, spatialReference)
+    AppendPoints(gp, layer, featureClass)
+    return featureClass
+
+
+# Sink for output.CrossingWriter appending to a point feature class, created
+# (or replaced) first unless "create" is False.
+class PointSink(object):
+
+    def __init__(self, gp, featureClass, fields, spatialReference="", create=True):
+        self.gp = gp
+        self.featureClass = featureClass
+        if create:
+            CreatePointFeatureClass(gp, featureClass, fields, spatialReference)
+
+    def Append(self, layer):
+        AppendPoints(self.gp, layer, self.featureClass)
+
+    def Close(self):
+        pass
+
+
+# Process: Stream the features of "source" into the existing feature class
+# "target", one row at a time.  Of "fields", those the source has are copied
+# and the rest are left NULL.  Returns the number of features copied.
+def AppendFeatures(gp, source, target, fields):
+    available = set(field.name.lower() for field in gp.ListFields(source))
+    names = [field.name for field in fields if field.name.lower() in available]
+    rows = gp.SearchCursor(source, "", "", ";".join([gp.Describe(source).ShapeFieldName] + names))
+    inserts = gp.InsertCursor(target)
+    count = 0
+    row = rows.Next()
+    while row:
+        newRow = inserts.NewRow()
+        newRow.shape = row.shape
+        for name in names:
+            value = row.GetValue(name)
+            if value is not None:
+                newRow.SetValue(name, value)
+        inserts.InsertRow(newRow)
+        count += 1
+        row = rows.Next()
+    del row
+    del rows
+    del inserts
+    return count
+
+
+# Process: Add field definitions to a table, skipping fields it already has.
+def AddFields(gp, table, fields):
+    existing = set(field.name.lower() for field in gp.ListFields(table))
+    for field in fields:
+        if field.name.lower() in existing:
+            continue
+        length = field.length if field.type == "TEXT" else ""
+        gp.AddField_management(table, field.name, field.type, "", "", length or "",
+                               field.alias, "NULLABLE", "NON_REQUIRED", "")
+
+
+# Process: Read numeric columns from a table in one arcpy.da cursor pass.
+# Returns the object IDs and a dict of float64 arrays (NULL becomes NaN).  With
+# "withXY" the X,Y of each point feature are returned as POINT_X and POINT_Y.
+def ReadColumns(gp, table, fieldNames, withXY=False):
+    import arcpy
+    oids = []
+    values = dict((name, []) for name in fieldNames)
+    names = ["OID@"] + (["SHAPE@XY"] if withXY else []) + list(fieldNames)
+    if withXY:
+        values["POINT_X"] = []
+        values["POINT_Y"] = []
+    with arcpy.da.SearchCursor(_Path(gp, table), names) as rows:
+        for row in rows:
+            oids.append(row[0])
+            if withXY:
+                x, y = row[1] if row[1] else (None, None)
+                values["POINT_X"].append(x)
+                values["POINT_Y"].append(y)
+            for name, value in zip(fieldNames, row[2 if withXY else 1:]):
+                values[name].append(value)
+    columns = dict((name, ColumnArray(column, "DOUBLE")) for name, column in values.items())
+    return np.array(oids, dtype=np.int64), columns
+
+
+# Process: Write columns back to a table, touching every row exactly once.
+# "fields" gives the field definitions for the names in "columns"; rows are
+# matched to the column entries by object ID.
+def UpdateColumns(gp, table, oids, columns, fields):
+    oidField = gp.Describe(table).OIDFieldName
+    index = dict((int(oid), i) for i, oid in enumerate(oids))
+    types = [(field.name, field.type, columns[field.name]) for field in fields if field.name in columns]
+    rows = gp.UpdateCursor(table)
+    row = rows.Next()
+    while row:
+        i = index.get(row.GetValue(oidField))
+        if i is not None:
+            for name, fieldType, column in types:
+                value = _Value(column[i], fieldType)
+                if value is None:
+                    row.SetNull(name)
+                else:
+                    row.SetValue(name, value)
+            rows.UpdateRow(row)
+        row = rows.Next()
+    del row
+    del rows
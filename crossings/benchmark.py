@@ -0,0 +1,192 @@
+#
+# -----------------------------------------------------------------------------
+#                                 benchmark.py
+#
+# PURPOSE:
+#
+# Time every stage of the crossing pipeline on synthetic networks (see
+# synthetic.py) so performance can be compared run to run without SDE.  The
+# stages are the native equivalents of the script's steps:
+#
+#   ingest        apply the field maps to the seven source classes
+#   merge         merge the sewer and water classes into snPipes/wnPipes
+#   xy            upstream X,Y of swPipes and snPipes
+#   validate      QA flags of the storm, sewer and water pipes
+#   intersect     one stage per utility pair (intersect SWSS, intersect SWW,
+#                 intersect SSW), with InterType; its records are the pair's
+#                 crossings
+#   vertsep       vertical separation at the storm/sewer crossings
+#   final write   the three crossing layers streamed into AllIntersections
+#
+# For each stage the wall time, the records processed per second and the
+# peak memory allocated during the stage are reported as JSON (peak memory
+# needs tracemalloc, Python 3.4 or higher; otherwise it is null).  With a
+# workspace folder the network is first written to a GeoPackage and the
+# ingest stage reads it back, including the file I/O in the timing.
+#
+# Usage:
+#
+#   python -m crossings.benchmark --sizes 10000 100000 1000000 --output results.json
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import json
+import os
+import platform
+import time
+
+import numpy as np
+
+from crossings import fieldmap, incremental, output, quality, synthetic, vertsep
+from crossings.allpairs import DEFAULT_PAIRS, IntersectAllPairs
+from crossings.geometry import MakeField, MergeLayers
+from crossings.gpkg import ReadGeoPackage
+from crossings.tracing import PeakRssMB
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SIZES = (10000, 100000, 1000000)
+
+MERGES = (("snPipes", ("snGravity", "snLateral", "snForce")),
+          ("wnPipes", ("wnGravity", "wnLateral", "wnWaterMain")))
+
+
+# Process: Each stage takes the dict of layers built so far, adds its outputs
+# and returns the number of records it processed.
+def Ingest(data):
+    for className in synthetic.CLASSES:
+        source = data["sources"][className]
+        if isinstance(source, str):
+            source = ReadGeoPackage(source, className, fieldmap.FIELD_MAPS[className].SourceFields())
+        data[className] = fieldmap.ApplyFieldMap(source, fieldmap.FIELD_MAPS[className])
+    return sum(len(data[className]) for className in synthetic.CLASSES)
+
+
+def Merge(data):
+    for name, classNames in MERGES:
+        data[name] = MergeLayers(name, [data[className] for className in classNames])
+    return len(data["snPipes"]) + len(data["wnPipes"])
+
+
+def UpstreamXY(data):
+    for name, xField, yField in (("swPipes", "SWUpX", "SWUpY"), ("snPipes", "SSUpX", "SSUpY")):
+        first = data[name].Endpoints()[0]
+        data[name].AddColumn(MakeField(xField, "DOUBLE"), first[:, 0])
+        data[name].AddColumn(MakeField(yField, "DOUBLE"), first[:, 1])
+    return len(data["swPipes"]) + len(data["snPipes"])
+
+
+def Validate(data):
+    for name in quality.UTILITIES:
+        data[name].AddColumn(quality.FlagField(name), quality.ValidateLayer(data[name], name))
+    return sum(len(data[name]) for name in quality.UTILITIES)
+
+
+# Process: The stage that intersects one utility pair and counts its
+# crossings.
+def IntersectPair(pair):
+    def Intersect(data):
+        points = IntersectAllPairs(data, [pair], exclude=incremental.DATE_FIELDS)[0]
+        data[points.name] = points
+        return len(points)
+    return Intersect
+
+
+def VerticalSeparation(data):
+    vertsep.AddVerticalSeparation(data["SWSSIntersect"], data["snPipes"], data["swPipes"])
+    return len(data["SWSSIntersect"])
+
+
+def FinalWrite(data):
+    sink = output.LayerSink()
+    writer = output.CrossingWriter(sink)
+    for name in ("SWWIntersect", "SSWIntersect", "SWSSIntersect"):
+        writer.Write(data[name])
+    writer.Close()
+    data["AllIntersections"] = sink.layer
+    return len(data["AllIntersections"])
+
+
+STAGES = ([("ingest", Ingest), ("merge", Merge), ("xy", UpstreamXY), ("validate", Validate)] +
+          [("intersect " + pair.output.replace("Intersect", ""), IntersectPair(pair)) for pair in DEFAULT_PAIRS] +
+          [("vertsep", VerticalSeparation), ("final write", FinalWrite)])
+
+
+# Process: Run every stage once and return its timings.
+def RunStages(data, stages=STAGES):
+    results = []
+    for name, func in stages:
+        if tracemalloc is not None:
+            tracemalloc.start()
+        start = time.time()
+        records = func(data)
+        seconds = time.time() - start
+        peak = None
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+            tracemalloc.stop()
+        results.append(collections.OrderedDict([
+            ("stage", name), ("seconds", round(seconds, 4)), ("records", records),
+            ("recordsPerSecond", round(records / seconds, 1) if seconds > 0 else None),
+            ("peakMB", round(peak, 1) if peak is not None else None)]))
+    return results
+
+
+# Process: Benchmark one network size.  "workspace" is an optional folder for
+# the GeoPackage the ingest stage reads from.
+def Benchmark(pipes, pipesPerSquareMile=400.0, sentinelRate=0.05, multipartRate=0.02, seed=1, workspace=None):
+    sources = synthetic.SyntheticNetwork(pipes, pipesPerSquareMile, sentinelRate, multipartRate, seed)
+    if workspace:
+        path = os.path.join(workspace, "synthetic%d.gpkg" % pipes)
+        if os.path.exists(path):
+            os.remove(path)
+        synthetic.WriteSyntheticNetwork(path, sources)
+        sources = dict((className, path) for className in sources)
+    data = {"sources": sources}
+    stages = RunStages(data)
+    crossings = dict((pair.output, len(data[pair.output])) for pair in DEFAULT_PAIRS)
+    return collections.OrderedDict([
+        ("pipes", pipes), ("pipesPerSquareMile", pipesPerSquareMile), ("sentinelRate", sentinelRate),
+        ("multipartRate", multipartRate), ("seed", seed), ("crossings", crossings),
+        ("totalSeconds", round(sum(stage["seconds"] for stage in stages), 4)), ("stages", stages)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the crossing pipeline stages on synthetic networks.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--pipes-per-square-mile", type=float, default=400.0)
+    parser.add_argument("--sentinel-rate", type=float, default=0.05)
+    parser.add_argument("--multipart-rate", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workspace", help="folder for GeoPackage input; ingest reads from it when given")
+    parser.add_argument("--output", help="write the JSON results here instead of to stdout")
+    args = parser.parse_args(argv)
+
+    runs = [Benchmark(size, args.pipes_per_square_mile, args.sentinel_rate, args.multipart_rate, args.seed,
+                      args.workspace) for size in args.sizes]
+    report = collections.OrderedDict([
+        ("python", platform.python_version()), ("numpy", np.__version__), ("platform", platform.platform()),
+        ("peakRssMB", PeakRssMB()), ("runs", runs)])
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+#
+# -----------------------------------------------------------------------------
+#                                 cache.py
+#
+# PURPOSE:
+#
+# Stage cache so a failed nightly run can be resumed instead of starting over
+# from the SDE copy.  Every stage gets a key: a hash of its name, its code, its
+# arguments, the run parameters (for the script: the date and the engine
+# settings) and the keys of the stages that wrote its inputs.  When a stage
+# finishes, its output datasets are saved in a cache entry under that key.
+#
+# On the next run a stage is skipped when an entry with its key exists and
+# every stage it depends on was skipped too (stages marked not cacheable, such
+# as creating the folder and geodatabase, always run and do not stop the
+# stages after them from being skipped).  The first stage without a valid
+# entry, and everything after it, runs again.  Skipped stages whose outputs are
+# still needed restore them from the cache in place of running.
+#
+# Entries are folders named after the key, holding the saved datasets and a
+# manifest.json written last, so a half-written entry is never used.  Evict
+# removes entries older than maxAgeDays and then the oldest ones until the
+# cache is under maxSizeMB.
+#
+# How datasets are saved and restored is up to the caller ("save" and
+# "restore" functions taking the dataset names and the entry folder); they
+# must be module-level functions because they run in the worker processes.
+# SaveFiles/RestoreFiles copy plain files and folders.
+#
+# A stage's code hash only covers the stage function itself, not the modules
+# it calls.  SourceHash hashes whole source files and folders (every .py file
+# in them), so the caller can put the helper modules, and anything else the
+# outputs depend on, in the run parameters.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# None beyond the Python standard library.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+MANIFEST = "manifest.json"
+
+# What the scheduler does with a stage when it runs with a cache.
+RUN = "run"
+RESTORE = "restore"
+SKIP = "skip"
+
+
+def _CodeHash(code, digest):
+    digest.update(code.co_code)
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            _CodeHash(const, digest)
+        else:
+            digest.update(repr(const).encode("utf-8"))
+    digest.update(repr(code.co_names).encode("utf-8"))
+
+
+# Process: Hash of the contents of "paths", files or folders of .py files.
+def SourceHash(paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, dirs, names in os.walk(path)
+                           for name in names if name.endswith(".py"))
+        for name in files:
+            digest.update(os.path.relpath(name, os.path.dirname(path)).replace(os.sep, "/").encode("utf-8"))
+            with open(name, "rb") as source:
+                digest.update(source.read())
+    return digest.hexdigest()
+
+
+# Process: Key of every stage, in the order given.  A stage's key covers the
+# keys of the last stages to write each of its inputs, so changing one stage
+# changes the key of everything downstream of it.
+def StageKeys(stages, params=()):
+    lastWriter = {}
+    keys = {}
+    for stage in stages:
+        digest = hashlib.sha1()
+        digest.update(stage.name.encode("utf-8"))
+        _CodeHash(stage.func.__code__, digest)
+        digest.update(repr(stage.args).encode("utf-8"))
+        digest.update(repr(tuple(params)).encode("utf-8"))
+        for dataset in sorted(set(stage.inputs + stage.outputs)):
+            digest.update(("%s=%s;" % (dataset, lastWriter.get(dataset, ""))).encode("utf-8"))
+        keys[stage.name] = digest.hexdigest()
+        for dataset in stage.outputs:
+            lastWriter[dataset] = keys[stage.name]
+    return keys
+
+
+def _FolderSize(folder):
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class StageCache(object):
+
+    def __init__(self, folder, save, restore, params=(), maxAgeDays=7, maxSizeMB=20000):
+        self.folder = folder
+        self.save = save
+        self.restore = restore
+        self.params = tuple(params)
+        self.maxAgeDays = maxAgeDays
+        self.maxSizeMB = maxSizeMB
+
+    def EntryFolder(self, key):
+        return os.path.join(self.folder, key)
+
+    def Has(self, key):
+        return os.path.exists(os.path.join(self.EntryFolder(key), MANIFEST))
+
+    # Process: Decide what to do with each stage.  Returns a dict of stage
+    # name to (action, key, datasets to restore).
+    def Plan(self, stages, depends):
+        keys = StageKeys(stages, self.params)
+        cacheable = dict((stage.name, stage.cacheable) for stage in stages)
+        skipped = set()
+        for stage in stages:
+            if (stage.cacheable and self.Has(keys[stage.name]) and
+                    all(name in skipped or not cacheable[name] for name in depends[stage.name])):
+                skipped.add(stage.name)
+
+        plan = {}
+        for i, stage in enumerate(stages):
+            if stage.name not in skipped:
+                plan[stage.name] = (RUN if stage.cacheable else None, keys[stage.name], ())
+                continue
+            # Restore an output unless a later skipped stage writes it again.
+            restore = []
+            for dataset in stage.outputs:
+                nextWriter = None
+                for later in stages[i + 1:]:
+                    if dataset in later.outputs:
+                        nextWriter = later.name
+                        break
+                if nextWriter is None or nextWriter not in skipped:
+                    restore.append(dataset)
+            plan[stage.name] = (RESTORE if restore else SKIP, keys[stage.name], tuple(restore))
+        return plan
+
+    # Process: Save the outputs of a finished stage under its key.  The entry
+    # is built in a temporary folder and renamed into place.
+    def Save(self, key, name, datasets):
+        entry = self.EntryFolder(key)
+        partial = entry + ".partial"
+        if os.path.exists(partial):
+            shutil.rmtree(partial)
+        os.makedirs(partial)
+        self.save(list(datasets), partial)
+        manifest = {"stage": name, "key": key, "datasets": list(datasets), "created": time.time(),
+                    "bytes": _FolderSize(partial)}
+        with open(os.path.join(partial, MANIFEST), "w") as output:
+            json.dump(manifest, output)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(partial, entry)
+
+    def Restore(self, key, datasets):
+        self.restore(list(datasets), self.EntryFolder(key))
+
+    # Process: Manifests of every complete entry, oldest first.
+    def Entries(self):
+        entries = []
+        if not os.path.isdir(self.folder):
+            return entries
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name, MANIFEST)
+            if os.path.exists(path):
+                with open(path) as manifest:
+                    entries.append(json.load(manifest))
+        return sorted(entries, key=lambda entry: entry["created"])
+
+    # Process: Remove entries past the age limit, then the oldest entries
+    # until the cache fits the size limit, and any half-written entries.
+    # Returns the keys removed.
+    def Evict(self, now=None):
+        now = time.time() if now is None else now
+        removed = []
+        entries = self.Entries()
+        for entry in list(entries):
+            if self.maxAgeDays is not None and now - entry["created"] > self.maxAgeDays * 86400:
+                entries.remove(entry)
+                removed.append(entry["key"])
+        if self.maxSizeMB is not None:
+            total = sum(entry["bytes"] for entry in entries)
+            while entries and total > self.maxSizeMB * 1024 * 1024:
+                entry = entries.pop(0)
+                total -= entry["bytes"]
+                removed.append(entry["key"])
+        for key in removed:
+            shutil.rmtree(self.EntryFolder(key), ignore_errors=True)
+        if os.path.isdir(self.folder):
+            for name in os.listdir(self.folder):
+                if name.endswith(".partial"):
+                    shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+        return removed
+
+
+# Process: Stage wrappers run by the scheduler in place of the stage function.
+def RunAndSave(cache, key, name, func, args, outputs):
+    func(*args)
+    cache.Save(key, name, outputs)
+
+
+def RestoreOutputs(cache, key, datasets):
+    cache.Restore(key, datasets)
+
+
+def Skip():
+    pass
+
+
+# Process: Save and restore functions for datasets that are plain files or
+# folders (paths relative to the current folder or absolute).
+def SaveFiles(datasets, folder):
+    for i, path in enumerate(datasets):
+        target = os.path.join(folder, "%d_%s" % (i, os.path.basename(path.rstrip("/\\"))))
+        if os.path.isdir(path):
+            shutil.copytree(path, target)
+        elif os.path.exists(path):
+            shutil.copy2(path, target)
+
+
+def RestoreFiles(datasets, folder):
+    for i, path in enumerate(datasets):
+        source = os.path.join(folder, "%d_%s" % (i, os.path.basename(path.rstrip("/\\"))))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        if os.path.isdir(source):
+            shutil.copytree(source, path)
+        elif os.path.exists(source):
+            shutil.copy2(source, path)
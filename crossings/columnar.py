@@ -0,0 +1,355 @@
+#
+# -----------------------------------------------------------------------------
+#                                 columnar.py
+#
+# PURPOSE:
+#
+# On-disk columnar format for the intermediate layers (swPipes, snPipes,
+# wnPipes, the *Intersect tables and AllIntersections) so later stages map
+# them instead of re-reading the file geodatabase.  Each layer is a folder:
+#
+#   schema.json          name, kind (pipe or point), row count, fields and
+#                        the file holding each column
+#   oids.npy             object IDs
+#   coords.npy           pipes: float64 (nvertices, 2), see geometry.py
+#   partOffsets.npy      pipes: int64 (nparts + 1)
+#   pipeParts.npy        pipes: int64 (npipes + 1)
+#   x.npy, y.npy         points: float64
+#   <field>.<n>.npy      numeric fields: float64, NaN for NULL (int64 for
+#                        SHORT and LONG columns held as integers)
+#                        text fields: int64 offsets (.<n>.npy) into UTF-8
+#                        bytes (.<n>.data.npy), offset -1 for NULL
+#                        date fields: int64 microseconds since 1970 with
+#                        NULL_DATE for NULL (or stored as text when the
+#                        values are not all datetimes)
+#
+# ReadColumnar maps the geometry and numeric files copy-on-write
+# (numpy.load with mmap_mode "c"), so nothing is read until it is used,
+# in-place changes stay in the process making them, and every worker process
+# mapping the same layer shares the pages through the operating system
+# instead of having them pickled across.  Text and date columns are decoded
+# into object arrays when read.
+#
+# ReadRows decodes only the rows asked for and ReadArrayRange reads a range of
+# rows from a file without mapping it, for callers that must stay within a
+# memory budget (outofcore.py).
+#
+# WriteColumnar writes a layer into a new folder and swaps it into place;
+# WriteColumns adds or replaces single columns without touching the rest.
+# Column files get a new generation number when replaced, so a file that is
+# still mapped (Windows will not overwrite those) is never written over.
+#
+# ColumnarStore keeps the layers of one run in one folder and exports them to
+# a GeoPackage (or, with arcgis.py, a geodatabase) when the run is done.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import datetime
+import json
+import os
+import shutil
+
+import numpy as np
+
+from crossings.geometry import AttributeTable, INTEGER_TYPES, MakeField, NUMERIC_TYPES, PipeLayer, PointLayer
+from crossings.gpkg import WriteGeoPackage
+
+SCHEMA = "schema.json"
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+NULL_DATE = np.iinfo(np.int64).min
+
+
+def _ReplaceFile(source, target):
+    if hasattr(os, "replace"):
+        os.replace(source, target)
+        return
+    if os.path.exists(target):
+        os.remove(target)
+    os.rename(source, target)
+
+
+def _Load(path):
+    try:
+        return np.load(path, mmap_mode="c")
+    except ValueError:
+        # Empty arrays cannot be mapped.
+        return np.load(path)
+
+
+def _IsDatetime(value):
+    return isinstance(value, datetime.datetime)
+
+
+def _Microseconds(value):
+    delta = value.replace(tzinfo=None) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+# Process: Encode one column.  Returns the encoding name and the arrays to
+# save, keyed by file suffix.
+def _EncodeColumn(field, values):
+    if field.type in INTEGER_TYPES and isinstance(values, np.ndarray) and values.dtype.kind in "iu":
+        return "int64", {"": values.astype(np.int64)}
+    if field.type in NUMERIC_TYPES:
+        return "float64", {"": np.asarray(values, dtype=np.float64)}
+    values = list(values)
+    if field.type == "DATE" and all(value is None or _IsDatetime(value) for value in values):
+        stamps = np.array([NULL_DATE if value is None else _Microseconds(value) for value in values],
+                          dtype=np.int64)
+        return "datetime", {"": stamps}
+    chunks = []
+    offsets = np.empty(len(values) + 1, dtype=np.int64)
+    position = 0
+    for i, value in enumerate(values):
+        if value is None:
+            offsets[i] = -1
+            continue
+        if not isinstance(value, type(u"")):
+            value = value.isoformat() if hasattr(value, "isoformat") else (u"%s" % (value,))
+        chunk = value.encode("utf-8")
+        offsets[i] = position
+        chunks.append(chunk)
+        position += len(chunk)
+    offsets[-1] = position
+    data = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+    return "utf8", {"": offsets, ".data": data}
+
+
+# Process: Decode a column, or only the entries "rows" of it.
+def _DecodeColumn(encoding, arrays, rows=None):
+    if encoding in ("float64", "int64"):
+        return arrays[""] if rows is None else np.asarray(arrays[""][rows])
+    if encoding == "datetime":
+        stamps = arrays[""] if rows is None else arrays[""][rows]
+        column = np.empty(len(stamps), dtype=object)
+        for i, stamp in enumerate(stamps.tolist()):
+            if stamp != NULL_DATE:
+                column[i] = EPOCH + datetime.timedelta(microseconds=stamp)
+        return column
+    offsets = np.asarray(arrays[""])
+    data = arrays[".data"]
+    # The end of each value is the start of the next non-NULL one.
+    ends = offsets.copy()
+    ends[ends < 0] = offsets[-1]
+    ends = np.minimum.accumulate(ends[::-1])[::-1]
+    rows = np.arange(len(offsets) - 1) if rows is None else np.asarray(rows, dtype=np.int64)
+    column = np.empty(len(rows), dtype=object)
+    for i in np.nonzero(offsets[rows] >= 0)[0]:
+        row = rows[i]
+        column[i] = np.asarray(data[offsets[row]:ends[row + 1]]).tobytes().decode("utf-8")
+    return column
+
+
+def _ReadSchema(folder):
+    with open(os.path.join(folder, SCHEMA)) as schema:
+        return json.load(schema)
+
+
+def _WriteSchema(folder, schema):
+    path = os.path.join(folder, SCHEMA)
+    with open(path + ".tmp", "w") as output:
+        json.dump(schema, output, indent=1)
+    _ReplaceFile(path + ".tmp", path)
+
+
+def _SaveColumn(folder, schema, field, values):
+    encoding, arrays = _EncodeColumn(field, values)
+    previous = schema["columns"].get(field.name)
+    generation = previous["generation"] + 1 if previous else 0
+    base = "%s.%d" % (field.name, generation)
+    for suffix, array in arrays.items():
+        np.save(os.path.join(folder, base + suffix + ".npy"), array)
+    schema["columns"][field.name] = {"encoding": encoding, "file": base, "generation": generation,
+                                     "suffixes": sorted(arrays)}
+    return previous
+
+
+def _RemoveColumnFiles(folder, column):
+    for suffix in column["suffixes"]:
+        try:
+            os.remove(os.path.join(folder, column["file"] + suffix + ".npy"))
+        except OSError:
+            # Still mapped somewhere; it is removed with the layer.
+            pass
+
+
+# Process: Write a PipeLayer or PointLayer to "folder", replacing any layer
+# already there.  The layer is built beside the folder and renamed into place.
+def WriteColumnar(folder, layer):
+    partial = folder.rstrip("/\\") + ".partial"
+    if os.path.exists(partial):
+        shutil.rmtree(partial)
+    os.makedirs(partial)
+    isPoint = isinstance(layer, PointLayer)
+    np.save(os.path.join(partial, "oids.npy"), np.asarray(layer.oids, dtype=np.int64))
+    if isPoint:
+        np.save(os.path.join(partial, "x.npy"), np.asarray(layer.x, dtype=np.float64))
+        np.save(os.path.join(partial, "y.npy"), np.asarray(layer.y, dtype=np.float64))
+    else:
+        np.save(os.path.join(partial, "coords.npy"), np.asarray(layer.coords, dtype=np.float64))
+        np.save(os.path.join(partial, "partOffsets.npy"), np.asarray(layer.partOffsets, dtype=np.int64))
+        np.save(os.path.join(partial, "pipeParts.npy"), np.asarray(layer.pipeParts, dtype=np.int64))
+    schema = {"name": layer.name, "kind": "point" if isPoint else "pipe", "count": len(layer),
+              "fields": [list(field) for field in layer.fields], "columns": {}}
+    for field in layer.fields:
+        _SaveColumn(partial, schema, field, layer.columns[field.name])
+    _WriteSchema(partial, schema)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.rename(partial, folder)
+    return folder
+
+
+# Process: Map a layer written by WriteColumnar.  "fieldNames" restricts the
+# attribute fields that are loaded.
+def ReadColumnar(folder, fieldNames=None, name=None):
+    schema = _ReadSchema(folder)
+    load = lambda fileName: _Load(os.path.join(folder, fileName))
+    oids = load("oids.npy")
+    if schema["kind"] == "point":
+        layer = PointLayer(name or schema["name"], load("x.npy"), load("y.npy"), oids=oids)
+    else:
+        layer = PipeLayer(name or schema["name"], load("coords.npy"), load("partOffsets.npy"),
+                          load("pipeParts.npy"), oids=oids)
+    # Columns are put in place directly; going through AttributeTable would
+    # copy the mapped arrays.
+    for values in schema["fields"]:
+        field = MakeField(*values)
+        if fieldNames is not None and field.name not in fieldNames:
+            continue
+        column = schema["columns"][field.name]
+        arrays = dict((suffix, load(column["file"] + suffix + ".npy")) for suffix in column["suffixes"])
+        layer.fields.append(field)
+        layer.columns[field.name] = _DecodeColumn(column["encoding"], arrays)
+    return layer
+
+
+# Process: Attributes of only the rows "rows" of a stored layer, as an
+# AttributeTable in that order.  Only the pages holding those rows are read.
+def ReadRows(folder, rows, fieldNames=None, name=None):
+    schema = _ReadSchema(folder)
+    rows = np.asarray(rows, dtype=np.int64)
+    load = lambda fileName: _Load(os.path.join(folder, fileName))
+    oids = np.asarray(load("oids.npy")[rows])
+    fields = []
+    columns = {}
+    for values in schema["fields"]:
+        field = MakeField(*values)
+        if fieldNames is not None and field.name not in fieldNames:
+            continue
+        column = schema["columns"][field.name]
+        arrays = dict((suffix, load(column["file"] + suffix + ".npy")) for suffix in column["suffixes"])
+        fields.append(field)
+        columns[field.name] = _DecodeColumn(column["encoding"], arrays, rows)
+    return AttributeTable(name or schema["name"], len(rows), fields, columns, oids)
+
+
+def _ArrayHeader(handle):
+    version = np.lib.format.read_magic(handle)
+    if version == (1, 0):
+        shape, fortran, dtype = np.lib.format.read_array_header_1_0(handle)
+    else:
+        shape, fortran, dtype = np.lib.format.read_array_header_2_0(handle)
+    return shape, dtype
+
+
+# Process: Rows start:stop of a saved array, read from the file rather than
+# mapped, so nothing else of it is ever resident.
+def ReadArrayRange(path, start, stop):
+    with open(path, "rb") as handle:
+        shape, dtype = _ArrayHeader(handle)
+        rowItems = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+        start = min(max(int(start), 0), shape[0])
+        stop = min(max(int(stop), start), shape[0])
+        handle.seek(start * rowItems * dtype.itemsize, 1)
+        data = np.fromfile(handle, dtype=dtype, count=(stop - start) * rowItems)
+    return data.reshape((stop - start,) + tuple(shape[1:]))
+
+
+# Process: Add or replace columns of a stored layer.  "columns" maps field
+# names to arrays in the layer's row order; fields already in the layer keep
+# their position.
+def WriteColumns(folder, fields, columns):
+    schema = _ReadSchema(folder)
+    known = [values[0] for values in schema["fields"]]
+    replaced = []
+    for field in fields:
+        if len(columns[field.name]) != schema["count"]:
+            raise ValueError("Column %s has %d values, %s has %d rows" %
+                             (field.name, len(columns[field.name]), schema["name"], schema["count"]))
+        previous = _SaveColumn(folder, schema, field, columns[field.name])
+        if previous:
+            replaced.append(previous)
+        if field.name in known:
+            schema["fields"][known.index(field.name)] = list(field)
+        else:
+            schema["fields"].append(list(field))
+            known.append(field.name)
+    _WriteSchema(folder, schema)
+    for column in replaced:
+        _RemoveColumnFiles(folder, column)
+
+
+# Process: Remove columns from a stored layer.
+def DropColumns(folder, names):
+    schema = _ReadSchema(folder)
+    dropped = [schema["columns"].pop(name) for name in names if name in schema["columns"]]
+    schema["fields"] = [values for values in schema["fields"] if values[0] not in names]
+    _WriteSchema(folder, schema)
+    for column in dropped:
+        _RemoveColumnFiles(folder, column)
+
+
+class ColumnarStore(object):
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def Path(self, name):
+        return os.path.join(self.folder, name)
+
+    def Exists(self, name):
+        return os.path.exists(os.path.join(self.Path(name), SCHEMA))
+
+    def Names(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(name for name in os.listdir(self.folder) if self.Exists(name))
+
+    def Count(self, name):
+        return _ReadSchema(self.Path(name))["count"]
+
+    def Fields(self, name):
+        return [MakeField(*values) for values in _ReadSchema(self.Path(name))["fields"]]
+
+    def Write(self, layer, name=None):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        return WriteColumnar(self.Path(name or layer.name), layer)
+
+    def Read(self, name, fieldNames=None):
+        return ReadColumnar(self.Path(name), fieldNames, name)
+
+    def WriteColumns(self, name, fields, columns):
+        WriteColumns(self.Path(name), fields, columns)
+
+    def DropColumns(self, name, names):
+        DropColumns(self.Path(name), names)
+
+    def Delete(self, name):
+        if os.path.exists(self.Path(name)):
+            shutil.rmtree(self.Path(name))
+
+    # Process: Export a stored layer to a GeoPackage table.
+    def Export(self, name, path, table=None, srsId=0, srsDefinition=None):
+        return WriteGeoPackage(path, self.Read(name), table or name, srsId, srsDefinition)
@@ -0,0 +1,228 @@
+#
+# -----------------------------------------------------------------------------
+#                                 diff.py
+#
+# PURPOSE:
+#
+# What changed in AllIntersections between two runs (two Crossings<YYYYMMDD>
+# outputs), as a changeset that can be applied to the old layer instead of
+# reloading the new one.
+#
+# Object IDs are not stable from one run to the next, so every crossing is
+# keyed by what it is: its InterType, the facility IDs of its pipes (SnFID,
+# SWFID, WnFID) and its location rounded to a grid of QUANTUM_FEET.  When two
+# crossings of the same pipes fall in the same cell they are numbered in
+# order of X,Y.  The two runs are matched with one dictionary of the old
+# keys, so the diff is linear in the number of crossings.  A crossing whose
+# point moved across a cell border is matched to its old key in the
+# neighbouring cell.
+#
+# Each changeset row has Change ("added", "removed" or "changed"), the
+# CrossingKey it adds, removes or replaces, and the AllIntersections fields:
+# the new values for added and changed rows and the old ones for removed
+# rows.  A crossing is "changed" when VertSep moved by more than the
+# tolerance or CrossTy or PipeInter differ; changed rows also have the old
+# values in OldVertSep, OldCrossTy and OldPipeInter.
+#
+#   changes, summary = DiffCrossings(yesterday, today)
+#   today = ApplyChangeset(yesterday, changes)
+#
+#   python -m crossings.diff old.gpkg new.gpkg --output changes.gpkg
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import json
+
+import numpy as np
+
+from crossings.geometry import MakeField, MergeLayers, NullColumn, PointLayer
+from crossings.gpkg import ReadGeoPackagePoints, WriteGeoPackage
+from crossings.output import ALL_INTERSECTIONS_FIELDS, INTER_TYPE, CanonicalLayer
+
+# Fields that, with InterType, identify the pipes of a crossing.
+FACILITY_FIELDS = ("SnFID", "SWFID", "WnFID")
+
+# Size of the grid crossing points are rounded to for their key.
+QUANTUM_FEET = 0.1
+
+# VertSep changes up to this many feet are not reported.
+VERTSEP_TOLERANCE = 0.01
+
+# Values compared between matched crossings.
+COMPARED_FIELDS = ("VertSep", "CrossTy", "PipeInter")
+
+CHANGE = MakeField("Change", "TEXT", 10, "Change")
+CROSSING_KEY = MakeField("CrossingKey", "TEXT", 120, "Crossing Key")
+OLD_FIELDS = [MakeField("OldVertSep", "DOUBLE", None, "Old Vertical Separation"),
+              MakeField("OldCrossTy", "TEXT", 30, "Old Crossing Type"),
+              MakeField("OldPipeInter", "TEXT", 20, "Old Do Pipes Intersect")]
+
+CHANGESET_FIELDS = [CHANGE, CROSSING_KEY] + ALL_INTERSECTIONS_FIELDS + OLD_FIELDS
+
+NEIGHBOURS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+
+
+def _Text(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return u""
+    if isinstance(value, float) and value == int(value):
+        value = int(value)
+    return u"%s" % (value,)
+
+
+def _Column(layer, name):
+    if name in layer.columns:
+        return layer.columns[name]
+    return [None] * len(layer)
+
+
+# Process: Key of every crossing: (InterType, SnFID, SWFID, WnFID, cell X,
+# cell Y, number within the cell).
+def CrossingKeys(layer, quantum=QUANTUM_FEET):
+    identity = list(zip(*[[_Text(value) for value in _Column(layer, name)]
+                          for name in (INTER_TYPE.name,) + FACILITY_FIELDS]))
+    cellX = np.floor(layer.x / quantum).astype(np.int64)
+    cellY = np.floor(layer.y / quantum).astype(np.int64)
+    keys = [None] * len(layer)
+    seen = collections.defaultdict(int)
+    for i in np.lexsort((layer.y, layer.x)):
+        base = identity[i] + (int(cellX[i]), int(cellY[i]))
+        keys[i] = base + (seen[base],)
+        seen[base] += 1
+    return keys
+
+
+def KeyText(key):
+    return u"|".join(u"%s" % (part,) for part in key)
+
+
+def _Neighbours(key):
+    for dx, dy in NEIGHBOURS:
+        yield key[:4] + (key[4] + dx, key[5] + dy, key[6])
+
+
+# Process: Match the crossings of two runs by key.  Returns, for each new
+# crossing, the index of its old crossing or -1, and the keys of the old
+# layer.
+def MatchCrossings(old, new, quantum=QUANTUM_FEET):
+    oldKeys = CrossingKeys(old, quantum)
+    newKeys = CrossingKeys(new, quantum)
+    unmatched = dict((key, i) for i, key in enumerate(oldKeys))
+    match = np.full(len(new), -1, dtype=np.int64)
+    for j, key in enumerate(newKeys):
+        i = unmatched.pop(key, None)
+        if i is not None:
+            match[j] = i
+    for j in np.nonzero(match < 0)[0]:
+        for key in _Neighbours(newKeys[j]):
+            i = unmatched.pop(key, None)
+            if i is not None:
+                match[j] = i
+                break
+    return match, oldKeys, newKeys
+
+
+def _Numbers(layer, name):
+    return np.asarray(_Column(layer, name), dtype=np.float64)
+
+
+def _Labels(layer, name, rows):
+    return np.array([_Text(value) for value in np.asarray(_Column(layer, name), dtype=object)[rows]], dtype=object)
+
+
+# Process: Which of the matched crossings changed.  Returns a dict of boolean
+# arrays by compared field, over the pairs (oldRows, newRows).
+def ChangedValues(old, new, oldRows, newRows, tolerance=VERTSEP_TOLERANCE):
+    before = _Numbers(old, "VertSep")[oldRows]
+    after = _Numbers(new, "VertSep")[newRows]
+    with np.errstate(invalid="ignore"):
+        moved = np.abs(after - before) > tolerance
+    changed = collections.OrderedDict()
+    changed["VertSep"] = moved | (np.isnan(before) != np.isnan(after))
+    for name in ("CrossTy", "PipeInter"):
+        changed[name] = _Labels(old, name, oldRows) != _Labels(new, name, newRows)
+    return changed
+
+
+def _Rows(layer, rows, change, keys, olds=None):
+    part = CanonicalLayer(layer.Take(rows))
+    columns = dict(part.columns)
+    columns[CHANGE.name] = np.array([change] * len(rows), dtype=object)
+    columns[CROSSING_KEY.name] = np.array([KeyText(key) for key in keys], dtype=object)
+    for field in OLD_FIELDS:
+        columns[field.name] = olds[field.name] if olds else NullColumn(field.type, len(rows))
+    return PointLayer("Changes", part.x, part.y, CHANGESET_FIELDS, columns)
+
+
+# Process: Changeset from the "old" to the "new" AllIntersections layer.
+# Returns the changeset PointLayer and a summary of the counts.
+def DiffCrossings(old, new, quantum=QUANTUM_FEET, tolerance=VERTSEP_TOLERANCE):
+    match, oldKeys, newKeys = MatchCrossings(old, new, quantum)
+    matched = np.nonzero(match >= 0)[0]
+    oldRows = match[matched]
+    changed = ChangedValues(old, new, oldRows, matched, tolerance)
+    anyChange = np.zeros(len(matched), dtype=bool)
+    for mask in changed.values():
+        anyChange |= mask
+
+    added = np.nonzero(match < 0)[0]
+    kept = np.zeros(len(old), dtype=bool)
+    kept[oldRows] = True
+    removed = np.nonzero(~kept)[0]
+    changedOld = oldRows[anyChange]
+    changedNew = matched[anyChange]
+    olds = {"OldVertSep": _Numbers(old, "VertSep")[changedOld],
+            "OldCrossTy": np.asarray(_Column(old, "CrossTy"), dtype=object)[changedOld],
+            "OldPipeInter": np.asarray(_Column(old, "PipeInter"), dtype=object)[changedOld]}
+    changes = MergeLayers("Changes", [
+        _Rows(new, added, "added", [newKeys[j] for j in added]),
+        _Rows(old, removed, "removed", [oldKeys[i] for i in removed]),
+        _Rows(new, changedNew, "changed", [oldKeys[i] for i in changedOld], olds)])
+    summary = collections.OrderedDict([
+        ("old", len(old)), ("new", len(new)), ("added", len(added)), ("removed", len(removed)),
+        ("changed", len(changedNew)),
+        ("changedFields", collections.OrderedDict((name, int(np.count_nonzero(mask)))
+                                                  for name, mask in changed.items()))])
+    return changes, summary
+
+
+# Process: Apply a changeset from DiffCrossings to the old layer.  Removed and
+# changed crossings are dropped by key and the added and changed rows are
+# appended, giving the new layer (in a different order, with new object IDs).
+def ApplyChangeset(layer, changes, quantum=QUANTUM_FEET):
+    change = np.asarray(changes.columns[CHANGE.name], dtype=object)
+    dropped = set(np.asarray(changes.columns[CROSSING_KEY.name], dtype=object)[change != "added"])
+    keep = [i for i, key in enumerate(CrossingKeys(layer, quantum)) if KeyText(key) not in dropped]
+    appended = changes.Take(np.nonzero(change != "removed")[0])
+    return MergeLayers(layer.name, [CanonicalLayer(layer.Take(keep)), CanonicalLayer(appended)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the crossings of two runs and write the changeset.")
+    parser.add_argument("old", help="GeoPackage with the earlier run's crossings")
+    parser.add_argument("new", help="GeoPackage with the later run's crossings")
+    parser.add_argument("--table", default="AllIntersections")
+    parser.add_argument("--quantum", type=float, default=QUANTUM_FEET, help="key grid size in feet")
+    parser.add_argument("--tolerance", type=float, default=VERTSEP_TOLERANCE, help="VertSep tolerance in feet")
+    parser.add_argument("--output", help="GeoPackage to write the changeset to (table Changes)")
+    args = parser.parse_args(argv)
+    old = ReadGeoPackagePoints(args.old, args.table)
+    new = ReadGeoPackagePoints(args.new, args.table)
+    changes, summary = DiffCrossings(old, new, args.quantum, args.tolerance)
+    if args.output:
+        WriteGeoPackage(args.output, changes, "Changes")
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
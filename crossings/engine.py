@@ -0,0 +1,196 @@
+#
+# -----------------------------------------------------------------------------
+#                                 engine.py
+#
+# PURPOSE:
+#
+# Native replacement for gp.Intersect_analysis(..., "POINT") on two pipe layers.
+# Every pipe is split into straight segments, the segments are bucketed into a
+# uniform grid (see spatialindex.py), and only segment pairs that share a grid
+# cell are tested for an intersection.  The result is one crossing point per
+# location where a pipe of the first layer crosses a pipe of the second layer,
+# carrying the attributes of both pipes the same way Intersect "ALL" does:
+#
+#   FID_<first>, <first fields>, FID_<second>, <second fields>
+#
+# Field names already used by the first layer get a "_1" suffix.  Two more
+# fields, Chainage_<first> and Chainage_<second>, hold the distance along each
+# pipe from its start to the crossing, taken from the segment and position the
+# crossing was found on, so later steps never have to search the pipes for the
+# point again.  Segments that overlap along their length (collinear) are not
+# reported; Intersect only emits those as line output.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from crossings.geometry import MakeField, PipeLayer, PointLayer
+from crossings.spatialindex import OverlappingPairs
+
+# Default XY tolerance, in the units of the data (feet for NAD83 State Plane).
+# Matches the ArcGIS default for feature classes in feet.
+XY_TOLERANCE = 0.001
+
+CROSSING_ARRAYS = ("x", "y", "first", "second", "firstVertex", "secondVertex", "firstT", "secondT")
+
+CHAINAGE_PREFIX = "Chainage_"
+
+
+# Crossings found between two pipe layers.  Each entry has the crossing point,
+# the index of the pipe in each layer, the first vertex of the segment that was
+# crossed in each layer and the position (0-1) of the point along that segment.
+# "measures" is optionally the (first, second) distance along each pipe, for
+# crossings whose pipe layers are not at hand when the table is built.
+class Crossings(object):
+
+    def __init__(self, x, y, first, second, firstVertex, secondVertex, firstT, secondT):
+        self.x = x
+        self.y = y
+        self.first = first
+        self.second = second
+        self.firstVertex = firstVertex
+        self.secondVertex = secondVertex
+        self.firstT = firstT
+        self.secondT = secondT
+        self.measures = None
+
+    def __len__(self):
+        return len(self.x)
+
+    def Take(self, indices):
+        taken = Crossings(*[getattr(self, name)[indices] for name in CROSSING_ARRAYS])
+        if self.measures is not None:
+            taken.measures = tuple(measure[indices] for measure in self.measures)
+        return taken
+
+
+def _Cross(ax, ay, bx, by):
+    return ax * by - ay * bx
+
+
+# Process: Intersect segment pairs.  "a" and "b" are the first vertex of each
+# segment in coordsA and coordsB.  Returns a mask of the pairs that cross, with
+# the crossing point and the position along each segment.
+def IntersectSegments(coordsA, a, coordsB, b, tolerance=XY_TOLERANCE):
+    p = coordsA[a]
+    r = coordsA[a + 1] - p
+    q = coordsB[b]
+    s = coordsB[b + 1] - q
+    denom = _Cross(r[:, 0], r[:, 1], s[:, 0], s[:, 1])
+    qp = q - p
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = _Cross(qp[:, 0], qp[:, 1], s[:, 0], s[:, 1]) / denom
+        u = _Cross(qp[:, 0], qp[:, 1], r[:, 0], r[:, 1]) / denom
+        slackT = tolerance / np.hypot(r[:, 0], r[:, 1])
+        slackU = tolerance / np.hypot(s[:, 0], s[:, 1])
+    hit = ((denom != 0) & (t >= -slackT) & (t <= 1 + slackT) & (u >= -slackU) & (u <= 1 + slackU))
+    t = np.clip(t[hit], 0.0, 1.0)
+    u = np.clip(u[hit], 0.0, 1.0)
+    x = p[hit, 0] + t * r[hit, 0]
+    y = p[hit, 1] + t * r[hit, 1]
+    return hit, x, y, t, u
+
+
+# Process: Find every point where a pipe in "first" crosses a pipe in "second".
+# Crossings of the same two pipes closer together than "tolerance" (for example
+# where a pipe crosses exactly at a vertex of the other) are reported once.
+def FindCrossings(first, second, tolerance=XY_TOLERANCE, cellSize=None):
+    startA, pipesA = first.Segments()
+    startB, pipesB = second.Segments()
+    candA, candB = OverlappingPairs(first.SegmentBoxes(), second.SegmentBoxes(), cellSize)
+
+    a = startA[candA]
+    b = startB[candB]
+    hit, x, y, t, u = IntersectSegments(first.coords, a, second.coords, b, tolerance)
+    crossings = Crossings(x, y, pipesA[candA][hit], pipesB[candB][hit], a[hit], b[hit], t, u)
+    return UniqueCrossings(crossings, tolerance)
+
+
+def ConcatCrossings(parts):
+    return Crossings(*[np.concatenate([getattr(part, name) for part in parts]) for name in CROSSING_ARRAYS])
+
+
+# Process: Drop repeated points per pipe pair and sort the output by the pipe
+# indexes, then X, then Y, so repeated runs produce identical tables.
+def UniqueCrossings(crossings, tolerance=XY_TOLERANCE):
+    if not len(crossings):
+        return crossings
+    qx = np.round(crossings.x / tolerance).astype(np.int64)
+    qy = np.round(crossings.y / tolerance).astype(np.int64)
+    order = np.lexsort((qy, qx, crossings.second, crossings.first))
+    keys = np.column_stack((crossings.first, crossings.second, qx, qy))[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+    return crossings.Take(order[first])
+
+
+# Process: Output field names for the Intersect style table.  Fields named in
+# "exclude" are left out.
+def IntersectSchema(first, second, exclude=()):
+    used = set()
+    schema = []
+    for layer in (first, second):
+        for field in [MakeField("FID_" + layer.name, "LONG")] + layer.fields:
+            if field.name in exclude:
+                continue
+            name = field.name
+            suffix = 1
+            while name.lower() in used:
+                name = "%s_%d" % (field.name, suffix)
+                suffix += 1
+            used.add(name.lower())
+            schema.append((layer, field.name, field._replace(name=name)))
+    return schema
+
+
+def ChainageField(layer):
+    return MakeField(CHAINAGE_PREFIX + layer.name, "DOUBLE", None, "Distance Along %s" % layer.name)
+
+
+# Process: Distance along the first and second pipe of every crossing: the
+# carried measures, or measured on the pipe layers.  None when neither is
+# available.
+def CrossingMeasures(crossings, first, second):
+    if getattr(crossings, "measures", None) is not None:
+        return crossings.measures
+    if isinstance(first, PipeLayer) and isinstance(second, PipeLayer):
+        return (first.Measure(crossings.firstVertex, crossings.firstT),
+                second.Measure(crossings.secondVertex, crossings.secondT))
+    return None
+
+
+# Process: Build the crossing point layer with the attributes of both pipes
+# and the chainage of the crossing on each.
+def CrossingLayer(crossings, first, second, name, exclude=()):
+    fields = []
+    columns = {}
+    for layer, source, field in IntersectSchema(first, second, exclude):
+        pipes = crossings.first if layer is first else crossings.second
+        if source == "FID_" + layer.name:
+            values = layer.oids[pipes]
+        else:
+            values = layer.columns[source][pipes]
+        fields.append(field)
+        columns[field.name] = values
+    measures = CrossingMeasures(crossings, first, second)
+    for layer, values in zip((first, second), measures or ()):
+        field = ChainageField(layer)
+        if field.name not in exclude and field.name not in columns:
+            fields.append(field)
+            columns[field.name] = values
+    return PointLayer(name, crossings.x, crossings.y, fields, columns)
+
+
+# Process: Native equivalent of
+#   gp.Intersect_analysis("<first>; <second>", name, "ALL", "", "POINT")
+def IntersectLayers(first, second, name, tolerance=XY_TOLERANCE, cellSize=None, exclude=()):
+    crossings = FindCrossings(first, second, tolerance, cellSize)
+    return CrossingLayer(crossings, first, second, name, exclude)
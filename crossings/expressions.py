@@ -0,0 +1,300 @@
+#
+# -----------------------------------------------------------------------------
+#                                 expressions.py
+#
+# PURPOSE:
+#
+# CalculateField_management expressions (VB syntax, fields in brackets)
+# compiled to NumPy.  A sequence of field calculations, each of which may use
+# the fields calculated before it, is turned into one Python function that
+# computes them over whole columns, so the expressions can be kept as they
+# were written for the geoprocessor:
+#
+#   calculator = FieldCalculator([
+#       ("Snslope", "(([SnUpinvert]-[SnDninvert])/[SnLength])*100"),
+#       ("SS_Length", "Sqr (( [SSUpX]- [POINT_X])^2+( [SSUpY]- [POINT_Y])^2  )"),
+#       ("SS_Invert", "[SnUpinvert]-( [Snslope]/100* [SS_Length])")])
+#   values = calculator.Evaluate(columns, ["SS_Invert"])
+#
+# Only the calculations the requested fields depend on are compiled, and the
+# fields in between are local arrays of the function, never written to a
+# table.  Each compiled function is kept for the next call with the same
+# fields.
+#
+# Supported: numbers, [Field], NULL, "text" (as a whole expression), + - * /
+# and ^ (left to right, above unary minus, as in VB), parentheses and the
+# functions Sqr, Abs, Int, Fix, Sgn, Exp and Log.  NULL is NaN and carries
+# through every operation; a result that is not finite (division by zero, the
+# root of a negative number) is NULL, where the geoprocessor would have left
+# the row unset.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import re
+
+import numpy as np
+
+from crossings.geometry import ColumnArray
+
+# VB functions and the NumPy functions they become.
+FUNCTIONS = {"sqr": "np.sqrt", "abs": "np.abs", "int": "np.floor", "fix": "np.trunc", "sgn": "np.sign",
+             "exp": "np.exp", "log": "np.log"}
+
+OPERATORS = {"+": "+", "-": "-", "*": "*", "/": "/", "^": "**"}
+
+_TOKEN = re.compile(r"""\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+                           |\[(?P<field>[^\]]+)\]
+                           |"(?P<text>[^"]*)"
+                           |(?P<name>[A-Za-z_]\w*)
+                           |(?P<symbol>[-+*/^(),]))""", re.VERBOSE)
+
+Calculation = collections.namedtuple("Calculation", "target expression")
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+# Process: Split an expression into (kind, value, position) tokens.
+def Tokens(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            position = len(text) - len(text[position:].lstrip())
+            raise ExpressionError("Unexpected %r at %d in %r" % (text[position], position, text))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind), match.start(kind)))
+        position = match.end()
+    tokens.append(("end", None, len(text)))
+    return tokens
+
+
+# Recursive descent parser.  The tree is made of tuples:
+#   ("number", value) ("field", name) ("null",) ("text", value)
+#   ("negate", operand) ("binary", operator, left, right) ("call", function, argument)
+class _Parser(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = Tokens(text)
+        self.index = 0
+
+    def Peek(self):
+        return self.tokens[self.index]
+
+    def Next(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def Fail(self, token, wanted):
+        found = "the end" if token[0] == "end" else repr(token[1])
+        return ExpressionError("Expected %s but found %s at %d in %r" % (wanted, found, token[2], self.text))
+
+    def Expect(self, symbol):
+        token = self.Next()
+        if token[0] != "symbol" or token[1] != symbol:
+            raise self.Fail(token, repr(symbol))
+
+    def IsSymbol(self, *symbols):
+        kind, value, position = self.Peek()
+        return kind == "symbol" and value in symbols
+
+    def Parse(self):
+        if self.Peek()[0] == "text" and self.tokens[self.index + 1][0] == "end":
+            return ("text", self.Next()[1])
+        tree = self.Sum()
+        if self.Peek()[0] != "end":
+            raise self.Fail(self.Peek(), "an operator")
+        return tree
+
+    def Sum(self):
+        tree = self.Product()
+        while self.IsSymbol("+", "-"):
+            tree = ("binary", self.Next()[1], tree, self.Product())
+        return tree
+
+    def Product(self):
+        tree = self.Unary()
+        while self.IsSymbol("*", "/"):
+            tree = ("binary", self.Next()[1], tree, self.Unary())
+        return tree
+
+    def Unary(self):
+        if self.IsSymbol("-"):
+            self.Next()
+            return ("negate", self.Unary())
+        if self.IsSymbol("+"):
+            self.Next()
+            return self.Unary()
+        return self.Power()
+
+    def Power(self):
+        tree = self.Primary()
+        while self.IsSymbol("^"):
+            self.Next()
+            if self.IsSymbol("-"):
+                self.Next()
+                exponent = ("negate", self.Primary())
+            else:
+                exponent = self.Primary()
+            tree = ("binary", "^", tree, exponent)
+        return tree
+
+    def Primary(self):
+        kind, value, position = token = self.Next()
+        if kind == "number":
+            return ("number", float(value))
+        if kind == "field":
+            return ("field", value.strip())
+        if kind == "name" and value.lower() == "null":
+            return ("null",)
+        if kind == "name" and value.lower() in FUNCTIONS:
+            self.Expect("(")
+            argument = self.Sum()
+            self.Expect(")")
+            return ("call", value.lower(), argument)
+        if kind == "symbol" and value == "(":
+            tree = self.Sum()
+            self.Expect(")")
+            return tree
+        if kind == "name":
+            raise ExpressionError("Unknown function %r at %d in %r" % (value, position, self.text))
+        raise self.Fail(token, "a value")
+
+
+def ParseExpression(text):
+    return _Parser(text).Parse()
+
+
+# Process: Names of the fields an expression tree reads.
+def TreeFields(tree):
+    if tree[0] == "field":
+        return [tree[1]]
+    fields = []
+    for child in tree[1:]:
+        if isinstance(child, tuple):
+            fields += [name for name in TreeFields(child) if name not in fields]
+    return fields
+
+
+def _Source(tree, names):
+    kind = tree[0]
+    if kind == "number":
+        return repr(tree[1])
+    if kind == "field":
+        return names[tree[1]]
+    if kind == "null":
+        return "np.nan"
+    if kind == "negate":
+        return "(-%s)" % _Source(tree[1], names)
+    if kind == "binary":
+        return "(%s %s %s)" % (_Source(tree[2], names), OPERATORS[tree[1]], _Source(tree[3], names))
+    if kind == "call":
+        return "%s(%s)" % (FUNCTIONS[tree[1]], _Source(tree[2], names))
+    raise ExpressionError("Text can only be a whole expression")
+
+
+def _Number(values):
+    if isinstance(values, np.ndarray) and values.dtype == np.float64:
+        return values
+    return ColumnArray(values, "DOUBLE")
+
+
+def _Finite(values, count):
+    values = np.array(np.broadcast_to(values, (count,)), dtype=np.float64)
+    values[~np.isfinite(values)] = np.nan
+    return values
+
+
+def _Text(value, count):
+    column = np.empty(count, dtype=object)
+    column[:] = value
+    return column
+
+
+class FieldCalculator(object):
+
+    # "calculations" is a sequence of (target field, expression) in the order
+    # they would have been calculated.  A target may be calculated more than
+    # once; each expression sees the value calculated before it.
+    def __init__(self, calculations):
+        self.calculations = [Calculation(*calculation) for calculation in calculations]
+        self.trees = [ParseExpression(calculation.expression) for calculation in self.calculations]
+        self.kernels = {}
+
+    # Process: Indices of the calculations needed for "outputs", and for each
+    # one the calculation (or None, an input column) each field it reads
+    # comes from.  Fields in "given" are always input columns.
+    def Plan(self, outputs, given=()):
+        latest = {}
+        sources = []
+        for i, (calculation, tree) in enumerate(zip(self.calculations, self.trees)):
+            sources.append(dict((name, latest.get(name)) for name in TreeFields(tree)))
+            if calculation.target not in given:
+                latest[calculation.target] = i
+        needed = set()
+        pending = [latest[name] for name in outputs if name in latest]
+        while pending:
+            i = pending.pop()
+            if i not in needed:
+                needed.add(i)
+                pending += [j for j in sources[i].values() if j is not None]
+        return sorted(needed), sources, latest
+
+    # Process: Python source of the function computing "outputs" from a dict
+    # of input columns with "count" rows.
+    def Source(self, outputs, given=()):
+        needed, sources, latest = self.Plan(outputs, given)
+        inputs = []
+        for i in needed:
+            inputs += [name for name, j in sources[i].items() if j is None and name not in inputs]
+        inputs += [name for name in outputs if name not in latest and name not in inputs]
+        lines = ["def kernel(columns, count):"]
+        inputNames = {}
+        for k, name in enumerate(inputs):
+            inputNames[name] = "f%d" % k
+            lines.append("    f%d = _Number(columns[%r])" % (k, name))
+        lines.append("    with np.errstate(all='ignore'):")
+        for i in needed:
+            names = dict((name, inputNames[name] if j is None else "v%d" % j) for name, j in sources[i].items())
+            if self.trees[i][0] == "text":
+                lines.append("        v%d = _Text(%r, count)" % (i, self.trees[i][1]))
+            else:
+                lines.append("        v%d = _Finite(%s, count)" % (i, _Source(self.trees[i], names)))
+        results = [("v%d" % latest[name]) if name in latest else inputNames[name] for name in outputs]
+        lines.append("    return (%s)" % "".join(result + ", " for result in results))
+        return "\n".join(lines) + "\n"
+
+    # Process: The compiled function for "outputs", built on first use.
+    def Kernel(self, outputs, given=()):
+        key = (tuple(outputs), tuple(sorted(given)))
+        if key not in self.kernels:
+            namespace = {"np": np, "_Number": _Number, "_Finite": _Finite, "_Text": _Text}
+            exec(compile(self.Source(outputs, given), "<FieldCalculator>", "exec"), namespace)
+            self.kernels[key] = namespace["kernel"]
+        return self.kernels[key]
+
+    # Process: Calculate "outputs" (every target by default) from "columns", a
+    # dict of input arrays by field name.  Returns an ordered dict of arrays.
+    def Evaluate(self, columns, outputs=None, given=()):
+        if outputs is None:
+            outputs = []
+            for calculation in self.calculations:
+                if calculation.target not in outputs:
+                    outputs.append(calculation.target)
+        count = len(next(iter(columns.values()))) if columns else 0
+        values = self.Kernel(outputs, given)(columns, count)
+        return collections.OrderedDict(zip(outputs, values))
@@ -0,0 +1,140 @@
+#
+# -----------------------------------------------------------------------------
+#                                 fieldmap.py
+#
+# PURPOSE:
+#
+# Declarative field maps for the seven source feature classes.  Each map lists
+# the fields that are kept, in order: the source field each one is read from
+# (or a constant value such as UtilType) and its name, type and alias in the
+# local copy.  The map is applied while the features are streamed out of the
+# source, so only these fields are ever written; there are no AddField/
+# CalculateField rewrites and no DeleteField afterwards.
+#
+# The target names are the final ones (SnFID, SWDiam, WnDninvert, ...), so the
+# merged snPipes and wnPipes layers need no clean-up after the merge.  Change
+# the source names below to match your feature classes.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+
+import numpy as np
+
+from crossings.geometry import MakeField, NullColumn, PipeLayer
+
+# Source token for the 2D length of the pipe geometry (Shape_Length in a file
+# geodatabase, SHAPE.LEN in SDE).
+LENGTH = "@Length"
+
+# One output field: where its values come from and its definition.  "source"
+# is None for constant fields.
+MapField = collections.namedtuple("MapField", "source field value")
+
+
+def Copy(source, name, fieldType, length=None, alias=None):
+    return MapField(source, MakeField(name, fieldType, length, alias), None)
+
+
+def Constant(name, fieldType, length, alias, value):
+    return MapField(None, MakeField(name, fieldType, length, alias), value)
+
+
+class FieldMap(object):
+
+    def __init__(self, target, entries):
+        self.target = target
+        self.entries = list(entries)
+
+    def Fields(self):
+        return [entry.field for entry in self.entries]
+
+    # Process: Source fields to fetch, so the reader can leave the rest behind.
+    def SourceFields(self):
+        names = []
+        for entry in self.entries:
+            if entry.source not in (None, LENGTH) and entry.source not in names:
+                names.append(entry.source)
+        return names
+
+    # Process: Output values for one source row.  "get" returns the value of a
+    # source field; "length" is the pipe's length.
+    def Values(self, get, length):
+        values = []
+        for entry in self.entries:
+            if entry.source is None:
+                values.append(entry.value)
+            elif entry.source == LENGTH:
+                values.append(length)
+            else:
+                values.append(get(entry.source))
+        return values
+
+
+DATE_ENTRIES = [Copy("CREATEDATE", "CREATEDATE", "DATE", None, "Create Date"),
+                Copy("MODIFYDATE", "MODIFYDATE", "DATE", None, "Modify Date")]
+
+
+def _SewerMap(target, utilType):
+    return FieldMap(target, [
+        Constant("UtilType", "TEXT", 20, "Utility Type", utilType),
+        Copy("MATERIAL", "SnMaterial", "TEXT", 30, "Sewer Material"),
+        Copy("FACILITYID", "SnFID", "TEXT", 20, "Sewer FacID"),
+        Copy("DIAMETER", "SnDiam", "SHORT", None, "Sewer Diameter"),
+        Copy(LENGTH, "SnLength", "DOUBLE", None, "Sewer Pipe Length"),
+        Copy("UPSTREAMINVERT", "SnUpinvert", "DOUBLE", None, "Sewer Upstream Invert"),
+        Copy("DOWNSTREAMINVERT", "SnDninvert", "DOUBLE", None, "Sewer Downstream Invert")] + DATE_ENTRIES)
+
+
+def _WaterMap(target, utilType):
+    return FieldMap(target, [
+        Constant("UtilType", "TEXT", 20, "Utility Type", utilType),
+        Copy("MATERIAL", "WnMaterial", "TEXT", 30, "Water Material"),
+        Copy("DIAMETER", "WnDiam", "SHORT", None, "Water Diameter"),
+        Copy("UPSTREAMINVERT", "WnUpinvert", "DOUBLE", None, "Water Upstream Invert"),
+        Copy("DOWNSTREAMINVERT", "WnDninvert", "DOUBLE", None, "Water Downstream Invert"),
+        Copy("SLOPE", "Wnslope", "DOUBLE", None, "Water Slope(%)"),
+        Copy("FACILITYID", "WnFID", "TEXT", 20, "Water FacID")] + DATE_ENTRIES)
+
+
+FIELD_MAPS = dict((fieldMap.target, fieldMap) for fieldMap in [
+    FieldMap("swPipes", [
+        Copy("FACILITYID", "SWFID", "TEXT", 20, "Stormwater FacID"),
+        Constant("UtilType", "TEXT", 20, "Utility Type", "Storm"),
+        Copy("DIAMETER", "SWDiam", "SHORT", None, "Stormwater Diameter"),
+        Copy(LENGTH, "SWLength", "DOUBLE", None, "Storm Pipe Length"),
+        Copy("INVERTUS", "SWUpinvert", "DOUBLE", None, "Stormwater Upstream Invert"),
+        Copy("INVERTDS", "SWDninvert", "DOUBLE", None, "Stormwater Downstream Invert"),
+        Copy("MATERIAL", "SWMaterial", "TEXT", 30, "Stormwater Material")] + DATE_ENTRIES),
+    _SewerMap("snGravity", "snGravity"),
+    _SewerMap("snLateral", "snLateral"),
+    _SewerMap("snForce", "snForce"),
+    _WaterMap("wnGravity", "wnGravity"),
+    _WaterMap("wnLateral", "wnLateral"),
+    _WaterMap("wnWaterMain", "wnMain")])
+
+
+# Process: Apply a field map to a native layer read from a shapefile or
+# GeoPackage.  Source fields the layer does not have come out NULL.
+def ApplyFieldMap(layer, fieldMap):
+    columns = {}
+    for entry in fieldMap.entries:
+        field = entry.field
+        if entry.source is None:
+            columns[field.name] = np.array([entry.value] * len(layer), dtype=object)
+        elif entry.source == LENGTH:
+            columns[field.name] = layer.Lengths()
+        elif entry.source in layer.columns:
+            columns[field.name] = layer.columns[entry.source]
+        else:
+            columns[field.name] = NullColumn(field.type, len(layer))
+    return PipeLayer(fieldMap.target, layer.coords, layer.partOffsets, layer.pipeParts,
+                     fieldMap.Fields(), columns, layer.oids)
@@ -0,0 +1,552 @@
+#
+# -----------------------------------------------------------------------------
+#                                 geometry.py
+#
+# PURPOSE:
+#
+# In-memory layers used by the native crossing engine.  A pipe layer holds every
+# polyline as flat NumPy arrays instead of one geometry object per row:
+#
+#   coords       float64 (nvertices, 2)  X,Y of every vertex, pipe after pipe
+#   partOffsets  int64   (nparts + 1)    first vertex of each part
+#   pipeParts    int64   (npipes + 1)    first part of each pipe
+#
+# Attributes are kept column by column.  Numeric columns are float64 arrays with
+# NaN standing in for NULL; text and date columns are object arrays with None.
+# SHORT and LONG columns built from integer arrays (object IDs, flag words)
+# have no NULLs and stay int64.
+#
+# The geometry of a layer is never changed once it is built, so the per-pipe
+# boxes, lengths and endpoints and the per-segment boxes are computed once, on
+# first use, and kept with the layer.  PipeView gives one pipe's geometry and
+# attributes by name without building a geometry object per row.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import struct
+
+import numpy as np
+
+
+# A field definition.  "type" uses the AddField_management vocabulary (TEXT,
+# SHORT, LONG, FLOAT, DOUBLE, DATE) so definitions can be handed straight to
+# the geoprocessor.
+Field = collections.namedtuple("Field", "name type length alias")
+
+NUMERIC_TYPES = ("SHORT", "LONG", "FLOAT", "DOUBLE")
+
+INTEGER_TYPES = ("SHORT", "LONG")
+
+
+def MakeField(name, fieldType, length=None, alias=None):
+    return Field(name, fieldType, length, alias or name)
+
+
+# Process: Convert a sequence of values to the column representation used for
+# the field type.
+def ColumnArray(values, fieldType):
+    if fieldType in NUMERIC_TYPES:
+        if isinstance(values, np.ndarray) and values.dtype.kind in "iu" and fieldType in INTEGER_TYPES:
+            return values.astype(np.int64)
+        if isinstance(values, np.ndarray) and values.dtype.kind == "f":
+            return values.astype(np.float64)
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    column = np.empty(len(values), dtype=object)
+    column[:] = list(values)
+    return column
+
+
+def NullColumn(fieldType, count):
+    if fieldType in NUMERIC_TYPES:
+        return np.full(count, np.nan)
+    return np.empty(count, dtype=object)
+
+
+# Attribute columns shared by pipe and point layers.  "oids" is the object ID
+# of each row in the source it was read from.
+class AttributeTable(object):
+
+    def __init__(self, name, count, fields=None, columns=None, oids=None):
+        self.name = name
+        self.fields = list(fields or [])
+        self.columns = collections.OrderedDict()
+        for field in self.fields:
+            values = columns[field.name] if columns is not None else NullColumn(field.type, count)
+            self.columns[field.name] = ColumnArray(values, field.type)
+        if oids is None:
+            oids = np.arange(1, count + 1)
+        self.oids = np.asarray(oids, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.oids)
+
+    def Field(self, name):
+        for field in self.fields:
+            if field.name == name:
+                return field
+        raise KeyError(name)
+
+    def Column(self, name):
+        return self.columns[name]
+
+    def AddColumn(self, field, values):
+        if field.name in self.columns:
+            raise ValueError("Field %s already exists in %s" % (field.name, self.name))
+        self.fields.append(field)
+        self.columns[field.name] = ColumnArray(values, field.type)
+
+    # Process: Row index of each object ID in "oids" (binary search over the
+    # sorted object IDs), -1 where the ID is not in the table.
+    def OIDIndex(self, oids):
+        oids = np.asarray(oids, dtype=np.float64)
+        order = np.argsort(self.oids, kind="mergesort")
+        sortedOids = self.oids[order]
+        known = ~np.isnan(oids)
+        index = np.full(len(oids), -1, dtype=np.int64)
+        if not len(sortedOids):
+            return index
+        wanted = oids[known].astype(np.int64)
+        found = np.minimum(np.searchsorted(sortedOids, wanted), len(sortedOids) - 1)
+        index[known] = np.where(sortedOids[found] == wanted, order[found], -1)
+        return index
+
+    def Rows(self):
+        names = [field.name for field in self.fields]
+        columns = [self.columns[name] for name in names]
+        for i in range(len(self)):
+            yield dict((name, _Scalar(column[i])) for name, column in zip(names, columns))
+
+
+def _Scalar(value):
+    if isinstance(value, np.floating):
+        value = float(value)
+        return None if value != value else value
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+class PointLayer(AttributeTable):
+
+    def __init__(self, name, x, y, fields=None, columns=None, oids=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        AttributeTable.__init__(self, name, len(self.x), fields, columns, oids)
+
+    # Process: Copy a subset of the points (in the order given) to a new layer.
+    def Take(self, indices, name=None):
+        indices = np.asarray(indices, dtype=np.int64)
+        columns = dict((field, column[indices]) for field, column in self.columns.items())
+        return PointLayer(name or self.name, self.x[indices], self.y[indices], self.fields, columns,
+                          self.oids[indices])
+
+
+class PipeLayer(AttributeTable):
+
+    def __init__(self, name, coords, partOffsets, pipeParts, fields=None, columns=None, oids=None):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.partOffsets = np.asarray(partOffsets, dtype=np.int64)
+        self.pipeParts = np.asarray(pipeParts, dtype=np.int64)
+        AttributeTable.__init__(self, name, len(self.pipeParts) - 1, fields, columns, oids)
+        self._segments = None
+        self._chainage = None
+        self._segmentBoxes = None
+        self._boxes = None
+        self._lengths = None
+        self._endpoints = None
+
+    # Process: Build a layer from Python sequences.  Each entry of "lines" is
+    # either a list of (x, y) vertices or, for multipart pipes, a list of such
+    # lists.  "rows" is a list of dicts keyed by field name.
+    @classmethod
+    def FromLines(cls, name, lines, fields=None, rows=None, oids=None):
+        parts = []
+        for line in lines:
+            if len(line) and np.ndim(line[0]) == 2:
+                parts.append([np.asarray(part, dtype=np.float64).reshape(-1, 2) for part in line])
+            elif len(line):
+                parts.append([np.asarray(line, dtype=np.float64).reshape(-1, 2)])
+            else:
+                parts.append([])
+        coords, partOffsets, pipeParts = AssembleParts(parts)
+        fields = list(fields or [])
+        columns = None
+        if rows is not None:
+            columns = dict((field.name, [row.get(field.name) for row in rows]) for field in fields)
+        return cls(name, coords, partOffsets, pipeParts, fields, columns, oids)
+
+    def PartCount(self):
+        return len(self.partOffsets) - 1
+
+    # Process: Index of the pipe owning every part and every vertex.
+    def PartPipes(self):
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.pipeParts))
+
+    def VertexParts(self):
+        return np.repeat(np.arange(self.PartCount(), dtype=np.int64), np.diff(self.partOffsets))
+
+    # Process: Split every part into its straight segments.  Returns the index of
+    # the first vertex of each segment and the pipe it belongs to; the segment
+    # runs from coords[start] to coords[start + 1].
+    def Segments(self):
+        if self._segments is None:
+            lastVertex = np.zeros(len(self.coords), dtype=bool)
+            ends = self.partOffsets[1:] - 1
+            lastVertex[ends[ends >= 0]] = True
+            start = np.nonzero(~lastVertex)[0]
+            vertexPipes = self.PartPipes()[self.VertexParts()]
+            self._segments = (start, vertexPipes[start])
+        return self._segments
+
+    # Process: Bounding box (xmin, ymin, xmax, ymax) of every segment, in the
+    # order of Segments().
+    def SegmentBoxes(self):
+        if self._segmentBoxes is None:
+            start = self.Segments()[0]
+            p0 = self.coords[start]
+            p1 = self.coords[start + 1]
+            self._segmentBoxes = np.column_stack((np.minimum(p0[:, 0], p1[:, 0]), np.minimum(p0[:, 1], p1[:, 1]),
+                                                  np.maximum(p0[:, 0], p1[:, 0]), np.maximum(p0[:, 1], p1[:, 1])))
+        return self._segmentBoxes
+
+    # Process: 2D length of every pipe (the sum of its parts).
+    def Lengths(self):
+        if self._lengths is None:
+            start, pipes = self.Segments()
+            step = self.coords[start + 1] - self.coords[start]
+            self._lengths = np.bincount(pipes, weights=np.hypot(step[:, 0], step[:, 1]), minlength=len(self))
+        return self._lengths
+
+    # Process: Chainage index.  Returns the distance of every vertex from the
+    # start of its pipe, measured along the pipe (parts follow on from each
+    # other with no gap).
+    def Chainage(self):
+        if self._chainage is None:
+            start = self.Segments()[0]
+            step = np.zeros(len(self.coords))
+            delta = self.coords[start + 1] - self.coords[start]
+            step[start + 1] = np.hypot(delta[:, 0], delta[:, 1])
+            running = np.cumsum(step)
+            pipeStart = self.partOffsets[self.pipeParts[:-1]]
+            vertexPipes = self.PartPipes()[self.VertexParts()]
+            self._chainage = running - running[pipeStart[vertexPipes]]
+        return self._chainage
+
+    # Process: Distance along the pipe of the points at position "t" (0-1) on
+    # the segments starting at vertices "vertex".  NaN where vertex is -1.
+    def Measure(self, vertex, t):
+        chainage = self.Chainage()
+        vertex = np.asarray(vertex, dtype=np.int64)
+        found = vertex >= 0
+        measures = np.full(len(vertex), np.nan)
+        v = vertex[found]
+        measures[found] = chainage[v] + np.asarray(t, dtype=np.float64)[found] * (chainage[v + 1] - chainage[v])
+        return measures
+
+    # Process: Bounding box (xmin, ymin, xmax, ymax) of every pipe.  Pipes with
+    # no geometry get a NaN box.
+    def PipeBoxes(self):
+        if self._boxes is None:
+            boxes = np.full((len(self), 4), np.nan)
+            vertexCount = self.partOffsets[self.pipeParts[1:]] - self.partOffsets[self.pipeParts[:-1]]
+            filled = vertexCount > 0
+            if filled.any():
+                starts = self.partOffsets[self.pipeParts[:-1]][filled]
+                x, y = self.coords[:, 0], self.coords[:, 1]
+                boxes[filled] = np.column_stack((np.minimum.reduceat(x, starts), np.minimum.reduceat(y, starts),
+                                                 np.maximum.reduceat(x, starts), np.maximum.reduceat(y, starts)))
+            self._boxes = boxes
+        return self._boxes
+
+    # Process: First and last vertex of every part, as two (parts, 2) arrays.
+    def PartEndpoints(self):
+        return self.coords[self.partOffsets[:-1]], self.coords[self.partOffsets[1:] - 1]
+
+    # Process: First vertex of the first part and last vertex of the last part
+    # of every pipe (the FirstPoint and LastPoint of a multipart line).  Pipes
+    # with no geometry get NaN.
+    def Endpoints(self):
+        if self._endpoints is None:
+            first = np.full((len(self), 2), np.nan)
+            last = np.full((len(self), 2), np.nan)
+            start = self.partOffsets[self.pipeParts[:-1]]
+            end = self.partOffsets[self.pipeParts[1:]]
+            filled = end > start
+            first[filled] = self.coords[start[filled]]
+            last[filled] = self.coords[end[filled] - 1]
+            self._endpoints = (first, last)
+        return self._endpoints
+
+    def View(self, i):
+        return PipeView(self, i)
+
+    def Views(self):
+        for i in range(len(self)):
+            yield PipeView(self, i)
+
+    # Process: Copy a subset of the pipes (in the order given) to a new layer.
+    def Take(self, indices, name=None):
+        indices = np.asarray(indices, dtype=np.int64)
+        partStart = self.pipeParts[indices]
+        partCount = self.pipeParts[indices + 1] - partStart
+        parts = Ranges(partStart, partCount)
+        vertexStart = self.partOffsets[parts]
+        vertexCount = self.partOffsets[parts + 1] - vertexStart
+        vertices = Ranges(vertexStart, vertexCount)
+        partOffsets = np.concatenate(([0], np.cumsum(vertexCount)))
+        pipeParts = np.concatenate(([0], np.cumsum(partCount)))
+        columns = dict((field, column[indices]) for field, column in self.columns.items())
+        return PipeLayer(name or self.name, self.coords[vertices], partOffsets, pipeParts,
+                         self.fields, columns, self.oids[indices])
+
+
+# One pipe of a PipeLayer.  Nothing is copied: the geometry and the values are
+# looked up in the layer's arrays when asked for.  view["DIAMETER"] reads an
+# attribute; NULL is None.
+class PipeView(object):
+
+    __slots__ = ("layer", "index")
+
+    def __init__(self, layer, index):
+        self.layer = layer
+        self.index = index
+
+    def __getitem__(self, name):
+        return _Scalar(self.layer.columns[name][self.index])
+
+    @property
+    def oid(self):
+        return int(self.layer.oids[self.index])
+
+    @property
+    def parts(self):
+        return PipeParts(self.layer, self.index)
+
+    @property
+    def box(self):
+        return tuple(self.layer.PipeBoxes()[self.index].tolist())
+
+    @property
+    def length(self):
+        return float(self.layer.Lengths()[self.index])
+
+    @property
+    def firstPoint(self):
+        return tuple(self.layer.Endpoints()[0][self.index].tolist())
+
+    @property
+    def lastPoint(self):
+        return tuple(self.layer.Endpoints()[1][self.index].tolist())
+
+
+# Process: Native equivalent of gp.Merge_management for layers of one kind.
+# The output has every field of the inputs (first definition wins), in the
+# order first seen; rows missing a field get NULL.  Object IDs run from 1.
+def MergeLayers(name, layers):
+    fields = []
+    for layer in layers:
+        for field in layer.fields:
+            if field.name not in [f.name for f in fields]:
+                fields.append(field)
+    columns = {}
+    for field in fields:
+        columns[field.name] = np.concatenate(
+            [layer.columns[field.name] if field.name in layer.columns else NullColumn(field.type, len(layer))
+             for layer in layers] or [NullColumn(field.type, 0)])
+    count = sum(len(layer) for layer in layers)
+    if all(isinstance(layer, PointLayer) for layer in layers):
+        return PointLayer(name, np.concatenate([layer.x for layer in layers] or [np.zeros(0)]),
+                          np.concatenate([layer.y for layer in layers] or [np.zeros(0)]), fields, columns)
+    vertexBase = np.cumsum([0] + [len(layer.coords) for layer in layers])
+    partBase = np.cumsum([0] + [layer.PartCount() for layer in layers])
+    coords = np.concatenate([layer.coords for layer in layers] or [np.zeros((0, 2))])
+    partOffsets = np.concatenate([[0]] + [layer.partOffsets[1:] + base for layer, base in zip(layers, vertexBase)])
+    pipeParts = np.concatenate([[0]] + [layer.pipeParts[1:] + base for layer, base in zip(layers, partBase)])
+    return PipeLayer(name, coords, partOffsets, pipeParts, fields, columns, np.arange(1, count + 1))
+
+
+# Process: Concatenate ranges [start, start + count) into one index array
+# without a Python loop.
+def Ranges(start, count):
+    start = np.asarray(start, dtype=np.int64)
+    count = np.asarray(count, dtype=np.int64)
+    total = int(count.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    groupStart = np.cumsum(count) - count
+    return np.repeat(start - groupStart, count) + np.arange(total, dtype=np.int64)
+
+
+# Process: Flatten a list of pipes (each a list of (n, 2) part arrays) into the
+# coords/partOffsets/pipeParts arrays.
+def AssembleParts(pipes):
+    partArrays = [part for pipe in pipes for part in pipe]
+    partLengths = np.array([len(part) for part in partArrays], dtype=np.int64)
+    partOffsets = np.concatenate(([0], np.cumsum(partLengths))).astype(np.int64)
+    pipeParts = np.concatenate(([0], np.cumsum([len(pipe) for pipe in pipes]))).astype(np.int64)
+    if partArrays:
+        coords = np.concatenate(partArrays)
+    else:
+        coords = np.zeros((0, 2))
+    return coords, partOffsets, pipeParts
+
+
+# WKB geometry types this module understands, without the Z/M modifiers.
+WKB_POINT = 1
+WKB_LINESTRING = 2
+WKB_MULTILINESTRING = 5
+
+
+def _WKBHeader(blob, offset):
+    order = "<" if struct.unpack_from("B", blob, offset)[0] == 1 else ">"
+    geomType = struct.unpack_from(order + "I", blob, offset + 1)[0]
+    dims = 2
+    if geomType & 0x80000000:
+        dims += 1
+    if geomType & 0x40000000:
+        dims += 1
+    offset += 5
+    if geomType & 0x20000000:
+        offset += 4
+    geomType &= 0x0FFFFFFF
+    if geomType >= 3000:
+        dims, geomType = 4, geomType - 3000
+    elif geomType >= 1000:
+        dims, geomType = 3, geomType % 1000
+    return order, geomType, dims, offset
+
+
+def _WKBLineString(blob, offset, order, dims):
+    count = struct.unpack_from(order + "I", blob, offset)[0]
+    offset += 4
+    values = np.frombuffer(blob, dtype=order + "f8", count=count * dims, offset=offset)
+    return values.reshape(count, dims)[:, :2], offset + 8 * count * dims
+
+
+# Process: Decode one WKB LineString or MultiLineString into a list of parts.
+def WKBParts(blob):
+    if blob is None or len(blob) == 0:
+        return []
+    blob = bytes(blob)
+    order, geomType, dims, offset = _WKBHeader(blob, 0)
+    if geomType == WKB_LINESTRING:
+        part, offset = _WKBLineString(blob, offset, order, dims)
+        return [part] if len(part) else []
+    if geomType == WKB_MULTILINESTRING:
+        count = struct.unpack_from(order + "I", blob, offset)[0]
+        offset += 4
+        parts = []
+        for i in range(count):
+            partOrder, partType, partDims, offset = _WKBHeader(blob, offset)
+            part, offset = _WKBLineString(blob, offset, partOrder, partDims)
+            if len(part):
+                parts.append(part)
+        return parts
+    raise ValueError("Unsupported WKB geometry type %d" % geomType)
+
+
+def WKBPoint(blob):
+    if blob is None:
+        return np.nan, np.nan
+    blob = bytes(blob)
+    order, geomType, dims, offset = _WKBHeader(blob, 0)
+    if geomType != WKB_POINT:
+        raise ValueError("Unsupported WKB geometry type %d" % geomType)
+    return struct.unpack_from(order + "dd", blob, offset)
+
+
+def LineWKB(parts):
+    chunks = [struct.pack("<BII", 1, WKB_MULTILINESTRING, len(parts))]
+    for part in parts:
+        part = np.ascontiguousarray(part, dtype="<f8")
+        chunks.append(struct.pack("<BII", 1, WKB_LINESTRING, len(part)))
+        chunks.append(part.tobytes())
+    return b"".join(chunks)
+
+
+def PointWKB(x, y):
+    return struct.pack("<BIdd", 1, WKB_POINT, x, y)
+
+
+# Process: Decode a list of WKB LineStrings/MultiLineStrings (one per pipe)
+# straight into the coords/partOffsets/pipeParts arrays.  Only the headers are
+# walked in Python; the coordinates of every part are gathered from the joined
+# blobs with one index array, so no per-part arrays are built.
+def WKBArrays(blobs):
+    chunks = []
+    byteStart = []
+    vertexCount = []
+    partDims = []
+    bigEndian = []
+    pipePartCount = []
+    base = 0
+    for blob in blobs:
+        if blob is None or len(blob) == 0:
+            pipePartCount.append(0)
+            continue
+        blob = bytes(blob)
+        order, geomType, dims, offset = _WKBHeader(blob, 0)
+        if geomType == WKB_LINESTRING:
+            headers = [(order, dims, offset)]
+        elif geomType == WKB_MULTILINESTRING:
+            headers = []
+            offset += 4
+            for i in range(struct.unpack_from(order + "I", blob, offset - 4)[0]):
+                partOrder, partType, dims, offset = _WKBHeader(blob, offset)
+                headers.append((partOrder, dims, offset))
+                offset += 4 + 8 * dims * struct.unpack_from(partOrder + "I", blob, offset)[0]
+        else:
+            raise ValueError("Unsupported WKB geometry type %d" % geomType)
+        parts = 0
+        for order, dims, offset in headers:
+            count = struct.unpack_from(order + "I", blob, offset)[0]
+            if count:
+                byteStart.append(base + offset + 4)
+                vertexCount.append(count)
+                partDims.append(dims)
+                bigEndian.append(order == ">")
+                parts += 1
+        pipePartCount.append(parts)
+        chunks.append(blob)
+        base += len(blob)
+
+    vertexCount = np.array(vertexCount, dtype=np.int64)
+    partOffsets = np.concatenate(([0], np.cumsum(vertexCount))).astype(np.int64)
+    pipeParts = np.concatenate(([0], np.cumsum(pipePartCount))).astype(np.int64)
+    if not len(vertexCount):
+        return np.zeros((0, 2)), partOffsets, pipeParts
+
+    # Byte offset of the X of every vertex; Y follows 8 bytes later.
+    partDims = np.array(partDims, dtype=np.int64)
+    vertexParts = np.repeat(np.arange(len(vertexCount)), vertexCount)
+    vertexStart = (np.repeat(np.array(byteStart, dtype=np.int64), vertexCount) +
+                   8 * partDims[vertexParts] * (np.arange(partOffsets[-1]) - partOffsets[vertexParts]))
+    raw = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+    values = raw[(vertexStart[:, None] + np.arange(16)).reshape(-1, 8)]
+    flip = np.repeat(np.array(bigEndian)[vertexParts], 2)
+    values[flip] = values[flip, ::-1]
+    coords = np.ascontiguousarray(values).view("<f8").reshape(-1, 2)
+    return coords, partOffsets, pipeParts
+
+
+# Process: Build a pipe layer from a list of WKB blobs (one per pipe).
+def PipeLayerFromWKB(name, blobs, fields=None, columns=None, oids=None):
+    coords, partOffsets, pipeParts = WKBArrays(blobs)
+    return PipeLayer(name, coords, partOffsets, pipeParts, fields, columns, oids)
+
+
+# Process: Parts of pipe "i" as a list of (n, 2) arrays.
+def PipeParts(layer, i):
+    parts = []
+    for part in range(layer.pipeParts[i], layer.pipeParts[i + 1]):
+        parts.append(layer.coords[layer.partOffsets[part]:layer.partOffsets[part + 1]])
+    return parts
@@ -0,0 +1,243 @@
+#
+# -----------------------------------------------------------------------------
+#                                 gpkg.py
+#
+# PURPOSE:
+#
+# Read pipe layers from, and write pipe or crossing point layers to, an OGC
+# GeoPackage using only the sqlite3 module that ships with Python.  This lets
+# the native crossing engine run on machines without ArcGIS.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import sqlite3
+import struct
+
+import numpy as np
+
+from crossings.geometry import (LineWKB, MakeField, PipeLayerFromWKB, PipeParts, PointLayer, PointWKB,
+                                WKBPoint)
+
+# Envelope sizes (bytes) keyed by the envelope indicator in the blob flags.
+ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+SQL_TYPES = {"TEXT": "TEXT", "SHORT": "SMALLINT", "LONG": "INTEGER", "FLOAT": "FLOAT",
+             "DOUBLE": "DOUBLE", "DATE": "DATETIME"}
+
+
+def _Quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _FieldType(declared):
+    declared = (declared or "").upper()
+    if declared.startswith(("TEXT", "VARCHAR", "CHAR")):
+        return "TEXT"
+    if declared in ("SMALLINT", "TINYINT", "BOOLEAN"):
+        return "SHORT"
+    if declared in ("INTEGER", "INT", "MEDIUMINT", "BIGINT"):
+        return "LONG"
+    if declared in ("FLOAT", "REAL", "DOUBLE"):
+        return "DOUBLE"
+    if declared in ("DATE", "DATETIME"):
+        return "DATE"
+    return "TEXT"
+
+
+# Process: Strip the GeoPackage binary header and return the WKB that follows.
+def BlobWKB(blob):
+    if blob is None:
+        return None
+    blob = bytes(blob)
+    if blob[:2] != b"GP":
+        raise ValueError("Not a GeoPackage geometry blob")
+    flags = struct.unpack_from("B", blob, 3)[0]
+    if flags & 0x10:
+        return None
+    return blob[8 + ENVELOPE_SIZES[(flags >> 1) & 0x07]:]
+
+
+def GeometryBlob(wkb, srsId):
+    return struct.pack("<2sBBi", b"GP", 0, 0x01, srsId) + wkb
+
+
+def GeometryColumn(connection, table):
+    row = connection.execute("SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?",
+                             (table,)).fetchone()
+    if row is None:
+        raise ValueError("%s is not a feature table" % table)
+    return row[0]
+
+
+# Process: Field definitions for "table", skipping the primary key and geometry.
+def TableFields(connection, table):
+    geometry = GeometryColumn(connection, table)
+    fields = []
+    key = None
+    for cid, name, declared, notnull, default, pk in connection.execute(
+            "PRAGMA table_info(%s)" % _Quote(table)):
+        if pk:
+            key = name
+        elif name != geometry:
+            fields.append(MakeField(name, _FieldType(declared)))
+    return key, geometry, fields
+
+
+# Process: Read a line feature table into a PipeLayer.  "fieldNames" restricts
+# the attribute fields that are loaded.
+def ReadGeoPackage(path, table, fieldNames=None, name=None):
+    connection = sqlite3.connect(path)
+    try:
+        key, geometry, fields = TableFields(connection, table)
+        if fieldNames is not None:
+            fields = [field for field in fields if field.name in fieldNames]
+        columnSql = ", ".join([_Quote(key), _Quote(geometry)] + [_Quote(f.name) for f in fields])
+        rows = connection.execute("SELECT %s FROM %s ORDER BY %s" %
+                                  (columnSql, _Quote(table), _Quote(key))).fetchall()
+    finally:
+        connection.close()
+    oids = [row[0] for row in rows]
+    blobs = [BlobWKB(row[1]) for row in rows]
+    columns = dict((field.name, [row[i + 2] for row in rows]) for i, field in enumerate(fields))
+    return PipeLayerFromWKB(name or table, blobs, fields, columns, oids)
+
+
+# Process: Read a point feature table into a PointLayer.
+def ReadGeoPackagePoints(path, table, fieldNames=None, name=None):
+    connection = sqlite3.connect(path)
+    try:
+        key, geometry, fields = TableFields(connection, table)
+        if fieldNames is not None:
+            fields = [field for field in fields if field.name in fieldNames]
+        columnSql = ", ".join([_Quote(key), _Quote(geometry)] + [_Quote(f.name) for f in fields])
+        rows = connection.execute("SELECT %s FROM %s ORDER BY %s" %
+                                  (columnSql, _Quote(table), _Quote(key))).fetchall()
+    finally:
+        connection.close()
+    xy = [WKBPoint(BlobWKB(row[1])) for row in rows]
+    columns = dict((field.name, [row[i + 2] for row in rows]) for i, field in enumerate(fields))
+    return PointLayer(name or table, [p[0] for p in xy], [p[1] for p in xy], fields, columns,
+                      [row[0] for row in rows])
+
+
+def HasTable(path, table):
+    connection = sqlite3.connect(path)
+    try:
+        row = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                 (table,)).fetchone()
+    finally:
+        connection.close()
+    return row is not None
+
+
+def _CreateMetadata(connection, srsId, srsDefinition):
+    connection.execute("PRAGMA application_id = 1196444487")
+    connection.execute("PRAGMA user_version = 10200")
+    connection.execute("CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, "
+                       "srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL, "
+                       "organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, "
+                       "description TEXT)")
+    connection.execute("CREATE TABLE IF NOT EXISTS gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, "
+                       "data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', "
+                       "last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), "
+                       "min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER)")
+    connection.execute("CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (table_name TEXT NOT NULL, "
+                       "column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, "
+                       "srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, "
+                       "CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name))")
+    defaults = [("Undefined cartesian SRS", -1, "NONE", -1, "undefined"),
+                ("Undefined geographic SRS", 0, "NONE", 0, "undefined")]
+    if srsId not in (-1, 0):
+        defaults.append(("EPSG:%d" % srsId, srsId, "EPSG", srsId, srsDefinition or "undefined"))
+    connection.executemany("INSERT OR IGNORE INTO gpkg_spatial_ref_sys (srs_name, srs_id, organization, "
+                           "organization_coordsys_id, definition) VALUES (?, ?, ?, ?, ?)", defaults)
+
+
+def _SqlValue(value, fieldType):
+    if value is None:
+        return None
+    if isinstance(value, (float, np.floating)):
+        value = float(value)
+        if value != value:
+            return None
+        if fieldType in ("SHORT", "LONG"):
+            return int(value)
+        return value
+    if isinstance(value, np.integer):
+        return int(value)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+# Process: Create (or replace) an empty feature table for "fields" on an open
+# connection.  "isPoint" picks POINT or MULTILINESTRING geometry.
+def CreateFeatureTable(connection, table, fields, isPoint, srsId=0, srsDefinition=None):
+    geometryType = "POINT" if isPoint else "MULTILINESTRING"
+    _CreateMetadata(connection, srsId, srsDefinition)
+    connection.execute("DROP TABLE IF EXISTS %s" % _Quote(table))
+    connection.execute("DELETE FROM gpkg_contents WHERE table_name = ?", (table,))
+    connection.execute("DELETE FROM gpkg_geometry_columns WHERE table_name = ?", (table,))
+    columnSql = ["fid INTEGER PRIMARY KEY AUTOINCREMENT", "geom %s" % geometryType]
+    columnSql += ["%s %s" % (_Quote(f.name), SQL_TYPES.get(f.type, "TEXT")) for f in fields]
+    connection.execute("CREATE TABLE %s (%s)" % (_Quote(table), ", ".join(columnSql)))
+    connection.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) "
+                       "VALUES (?, 'features', ?, ?)", (table, table, srsId))
+    connection.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', ?, ?, 0, 0)",
+                       (table, geometryType, srsId))
+
+
+# Process: Insert the features of a layer into a table made by
+# CreateFeatureTable and grow the table's bounds in gpkg_contents.  The
+# layer's fields must be in the table.  With "keepOids" the object IDs are
+# used as the fid, otherwise new fids are numbered on from the last one.
+def InsertFeatures(connection, table, layer, srsId=0, keepOids=True):
+    if isinstance(layer, PointLayer):
+        geometries = [PointWKB(x, y) for x, y in zip(layer.x.tolist(), layer.y.tolist())]
+        xy = np.column_stack((layer.x, layer.y))
+    else:
+        geometries = [LineWKB(PipeParts(layer, i)) for i in range(len(layer))]
+        xy = layer.coords
+    columns = [layer.columns[f.name] for f in layer.fields]
+    types = [f.type for f in layer.fields]
+    rows = []
+    for i, wkb in enumerate(geometries):
+        values = [int(layer.oids[i])] if keepOids else []
+        values.append(GeometryBlob(wkb, srsId))
+        values += [_SqlValue(column[i], fieldType) for column, fieldType in zip(columns, types)]
+        rows.append(values)
+    names = (["fid"] if keepOids else []) + ["geom"] + [_Quote(f.name) for f in layer.fields]
+    placeholders = ", ".join(["?"] * len(names))
+    connection.executemany("INSERT INTO %s (%s) VALUES (%s)" % (_Quote(table), ", ".join(names), placeholders),
+                           rows)
+    if len(xy):
+        bounds = [float(v) for v in (xy[:, 0].min(), xy[:, 1].min(), xy[:, 0].max(), xy[:, 1].max())]
+        connection.execute("UPDATE gpkg_contents SET min_x = min(coalesce(min_x, ?), ?), "
+                           "min_y = min(coalesce(min_y, ?), ?), max_x = max(coalesce(max_x, ?), ?), "
+                           "max_y = max(coalesce(max_y, ?), ?) WHERE table_name = ?",
+                           [bounds[0], bounds[0], bounds[1], bounds[1], bounds[2], bounds[2],
+                            bounds[3], bounds[3], table])
+    return len(rows)
+
+
+# Process: Write a PointLayer or PipeLayer to "path" as feature table "table",
+# replacing the table if it already exists.  Object IDs are kept as the fid.  "srsId" is the EPSG code of the
+# coordinates (0 leaves the reference system undefined).
+def WriteGeoPackage(path, layer, table=None, srsId=0, srsDefinition=None):
+    table = table or layer.name
+    connection = sqlite3.connect(path)
+    try:
+        CreateFeatureTable(connection, table, layer.fields, isinstance(layer, PointLayer), srsId, srsDefinition)
+        InsertFeatures(connection, table, layer, srsId)
+        connection.commit()
+    finally:
+        connection.close()
+    return table
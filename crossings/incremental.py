@@ -0,0 +1,269 @@
+#
+# -----------------------------------------------------------------------------
+#                                 incremental.py
+#
+# PURPOSE:
+#
+# Incremental crossings.  Only a few hundred pipes change on a normal day, so
+# instead of intersecting the whole network again the previous run's pipe state
+# and crossings are kept in a GeoPackage (the crossing store) and only the
+# crossings that can have changed are recomputed:
+#
+# 1).  Every pipe gets a key (its facility ID, plus UtilType for the merged
+#      sewer and water layers) and an edit stamp built from CREATEDATE and
+#      MODIFYDATE.  Pipes without either date are stamped with a hash of their
+#      geometry and attributes instead.
+#
+# 2).  Keys that are new, or whose stamp differs from the store, are added or
+#      modified pipes.  Keys in the store that are gone are deleted pipes.
+#      Pipes with a missing or duplicate key cannot be tracked and are always
+#      treated as modified.
+#
+# 3).  Stored crossings that involve a modified or deleted pipe are dropped.
+#      The changed pipes are intersected against their spatial neighbours in
+#      the other layer (pipes whose bounding boxes overlap) and the results are
+#      added back.
+#
+# The crossing attributes are rebuilt from the current layers on every run, so
+# the output is the same as a full rebuild.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+from crossings.engine import (ConcatCrossings, CrossingLayer, Crossings, FindCrossings,
+                              UniqueCrossings, XY_TOLERANCE)
+from crossings.geometry import MakeField, PointLayer
+from crossings.gpkg import HasTable, ReadGeoPackagePoints, WriteGeoPackage
+from crossings.spatialindex import OverlappingPairs
+
+# Fields that identify a pipe in each merged layer.
+PIPE_KEYS = {"swPipes": ("SWFID",),
+             "snPipes": ("UtilType", "SnFID"),
+             "wnPipes": ("UtilType", "WnFID")}
+
+# The three pairwise crossings: first layer, second layer, output.
+CROSSING_PAIRS = (("snPipes", "swPipes", "SWSSIntersect"),
+                  ("wnPipes", "swPipes", "SWWIntersect"),
+                  ("snPipes", "wnPipes", "SSWIntersect"))
+
+DATE_FIELDS = ("CREATEDATE", "MODIFYDATE")
+
+# Extra fields kept with each stored crossing so it can be matched to its pipes.
+STORE_FIELDS = [MakeField("FirstKey", "TEXT", 60), MakeField("SecondKey", "TEXT", 60),
+                MakeField("FirstVertex", "LONG"), MakeField("SecondVertex", "LONG"),
+                MakeField("FirstT", "DOUBLE"), MakeField("SecondT", "DOUBLE")]
+
+STATE_TABLE = "PipeState"
+
+
+def _Text(value):
+    if isinstance(value, float) and value == int(value):
+        value = int(value)
+    return u"%s" % (value,)
+
+
+def _IsNull(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+# Process: Key of every pipe, or None where the key is missing or shared by more
+# than one pipe.
+def PipeKeys(layer, keyFields):
+    columns = [layer.columns[name] for name in keyFields]
+    keys = np.empty(len(layer), dtype=object)
+    for i in range(len(layer)):
+        values = [column[i] for column in columns]
+        if not any(_IsNull(value) for value in values):
+            keys[i] = u":".join(_Text(value) for value in values)
+    counts = collections.Counter(key for key in keys if key is not None)
+    for i, key in enumerate(keys):
+        if key is not None and counts[key] > 1:
+            keys[i] = None
+    return keys
+
+
+# Process: Edit stamp of every pipe.
+def EditStamps(layer):
+    dates = [layer.columns[name] for name in DATE_FIELDS if name in layer.columns]
+    attributes = [layer.columns[field.name] for field in layer.fields]
+    start = layer.partOffsets[layer.pipeParts[:-1]]
+    end = layer.partOffsets[layer.pipeParts[1:]]
+    stamps = np.empty(len(layer), dtype=object)
+    for i in range(len(layer)):
+        values = [column[i] for column in dates]
+        if any(not _IsNull(value) for value in values):
+            stamps[i] = u"|".join(u"" if _IsNull(value) else _Text(value) for value in values)
+        else:
+            digest = hashlib.sha1(np.ascontiguousarray(layer.coords[start[i]:end[i]]).tobytes())
+            digest.update(repr([column[i] for column in attributes]).encode("utf-8"))
+            stamps[i] = digest.hexdigest()
+    return stamps
+
+
+# The persisted state of the last run: one row per pipe key with its edit stamp
+# and one point table per crossing output.
+class CrossingStore(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def PipeState(self, layerName):
+        if not os.path.exists(self.path) or not HasTable(self.path, STATE_TABLE):
+            return {}
+        connection = sqlite3.connect(self.path)
+        try:
+            rows = connection.execute("SELECT key, stamp FROM %s WHERE layer = ?" % STATE_TABLE,
+                                      (layerName,)).fetchall()
+        finally:
+            connection.close()
+        return dict(rows)
+
+    def SavePipeState(self, layerName, keys, stamps):
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS %s (layer TEXT NOT NULL, key TEXT NOT NULL, "
+                               "stamp TEXT, PRIMARY KEY (layer, key))" % STATE_TABLE)
+            connection.execute("DELETE FROM %s WHERE layer = ?" % STATE_TABLE, (layerName,))
+            connection.executemany("INSERT INTO %s VALUES (?, ?, ?)" % STATE_TABLE,
+                                   [(layerName, key, stamp) for key, stamp in zip(keys, stamps)
+                                    if key is not None])
+            connection.commit()
+        finally:
+            connection.close()
+
+    def LoadCrossings(self, name):
+        if not os.path.exists(self.path) or not HasTable(self.path, name):
+            return None
+        return ReadGeoPackagePoints(self.path, name)
+
+    def SaveCrossings(self, name, crossings, firstKeys, secondKeys, first, second):
+        columns = {"FirstKey": firstKeys[crossings.first],
+                   "SecondKey": secondKeys[crossings.second],
+                   "FirstVertex": crossings.firstVertex - _PipeStart(first)[crossings.first],
+                   "SecondVertex": crossings.secondVertex - _PipeStart(second)[crossings.second],
+                   "FirstT": crossings.firstT,
+                   "SecondT": crossings.secondT}
+        WriteGeoPackage(self.path, PointLayer(name, crossings.x, crossings.y, STORE_FIELDS, columns))
+
+
+def _PipeStart(layer):
+    return layer.partOffsets[layer.pipeParts[:-1]]
+
+
+def _EmptyCrossings():
+    empty = np.zeros(0, dtype=np.int64)
+    return Crossings(np.zeros(0), np.zeros(0), empty, empty, empty, empty, np.zeros(0), np.zeros(0))
+
+
+# Process: Stored crossings whose pipes are both unchanged, re-indexed against
+# the current layers.
+def _KeptCrossings(stored, first, second, firstIndex, secondIndex, firstDirty, secondDirty):
+    if stored is None or not len(stored):
+        return _EmptyCrossings()
+    firstKeys = stored.columns["FirstKey"]
+    secondKeys = stored.columns["SecondKey"]
+    keep = np.array([a is not None and b is not None and a not in firstDirty and b not in secondDirty
+                     and a in firstIndex and b in secondIndex
+                     for a, b in zip(firstKeys, secondKeys)], dtype=bool)
+    a = np.array([firstIndex[key] for key in firstKeys[keep]], dtype=np.int64)
+    b = np.array([secondIndex[key] for key in secondKeys[keep]], dtype=np.int64)
+    return Crossings(stored.x[keep], stored.y[keep], a, b,
+                     _PipeStart(first)[a] + stored.columns["FirstVertex"][keep].astype(np.int64),
+                     _PipeStart(second)[b] + stored.columns["SecondVertex"][keep].astype(np.int64),
+                     stored.columns["FirstT"][keep], stored.columns["SecondT"][keep])
+
+
+# Process: Pipes in "layer" (limited to "candidates") whose bounding boxes
+# overlap any of the pipes "indices" in "changedLayer".
+def Neighbours(changedLayer, indices, layer, candidates):
+    changedBoxes = changedLayer.PipeBoxes()[indices]
+    changedBoxes = changedBoxes[~np.isnan(changedBoxes[:, 0])]
+    candidates = np.asarray(candidates, dtype=np.int64)
+    boxes = layer.PipeBoxes()[candidates]
+    filled = ~np.isnan(boxes[:, 0])
+    candidates, boxes = candidates[filled], boxes[filled]
+    if not len(changedBoxes) or not len(boxes):
+        return np.zeros(0, dtype=np.int64)
+    pairs = OverlappingPairs(changedBoxes, boxes)[1]
+    return candidates[np.unique(pairs)]
+
+
+# Process: Crossings between pipes "a" of "first" and pipes "b" of "second",
+# indexed against the full layers.
+def _SubsetCrossings(first, a, second, b, tolerance):
+    if not len(a) or not len(b):
+        return _EmptyCrossings()
+    subFirst, subSecond = first.Take(a), second.Take(b)
+    found = FindCrossings(subFirst, subSecond, tolerance)
+    pipeA, pipeB = a[found.first], b[found.second]
+    return Crossings(found.x, found.y, pipeA, pipeB,
+                     found.firstVertex - _PipeStart(subFirst)[found.first] + _PipeStart(first)[pipeA],
+                     found.secondVertex - _PipeStart(subSecond)[found.second] + _PipeStart(second)[pipeB],
+                     found.firstT, found.secondT)
+
+
+# Process: Crossings involving at least one changed pipe.
+def ChangedCrossings(first, second, firstChanged, secondChanged, tolerance=XY_TOLERANCE):
+    changedA = np.nonzero(firstChanged)[0]
+    changedB = np.nonzero(secondChanged)[0]
+    parts = [_EmptyCrossings()]
+    if len(changedA):
+        near = Neighbours(first, changedA, second, np.arange(len(second)))
+        parts.append(_SubsetCrossings(first, changedA, second, near, tolerance))
+    if len(changedB):
+        near = Neighbours(second, changedB, first, np.nonzero(~firstChanged)[0])
+        parts.append(_SubsetCrossings(first, near, second, changedB, tolerance))
+    return ConcatCrossings(parts)
+
+
+# Process: Bring the crossings in "store" up to date with the current pipe
+# layers.  "layers" maps the layer names used in "pairs" to PipeLayers, and
+# each of them needs its key fields in "keyFields".  Returns an ordered dict of
+# crossing PointLayers (Intersect "ALL" schema, without the date fields) and a
+# dict of change counts per layer for logging.
+def UpdateCrossings(store, layers, pairs=CROSSING_PAIRS, keyFields=PIPE_KEYS, tolerance=XY_TOLERANCE):
+    missing = [name for name in layers if name not in keyFields]
+    if missing:
+        raise ValueError("No key fields for %s; add them to incremental.PIPE_KEYS" % ", ".join(sorted(missing)))
+    keys, stamps, changed, dirty, index, counts = {}, {}, {}, {}, {}, {}
+    for name, layer in layers.items():
+        keys[name] = PipeKeys(layer, keyFields[name])
+        stamps[name] = EditStamps(layer)
+        previous = store.PipeState(name)
+        current = dict((key, stamp) for key, stamp in zip(keys[name], stamps[name]) if key is not None)
+        changed[name] = np.array([key is None or previous.get(key) != stamp
+                                  for key, stamp in zip(keys[name], stamps[name])], dtype=bool)
+        dirty[name] = set(key for key, stamp in previous.items() if current.get(key) != stamp)
+        index[name] = dict((key, i) for i, key in enumerate(keys[name]) if key is not None)
+        counts[name] = {"added": len(set(current) - set(previous)),
+                        "modified": len([key for key in dirty[name] if key in current]),
+                        "deleted": len(set(previous) - set(current)),
+                        "untracked": int(np.sum(np.equal(keys[name], None)))}
+
+    results = collections.OrderedDict()
+    for firstName, secondName, outName in pairs:
+        first, second = layers[firstName], layers[secondName]
+        kept = _KeptCrossings(store.LoadCrossings(outName), first, second, index[firstName],
+                              index[secondName], dirty[firstName], dirty[secondName])
+        new = ChangedCrossings(first, second, changed[firstName], changed[secondName], tolerance)
+        crossings = UniqueCrossings(ConcatCrossings([kept, new]), tolerance)
+        store.SaveCrossings(outName, crossings, keys[firstName], keys[secondName], first, second)
+        results[outName] = CrossingLayer(crossings, first, second, outName, DATE_FIELDS)
+
+    for name in layers:
+        store.SavePipeState(name, keys[name], stamps[name])
+    return results, counts
@@ -0,0 +1,60 @@
+#
+# -----------------------------------------------------------------------------
+#                                 lazy.py
+#
+# PURPOSE:
+#
+# Stand-ins for modules and objects that are expensive to load, so importing
+# CalculatingUtilityCrossings.py (as every worker process does) costs nothing
+# until a stage actually needs them.  The geoprocessor, NumPy and the crossing
+# engine modules are only loaded by the first attribute lookup on their
+# stand-in:
+#
+#   engine = LazyModule("crossings.engine")     # nothing imported yet
+#   engine.IntersectLayers(...)                  # imported here, once
+#
+#   gp = LazyObject(CreateGeoprocessor)          # not created yet
+#   gp.Exists("swPipes")                         # created here, once
+#
+# Setting an attribute on a LazyObject sets it on the real object.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# None beyond the Python standard library.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import importlib
+
+
+class LazyObject(object):
+
+    # "factory" is called with no arguments the first time the object is used.
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_target", None)
+
+    def Resolve(self):
+        if self._target is None:
+            object.__setattr__(self, "_target", self._factory())
+        return self._target
+
+    def Loaded(self):
+        return self._target is not None
+
+    def __getattr__(self, name):
+        return getattr(self.Resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.Resolve(), name, value)
+
+
+class LazyModule(LazyObject):
+
+    def __init__(self, name):
+        LazyObject.__init__(self, lambda: importlib.import_module(name))
+        object.__setattr__(self, "__name__", name)
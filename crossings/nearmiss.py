@@ -0,0 +1,193 @@
+#
+# -----------------------------------------------------------------------------
+#                                 nearmiss.py
+#
+# PURPOSE:
+#
+# Near-miss search: pipes of two layers that pass within a horizontal distance
+# of each other, whether or not they cross.  A storm line running parallel to
+# a sewer 2 ft away never shows up in the crossing tables but is as much of a
+# conflict as a crossing.
+#
+# Every segment's bounding box in the first layer is grown by the search
+# distance and paired with the overlapping segment boxes of the second layer
+# through the grid in spatialindex.py, so only nearby segments are compared.
+# For each candidate pair the closest points of the two segments are found
+# exactly, and pairs within the distance are kept.  A parallel run gives one
+# entry per segment pair along it.
+#
+# NearMissLayer builds a point table like engine.CrossingLayer (FID and fields
+# of both pipes), at the midpoint of the closest approach, with
+#
+#   HorizDist                     horizontal distance between the pipes
+#   X_<first>, Y_<first>          closest point on the first pipe
+#   X_<second>, Y_<second>        closest point on the second pipe
+#
+# For sewer/storm pairs AddNearMissSeparation adds the vertsep.py fields, with
+# the inverts interpolated at each pipe's own closest point.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from crossings import vertsep
+from crossings.engine import XY_TOLERANCE, CrossingLayer
+from crossings.geometry import MakeField
+from crossings.spatialindex import OverlappingPairs
+
+NEAR_MISS_ARRAYS = ("x", "y", "first", "second", "firstVertex", "secondVertex", "firstT", "secondT",
+                    "firstX", "firstY", "secondX", "secondY", "distance")
+
+HORIZ_DIST = MakeField("HorizDist", "DOUBLE", None, "Horizontal Distance")
+
+
+# Segment pairs of two pipe layers within the search distance.  Each entry has
+# the pipe and first segment vertex in each layer, the position (0-1) of the
+# closest point along each segment, the two closest points, their midpoint
+# (x, y) and the distance between them.
+class NearMisses(object):
+
+    def __init__(self, *arrays):
+        for name, array in zip(NEAR_MISS_ARRAYS, arrays):
+            setattr(self, name, array)
+
+    def __len__(self):
+        return len(self.x)
+
+    def Take(self, indices):
+        return NearMisses(*[getattr(self, name)[indices] for name in NEAR_MISS_ARRAYS])
+
+
+def _Dot(a, b):
+    return a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1]
+
+
+# Process: Closest points of segment pairs.  "a" and "b" are the first vertex
+# of each segment in coordsA and coordsB.  Returns the position (0-1) along
+# each segment of its closest point and the distance between the points.
+def SegmentDistances(coordsA, a, coordsB, b):
+    p = coordsA[a]
+    r = coordsA[a + 1] - p
+    q = coordsB[b]
+    s = coordsB[b + 1] - q
+    w = p - q
+    rr = _Dot(r, r)
+    ss = _Dot(s, s)
+    rs = _Dot(r, s)
+    rw = _Dot(r, w)
+    sw = _Dot(s, w)
+    denom = rr * ss - rs * rs
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Closest point on the first segment to the second's line, then the
+        # second segment's point for it, each clamped to its segment and the
+        # first recomputed when the second was clamped.
+        t = np.where(denom > 1e-12 * rr * ss, np.clip((rs * sw - rw * ss) / denom, 0.0, 1.0), 0.0)
+        u = np.where(ss > 0, (rs * t + sw) / ss, 0.0)
+        low = u < 0
+        high = u > 1
+        u = np.clip(u, 0.0, 1.0)
+        t = np.where(low, np.clip(-rw / rr, 0.0, 1.0), t)
+        t = np.where(high, np.clip((rs - rw) / rr, 0.0, 1.0), t)
+    t[~np.isfinite(t)] = 0.0
+    u[~np.isfinite(u)] = 0.0
+    gap = (p + t[:, None] * r) - (q + u[:, None] * s)
+    return t, u, np.hypot(gap[:, 0], gap[:, 1])
+
+
+# Process: Every segment pair of "first" and "second" within "distance" of
+# each other.  Pairs that touch or cross (closer than "tolerance") are left
+# out unless "crossings" is True, since the crossing tables already have them.
+# The same closest approach reached from two segments sharing a vertex is
+# reported once.
+def FindNearMisses(first, second, distance, cellSize=None, tolerance=XY_TOLERANCE, crossings=False):
+    startA, pipesA = first.Segments()
+    startB, pipesB = second.Segments()
+    boxesA = first.SegmentBoxes() + np.array([-distance, -distance, distance, distance])
+    boxesB = second.SegmentBoxes()
+    candA, candB = OverlappingPairs(boxesA, boxesB, cellSize)
+
+    a = startA[candA]
+    b = startB[candB]
+    t, u, gap = SegmentDistances(first.coords, a, second.coords, b)
+    keep = gap <= distance
+    if not crossings:
+        keep &= gap > tolerance
+    a, b, t, u, gap = a[keep], b[keep], t[keep], u[keep], gap[keep]
+    pointA = first.coords[a] + t[:, None] * (first.coords[a + 1] - first.coords[a])
+    pointB = second.coords[b] + u[:, None] * (second.coords[b + 1] - second.coords[b])
+    middle = (pointA + pointB) / 2
+    found = NearMisses(middle[:, 0], middle[:, 1], pipesA[candA][keep], pipesB[candB][keep], a, b, t, u,
+                       pointA[:, 0], pointA[:, 1], pointB[:, 0], pointB[:, 1], gap)
+    return UniqueNearMisses(found, tolerance)
+
+
+# Process: Drop repeated closest approaches per pipe pair and sort by the pipe
+# indexes, then the segments, so repeated runs produce identical tables.
+def UniqueNearMisses(nearMisses, tolerance=XY_TOLERANCE):
+    if not len(nearMisses):
+        return nearMisses
+    quantized = [np.round(getattr(nearMisses, name) / tolerance).astype(np.int64)
+                 for name in ("firstX", "firstY", "secondX", "secondY")]
+    keys = [nearMisses.first, nearMisses.second] + quantized
+    byPoint = np.lexsort(tuple(keys[::-1]))
+    keys = np.column_stack(keys)[byPoint]
+    unique = np.ones(len(keys), dtype=bool)
+    unique[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+    kept = byPoint[unique]
+    order = np.lexsort((nearMisses.secondVertex[kept], nearMisses.firstVertex[kept], nearMisses.second[kept],
+                        nearMisses.first[kept]))
+    return nearMisses.Take(kept[order])
+
+
+# Process: Keep only the closest segment pair of each pipe pair.
+def ClosestPerPipePair(nearMisses):
+    if not len(nearMisses):
+        return nearMisses
+    order = np.lexsort((nearMisses.distance, nearMisses.second, nearMisses.first))
+    pairs = np.column_stack((nearMisses.first, nearMisses.second))[order]
+    unique = np.ones(len(order), dtype=bool)
+    unique[1:] = np.any(pairs[1:] != pairs[:-1], axis=1)
+    return nearMisses.Take(order[unique])
+
+
+# Process: Build the near-miss point layer with the attributes of both pipes,
+# the horizontal distance and the closest point on each pipe.
+def NearMissLayer(nearMisses, first, second, name, exclude=()):
+    layer = CrossingLayer(nearMisses, first, second, name, exclude)
+    layer.AddColumn(HORIZ_DIST, nearMisses.distance)
+    for pipes, prefix in ((first, "first"), (second, "second")):
+        for axis in ("X", "Y"):
+            layer.AddColumn(MakeField("%s_%s" % (axis, pipes.name), "DOUBLE"),
+                            getattr(nearMisses, prefix + axis))
+    return layer
+
+
+# Process: Vertical separation of sewer/storm near misses.  Each pipe's invert
+# is interpolated at its own closest point, measured along the pipe.  "first"
+# and "second" are the layers the near misses were found between, one of them
+# the sewer ("sewer" names which).
+def AddNearMissSeparation(layer, nearMisses, first, second, sewer="first"):
+    firstLength = first.Measure(nearMisses.firstVertex, nearMisses.firstT)
+    secondLength = second.Measure(nearMisses.secondVertex, nearMisses.secondT)
+    lengths = (firstLength, secondLength) if sewer == "first" else (secondLength, firstLength)
+    return vertsep.AddVerticalSeparation(layer, lengths=lengths)
+
+
+# Process: Near-miss table of two pipe layers.  With "sewer" set ("first" or
+# "second"), the vertical separation fields are added as well.
+def NearMissTable(first, second, name, distance, sewer=None, cellSize=None, exclude=(), perPipePair=False):
+    nearMisses = FindNearMisses(first, second, distance, cellSize)
+    if perPipePair:
+        nearMisses = ClosestPerPipePair(nearMisses)
+    layer = NearMissLayer(nearMisses, first, second, name, exclude)
+    if sewer is not None:
+        AddNearMissSeparation(layer, nearMisses, first, second, sewer)
+    return layer
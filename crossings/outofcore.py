@@ -0,0 +1,407 @@
+#
+# -----------------------------------------------------------------------------
+#                                 outofcore.py
+#
+# PURPOSE:
+#
+# Crossings of two pipe layers too large to hold in memory, within a memory
+# budget.  The layers are read from columnar folders (columnar.py) and only a
+# window of pipes is ever resident:
+#
+# 1. Each layer is streamed in ranges of pipes, read from the files rather
+#    than mapped, to get every pipe's bounding box.
+# 2. The area is split into quadtree tiles, visited in Morton (Z) order, a
+#    tile being split while more pipes than fit in the window have a box
+#    (grown by the tolerance) touching it.  A tile whose pipes all touch one
+#    of its quarters is not split further, so pipes that overlap too much to
+#    separate can leave a tile above the window; the log says so.  The window
+#    size follows from the budget, the memory the boxes take and the average
+#    vertices per pipe.
+# 3. Each layer is streamed again and every pipe is written to the bucket
+#    file of each tile its box touches (grown by the tolerance).
+# 4. The tiles are processed one at a time in Morton order: the two buckets
+#    are read, crossed with tiling.TileCrossings (which keeps the crossings
+#    whose point the tile owns) and the crossings are appended to spill
+#    files.  The buckets are deleted as they are used.
+# 5. The spilled crossings (with their chainage on each pipe, measured while
+#    the tile's pipes were in memory) are read back, de-duplicated and sorted
+#    like engine.FindCrossings, and the attributes of only the crossing pipes
+#    are read (columnar.ReadRows) to build the crossing table.
+#
+# The output is the same as engine.IntersectLayers on the whole layers.
+# OutOfCoreIntersect returns it with a dict of statistics, including the
+# window size, the largest tile, the spill size and the peak resident memory
+# of the run.
+#
+# Only the intersection is bounded this way.  The budget counts what the
+# process already holds when the intersection starts, but it is not a ceiling
+# for the run: the other steps of the script (upstream X,Y, validation,
+# vertical separation, near misses) still read whole layers.  From the
+# command line:
+#
+#   python -m crossings.outofcore snPipes_folder swPipes_folder --budget-mb 2000
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from crossings.columnar import ReadArrayRange, ReadRows, _ReadSchema
+from crossings.engine import XY_TOLERANCE, CROSSING_ARRAYS, Crossings, CrossingLayer, UniqueCrossings
+from crossings.geometry import PipeLayer
+from crossings.gpkg import WriteGeoPackage
+from crossings.spatialindex import OverlappingPairs
+from crossings.tiling import TileCrossings
+from crossings.tracing import PeakRssMB, RssMB
+
+# Bits per axis of the Morton keys, and so the deepest quadtree level.
+MORTON_BITS = 16
+
+# Working memory per vertex of a tile while its crossings are found (the
+# segment boxes, grid entries and candidate pairs of engine.FindCrossings).
+BYTES_PER_VERTEX = 400
+
+# Memory per pipe held for the whole run: the box and the pipeParts offsets,
+# plus the index lists and masks of the quadtree split.
+BYTES_PER_PIPE = 64
+
+# Smallest window, however tight the budget.
+MIN_WINDOW_PIPES = 1000
+
+PIPE_RECORD = 3  # original pipe index, original first vertex, part count
+
+# Spill files of the chainage of each crossing on the first and second pipe.
+MEASURE_SPILLS = ("firstMeasure", "secondMeasure")
+
+
+def _Compact(values):
+    values = values.astype(np.uint64) & np.uint64(0x55555555)
+    values = (values | (values >> np.uint64(1))) & np.uint64(0x33333333)
+    values = (values | (values >> np.uint64(2))) & np.uint64(0x0F0F0F0F)
+    values = (values | (values >> np.uint64(4))) & np.uint64(0x00FF00FF)
+    values = (values | (values >> np.uint64(8))) & np.uint64(0x0000FFFF)
+    return values
+
+
+# Process: Box of the quadtree tile with Morton code "prefix" at "level" of
+# the square (xmin, ymin, side).
+def _TileBox(level, prefix, square):
+    xmin, ymin, side = square
+    tx = int(_Compact(np.array([prefix]))[0])
+    ty = int(_Compact(np.array([prefix >> 1]))[0])
+    size = side / 2 ** level
+    return xmin + tx * size, ymin + ty * size, xmin + (tx + 1) * size, ymin + (ty + 1) * size
+
+
+# Process: Indexes of the boxes in "inside" that touch "tile" grown by the
+# tolerance, the same test _FillBuckets buckets the pipes with.
+def _Touching(boxes, inside, tile, tolerance):
+    touching = boxes[inside, 0] <= tile[2] + tolerance
+    touching &= boxes[inside, 2] >= tile[0] - tolerance
+    touching &= boxes[inside, 1] <= tile[3] + tolerance
+    touching &= boxes[inside, 3] >= tile[1] - tolerance
+    return inside[touching]
+
+
+# Process: Quadtree tiles along Morton order.  "boxes" are the pipe boxes of
+# both layers; a tile is split while more than "maxPipes" of them touch it
+# (within the tolerance), unless one of its quarters would still hold them
+# all.  Returns the (ntiles, 4) tile boxes in Morton order, which together
+# cover the square exactly, and the number of pipes touching each tile.
+def MortonTiles(boxes, square, maxPipes, tolerance=0.0, bits=MORTON_BITS):
+    tiles, counts = [], []
+    inside = _Touching(boxes, np.arange(len(boxes)), _TileBox(0, 0, square), tolerance)
+    pending = [(0, 0, inside)]
+    while pending:
+        level, prefix, inside = pending.pop()
+        if len(inside) > maxPipes and level < bits:
+            children = []
+            for child in (0, 1, 2, 3):
+                childPrefix = (prefix << 2) + child
+                tile = _TileBox(level + 1, childPrefix, square)
+                children.append((level + 1, childPrefix, _Touching(boxes, inside, tile, tolerance)))
+            if max(len(child[2]) for child in children) < len(inside):
+                pending.extend(reversed(children))
+                continue
+        tiles.append(_TileBox(level, prefix, square))
+        counts.append(len(inside))
+    return np.array(tiles, dtype=np.float64).reshape(-1, 4), np.array(counts, dtype=np.int64)
+
+
+# Sequential reader of a pipe layer in a columnar folder.  Only the pipeParts
+# offsets are held; each range of pipes is read from the files when asked for.
+class PipeStream(object):
+
+    def __init__(self, folder):
+        self.folder = folder
+        schema = _ReadSchema(folder)
+        self.name = schema["name"]
+        self.count = schema["count"]
+        self.pipeParts = ReadArrayRange(self._Path("pipeParts"), 0, self.count + 1)
+        partCount = self.pipeParts[-1] if len(self.pipeParts) else 0
+        last = ReadArrayRange(self._Path("partOffsets"), partCount, partCount + 1)
+        self.vertices = int(last[0]) if len(last) else 0
+
+    def _Path(self, name):
+        return os.path.join(self.folder, name + ".npy")
+
+    # Process: Pipes start:stop as a PipeLayer, with the index of the first
+    # vertex of the range in the whole layer.
+    def Range(self, start, stop):
+        pipeParts = self.pipeParts[start:stop + 1]
+        partOffsets = ReadArrayRange(self._Path("partOffsets"), pipeParts[0], pipeParts[-1] + 1)
+        coords = ReadArrayRange(self._Path("coords"), partOffsets[0], partOffsets[-1])
+        layer = PipeLayer(self.name, coords, partOffsets - partOffsets[0], pipeParts - pipeParts[0])
+        return layer, int(partOffsets[0])
+
+    def Ranges(self, windowPipes):
+        for start in range(0, self.count, windowPipes):
+            stop = min(start + windowPipes, self.count)
+            layer, firstVertex = self.Range(start, stop)
+            yield start, layer, firstVertex
+
+
+def _Boxes(stream, windowPipes):
+    boxes = np.empty((stream.count, 4))
+    for start, layer, firstVertex in stream.Ranges(windowPipes):
+        boxes[start:start + len(layer)] = layer.PipeBoxes()
+    return boxes
+
+
+def _Square(boxSets, tolerance):
+    boxSets = [boxes for boxes in boxSets if len(boxes) and not np.isnan(boxes[:, 0]).all()]
+    if not boxSets:
+        return 0.0, 0.0, 1.0
+    xmin = min(np.nanmin(boxes[:, 0]) for boxes in boxSets)
+    ymin = min(np.nanmin(boxes[:, 1]) for boxes in boxSets)
+    xmax = max(np.nanmax(boxes[:, 2]) for boxes in boxSets)
+    ymax = max(np.nanmax(boxes[:, 3]) for boxes in boxSets)
+    side = max(xmax - xmin, ymax - ymin, 1.0)
+    # Grown on the upper sides so points on the far edge belong to a tile.
+    return xmin, ymin, side * (1 + 1e-9) + 2 * tolerance
+
+
+def _BucketPath(spillFolder, layerIndex, tile, kind):
+    return os.path.join(spillFolder, "tile%06d_%d.%s" % (tile, layerIndex, kind))
+
+
+def _Append(path, array):
+    with open(path, "ab") as output:
+        np.ascontiguousarray(array).tofile(output)
+
+
+# Process: Write every pipe of a stream to the buckets of the tiles its box
+# touches.  Returns the bytes written.
+def _FillBuckets(stream, layerIndex, boxes, tiles, tolerance, windowPipes, spillFolder):
+    grown = tiles + np.array([-tolerance, -tolerance, tolerance, tolerance])
+    sides = tiles[:, 2] - tiles[:, 0]
+    cellSize = max(float(np.median(sides)), float(sides.max()) / 1024)
+    written = 0
+    for start, layer, firstVertex in stream.Ranges(windowPipes):
+        chunkBoxes = boxes[start:start + len(layer)]
+        valid = np.nonzero(~np.isnan(chunkBoxes).any(axis=1))[0]
+        pipes, tileIndex = OverlappingPairs(chunkBoxes[valid], grown, cellSize)
+        pipes = valid[pipes]
+        order = np.lexsort((pipes, tileIndex))
+        pipes, tileIndex = pipes[order], tileIndex[order]
+        bounds = np.nonzero(np.diff(tileIndex))[0] + 1
+        for group in np.split(np.arange(len(pipes)), bounds):
+            if not len(group):
+                continue
+            tile = int(tileIndex[group[0]])
+            sub = layer.Take(pipes[group])
+            records = np.column_stack((start + pipes[group],
+                                       firstVertex + layer.partOffsets[layer.pipeParts[pipes[group]]],
+                                       np.diff(sub.pipeParts))).astype(np.int64)
+            parts = np.diff(sub.partOffsets).astype(np.int64)
+            _Append(_BucketPath(spillFolder, layerIndex, tile, "pipes"), records)
+            _Append(_BucketPath(spillFolder, layerIndex, tile, "parts"), parts)
+            _Append(_BucketPath(spillFolder, layerIndex, tile, "coords"), sub.coords)
+            written += records.nbytes + parts.nbytes + sub.coords.nbytes
+    return written
+
+
+def _FromFile(path, dtype):
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=dtype)
+    return np.fromfile(path, dtype=dtype)
+
+
+# Process: Read and delete a tile's bucket.  Returns the pipes as a PipeLayer
+# and their (original index, original first vertex, parts) records.
+def _ReadBucket(spillFolder, layerIndex, tile, name):
+    paths = [_BucketPath(spillFolder, layerIndex, tile, kind) for kind in ("pipes", "parts", "coords")]
+    records = _FromFile(paths[0], np.int64).reshape(-1, PIPE_RECORD)
+    parts = _FromFile(paths[1], np.int64)
+    coords = _FromFile(paths[2], np.float64).reshape(-1, 2)
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    partOffsets = np.concatenate(([0], np.cumsum(parts))).astype(np.int64)
+    pipeParts = np.concatenate(([0], np.cumsum(records[:, 2]))).astype(np.int64)
+    return PipeLayer(name, coords, partOffsets, pipeParts), records
+
+
+# Process: Pipe and vertex indexes of a tile's crossings, from the bucket
+# layers back to the whole layers.
+def _Remap(crossings, subA, recordsA, subB, recordsB):
+    for sub, records, pipeName, vertexName in ((subA, recordsA, "first", "firstVertex"),
+                                               (subB, recordsB, "second", "secondVertex")):
+        pipes = getattr(crossings, pipeName)
+        local = getattr(crossings, vertexName) - sub.partOffsets[sub.pipeParts[pipes]]
+        setattr(crossings, vertexName, records[pipes, 1] + local)
+        setattr(crossings, pipeName, records[pipes, 0])
+    return crossings
+
+
+# Process: Pipes per window for a memory budget.  "baselineMB" is the memory
+# the process holds already: its resident memory now by default (the peak on
+# platforms that only report that), so memory earlier stages in the same
+# process have freed is not counted.  Raises MemoryError when the budget does
+# not even cover the per-pipe bookkeeping, and logs a warning when it is
+# raised to MIN_WINDOW_PIPES, which then can exceed the budget.
+def WindowPipes(streams, budgetMB, baselineMB=None, log=None):
+    log = log or (lambda message: None)
+    if baselineMB is None:
+        baselineMB = RssMB()
+        baselineMB = PeakRssMB() if baselineMB is None else baselineMB
+    pipes = sum(stream.count for stream in streams)
+    vertices = sum(stream.vertices for stream in streams)
+    held = (baselineMB or 0) * 1024 * 1024 + pipes * BYTES_PER_PIPE
+    available = budgetMB * 1024 * 1024 - held
+    if available <= 0:
+        raise MemoryError("A memory budget of %d MB is below the %d MB needed before any pipes are read" %
+                          (budgetMB, held // (1024 * 1024) + 1))
+    perPipe = BYTES_PER_VERTEX * max(vertices / max(pipes, 1), 2.0)
+    windowPipes = int(available / perPipe)
+    if windowPipes < MIN_WINDOW_PIPES:
+        log("Warning: a %d MB budget leaves room for a window of %d pipes; using the minimum of %d, which can "
+            "exceed the budget by about %d MB" % (budgetMB, windowPipes, MIN_WINDOW_PIPES,
+                                                   (MIN_WINDOW_PIPES - windowPipes) * perPipe // (1024 * 1024) + 1))
+        windowPipes = MIN_WINDOW_PIPES
+    return windowPipes
+
+
+# Process: Crossings of the pipe layers in two columnar folders within about
+# "budgetMB" of resident memory.  Spill files go in "spillFolder" (a new
+# temporary folder by default, removed afterwards).  Returns the Crossings,
+# sorted like engine.FindCrossings, and the run statistics.
+def OutOfCoreCrossings(firstFolder, secondFolder, budgetMB, spillFolder=None, tolerance=XY_TOLERANCE,
+                       cellSize=None, log=None):
+    log = log or (lambda message: None)
+    removeSpill = spillFolder is None
+    spillFolder = spillFolder or tempfile.mkdtemp(prefix="crossings_spill_")
+    if not os.path.isdir(spillFolder):
+        os.makedirs(spillFolder)
+    try:
+        streams = [PipeStream(firstFolder), PipeStream(secondFolder)]
+        windowPipes = WindowPipes(streams, budgetMB, log=log)
+        log("Window of %d pipes for a %d MB budget" % (windowPipes, budgetMB))
+
+        # The boxes of both layers in one array, each layer's a view of it.
+        boxes = np.concatenate([_Boxes(stream, windowPipes) for stream in streams])
+        boxSets = [boxes[:streams[0].count], boxes[streams[0].count:]]
+        square = _Square(boxSets, tolerance)
+        tiles, tilePipes = MortonTiles(boxes, square, windowPipes, tolerance)
+        del boxes
+        largest = int(tilePipes.max()) if len(tilePipes) else 0
+        log("%d tiles, the largest touched by %d pipes" % (len(tiles), largest))
+        if largest > windowPipes:
+            log("Warning: %d tiles are touched by more than the window of %d pipes; their pipes overlap too much "
+                "to split, so those tiles can exceed the budget" % (np.count_nonzero(tilePipes > windowPipes),
+                                                                      windowPipes))
+
+        spilled = 0
+        for layerIndex, (stream, boxes) in enumerate(zip(streams, boxSets)):
+            spilled += _FillBuckets(stream, layerIndex, boxes, tiles, tolerance, windowPipes, spillFolder)
+        del boxSets
+        log("%.1f MB of pipes written to tile buckets" % (spilled / (1024.0 * 1024.0)))
+
+        found = 0
+        for tile in range(len(tiles)):
+            subA, recordsA = _ReadBucket(spillFolder, 0, tile, streams[0].name)
+            subB, recordsB = _ReadBucket(spillFolder, 1, tile, streams[1].name)
+            if not len(subA) or not len(subB):
+                continue
+            crossings = TileCrossings(subA, subB, tiles[tile], tolerance=tolerance, cellSize=cellSize)
+            # The buckets hold whole pipes, so the chainage is measured here,
+            # while the geometry is in memory.
+            measures = (subA.Measure(crossings.firstVertex, crossings.firstT),
+                        subB.Measure(crossings.secondVertex, crossings.secondT))
+            crossings = _Remap(crossings, subA, recordsA, subB, recordsB)
+            for name in CROSSING_ARRAYS:
+                _Append(os.path.join(spillFolder, "crossings." + name), getattr(crossings, name))
+            for name, values in zip(MEASURE_SPILLS, measures):
+                _Append(os.path.join(spillFolder, "crossings." + name), values)
+            found += len(crossings)
+
+        arrays = []
+        for name in CROSSING_ARRAYS:
+            dtype = np.float64 if name in ("x", "y", "firstT", "secondT") else np.int64
+            arrays.append(_FromFile(os.path.join(spillFolder, "crossings." + name), dtype))
+        crossings = Crossings(*arrays)
+        crossings.measures = tuple(_FromFile(os.path.join(spillFolder, "crossings." + name), np.float64)
+                                   for name in MEASURE_SPILLS)
+        crossings = UniqueCrossings(crossings, tolerance)
+    finally:
+        if removeSpill:
+            shutil.rmtree(spillFolder, ignore_errors=True)
+
+    stats = collections.OrderedDict([
+        ("pipes", sum(stream.count for stream in streams)), ("vertices", sum(stream.vertices for stream in streams)),
+        ("budgetMB", budgetMB), ("windowPipes", windowPipes), ("tiles", len(tiles)), ("largestTilePipes", largest),
+        ("spillMB", round(spilled / (1024.0 * 1024.0), 1)), ("crossings", len(crossings)),
+        ("peakRssMB", PeakRssMB())])
+    return crossings, stats
+
+
+# Process: Out-of-core equivalent of engine.IntersectLayers for two columnar
+# folders.  Returns the crossing point layer and the run statistics.
+def OutOfCoreIntersect(firstFolder, secondFolder, name, budgetMB, spillFolder=None, tolerance=XY_TOLERANCE,
+                       cellSize=None, exclude=(), log=None):
+    crossings, stats = OutOfCoreCrossings(firstFolder, secondFolder, budgetMB, spillFolder, tolerance, cellSize,
+                                          log)
+    # Only the crossing pipes' attributes are read, into small tables the
+    # crossings are re-indexed against.
+    pipesA, crossings.first = np.unique(crossings.first, return_inverse=True)
+    pipesB, crossings.second = np.unique(crossings.second, return_inverse=True)
+    first = ReadRows(firstFolder, pipesA)
+    second = ReadRows(secondFolder, pipesB)
+    points = CrossingLayer(crossings, first, second, name, exclude)
+    stats["peakRssMB"] = PeakRssMB()
+    return points, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find the crossings of two columnar pipe layers within a memory "
+                                                 "budget.")
+    parser.add_argument("first", help="columnar folder of the first pipe layer")
+    parser.add_argument("second", help="columnar folder of the second pipe layer")
+    parser.add_argument("--budget-mb", type=float, required=True)
+    parser.add_argument("--name", default="Crossings")
+    parser.add_argument("--spill", help="folder for the spill files (a temporary folder by default)")
+    parser.add_argument("--output", help="GeoPackage to write the crossings to")
+    args = parser.parse_args(argv)
+    points, stats = OutOfCoreIntersect(args.first, args.second, args.name, args.budget_mb, args.spill,
+                                       log=print)
+    if args.output:
+        WriteGeoPackage(args.output, points)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#
+# -----------------------------------------------------------------------------
+#                                 output.py
+#
+# PURPOSE:
+#
+# One fixed schema for AllIntersections, written to as a stream by each of the
+# pairwise crossing tables instead of merging the three tables and deleting
+# the duplicated fields the merge leaves behind.
+#
+# ALL_INTERSECTIONS_FIELDS is built from the field maps (fieldmap.py) and the
+# vertical separation fields (vertsep.py, uncertainty.py), so it follows them
+# when they change:
+#
+#   InterType
+#   FID_snPipes, the sewer fields, SSUpX, SSUpY
+#   the storm fields, SWUpX, SWUpY
+#   the water fields
+#   the vertical separation fields (SWSS crossings only)
+#   PConflict, VertSepLo, VertSepHi (SWSS crossings, when estimated)
+#
+# UtilType and the edit dates are left out, as the old clean-up did.  A
+# crossing table is written by taking each of these fields it has, by name,
+# and leaving the others NULL, so a Water-Storm crossing has no sewer values.
+#
+# CrossingWriter sends the rows on in chunks to a sink with an Append(layer)
+# and Close() method: LayerSink keeps them in memory, GeoPackageSink writes
+# them to a GeoPackage table, and arcgis.PointSink to a feature class.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import sqlite3
+
+import numpy as np
+
+from crossings import fieldmap, uncertainty, vertsep
+from crossings.geometry import MakeField, MergeLayers, NullColumn, PointLayer
+from crossings.gpkg import CreateFeatureTable, InsertFeatures
+
+INTER_TYPE = MakeField("InterType", "TEXT", 50, "Intersection Type")
+
+# Fields of the pipe layers that are not carried into AllIntersections.
+DROPPED_FIELDS = ("UtilType",) + tuple(entry.field.name for entry in fieldmap.DATE_ENTRIES)
+
+# Rows sent to the sink at a time.
+CHUNK_ROWS = 50000
+
+
+def _PipeFields(mapName):
+    return [field for field in fieldmap.FIELD_MAPS[mapName].Fields() if field.name not in DROPPED_FIELDS]
+
+
+ALL_INTERSECTIONS_FIELDS = (
+    [INTER_TYPE, MakeField("FID_snPipes", "LONG")] + _PipeFields("snGravity") +
+    [MakeField("SSUpX", "DOUBLE"), MakeField("SSUpY", "DOUBLE")] +
+    _PipeFields("swPipes") + [MakeField("SWUpX", "DOUBLE"), MakeField("SWUpY", "DOUBLE")] +
+    _PipeFields("wnGravity") + vertsep.DERIVED_FIELDS + uncertainty.UNCERTAINTY_FIELDS)
+
+
+# Process: Columns of "layer" in the canonical schema.  Fields the layer does
+# not have are NULL.
+def CanonicalLayer(layer, fields=ALL_INTERSECTIONS_FIELDS, name="AllIntersections"):
+    columns = {}
+    for field in fields:
+        if field.name in layer.columns:
+            columns[field.name] = layer.columns[field.name]
+        else:
+            columns[field.name] = NullColumn(field.type, len(layer))
+    return PointLayer(name, layer.x, layer.y, fields, columns, layer.oids)
+
+
+class CrossingWriter(object):
+
+    def __init__(self, sink, fields=ALL_INTERSECTIONS_FIELDS, chunkRows=CHUNK_ROWS):
+        self.sink = sink
+        self.fields = list(fields)
+        self.chunkRows = chunkRows
+        self.count = 0
+
+    # Process: Write one crossing table (a PointLayer).  Returns the rows written.
+    def Write(self, layer):
+        for start in range(0, len(layer), self.chunkRows):
+            chunk = layer.Take(np.arange(start, min(start + self.chunkRows, len(layer))))
+            self.sink.Append(CanonicalLayer(chunk, self.fields))
+        self.count += len(layer)
+        return len(layer)
+
+    def Close(self):
+        self.sink.Close()
+        return self.count
+
+
+class LayerSink(object):
+
+    def __init__(self, name="AllIntersections", fields=ALL_INTERSECTIONS_FIELDS):
+        self.name = name
+        self.fields = list(fields)
+        self.chunks = []
+        self.layer = None
+
+    def Append(self, layer):
+        self.chunks.append(layer)
+
+    def Close(self):
+        if self.chunks:
+            self.layer = MergeLayers(self.name, self.chunks)
+        else:
+            self.layer = PointLayer(self.name, [], [], self.fields)
+
+
+# Appends to a GeoPackage table created (or replaced) when the sink is made.
+# Rows are committed as they are written.
+class GeoPackageSink(object):
+
+    def __init__(self, path, table="AllIntersections", fields=ALL_INTERSECTIONS_FIELDS, srsId=0,
+                 srsDefinition=None):
+        self.table = table
+        self.srsId = srsId
+        self.connection = sqlite3.connect(path)
+        CreateFeatureTable(self.connection, table, fields, True, srsId, srsDefinition)
+        self.connection.commit()
+
+    def Append(self, layer):
+        InsertFeatures(self.connection, self.table, layer, self.srsId, keepOids=False)
+        self.connection.commit()
+
+    def Close(self):
+        self.connection.close()
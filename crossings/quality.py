@@ -0,0 +1,167 @@
+#
+# -----------------------------------------------------------------------------
+#                                 quality.py
+#
+# PURPOSE:
+#
+# Data-quality checks on the storm, sewer and water pipes, run once when the
+# pipes are loaded.  Every rule is an array expression over a whole layer and
+# sets one bit of a per-pipe flag word, so a pipe's problems are one small
+# integer (the SWQAFlags, SnQAFlags and WnQAFlags fields) that later steps use
+# as a mask instead of selecting the bad rows again rule by rule:
+#
+#   UP_SENTINEL, DN_SENTINEL    invert is a placeholder (0, or -9999 for storm
+#                               and water)
+#   UP_MISSING, DN_MISSING      invert is NULL
+#   INVERSE_SLOPE               downstream invert above the upstream invert
+#                               (gravity pipes only, not sewer force mains)
+#   ZERO_LENGTH                 pipe geometry has no length
+#   NO_GEOMETRY                 pipe has fewer than two vertices
+#   DIAMETER_SENTINEL           diameter is -9999
+#   DIAMETER_MISSING            diameter is NULL, 0 or negative
+#
+#   flags = ValidateLayer(pipes, "swPipes")
+#   bad = Mask(flags, UP_SENTINEL | UP_MISSING)
+#   summary = Summary(flags, "swPipes")
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+
+import numpy as np
+
+from crossings.geometry import MakeField
+
+UP_SENTINEL = 1
+DN_SENTINEL = 2
+UP_MISSING = 4
+DN_MISSING = 8
+INVERSE_SLOPE = 16
+ZERO_LENGTH = 32
+NO_GEOMETRY = 64
+DIAMETER_SENTINEL = 128
+DIAMETER_MISSING = 256
+
+# Rule names in the QA report, in bit order.
+RULES = collections.OrderedDict([
+    (UP_SENTINEL, "up_invert_sentinel"),
+    (DN_SENTINEL, "down_invert_sentinel"),
+    (UP_MISSING, "up_invert_missing"),
+    (DN_MISSING, "down_invert_missing"),
+    (INVERSE_SLOPE, "inverse_slope"),
+    (ZERO_LENGTH, "zero_length"),
+    (NO_GEOMETRY, "no_geometry"),
+    (DIAMETER_SENTINEL, "diameter_sentinel"),
+    (DIAMETER_MISSING, "diameter_missing")])
+
+DIAMETER_PLACEHOLDER = -9999
+
+# The checked fields of one pipe layer.  "pressureTypes" are the UtilType
+# values of pipes under pressure, which have no slope to check; "gravity" is
+# False when the whole utility is under pressure.
+Utility = collections.namedtuple(
+    "Utility", "name flagField upInvert dnInvert diameter invertPlaceholders gravity pressureTypes")
+
+# The sewer placeholders are those vertsep.py nulls at the storm/sewer
+# crossings.
+UTILITIES = collections.OrderedDict((layer, utility) for layer, utility in [
+    ("swPipes", Utility("storm", "SWQAFlags", "SWUpinvert", "SWDninvert", "SWDiam", (0, -9999), True, ())),
+    ("snPipes", Utility("sewer", "SnQAFlags", "SnUpinvert", "SnDninvert", "SnDiam", (0,), True, ("snForce",))),
+    ("wnPipes", Utility("water", "WnQAFlags", "WnUpinvert", "WnDninvert", "WnDiam", (0, -9999), False, ()))])
+
+
+def FlagField(layerName):
+    return MakeField(UTILITIES[layerName].flagField, "SHORT", None, "QA Flags")
+
+
+# Process: Flag words as uint16, whatever they were stored as (the column
+# files keep numbers as float64).  NULL is no flags.
+def Flags(values):
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        values = np.where(np.isnan(values), 0, values)
+    elif values.dtype == object:
+        values = np.array([0 if value is None else value for value in values], dtype=np.float64)
+    return values.astype(np.uint16)
+
+
+# Process: Rows of "flags" with any of the bits in "rules" set.
+def Mask(flags, rules):
+    return (Flags(flags) & rules) != 0
+
+
+def _Numbers(layer, name):
+    if name not in layer.columns:
+        return np.full(len(layer), np.nan)
+    return np.asarray(layer.columns[name], dtype=np.float64)
+
+
+def _Set(flags, rule, mask):
+    flags[mask] |= rule
+
+
+# Process: Flag word of every pipe of a layer ("swPipes", "snPipes" or
+# "wnPipes" in UTILITIES).  Fields the layer does not have count as NULL.
+def ValidateLayer(layer, layerName):
+    utility = UTILITIES[layerName]
+    flags = np.zeros(len(layer), dtype=np.uint16)
+
+    up = _Numbers(layer, utility.upInvert)
+    dn = _Numbers(layer, utility.dnInvert)
+    upSentinel = np.isin(up, utility.invertPlaceholders)
+    dnSentinel = np.isin(dn, utility.invertPlaceholders)
+    _Set(flags, UP_SENTINEL, upSentinel)
+    _Set(flags, DN_SENTINEL, dnSentinel)
+    _Set(flags, UP_MISSING, np.isnan(up))
+    _Set(flags, DN_MISSING, np.isnan(dn))
+
+    if utility.gravity:
+        gravity = np.ones(len(layer), dtype=bool)
+        if utility.pressureTypes and "UtilType" in layer.columns:
+            gravity = ~np.isin(np.asarray(layer.columns["UtilType"], dtype=object), utility.pressureTypes)
+        valid = ~(upSentinel | dnSentinel) & ~np.isnan(up) & ~np.isnan(dn)
+        _Set(flags, INVERSE_SLOPE, gravity & valid & (dn > up))
+
+    vertices = np.bincount(layer.PartPipes()[layer.VertexParts()], minlength=len(layer))
+    noGeometry = vertices < 2
+    _Set(flags, NO_GEOMETRY, noGeometry)
+    _Set(flags, ZERO_LENGTH, ~noGeometry & (layer.Lengths() <= 0))
+
+    diameter = _Numbers(layer, utility.diameter)
+    sentinel = diameter == DIAMETER_PLACEHOLDER
+    _Set(flags, DIAMETER_SENTINEL, sentinel)
+    with np.errstate(invalid="ignore"):
+        _Set(flags, DIAMETER_MISSING, ~sentinel & (np.isnan(diameter) | (diameter <= 0)))
+    return flags
+
+
+# Process: Pipes caught by each rule, and in total, for the QA report.
+def Summary(flags, layerName):
+    flags = Flags(flags)
+    count = len(flags)
+    percent = lambda pipes: round(100.0 * pipes / count, 3) if count else 0.0
+    rules = collections.OrderedDict()
+    for rule, name in RULES.items():
+        pipes = int(np.count_nonzero(flags & rule))
+        rules[name] = {"pipes": pipes, "percent": percent(pipes)}
+    flagged = int(np.count_nonzero(flags))
+    return collections.OrderedDict([("layer", layerName), ("utility", UTILITIES[layerName].name),
+                                    ("pipes", count), ("flagged", flagged), ("percent", percent(flagged)),
+                                    ("rules", rules)])
+
+
+# Process: One log line per utility from Summary, listing the rules that
+# caught any pipe.
+def SummaryLine(summary):
+    caught = ["%s %d (%.1f%%)" % (name, rule["pipes"], rule["percent"])
+              for name, rule in summary["rules"].items() if rule["pipes"]]
+    return "%s: %d of %d pipes flagged%s" % (summary["utility"], summary["flagged"], summary["pipes"],
+                                            "; " + ", ".join(caught) if caught else "")
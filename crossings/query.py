@@ -0,0 +1,416 @@
+#
+# -----------------------------------------------------------------------------
+#                                 query.py
+#
+# PURPOSE:
+#
+# Long-running lookup service over the latest AllIntersections, so field and
+# permitting staff can ask "what crosses near here" or "every crossing on
+# sewer SnFID X" without opening the whole layer.
+#
+# CrossingIndex holds one loaded crossing table with
+#
+#   a uniform grid over the points (the cell keys of spatialindex.Grid,
+#   sorted, so the points of one column of cells are one slice)
+#   a hash index (dict) on each of SnFID, SWFID and WnFID
+#
+# and answers bounding-box, radius, nearest-k and by-facility queries.  It is
+# never changed once built.  CrossingService keeps the current index and
+# swaps in a new one when the source changes: the new index is built beside
+# the old one, which keeps answering until the swap, so there is no downtime.
+# Watch polls the source's modification time and reloads it.
+#
+# The source is a GeoPackage table (the script's PublishIntersections writes
+# one each night), a columnar folder (columnar.py) or a PointLayer.  Run
+#
+#   python -m crossings.query C:/TEMP/Crossings/AllIntersections.gpkg --port 8642
+#
+# for a local HTTP endpoint returning JSON:
+#
+#   /bbox?xmin=&ymin=&xmax=&ymax=     crossings in a box
+#   /radius?x=&y=&r=                  crossings within r feet, nearest first
+#   /nearest?x=&y=&k=                 the k nearest crossings
+#   /facility?field=SnFID&value=      crossings on one pipe
+#   /status                           source, row count and load time
+#   /reload                           reload the source now
+#
+# Every query takes "limit" (rows returned) and "fields" (comma separated).
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+import numpy as np
+
+from crossings.columnar import SCHEMA, ReadColumnar
+from crossings.geometry import PointLayer, Ranges
+from crossings.gpkg import ReadGeoPackagePoints
+from crossings.spatialindex import Grid
+
+TABLE = "AllIntersections"
+
+# Fields given a hash index when the table has them.
+FACILITY_FIELDS = ("SnFID", "SWFID", "WnFID")
+
+# Points per grid cell the default cell size aims for.
+POINTS_PER_CELL = 4.0
+
+# Rows returned by an HTTP query unless "limit" says otherwise.
+DEFAULT_LIMIT = 1000
+
+
+# Process: Read a crossing table from a GeoPackage path, a columnar folder or
+# a PointLayer.
+def ReadCrossings(source, table=TABLE):
+    if isinstance(source, PointLayer):
+        return source
+    if os.path.isdir(source):
+        return ReadColumnar(source)
+    return ReadGeoPackagePoints(source, table)
+
+
+def _FacilityKey(value):
+    if value is None:
+        return None
+    if isinstance(value, (float, np.floating)):
+        if value != value:
+            return None
+        if value == int(value):
+            return "%d" % value
+    key = (u"%s" % (value,)).strip()
+    return key or None
+
+
+def _JsonValue(value):
+    if isinstance(value, (float, np.floating)):
+        return None if value != value else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+class CrossingIndex(object):
+
+    # "version" is the service's load count when this index was swapped in.
+    def __init__(self, layer, cellSize=None, source=None, version=0):
+        self.layer = layer
+        self.source = source
+        self.version = version
+        self.loaded = time.time()
+        x, y = layer.x, layer.y
+        valid = np.nonzero(~(np.isnan(x) | np.isnan(y)))[0]
+        if len(valid):
+            self.extent = (x[valid].min(), y[valid].min(), x[valid].max(), y[valid].max())
+            xmin, ymin, xmax, ymax = self.extent
+            area = max((xmax - xmin) * (ymax - ymin), 1.0)
+            cellSize = cellSize or max(np.sqrt(area * POINTS_PER_CELL / len(valid)), 1.0)
+        else:
+            self.extent = None
+            xmin, ymin = 0.0, 0.0
+            cellSize = cellSize or 1.0
+        self.grid = Grid((xmin, ymin), cellSize)
+        ix, iy = self.grid.Cell(x[valid], y[valid])
+        self.maxCell = (int(ix.max()) if len(ix) else -1, int(iy.max()) if len(iy) else -1)
+        keys = self.grid.Key(ix, iy)
+        order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[order]
+        self.rows = valid[order]
+
+        self.facilities = {}
+        for name in FACILITY_FIELDS:
+            if name not in layer.columns:
+                continue
+            groups = collections.defaultdict(list)
+            for row, value in enumerate(layer.columns[name]):
+                key = _FacilityKey(value)
+                if key is not None:
+                    groups[key].append(row)
+            self.facilities[name] = dict((key, np.array(rows, dtype=np.int64)) for key, rows in groups.items())
+
+    def __len__(self):
+        return len(self.layer)
+
+    # Process: Rows of the crossings inside a box (edges included), in row
+    # order.
+    def BBox(self, xmin, ymin, xmax, ymax):
+        if xmax < xmin or ymax < ymin or not len(self.rows):
+            return np.zeros(0, dtype=np.int64)
+        ix0, iy0 = self.grid.Cell(xmin, ymin)
+        ix1, iy1 = self.grid.Cell(xmax, ymax)
+        ix0, iy0 = max(int(ix0), 0), max(int(iy0), 0)
+        ix1, iy1 = min(int(ix1), self.maxCell[0]), min(int(iy1), self.maxCell[1])
+        if ix1 < ix0 or iy1 < iy0:
+            return np.zeros(0, dtype=np.int64)
+        columns = np.arange(ix0, ix1 + 1, dtype=np.int64)
+        lo = np.searchsorted(self.keys, self.grid.Key(columns, iy0), "left")
+        hi = np.searchsorted(self.keys, self.grid.Key(columns, iy1), "right")
+        rows = self.rows[Ranges(lo, hi - lo)]
+        x, y = self.layer.x[rows], self.layer.y[rows]
+        return np.sort(rows[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)])
+
+    # Process: Rows and distances of the crossings within "radius" of a point,
+    # nearest first.
+    def Radius(self, x, y, radius):
+        rows = self.BBox(x - radius, y - radius, x + radius, y + radius)
+        distance = np.hypot(self.layer.x[rows] - x, self.layer.y[rows] - y)
+        keep = distance <= radius
+        rows, distance = rows[keep], distance[keep]
+        order = np.lexsort((rows, distance))
+        return rows[order], distance[order]
+
+    # Process: Rows and distances of the k crossings nearest a point.  The
+    # search radius starts where k crossings would be at the average density
+    # and doubles until k crossings are in it (or it covers every crossing).
+    def Nearest(self, x, y, k):
+        if k <= 0 or self.extent is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        xmin, ymin, xmax, ymax = self.extent
+        farthest = max(abs(xmin - x), abs(xmax - x)) + max(abs(ymin - y), abs(ymax - y))
+        radius = self.grid.cellSize * max(np.sqrt(k / POINTS_PER_CELL), 1.0)
+        while True:
+            rows, distance = self.Radius(x, y, radius)
+            if len(rows) >= k or radius > farthest:
+                return rows[:k], distance[:k]
+            radius *= 2
+
+    # Process: Rows of the crossings on one pipe, by facility ID.
+    def Facility(self, field, value):
+        if field not in self.facilities:
+            raise KeyError("No facility index on %s; indexed fields are %s" %
+                           (field, ", ".join(sorted(self.facilities)) or "none"))
+        return self.facilities[field].get(_FacilityKey(value), np.zeros(0, dtype=np.int64))
+
+    # Process: Crossings as JSON-ready dicts.  "fields" restricts the
+    # attributes returned.
+    def Records(self, rows, fields=None, distance=None):
+        names = [field.name for field in self.layer.fields if fields is None or field.name in fields]
+        records = []
+        for i, row in enumerate(rows):
+            record = collections.OrderedDict([("oid", int(self.layer.oids[row])), ("x", float(self.layer.x[row])),
+                                              ("y", float(self.layer.y[row]))])
+            if distance is not None:
+                record["distance"] = float(distance[i])
+            for name in names:
+                record[name] = _JsonValue(self.layer.columns[name][row])
+            records.append(record)
+        return records
+
+
+def _Stamp(source):
+    if isinstance(source, PointLayer):
+        return None
+    path = os.path.join(source, SCHEMA) if os.path.isdir(source) else source
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class CrossingService(object):
+
+    def __init__(self, source=None, table=TABLE, cellSize=None, log=None):
+        self.source = source
+        self.table = table
+        self.cellSize = cellSize
+        self.log = log or (lambda message: None)
+        self.index = None
+        self.version = 0
+        self.stamp = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.watcher = None
+        if source is not None:
+            self.Load()
+
+    # Process: Build an index of "source" (the current source by default)
+    # and swap it in.  Queries keep using the old index until the swap.
+    def Load(self, source=None):
+        source = self.source if source is None else source
+        stamp = _Stamp(source)
+        start = time.time()
+        index = CrossingIndex(ReadCrossings(source, self.table), self.cellSize, source)
+        with self.lock:
+            self.source = source
+            self.index = index
+            self.stamp = stamp
+            self.version += 1
+            index.version = self.version
+        self.log("Loaded %d crossings from %s in %.2fs (version %d)" %
+                 (len(index), source, time.time() - start, index.version))
+        return index
+
+    def Index(self):
+        index = self.index
+        if index is None:
+            raise LookupError("No crossings loaded")
+        return index
+
+    # Process: Reload the source whenever its modification time changes,
+    # checking every "interval" seconds on a background thread.  A failed
+    # reload is logged and the current index kept.
+    def Watch(self, interval=60.0):
+        def Poll():
+            while not self.stopping.wait(interval):
+                try:
+                    stamp = _Stamp(self.source)
+                    if stamp is not None and stamp != self.stamp:
+                        self.Load()
+                except Exception as error:
+                    self.log("Reload of %s failed: %s" % (self.source, error))
+        self.watcher = threading.Thread(target=Poll)
+        self.watcher.daemon = True
+        self.watcher.start()
+        return self.watcher
+
+    def Stop(self):
+        self.stopping.set()
+
+    def _Answer(self, index, rows, fields, limit, distance=None, started=None):
+        shown = rows if limit is None else rows[:limit]
+        answer = collections.OrderedDict([
+            ("count", int(len(rows))), ("returned", int(len(shown))), ("version", index.version)])
+        if started is not None:
+            answer["ms"] = round((time.time() - started) * 1000.0, 3)
+        answer["crossings"] = index.Records(shown, fields, None if distance is None else distance[:len(shown)])
+        return answer
+
+    def BBox(self, xmin, ymin, xmax, ymax, fields=None, limit=None):
+        started = time.time()
+        index = self.Index()
+        return self._Answer(index, index.BBox(xmin, ymin, xmax, ymax), fields, limit, started=started)
+
+    def Radius(self, x, y, radius, fields=None, limit=None):
+        started = time.time()
+        index = self.Index()
+        rows, distance = index.Radius(x, y, radius)
+        return self._Answer(index, rows, fields, limit, distance, started)
+
+    def Nearest(self, x, y, k, fields=None):
+        started = time.time()
+        index = self.Index()
+        rows, distance = index.Nearest(x, y, k)
+        return self._Answer(index, rows, fields, None, distance, started)
+
+    def Facility(self, field, value, fields=None, limit=None):
+        started = time.time()
+        index = self.Index()
+        return self._Answer(index, index.Facility(field, value), fields, limit, started=started)
+
+    def Status(self):
+        index = self.index
+        return collections.OrderedDict([
+            ("source", None if isinstance(self.source, PointLayer) else self.source),
+            ("crossings", len(index) if index is not None else 0),
+            ("version", index.version if index is not None else 0),
+            ("loaded", datetime.datetime.fromtimestamp(index.loaded).isoformat() if index is not None else None),
+            ("facilityFields", sorted(index.facilities) if index is not None else [])])
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _Send(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        number = lambda key: float(params[key])
+        fields = params["fields"].split(",") if params.get("fields") else None
+        try:
+            limit = int(params.get("limit", DEFAULT_LIMIT))
+            if url.path == "/bbox":
+                body = service.BBox(number("xmin"), number("ymin"), number("xmax"), number("ymax"), fields, limit)
+            elif url.path == "/radius":
+                body = service.Radius(number("x"), number("y"), number("r"), fields, limit)
+            elif url.path == "/nearest":
+                body = service.Nearest(number("x"), number("y"), int(params.get("k", 1)), fields)
+            elif url.path == "/facility":
+                body = service.Facility(params["field"], params["value"], fields, limit)
+            elif url.path == "/status":
+                body = service.Status()
+            elif url.path == "/reload":
+                service.Load()
+                body = service.Status()
+            else:
+                self._Send(404, {"error": "Unknown query %s" % url.path})
+                return
+        except (KeyError, ValueError) as error:
+            self._Send(400, {"error": "Bad query: %s" % error})
+            return
+        except LookupError as error:
+            self._Send(503, {"error": str(error)})
+            return
+        self._Send(200, body)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Process: HTTP server answering queries from "service".  Call serve_forever
+# (or handle_request) on the result.
+def Serve(service, host="127.0.0.1", port=8642):
+    server = _Server((host, port), _Handler)
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve crossing queries over HTTP.")
+    parser.add_argument("source", help="GeoPackage or columnar folder holding the crossings")
+    parser.add_argument("--table", default=TABLE)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8642)
+    parser.add_argument("--watch", type=float, default=60.0, help="seconds between checks for a new output")
+    args = parser.parse_args(argv)
+    log = lambda message: print(time.strftime("%Y-%m-%dT%H:%M:%S ", time.localtime()) + message)
+    service = CrossingService(args.source, args.table, log=log)
+    if args.watch > 0:
+        service.Watch(args.watch)
+    server = Serve(service, args.host, args.port)
+    log("Serving crossing queries on http://%s:%d/" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.Stop()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
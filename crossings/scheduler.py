@@ -0,0 +1,278 @@
+#
+# -----------------------------------------------------------------------------
+#                                 scheduler.py
+#
+# PURPOSE:
+#
+# Run the crossing pipeline as a graph of stages instead of one long list of
+# calls.  Each stage names the datasets it reads (inputs) and writes (outputs);
+# a stage runs once every earlier stage that writes one of its inputs, or reads
+# one of its outputs, has finished.  Stages with nothing in common (the storm,
+# sewer and water branches, the three pairwise intersections) run at the same
+# time in a pool of worker processes.
+#
+# At the end of a run the critical path (the chain of dependent stages with the
+# longest total time) is reported; that chain is the lower bound on run time no
+# matter how many workers are used.
+#
+# With a Tracer (see tracing.py) every stage is timed in the process that runs
+# it and the spans are recorded by the main process as the stages finish.
+#
+# A stage marked "local" runs in the main process instead of a worker, for
+# stages that start a process pool of their own (worker processes cannot).
+#
+# With a StageCache (see cache.py) the outputs of each finished stage are saved
+# under a hash of its inputs, and a rerun skips the stages that are still valid,
+# restoring their outputs, and starts at the first stale stage.
+#
+# A stage whose arguments cannot be sent to a worker, or whose worker process
+# exits while running it, fails the run like a stage that raised.
+#
+# Stage functions must be module-level functions so they can be sent to the
+# worker processes.  On Windows the workers import the calling script again, so
+# the script has to keep its run under an  if __name__ == "__main__":  block.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# None beyond the Python standard library.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import multiprocessing
+import os
+import time
+import traceback
+
+from crossings import cache as stagecache
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Seconds between checks that the worker processes are still alive while
+# waiting for a stage to finish.
+POLL_SECONDS = 1.0
+
+
+class Stage(object):
+
+    # "cacheable" is False for stages that must run every time, such as the
+    # ones creating the folders the other stages write to.
+    def __init__(self, func, inputs=(), outputs=(), args=(), name=None, cacheable=True, local=False):
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.args = tuple(args)
+        self.name = name or func.__name__
+        self.cacheable = cacheable
+        self.local = local
+
+
+class StageError(Exception):
+    pass
+
+
+# Timing of one finished stage.  Times are seconds since the start of the run;
+# "span" is the tracing span when the run is traced.
+class StageResult(object):
+
+    def __init__(self, name, start, end, pid, span=None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.pid = pid
+        self.span = span
+
+    @property
+    def seconds(self):
+        return self.end - self.start
+
+
+# Process: Work out which earlier stages each stage has to wait for.  Stages are
+# taken in the order given: a stage waits for the last writer of each of its
+# inputs and outputs, and for every reader of its outputs since that writer.
+def Dependencies(stages):
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise StageError("Stage names must be unique")
+    lastWriter = {}
+    readers = {}
+    depends = {}
+    for stage in stages:
+        needs = set()
+        for dataset in stage.inputs + stage.outputs:
+            if dataset in lastWriter:
+                needs.add(lastWriter[dataset])
+        for dataset in stage.outputs:
+            needs.update(readers.get(dataset, ()))
+        needs.discard(stage.name)
+        depends[stage.name] = needs
+        for dataset in stage.inputs:
+            readers.setdefault(dataset, set()).add(stage.name)
+        for dataset in stage.outputs:
+            lastWriter[dataset] = stage.name
+            readers[dataset] = set()
+    return depends
+
+
+# Process: Longest chain of dependent stages by elapsed time.  Returns the
+# stage names in run order and the total seconds along the chain.
+def CriticalPath(stages, depends, results):
+    finish = {}
+    previous = {}
+    for stage in stages:
+        best = None
+        for name in depends[stage.name]:
+            if best is None or finish[name] > finish[best]:
+                best = name
+        previous[stage.name] = best
+        finish[stage.name] = (finish[best] if best else 0.0) + results[stage.name].seconds
+    if not finish:
+        return [], 0.0
+    last = max(finish, key=lambda name: finish[name])
+    path = []
+    name = last
+    while name:
+        path.append(name)
+        name = previous[name]
+    return list(reversed(path)), finish[last]
+
+
+def _RunStage(name, func, args, runStart, tracer=None, inputs=(), outputs=()):
+    start = time.time() - runStart
+    span = None
+    try:
+        if tracer is not None:
+            span = tracer.Trace(name, func, args, inputs, outputs)
+        else:
+            func(*args)
+    except Exception:
+        return name, start, time.time() - runStart, os.getpid(), traceback.format_exc(), None
+    return name, start, time.time() - runStart, os.getpid(), None, span
+
+
+# Process: Send a stage to the pool.  Its result is put on "done", or a
+# failure result when the stage could not be run in a worker at all.
+def _Submit(pool, arguments, done):
+    name, runStart = arguments[0], arguments[3]
+
+    def Failed(error):
+        now = time.time() - runStart
+        done.put((name, now, now, None, "".join(traceback.format_exception_only(type(error), error)), None))
+
+    pool.apply_async(_RunStage, arguments, callback=done.put, error_callback=Failed)
+
+
+def _WorkerPids():
+    return set(child.pid for child in multiprocessing.active_children())
+
+
+class Scheduler(object):
+
+    def __init__(self, stages, workers=1, log=None, tracer=None, cache=None):
+        self.stages = list(stages)
+        self.workers = max(1, int(workers))
+        self.log = log or (lambda message: None)
+        self.tracer = tracer
+        self.cache = cache
+        self.depends = Dependencies(self.stages)
+        self.plan = {}
+        self.results = {}
+
+    # Process: Run every stage.  Raises StageError with the worker traceback if a
+    # stage fails; stages already running are allowed to finish first.
+    def Run(self):
+        runStart = time.time()
+        if self.cache is not None:
+            self.plan = self.cache.Plan(self.stages, self.depends)
+            cached = [stage.name for stage in self.stages
+                      if self.plan[stage.name][0] in (stagecache.RESTORE, stagecache.SKIP)]
+            if cached:
+                self.log(" Resuming from cache, skipping %s" % ", ".join(cached))
+        if self.workers == 1:
+            for stage in self.stages:
+                self._Finished(_RunStage(*self._Arguments(stage, runStart)))
+        else:
+            self._RunPool(runStart)
+        self.wallSeconds = time.time() - runStart
+        self.criticalPath, self.criticalSeconds = CriticalPath(self.stages, self.depends, self.results)
+        return self.results
+
+    def _RunPool(self, runStart):
+        done = queue.Queue()
+        pending = list(self.stages)
+        running = set()
+        failure = None
+        pool = multiprocessing.Pool(self.workers)
+        workers = _WorkerPids()
+        try:
+            while pending or running:
+                if failure is None:
+                    for stage in [s for s in pending if not (self.depends[s.name] - set(self.results))]:
+                        pending.remove(stage)
+                        running.add(stage.name)
+                        self.log(" Start %s" % stage.name)
+                        if stage.local:
+                            done.put(_RunStage(*self._Arguments(stage, runStart)))
+                        else:
+                            _Submit(pool, self._Arguments(stage, runStart), done)
+                if not running:
+                    break
+                result = self._Next(done, running, workers)
+                running.discard(result[0])
+                try:
+                    self._Finished(result)
+                except StageError as error:
+                    failure = failure or error
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        if failure is not None:
+            raise failure
+
+    # Process: Wait for the next finished stage.  A worker process that is gone
+    # takes its stage with it, so the run fails instead of waiting forever.
+    def _Next(self, done, running, workers):
+        while True:
+            try:
+                return done.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if workers - _WorkerPids():
+                    raise StageError("A worker process exited while running %s" % ", ".join(sorted(running)))
+
+    def _Arguments(self, stage, runStart):
+        func, args = stage.func, stage.args
+        action, key, restore = self.plan.get(stage.name, (None, None, ()))
+        if action == stagecache.RUN:
+            func, args = stagecache.RunAndSave, (self.cache, key, stage.name, stage.func, stage.args, stage.outputs)
+        elif action == stagecache.RESTORE:
+            func, args = stagecache.RestoreOutputs, (self.cache, key, restore)
+        elif action == stagecache.SKIP:
+            func, args = stagecache.Skip, ()
+        return (stage.name, func, args, runStart, self.tracer, stage.inputs, stage.outputs)
+
+    def _Finished(self, result):
+        name, start, end, pid, error, span = result
+        if error:
+            raise StageError("Stage %s failed:\n%s" % (name, error))
+        self.results[name] = StageResult(name, start, end, pid, span)
+        if span is not None:
+            self.tracer.Record(span)
+        self.log(" Finished %s in %.1f s" % (name, end - start))
+
+    # Process: Lines describing the run, ending with the critical path.
+    def Report(self):
+        lines = [" Pipeline finished in %.1f s with %d worker(s)" % (self.wallSeconds, self.workers)]
+        cached = [name for name, (action, key, restore) in self.plan.items()
+                  if action in (stagecache.RESTORE, stagecache.SKIP)]
+        if cached:
+            lines.append(" %d stage(s) restored from the cache" % len(cached))
+        lines.append(" Critical path (%.1f s): %s" % (self.criticalSeconds, " -> ".join(
+            "%s (%.1f s)" % (name, self.results[name].seconds) for name in self.criticalPath)))
+        return lines
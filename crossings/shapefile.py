@@ -0,0 +1,133 @@
+#
+# -----------------------------------------------------------------------------
+#                                 shapefile.py
+#
+# PURPOSE:
+#
+# Read a polyline shapefile (.shp/.dbf pair) into a PipeLayer without ArcGIS.
+# PolyLine, PolyLineZ and PolyLineM shapes are supported; Z and M values are
+# dropped, the same as the outputZFlag/outputMFlag "Disabled" settings used when
+# the pipes are copied out of SDE.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import os
+import struct
+
+import numpy as np
+
+from crossings.geometry import AssembleParts, MakeField, PipeLayer
+
+POLYLINE_TYPES = (3, 13, 23)
+
+
+# Process: Read the shapes from the .shp file as a list of pipes, each a list of
+# (n, 2) part arrays.
+def ReadShapes(shpPath):
+    with open(shpPath, "rb") as shp:
+        data = shp.read()
+    fileLength = struct.unpack_from(">i", data, 24)[0] * 2
+    offset = 100
+    pipes = []
+    while offset < fileLength:
+        contentLength = struct.unpack_from(">i", data, offset + 4)[0] * 2
+        content = offset + 8
+        shapeType = struct.unpack_from("<i", data, content)[0]
+        if shapeType == 0:
+            pipes.append([])
+        elif shapeType in POLYLINE_TYPES:
+            numParts, numPoints = struct.unpack_from("<ii", data, content + 36)
+            starts = np.frombuffer(data, dtype="<i4", count=numParts, offset=content + 44)
+            points = np.frombuffer(data, dtype="<f8", count=numPoints * 2,
+                                   offset=content + 44 + 4 * numParts).reshape(numPoints, 2)
+            bounds = list(starts) + [numPoints]
+            pipes.append([points[bounds[i]:bounds[i + 1]] for i in range(numParts)
+                          if bounds[i + 1] > bounds[i]])
+        else:
+            raise ValueError("%s: shape type %d is not a polyline" % (shpPath, shapeType))
+        offset = content + contentLength
+    return pipes
+
+
+def _DbfFieldType(fieldType, length, decimals):
+    if fieldType == "C":
+        return "TEXT"
+    if fieldType == "D":
+        return "DATE"
+    if fieldType == "N" and decimals == 0:
+        return "SHORT" if length <= 4 else "LONG" if length <= 9 else "DOUBLE"
+    if fieldType in ("N", "F"):
+        return "DOUBLE"
+    return "TEXT"
+
+
+def _Encoding(dbfPath):
+    cpgPath = os.path.splitext(dbfPath)[0] + ".cpg"
+    if os.path.exists(cpgPath):
+        with io.open(cpgPath, encoding="ascii") as cpg:
+            return cpg.read().strip() or "latin-1"
+    return "latin-1"
+
+
+# Process: Read the attribute table.  Returns the field list, a dict of raw
+# column values and a mask of records that are not flagged as deleted.
+def ReadDbf(dbfPath, fieldNames=None):
+    with open(dbfPath, "rb") as dbf:
+        data = dbf.read()
+    encoding = _Encoding(dbfPath)
+    numRecords, headerLength, recordLength = struct.unpack_from("<IHH", data, 4)
+    descriptors = []
+    offset = 32
+    position = 1
+    while data[offset:offset + 1] != b"\r":
+        name = data[offset:offset + 11].split(b"\0")[0].decode("ascii")
+        fieldType = data[offset + 11:offset + 12].decode("ascii")
+        length, decimals = struct.unpack_from("BB", data, offset + 16)
+        descriptors.append((name, fieldType, length, decimals, position))
+        position += length
+        offset += 32
+
+    records = np.frombuffer(data, dtype="S%d" % recordLength, count=numRecords, offset=headerLength)
+    live = np.array([record[:1] != b"*" for record in records], dtype=bool)
+    fields = []
+    columns = {}
+    for name, fieldType, length, decimals, position in descriptors:
+        if fieldNames is not None and name not in fieldNames:
+            continue
+        targetType = _DbfFieldType(fieldType, length, decimals)
+        values = []
+        for record in records:
+            text = record[position:position + length].decode(encoding, "replace").strip()
+            if fieldType in ("N", "F"):
+                try:
+                    values.append(float(text))
+                except ValueError:
+                    values.append(None)
+            else:
+                values.append(text or None)
+        fields.append(MakeField(name, targetType, length if targetType == "TEXT" else None))
+        columns[name] = values
+    return fields, columns, live
+
+
+# Process: Read "path" (with or without the .shp extension) into a PipeLayer.
+# "fieldNames" restricts the attribute fields that are loaded.
+def ReadShapefile(path, fieldNames=None, name=None):
+    base = os.path.splitext(path)[0]
+    pipes = ReadShapes(base + ".shp")
+    fields, columns, live = ReadDbf(base + ".dbf", fieldNames)
+    keep = np.nonzero(live[:len(pipes)])[0]
+    pipes = [pipes[i] for i in keep]
+    columns = dict((field, [values[i] for i in keep]) for field, values in columns.items())
+    coords, partOffsets, pipeParts = AssembleParts(pipes)
+    return PipeLayer(name or os.path.basename(base), coords, partOffsets, pipeParts,
+                     fields, columns, keep + 1)
@@ -0,0 +1,491 @@
+#
+# -----------------------------------------------------------------------------
+#                                 sources.py
+#
+# PURPOSE:
+#
+# Readers for the seven source pipe classes, so the extraction can run (and be
+# timed and tuned) against a local file as well as the enterprise database.
+# Both backends have the same methods:
+#
+#   Fields(className)            field definitions of the source class
+#   SpatialReference(className)  for CreateFeatureclass ("" when unknown)
+#   Batches(className, names)    PipeLayers of at most batchSize pipes, with
+#                                only the fields named (projection is done
+#                                in the query, not after the rows arrive)
+#   Read(className, names)       the whole class as one PipeLayer
+#   Fingerprint(className)       row count, highest object ID and latest
+#                                MODIFYDATE, cheap to read and different
+#                                once the class is edited
+#   Pages(className, names, pageSize, workers)
+#                                the same batches, fetched "workers" at a
+#                                time over separate connections (one at a
+#                                time for readers that are not threadSafe)
+#   Close()
+#
+# Pages splits a class into ranges of object IDs holding pageSize pipes each
+# (the IDs alone are read first, in one narrow query) and fetches the ranges
+# on a pool of threads, so the round trips to the database overlap instead of
+# adding up.  The pages are handed back in object ID order, at most a few per
+# worker ahead of the caller, so the local copy is written in the same order
+# as a serial read.  "workers" limits the threads for one class; the
+# "connections" of a reader limits the queries in flight across all the
+# classes it reads at once.
+#
+# ArcSource reads a geodatabase or SDE workspace with arcpy.da cursors that
+# fetch only the object ID, the shape as WKB and the named fields.  arcpy keeps
+# one connection per workspace in a process, so one ArcSource reused for
+# every class (see Sources() in the script) opens the SDE connection once.
+# arcpy cursors and workspaces are not thread-safe, so extraction from SDE is
+# not parallel within a class: an ArcSource reads one page at a time whatever
+# "workers" says.  The only parallelism it gets is across classes, from the
+# script running each class's copy in its own process.
+#
+# GeoPackageSource reads a GeoPackage (or any SQLite file laid out like one)
+# whose tables have the class names, for example a network written by
+# synthetic.py.  Connections come from a ConnectionPool and are reused across
+# classes.  "latency" adds that many seconds to every query and fetch, to
+# stand in for the round trips to a remote database when timing Pages.
+#
+# Extract applies a field map (fieldmap.py) to each batch.  Run
+#
+#   python -m crossings.sources network.gpkg --batch-sizes 1000 10000 100000
+#   python -m crossings.sources network.gpkg --workers 1 4 8 --latency 0.02
+#
+# to time extraction of all seven classes from a local file.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# 2).  ArcSource needs ArcGIS 10.1 or higher (arcpy.da).
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from crossings import fieldmap
+from crossings.geometry import PipeLayerFromWKB
+from crossings.gpkg import BlobWKB, TableFields, _Quote
+
+# Pipes per batch unless the reader is told otherwise.
+BATCH_SIZE = 10000
+
+DATE_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S",
+                "%Y-%m-%d")
+
+
+# Connections shared by the calls of one reader.  At most "size" are open;
+# a caller waits for one to be released when all are in use.
+class ConnectionPool(object):
+
+    def __init__(self, connect, size=1):
+        self.connect = connect
+        self.size = max(1, int(size))
+        self.idle = queue.LifoQueue()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def Acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.opened) < self.size:
+                connection = self.connect()
+                self.opened.append(connection)
+                return connection
+        return self.idle.get()
+
+    def Release(self, connection):
+        self.idle.put(connection)
+
+    @contextlib.contextmanager
+    def Connection(self):
+        connection = self.Acquire()
+        try:
+            yield connection
+        finally:
+            self.Release(connection)
+
+    def Close(self):
+        with self.lock:
+            for connection in self.opened:
+                connection.close()
+            self.opened = []
+            self.idle = queue.LifoQueue()
+
+
+def _ParseDate(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    text = str(value).replace("Z", "")
+    # Python 3.7+ parses the ISO forms much faster than strptime.
+    if hasattr(datetime.datetime, "fromisoformat"):
+        try:
+            return datetime.datetime.fromisoformat(text)
+        except ValueError:
+            pass
+    for dateFormat in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, dateFormat)
+        except ValueError:
+            pass
+    return None
+
+
+# Process: func(item) for every item, run on "workers" threads, yielded in
+# the order of "items".  At most "ahead" items are started beyond the one the
+# caller is waiting for.  An exception raised by func is raised here when its
+# item is reached.
+def OrderedMap(func, items, workers=1, ahead=None):
+    items = list(items)
+    workers = max(1, min(int(workers), len(items)))
+    if workers == 1:
+        for item in items:
+            yield func(item)
+        return
+    ahead = ahead or 2 * workers
+    todo = queue.Queue()
+    done = queue.Queue()
+
+    def Work():
+        while True:
+            task = todo.get()
+            if task is None:
+                return
+            index, item = task
+            try:
+                done.put((index, True, func(item)))
+            except Exception as error:
+                done.put((index, False, error))
+
+    threads = [threading.Thread(target=Work) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    submitted = 0
+    finished = {}
+    try:
+        for index in range(len(items)):
+            while submitted < min(len(items), index + ahead):
+                todo.put((submitted, items[submitted]))
+                submitted += 1
+            while index not in finished:
+                position, ok, value = done.get()
+                finished[position] = (ok, value)
+            ok, value = finished.pop(index)
+            if not ok:
+                raise value
+            yield value
+    finally:
+        while True:
+            try:
+                todo.get_nowait()
+            except queue.Empty:
+                break
+        for thread in threads:
+            todo.put(None)
+
+
+class SourceReader(object):
+
+    # False for backends whose cursors cannot be used from several threads at
+    # once; Pages and Extract then fetch one page at a time.
+    threadSafe = True
+
+    # "connections" is the most queries the reader runs at once, over every
+    # class it is reading.
+    def __init__(self, batchSize=BATCH_SIZE, connections=1):
+        self.batchSize = batchSize
+        self.slots = threading.BoundedSemaphore(max(1, int(connections)))
+
+    # Process: Source field definitions for "names" (case-insensitive; names
+    # the class does not have are skipped).  All fields when names is None.
+    def Project(self, className, names=None):
+        fields = self.Fields(className)
+        if names is None:
+            return fields
+        byName = dict((field.name.lower(), field) for field in fields)
+        return [byName[name.lower()]._replace(name=name) for name in names if name.lower() in byName]
+
+    # Process: Pipes of a source class in batches.  The columns are keyed by
+    # the names as requested.
+    def Batches(self, className, names=None, batchSize=None, name=None):
+        batchSize = batchSize or self.batchSize
+        fields = self.Project(className, names)
+        sourceNames = self._SourceNames(className, fields)
+        batch = []
+        for row in self._Rows(className, sourceNames):
+            batch.append(row)
+            if len(batch) >= batchSize:
+                yield self._Layer(name or className, fields, batch)
+                batch = []
+        if batch:
+            yield self._Layer(name or className, fields, batch)
+
+    # Process: Start and end (exclusive, None for the last) object IDs of
+    # pages of "pageSize" pipes.
+    def KeyRanges(self, className, pageSize=None):
+        pageSize = pageSize or self.batchSize
+        with self.slots:
+            keys = np.sort(np.asarray(self._Keys(className), dtype=np.int64))
+        starts = keys[::pageSize].tolist()
+        return list(zip(starts, starts[1:] + [None]))
+
+    # Process: The batches of Batches, each a range of object IDs fetched on
+    # its own, "workers" at a time, and yielded in object ID order.
+    def Pages(self, className, names=None, pageSize=None, workers=1, name=None):
+        fields = self.Project(className, names)
+        sourceNames = self._SourceNames(className, fields)
+        pageSize = pageSize or self.batchSize
+
+        def Fetch(keyRange):
+            with self.slots:
+                rows = list(self._Rows(className, sourceNames, keyRange))
+            return self._Layer(name or className, fields, rows)
+
+        workers = workers if self.threadSafe else 1
+        for layer in OrderedMap(Fetch, self.KeyRanges(className, pageSize), workers):
+            yield layer
+
+    def Read(self, className, names=None, name=None):
+        fields = self.Project(className, names)
+        rows = list(self._Rows(className, self._SourceNames(className, fields)))
+        return self._Layer(name or className, fields, rows)
+
+    def _SourceNames(self, className, fields):
+        actual = dict((field.name.lower(), field.name) for field in self.Fields(className))
+        return [actual[field.name.lower()] for field in fields]
+
+    def _Layer(self, name, fields, rows):
+        columns = {}
+        for i, field in enumerate(fields):
+            values = [row[i + 2] for row in rows]
+            if field.type == "DATE":
+                values = [_ParseDate(value) for value in values]
+            columns[field.name] = values
+        return PipeLayerFromWKB(name, [row[1] for row in rows], fields, columns, [row[0] for row in rows])
+
+    # Process: (row count, highest object ID, latest MODIFYDATE) of a class;
+    # the date is None when the class has no MODIFYDATE field.
+    def Fingerprint(self, className):
+        modified = self._SourceNames(className, self.Project(className, ["MODIFYDATE"]))
+        return self._Fingerprint(className, modified[0] if modified else None)
+
+    def Close(self):
+        pass
+
+
+class GeoPackageSource(SourceReader):
+
+    # "tables" maps class names to table names where they differ.
+    def __init__(self, path, batchSize=BATCH_SIZE, poolSize=1, tables=None, latency=0.0):
+        SourceReader.__init__(self, batchSize, poolSize)
+        if not os.path.exists(path):
+            raise IOError("Source GeoPackage %s does not exist" % path)
+        self.path = path
+        self.tables = dict(tables or {})
+        self.latency = latency
+        self.pool = ConnectionPool(lambda: sqlite3.connect(path, check_same_thread=False), poolSize)
+        self._fields = {}
+
+    def Table(self, className):
+        return self.tables.get(className, className)
+
+    def Fields(self, className):
+        if className not in self._fields:
+            with self.pool.Connection() as connection:
+                self._fields[className] = TableFields(connection, self.Table(className))
+        return self._fields[className][2]
+
+    def SpatialReference(self, className):
+        return ""
+
+    def _Wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _Keys(self, className):
+        self.Fields(className)
+        key = self._fields[className][0]
+        with self.pool.Connection() as connection:
+            self._Wait()
+            rows = connection.execute("SELECT %s FROM %s" % (_Quote(key), _Quote(self.Table(className)))).fetchall()
+        return [row[0] for row in rows]
+
+    # Process: Rows of a class, batchSize per round trip, or of one page (a
+    # range of object IDs, so of bounded size) in a single round trip.
+    def _Rows(self, className, sourceNames, keyRange=None):
+        self.Fields(className)
+        key, geometry = self._fields[className][:2]
+        columnSql = ", ".join([_Quote(key), _Quote(geometry)] + [_Quote(name) for name in sourceNames])
+        whereSql, parameters = "", ()
+        if keyRange is not None:
+            start, end = keyRange
+            whereSql = " WHERE %s >= ?" % _Quote(key) + (" AND %s < ?" % _Quote(key) if end is not None else "")
+            parameters = (start,) if end is None else (start, end)
+        with self.pool.Connection() as connection:
+            self._Wait()
+            cursor = connection.execute("SELECT %s FROM %s%s ORDER BY %s" %
+                                        (columnSql, _Quote(self.Table(className)), whereSql, _Quote(key)),
+                                        parameters)
+            fetch = cursor.fetchall if keyRange is not None else lambda: cursor.fetchmany(self.batchSize)
+            rows = fetch()
+            while rows:
+                for row in rows:
+                    yield (row[0], BlobWKB(row[1])) + tuple(row[2:])
+                # A short batch is the last; no round trip to find that out.
+                if keyRange is not None or len(rows) < self.batchSize:
+                    break
+                self._Wait()
+                rows = fetch()
+
+    def _Fingerprint(self, className, modified):
+        self.Fields(className)
+        key = self._fields[className][0]
+        columns = "COUNT(*), MAX(%s)" % _Quote(key) + (", MAX(%s)" % _Quote(modified) if modified else "")
+        with self.pool.Connection() as connection:
+            self._Wait()
+            row = connection.execute("SELECT %s FROM %s" % (columns, _Quote(self.Table(className)))).fetchone()
+        return (row[0], row[1], row[2] if modified else None)
+
+    def Close(self):
+        self.pool.Close()
+
+
+class ArcSource(SourceReader):
+
+    # arcpy cursors cannot be shared between threads, so every page of a class
+    # is read in turn on the caller's thread.
+    threadSafe = False
+
+    # "tables" maps class names to their paths inside "workspace".
+    def __init__(self, workspace, tables, batchSize=BATCH_SIZE, connections=1):
+        SourceReader.__init__(self, batchSize, connections)
+        self.workspace = workspace
+        self.tables = dict(tables)
+        self._fields = {}
+        self._oidFields = {}
+
+    def Path(self, className):
+        return os.path.join(self.workspace, self.tables.get(className, className))
+
+    def Fields(self, className):
+        if className not in self._fields:
+            import arcpy
+            from crossings.arcgis import ListFields
+            self._fields[className] = ListFields(arcpy, self.Path(className))
+        return self._fields[className]
+
+    def SpatialReference(self, className):
+        import arcpy
+        return arcpy.Describe(self.Path(className)).spatialReference
+
+    def _Keys(self, className):
+        import arcpy
+        with arcpy.da.SearchCursor(self.Path(className), ["OID@"]) as rows:
+            return [row[0] for row in rows]
+
+    def _Rows(self, className, sourceNames, keyRange=None):
+        import arcpy
+        where = None
+        if keyRange is not None:
+            if className not in self._oidFields:
+                self._oidFields[className] = arcpy.Describe(self.Path(className)).OIDFieldName
+            oidField = self._oidFields[className]
+            start, end = keyRange
+            where = "%s >= %d" % (oidField, start) + (" AND %s < %d" % (oidField, end) if end is not None else "")
+        with arcpy.da.SearchCursor(self.Path(className), ["OID@", "SHAPE@WKB"] + sourceNames, where) as rows:
+            for row in rows:
+                yield row
+
+    def _Fingerprint(self, className, modified):
+        import arcpy
+        count, highest, latest = 0, None, None
+        with arcpy.da.SearchCursor(self.Path(className), ["OID@"] + ([modified] if modified else [])) as rows:
+            for row in rows:
+                count += 1
+                highest = row[0] if highest is None else max(highest, row[0])
+                if modified and row[1] is not None:
+                    latest = row[1] if latest is None else max(latest, row[1])
+        return (count, highest, latest)
+
+
+# Process: Field-mapped batches of one source class, ready to be written to
+# the local copy.  The length token of the map is measured from the geometry.
+# With more than one worker (and a threadSafe reader) the batches are fetched
+# as concurrent pages.
+def Extract(reader, className, fieldMap=None, batchSize=None, workers=1):
+    fieldMap = fieldMap or fieldmap.FIELD_MAPS[className]
+    if workers > 1 and reader.threadSafe:
+        batches = reader.Pages(className, fieldMap.SourceFields(), batchSize, workers)
+    else:
+        batches = reader.Batches(className, fieldMap.SourceFields(), batchSize)
+    for batch in batches:
+        yield fieldmap.ApplyFieldMap(batch, fieldMap)
+
+
+# Process: Time the extraction of every class from "reader".  Returns one
+# entry per class with the pipes read and the rate.
+def TimeExtraction(reader, classNames=None, batchSize=None, workers=1):
+    results = []
+    for className in classNames or sorted(fieldmap.FIELD_MAPS):
+        start = time.time()
+        pipes = 0
+        batches = 0
+        for batch in Extract(reader, className, batchSize=batchSize, workers=workers):
+            pipes += len(batch)
+            batches += 1
+        seconds = time.time() - start
+        results.append(collections.OrderedDict([
+            ("class", className), ("pipes", pipes), ("batches", batches), ("seconds", round(seconds, 4)),
+            ("pipesPerSecond", round(pipes / seconds, 1) if seconds > 0 else None)]))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time extraction of the pipe classes from a GeoPackage.")
+    parser.add_argument("path")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[BATCH_SIZE])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1],
+                        help="concurrent pages per class; each count is timed in turn")
+    parser.add_argument("--pool-size", type=int, help="connections (default: the largest worker count)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every query and fetch")
+    args = parser.parse_args(argv)
+    runs = []
+    for size in args.batch_sizes:
+        reader = GeoPackageSource(args.path, size, args.pool_size or max(args.workers), latency=args.latency)
+        try:
+            for workers in args.workers:
+                classes = TimeExtraction(reader, workers=workers)
+                runs.append(collections.OrderedDict([
+                    ("batchSize", size), ("workers", workers), ("latency", args.latency),
+                    ("seconds", round(sum(entry["seconds"] for entry in classes), 4)), ("classes", classes)]))
+        finally:
+            reader.Close()
+    print(json.dumps(runs, indent=2))
+
+
+if __name__ == "__main__":
+    main()
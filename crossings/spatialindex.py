@@ -0,0 +1,156 @@
+#
+# -----------------------------------------------------------------------------
+#                                 spatialindex.py
+#
+# PURPOSE:
+#
+# Uniform grid used to find candidate pairs of overlapping bounding boxes.  Each
+# box is bucketed into every grid cell it touches and only boxes sharing a cell
+# are compared, so the work grows with the number of nearby pairs instead of
+# the product of the two layer sizes.
+#
+# Boxes are (n, 4) arrays of xmin, ymin, xmax, ymax.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from crossings.geometry import Ranges
+
+# Number of (box, cell) entries from the first set joined per chunk.  Keeps the
+# candidate arrays to a few hundred MB on dense networks.
+CHUNK_ENTRIES = 1000000
+
+
+# Process: Pick a cell size close to the typical box extent so each box lands
+# in only a handful of cells.
+def DefaultCellSize(*boxSets):
+    boxes = np.concatenate([b for b in boxSets if len(b)]) if any(len(b) for b in boxSets) else None
+    if boxes is None:
+        return 1.0
+    extent = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+    cellSize = float(np.mean(extent))
+    if not cellSize > 0:
+        span = max(boxes[:, 2].max() - boxes[:, 0].min(), boxes[:, 3].max() - boxes[:, 1].min())
+        cellSize = float(span) / max(np.sqrt(len(boxes)), 1.0)
+    return cellSize if cellSize > 0 else 1.0
+
+
+class Grid(object):
+
+    def __init__(self, origin, cellSize):
+        self.originX, self.originY = origin
+        self.cellSize = float(cellSize)
+
+    @classmethod
+    def Covering(cls, boxSets, cellSize=None):
+        nonEmpty = [b for b in boxSets if len(b)]
+        if nonEmpty:
+            origin = (min(b[:, 0].min() for b in nonEmpty), min(b[:, 1].min() for b in nonEmpty))
+        else:
+            origin = (0.0, 0.0)
+        return cls(origin, cellSize or DefaultCellSize(*boxSets))
+
+    def Cell(self, x, y):
+        ix = np.floor((np.asarray(x) - self.originX) / self.cellSize).astype(np.int64)
+        iy = np.floor((np.asarray(y) - self.originY) / self.cellSize).astype(np.int64)
+        return ix, iy
+
+    def Key(self, ix, iy):
+        # Cells are keyed row-major on a 2**31 wide grid; more than enough for
+        # any cell size that keeps a county on one grid.
+        return (ix << 31) + iy
+
+    # Process: Bucket every box into the cells it touches.  Returns the box
+    # index and cell key of every (box, cell) entry.
+    def Entries(self, boxes):
+        if not len(boxes):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        ix0, iy0 = self.Cell(boxes[:, 0], boxes[:, 1])
+        ix1, iy1 = self.Cell(boxes[:, 2], boxes[:, 3])
+        rows = iy1 - iy0 + 1
+        count = (ix1 - ix0 + 1) * rows
+        items = np.repeat(np.arange(len(boxes), dtype=np.int64), count)
+        local = Ranges(np.zeros(len(boxes), dtype=np.int64), count)
+        rows = np.repeat(rows, count)
+        ix = np.repeat(ix0, count) + local // rows
+        iy = np.repeat(iy0, count) + local % rows
+        return items, self.Key(ix, iy)
+
+    # Process: All pairs (i, j) where first[i] overlaps second[j].  Each pair is
+    # reported once, from the cell holding the lower-left corner of the overlap.
+    def Pairs(self, first, second):
+        itemsA, keysA = self.Entries(first)
+        itemsB, keysB = self.Entries(second)
+        order = np.argsort(keysB, kind="mergesort")
+        return self._Join(first, itemsA, keysA, second, itemsB[order], keysB[order])
+
+    # Process: Join (box, cell) entries of "first" with the entries of
+    # "second", which are sorted by cell key.
+    def _Join(self, first, itemsA, keysA, second, itemsB, keysB):
+        pairsA, pairsB = [], []
+        for start in range(0, len(itemsA), CHUNK_ENTRIES):
+            chunkItems = itemsA[start:start + CHUNK_ENTRIES]
+            chunkKeys = keysA[start:start + CHUNK_ENTRIES]
+            lo = np.searchsorted(keysB, chunkKeys, "left")
+            hi = np.searchsorted(keysB, chunkKeys, "right")
+            counts = hi - lo
+            a = np.repeat(chunkItems, counts)
+            b = itemsB[Ranges(lo, counts)]
+            cellKeys = np.repeat(chunkKeys, counts)
+            boxA, boxB = first[a], second[b]
+            cornerX = np.maximum(boxA[:, 0], boxB[:, 0])
+            cornerY = np.maximum(boxA[:, 1], boxB[:, 1])
+            keep = ((cornerX <= np.minimum(boxA[:, 2], boxB[:, 2])) &
+                    (cornerY <= np.minimum(boxA[:, 3], boxB[:, 3])))
+            keep &= self.Key(*self.Cell(cornerX, cornerY)) == cellKeys
+            pairsA.append(a[keep])
+            pairsB.append(b[keep])
+        if not pairsA:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(pairsA), np.concatenate(pairsB)
+
+    # Process: Pairs of overlapping boxes of one box set whose tags are one of
+    # the (firstTag, secondTag) pairs in "tagPairs".  The boxes are bucketed
+    # once and the entries sorted by tag and cell, so each tag pair joins only
+    # the entries of its two tags.  Returns (i, j, pair) with tags[i] and
+    # tags[j] the tags of tagPairs[pair].
+    def TaggedPairs(self, boxes, tags, tagPairs):
+        items, keys = self.Entries(boxes)
+        entryTags = np.asarray(tags, dtype=np.int64)[items]
+        order = np.lexsort((keys, entryTags))
+        items, keys, entryTags = items[order], keys[order], entryTags[order]
+        # Entries of tag t are bounds[t]:bounds[t + 1].
+        bounds = np.searchsorted(entryTags, np.arange(max([0] + [max(pair) for pair in tagPairs]) + 2))
+        pairsA, pairsB, which = [], [], []
+        for pair, (tagA, tagB) in enumerate(tagPairs):
+            if tagA == tagB:
+                raise ValueError("Tag %d is paired with itself" % tagA)
+            spanA = slice(bounds[tagA], bounds[tagA + 1])
+            spanB = slice(bounds[tagB], bounds[tagB + 1])
+            a, b = self._Join(boxes, items[spanA], keys[spanA], boxes, items[spanB], keys[spanB])
+            pairsA.append(a)
+            pairsB.append(b)
+            which.append(np.full(len(a), pair, dtype=np.int64))
+        if not pairsA:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(pairsA), np.concatenate(pairsB), np.concatenate(which)
+
+
+# Process: Candidate pairs of overlapping boxes between two box sets.
+def OverlappingPairs(first, second, cellSize=None):
+    return Grid.Covering([first, second], cellSize).Pairs(first, second)
+
+
+# Process: Candidate pairs of overlapping boxes between the tagged groups of
+# one box set, for every (firstTag, secondTag) in "tagPairs", from one grid.
+def TaggedOverlappingPairs(boxes, tags, tagPairs, cellSize=None):
+    return Grid.Covering([boxes], cellSize).TaggedPairs(boxes, tags, tagPairs)
@@ -0,0 +1,201 @@
+#
+# -----------------------------------------------------------------------------
+#                                 synthetic.py
+#
+# PURPOSE:
+#
+# Synthetic utility network for profiling without the SDE connection.  Builds
+# the seven source pipe classes (swPipes, snGravity, snLateral, snForce,
+# wnGravity, wnLateral, wnWaterMain) with the source field names the field
+# maps in fieldmap.py expect, plus a few of the fields the copy drops.
+#
+#   pipes               total number of pipes over all seven classes
+#   pipesPerSquareMile  how tightly the pipes are packed; more pipes per
+#                       square mile means more crossings per pipe
+#   sentinelRate        share of inverts replaced by the placeholders the
+#                       script cleans up (0 for sewer, 0 or -9999 for storm)
+#   multipartRate       share of pipes split into two parts
+#   seed                random seed; the same arguments give the same network
+#
+# Coordinates are in feet.  Pipes are random walks of 2-8 vertices.  Upstream
+# inverts sit 4-12 ft below a sloping ground surface, and downstream inverts
+# fall from them at 0.5-2% slope.  Water pipes have no inverts.
+#
+# Usage:
+#
+#   python -m crossings.synthetic network.gpkg --pipes 100000
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import datetime
+
+import numpy as np
+
+from crossings.geometry import MakeField, PipeLayer, Ranges
+from crossings.gpkg import WriteGeoPackage
+
+# Share of the pipes in each class, typical pipe length (ft) and diameters (in).
+CLASSES = collections.OrderedDict([
+    ("swPipes", (0.30, 150.0, (12, 15, 18, 24, 30, 36, 48))),
+    ("snGravity", (0.20, 300.0, (8, 10, 12, 15, 18))),
+    ("snLateral", (0.12, 60.0, (4, 6))),
+    ("snForce", (0.03, 500.0, (4, 6, 8, 12))),
+    ("wnGravity", (0.02, 300.0, (6, 8, 12))),
+    ("wnLateral", (0.13, 40.0, (1, 2))),
+    ("wnWaterMain", (0.20, 400.0, (6, 8, 12, 16, 24)))])
+
+MATERIALS = {"sw": ("RCP", "CMP", "HDPE", "PVC"),
+             "sn": ("VCP", "PVC", "DIP", "CI"),
+             "wn": ("DIP", "CI", "PVC", "AC")}
+
+PREFIXES = {"swPipes": "SW", "snGravity": "SG", "snLateral": "SL", "snForce": "SF",
+            "wnGravity": "WG", "wnLateral": "WL", "wnWaterMain": "WM"}
+
+FEET_PER_MILE = 5280.0
+
+MAX_VERTICES = 8
+
+EPOCH = datetime.datetime(1990, 1, 1)
+
+
+def _SourceFields(className):
+    if className == "swPipes":
+        inverts = [MakeField("INVERTUS", "DOUBLE"), MakeField("INVERTDS", "DOUBLE"),
+                   MakeField("PSLOPE", "DOUBLE")]
+    else:
+        inverts = [MakeField("UPSTREAMINVERT", "DOUBLE"), MakeField("DOWNSTREAMINVERT", "DOUBLE"),
+                   MakeField("SLOPE", "DOUBLE")]
+    return ([MakeField("FACILITYID", "TEXT", 20), MakeField("LEGACYID", "TEXT", 20),
+             MakeField("DIAMETER", "SHORT"), MakeField("MATERIAL", "TEXT", 30)] + inverts +
+            [MakeField("SUBTYPE", "LONG"), MakeField("ENABLED", "SHORT"), MakeField("OWNER", "TEXT", 30),
+             MakeField("CREATEDATE", "DATE"), MakeField("MODIFYDATE", "DATE")])
+
+
+# Process: Random-walk pipes.  Returns coords, partOffsets and pipeParts.
+def _Geometry(rng, count, pipeLength, side, multipartRate):
+    vertexCount = rng.randint(2, MAX_VERTICES + 1, count)
+    segmentCount = vertexCount - 1
+    steps = int(segmentCount.sum())
+    heading = np.repeat(rng.uniform(0, 2 * np.pi, count), segmentCount) + rng.normal(0, 0.3, steps)
+    length = np.repeat(pipeLength / segmentCount, segmentCount) * rng.lognormal(0, 0.3, steps)
+
+    # Every pipe starts at a random point and walks its segments.
+    delta = np.zeros((int(vertexCount.sum()), 2))
+    firstVertex = np.cumsum(vertexCount) - vertexCount
+    stepVertex = Ranges(firstVertex + 1, segmentCount)
+    delta[stepVertex, 0] = length * np.cos(heading)
+    delta[stepVertex, 1] = length * np.sin(heading)
+    delta[firstVertex] = rng.uniform(0, side, (count, 2))
+    running = np.cumsum(delta, axis=0)
+    pipeOf = np.repeat(np.arange(count), vertexCount)
+    coords = running - np.vstack(([[0, 0]], running[firstVertex[1:] - 1]))[pipeOf]
+
+    # Multipart pipes: pipes with 4 or more vertices are split in two and the
+    # second part is nudged sideways, leaving a gap.
+    split = (rng.random_sample(count) < multipartRate) & (vertexCount >= 4)
+    middle = firstVertex + vertexCount // 2
+    coords[Ranges(middle[split], (firstVertex + vertexCount - middle)[split])] += 5.0
+    partCount = np.where(split, 2, 1)
+    starts = np.sort(np.concatenate((firstVertex, middle[split])))
+    partOffsets = np.concatenate((starts, [len(coords)])).astype(np.int64)
+    pipeParts = np.concatenate(([0], np.cumsum(partCount))).astype(np.int64)
+    return coords, partOffsets, pipeParts
+
+
+def _Dates(rng, count):
+    created = rng.uniform(0, 25 * 365, count)
+    modified = created + rng.uniform(0, 5 * 365, count)
+    column = lambda days: np.array([EPOCH + datetime.timedelta(days=int(d)) for d in days], dtype=object)
+    return column(created), column(modified)
+
+
+# Process: Build one source class.
+def SyntheticClass(className, count, side, sentinelRate=0.05, multipartRate=0.02, rng=None):
+    rng = rng if rng is not None else np.random.RandomState(0)
+    share, pipeLength, diameters = CLASSES[className]
+    utility = className[:2]
+    coords, partOffsets, pipeParts = _Geometry(rng, count, pipeLength, side, multipartRate)
+    layer = PipeLayer(className, coords, partOffsets, pipeParts)
+    ids = np.arange(1, count + 1)
+
+    columns = {}
+    columns["FACILITYID"] = np.array(["%s%07d" % (PREFIXES[className], i) for i in ids], dtype=object)
+    columns["LEGACYID"] = np.array(["L%d" % i for i in ids], dtype=object)
+    columns["DIAMETER"] = rng.choice(diameters, count).astype(np.float64)
+    columns["MATERIAL"] = rng.choice(np.array(MATERIALS[utility], dtype=object), count)
+    columns["SUBTYPE"] = rng.randint(1, 4, count).astype(np.float64)
+    columns["ENABLED"] = np.ones(count)
+    columns["OWNER"] = np.array(["Public"] * count, dtype=object)
+    columns["CREATEDATE"], columns["MODIFYDATE"] = _Dates(rng, count)
+
+    # Inverts follow the ground; the upstream end is the first vertex.
+    first = layer.Endpoints()[0]
+    lengths = layer.Chainage()[partOffsets[pipeParts[1:]] - 1]
+    ground = 300.0 + 0.002 * first[:, 0] - 0.001 * first[:, 1]
+    up = ground - rng.uniform(4, 12, count)
+    slope = rng.uniform(0.5, 2.0, count)
+    down = up - slope / 100 * lengths
+    if utility == "wn":
+        up[:] = np.nan
+        down[:] = np.nan
+        slope[:] = np.nan
+    else:
+        placeholders = (0.0, -9999.0) if utility == "sw" else (0.0,)
+        for values in (up, down):
+            bad = rng.random_sample(count) < sentinelRate
+            values[bad] = rng.choice(placeholders, int(bad.sum()))
+    if utility == "sw":
+        columns["INVERTUS"], columns["INVERTDS"], columns["PSLOPE"] = up, down, slope
+    else:
+        columns["UPSTREAMINVERT"], columns["DOWNSTREAMINVERT"], columns["SLOPE"] = up, down, slope
+
+    fields = _SourceFields(className)
+    return PipeLayer(className, coords, partOffsets, pipeParts, fields, columns, ids)
+
+
+# Process: Build all seven source classes.  Returns an ordered dict keyed by
+# class name.
+def SyntheticNetwork(pipes=10000, pipesPerSquareMile=400.0, sentinelRate=0.05, multipartRate=0.02, seed=1):
+    rng = np.random.RandomState(seed)
+    side = np.sqrt(pipes / pipesPerSquareMile) * FEET_PER_MILE
+    layers = collections.OrderedDict()
+    for className, (share, pipeLength, diameters) in CLASSES.items():
+        count = max(1, int(round(pipes * share)))
+        layers[className] = SyntheticClass(className, count, side, sentinelRate, multipartRate, rng)
+    return layers
+
+
+def WriteSyntheticNetwork(path, layers):
+    for layer in layers.values():
+        WriteGeoPackage(path, layer)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic utility network to a GeoPackage.")
+    parser.add_argument("path")
+    parser.add_argument("--pipes", type=int, default=10000)
+    parser.add_argument("--pipes-per-square-mile", type=float, default=400.0)
+    parser.add_argument("--sentinel-rate", type=float, default=0.05)
+    parser.add_argument("--multipart-rate", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    layers = SyntheticNetwork(args.pipes, args.pipes_per_square_mile, args.sentinel_rate,
+                              args.multipart_rate, args.seed)
+    WriteSyntheticNetwork(args.path, layers)
+    for name, layer in layers.items():
+        print("%s: %d pipes" % (name, len(layer)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#
+# -----------------------------------------------------------------------------
+#                                 tiling.py
+#
+# PURPOSE:
+#
+# Tiled crossing computation for networks too large to intersect in one call.
+# The area covered by the two pipe layers is split into tiles, either a
+# regular grid ("across" tiles on the longer side) or a quadtree that splits
+# a tile in four until no tile has more than "maxPipes" pipes.  Every pipe is
+# given to each tile its bounding box touches, so a crossing near a tile edge
+# is found by every tile holding both pipes.  Each tile keeps only the
+# crossings whose point falls inside it (tiles own [xmin, xmax) x [ymin,
+# ymax)), which drops the border duplicates the same way on every run.
+#
+# Tiles are independent and are run in a pool of worker processes.  The
+# combined crossings are de-duplicated and sorted like FindCrossings, so the
+# output tables are the same as the single-process engine's.
+#
+# The layers are sent to each worker once, when the pool starts.  A layer can
+# also be given as the folder of a layer written by columnar.py; the workers
+# then map the same files instead of receiving a copy.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import multiprocessing
+
+import numpy as np
+
+from crossings.columnar import ReadColumnar
+from crossings.engine import XY_TOLERANCE, ConcatCrossings, CrossingLayer, FindCrossings, UniqueCrossings
+
+# Quadtree tiles are not split below this depth.
+MAX_DEPTH = 12
+
+# The worker's layers, pipe boxes and settings, set up by _InitWorker.
+_worker = {}
+
+
+def _Layer(layer):
+    return ReadColumnar(layer) if isinstance(layer, str) else layer
+
+
+# Process: Extent (xmin, ymin, xmax, ymax) of a set of pipe boxes, grown a
+# little on the upper sides so points on the far edge belong to a tile.
+def Extent(boxSets):
+    boxes = np.concatenate([boxes for boxes in boxSets if len(boxes)] or [np.zeros((0, 4))])
+    boxes = boxes[~np.isnan(boxes).any(axis=1)]
+    if not len(boxes):
+        return np.array([0.0, 0.0, 1.0, 1.0])
+    extent = np.array([boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max()])
+    pad = max(extent[2] - extent[0], extent[3] - extent[1], 1.0) * 1e-9 + XY_TOLERANCE
+    extent[2:] += pad
+    return extent
+
+
+# Process: Regular grid of square-ish tiles, "across" tiles on the longer
+# side of the extent.  Returns an (ntiles, 4) array.
+def GridTiles(extent, across):
+    width = extent[2] - extent[0]
+    height = extent[3] - extent[1]
+    size = max(width, height) / max(int(across), 1)
+    columns = max(int(np.ceil(width / size)), 1)
+    rows = max(int(np.ceil(height / size)), 1)
+    xs = np.append(extent[0] + size * np.arange(columns), extent[2])
+    ys = np.append(extent[1] + size * np.arange(rows), extent[3])
+    return np.array([(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(columns) for j in range(rows)])
+
+
+def _Touching(boxes, tile):
+    return ((boxes[:, 0] <= tile[2]) & (boxes[:, 2] >= tile[0]) &
+            (boxes[:, 1] <= tile[3]) & (boxes[:, 3] >= tile[1]))
+
+
+# Process: Quadtree tiles.  A tile is split into four while more than
+# "maxPipes" pipes (of all the box sets together) touch it.
+def QuadTiles(extent, boxSets, maxPipes):
+    boxes = np.concatenate([boxes for boxes in boxSets if len(boxes)] or [np.zeros((0, 4))])
+    boxes = boxes[~np.isnan(boxes).any(axis=1)]
+    tiles = []
+    pending = [(np.asarray(extent, dtype=np.float64), np.arange(len(boxes)), 0)]
+    while pending:
+        tile, inside, depth = pending.pop()
+        if len(inside) <= maxPipes or depth >= MAX_DEPTH:
+            tiles.append(tile)
+            continue
+        midX = (tile[0] + tile[2]) / 2
+        midY = (tile[1] + tile[3]) / 2
+        for child in ((tile[0], tile[1], midX, midY), (midX, tile[1], tile[2], midY),
+                      (tile[0], midY, midX, tile[3]), (midX, midY, tile[2], tile[3])):
+            child = np.array(child)
+            pending.append((child, inside[_Touching(boxes[inside], child)], depth + 1))
+    tiles = np.array(tiles).reshape(-1, 4)
+    return tiles[np.lexsort((tiles[:, 1], tiles[:, 0]))]
+
+
+# Process: Tiles for a set of pipe layers: a quadtree when "maxPipes" is
+# given, otherwise a grid "across" tiles wide.
+def LayerTiles(layers, maxPipes=None, across=None):
+    boxSets = [layer.PipeBoxes() for layer in layers]
+    extent = Extent(boxSets)
+    if maxPipes:
+        return QuadTiles(extent, boxSets, maxPipes)
+    return GridTiles(extent, across or 1)
+
+
+# Process: Crossings of the pipes of "first" and "second" owned by one tile.
+# Pipe and vertex indexes refer to the full layers.
+def TileCrossings(first, second, tile, boxesA=None, boxesB=None, tolerance=XY_TOLERANCE, cellSize=None):
+    boxesA = first.PipeBoxes() if boxesA is None else boxesA
+    boxesB = second.PipeBoxes() if boxesB is None else boxesB
+    # Grown by the tolerance, since a crossing can sit that far off a pipe.
+    grown = np.asarray(tile) + np.array([-tolerance, -tolerance, tolerance, tolerance])
+    pipesA = np.nonzero(_Touching(boxesA, grown))[0]
+    pipesB = np.nonzero(_Touching(boxesB, grown))[0]
+    subA = first.Take(pipesA)
+    subB = second.Take(pipesB)
+    crossings = FindCrossings(subA, subB, tolerance, cellSize)
+    owned = ((crossings.x >= tile[0]) & (crossings.x < tile[2]) &
+             (crossings.y >= tile[1]) & (crossings.y < tile[3]))
+    crossings = crossings.Take(np.nonzero(owned)[0])
+    shiftA = first.partOffsets[first.pipeParts[pipesA]] - subA.partOffsets[subA.pipeParts[:-1]]
+    shiftB = second.partOffsets[second.pipeParts[pipesB]] - subB.partOffsets[subB.pipeParts[:-1]]
+    crossings.firstVertex = crossings.firstVertex + shiftA[crossings.first]
+    crossings.secondVertex = crossings.secondVertex + shiftB[crossings.second]
+    crossings.first = pipesA[crossings.first]
+    crossings.second = pipesB[crossings.second]
+    return crossings
+
+
+def _InitWorker(layers, tolerance, cellSize):
+    _worker.clear()
+    _worker["layers"] = dict((name, _Layer(layer)) for name, layer in layers.items())
+    _worker["boxes"] = dict((name, layer.PipeBoxes()) for name, layer in _worker["layers"].items())
+    _worker["tolerance"] = tolerance
+    _worker["cellSize"] = cellSize
+
+
+def _RunTile(task):
+    pair, firstName, secondName, tile = task
+    layers = _worker["layers"]
+    boxes = _worker["boxes"]
+    crossings = TileCrossings(layers[firstName], layers[secondName], tile, boxes[firstName], boxes[secondName],
+                              _worker["tolerance"], _worker["cellSize"])
+    return pair, crossings
+
+
+# Process: Crossings of several layer pairs, tile by tile.  "layers" maps
+# names to PipeLayers (or columnar folders) and "pairs" lists (first, second)
+# names.  Each pair is tiled separately.  Returns a list of Crossings, one per
+# pair, matching FindCrossings on the whole layers.
+def TiledCrossings(layers, pairs, maxPipes=None, across=None, workers=None, tolerance=XY_TOLERANCE, cellSize=None):
+    workers = workers or multiprocessing.cpu_count()
+    local = dict((name, _Layer(layer)) for name, layer in layers.items())
+    tasks = []
+    for pair, (firstName, secondName) in enumerate(pairs):
+        for tile in LayerTiles([local[firstName], local[secondName]], maxPipes, across):
+            tasks.append((pair, firstName, secondName, tile))
+
+    parts = [[] for pair in pairs]
+    if workers == 1:
+        _InitWorker(local, tolerance, cellSize)
+        results = [_RunTile(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(workers, _InitWorker, (layers, tolerance, cellSize))
+        try:
+            results = pool.map(_RunTile, tasks, 1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    for pair, crossings in results:
+        parts[pair].append(crossings)
+    return [UniqueCrossings(ConcatCrossings(part), tolerance) for part in parts]
+
+
+# Process: Tiled equivalent of engine.IntersectLayers for several pairs.
+# "pairs" lists (first, second, output name).  Returns the crossing point
+# layers in the same order.
+def TiledIntersectLayers(layers, pairs, maxPipes=None, across=None, workers=None, tolerance=XY_TOLERANCE,
+                         cellSize=None, exclude=()):
+    found = TiledCrossings(layers, [(first, second) for first, second, name in pairs], maxPipes, across, workers,
+                           tolerance, cellSize)
+    local = dict((name, _Layer(layer)) for name, layer in layers.items())
+    return [CrossingLayer(crossings, local[first], local[second], name, exclude)
+            for crossings, (first, second, name) in zip(found, pairs)]
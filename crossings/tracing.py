@@ -0,0 +1,290 @@
+#
+# -----------------------------------------------------------------------------
+#                                 tracing.py
+#
+# PURPOSE:
+#
+# Structured timing for the pipeline stages.  Every stage run through the
+# scheduler is wrapped in a span that records:
+#
+#   stage, start        stage name and local start time
+#   wallSeconds         elapsed time
+#   cpuSeconds          user + system CPU time of the process running it
+#   peakRssMB           peak resident memory of that process while the stage
+#                       ran (see StageMemory)
+#   rowsIn, rowsOut     rows in the stage's input and output datasets
+#   rowsPerSecond       rowsIn (or rowsOut when there are no inputs) / wall
+#
+# Spans are appended to a JSON-lines file as stages finish, and SummaryLines
+# gives a table of all of them for the end of the log.
+#
+# A stage can also be profiled without editing the script by setting
+#
+#   CROSSINGS_PROFILE=cprofile        (or pyinstrument, if it is installed)
+#   CROSSINGS_PROFILE_STAGES=SSSWVertSep,IntersectSWSS   (default: every stage)
+#
+# before the run.  Profiles are written next to the trace file as
+# <stage>.prof (load with pstats or snakeviz) or <stage>.html.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# None beyond the Python standard library.  pyinstrument is optional.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILERS = ("cprofile", "pyinstrument")
+
+# Seconds between resident memory samples where the peak cannot be reset.
+SAMPLE_SECONDS = 0.02
+
+
+def _WindowsCounters():
+    import ctypes
+    from ctypes import wintypes
+
+    class Counters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    counters = Counters()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return counters
+    return None
+
+
+# Process: Peak resident memory of this process in MB, or None if the
+# platform does not say.  After ResetPeakRss it is the peak since the reset.
+def PeakRssMB():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS.
+        return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+    if sys.platform == "win32":
+        counters = _WindowsCounters()
+        if counters is not None:
+            return counters.PeakWorkingSetSize / (1024.0 * 1024.0)
+    return None
+
+
+# Process: Resident memory of this process in MB right now, or None if the
+# platform does not say (Linux and Windows do).
+def RssMB():
+    if sys.platform == "win32":
+        counters = _WindowsCounters()
+        return counters.WorkingSetSize / (1024.0 * 1024.0) if counters is not None else None
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+
+
+# Process: The kernel's record of this process's peak resident memory
+# (VmHWM) in MB, or None where there is no /proc.
+def _HighWaterMB():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+# Process: Reset the peak resident memory of this process to its current
+# resident memory.  Returns False where that cannot be done (Linux before 4.0
+# and other platforms).
+def ResetPeakRss():
+    try:
+        with open("/proc/self/clear_refs", "w") as clearRefs:
+            clearRefs.write("5")
+    except (IOError, OSError):
+        return False
+    return _HighWaterMB() is not None
+
+
+# Peak resident memory of this process while one stage runs.  Where the
+# kernel's peak can be reset it is reset when the stage starts and read when
+# it stops.  Elsewhere the resident memory is sampled every SAMPLE_SECONDS on
+# a thread, which can miss a peak shorter than that; where the resident memory
+# is not known either (macOS) the peak is None.
+class StageMemory(object):
+
+    def __init__(self, interval=SAMPLE_SECONDS):
+        self.reset = ResetPeakRss()
+        self.peak = None if self.reset else RssMB()
+        self._stopped = threading.Event()
+        self._thread = None
+        if not self.reset and self.peak is not None:
+            self._thread = threading.Thread(target=self._Sample, args=(interval,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _Sample(self, interval):
+        while not self._stopped.wait(interval):
+            self._Update(RssMB())
+
+    def _Update(self, rss):
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    # Process: Stop watching and return the stage's peak in MB.
+    def Stop(self):
+        if self.reset:
+            return _HighWaterMB()
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._Update(RssMB())
+        return self.peak
+
+
+def CpuSeconds():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _Round(value, digits):
+    return None if value is None else round(value, digits)
+
+
+class Tracer(object):
+
+    # "path" is the JSON-lines file (None keeps spans in memory only).
+    # "counter" returns the row count of a dataset name, or None when the
+    # dataset does not exist; it must be a module-level function because the
+    # tracer is sent to the worker processes.
+    def __init__(self, path=None, counter=None, profile=None, profileStages=None, profileDir=None):
+        if profile and profile not in PROFILERS:
+            raise ValueError("Unknown profiler %s, expected one of %s" % (profile, ", ".join(PROFILERS)))
+        self.path = path
+        self.counter = counter
+        self.profile = profile
+        self.profileStages = set(profileStages) if profileStages else None
+        self.profileDir = profileDir or (os.path.dirname(path) if path else None) or os.getcwd()
+        self.spans = []
+
+    # The tracer is pickled for every stage sent to a worker; the spans stay
+    # in the main process.
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["spans"] = []
+        return state
+
+    # Process: Tracer with the profiling switches read from the environment.
+    @classmethod
+    def FromEnvironment(cls, path=None, counter=None, profileDir=None):
+        profile = os.environ.get("CROSSINGS_PROFILE", "").strip().lower() or None
+        stages = [name.strip() for name in os.environ.get("CROSSINGS_PROFILE_STAGES", "").split(",")
+                  if name.strip()]
+        return cls(path, counter, profile, stages, profileDir)
+
+    def _Count(self, datasets):
+        if self.counter is None:
+            return None
+        counts = [self.counter(dataset) for dataset in datasets]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+
+    def _Profiles(self, name):
+        return self.profile and (self.profileStages is None or name in self.profileStages)
+
+    # Process: Run one stage and return its span.  Called in the process that
+    # runs the stage; exceptions from the stage are passed on.
+    def Trace(self, name, func, args=(), inputs=(), outputs=()):
+        rowsIn = self._Count(inputs)
+        profiler = None
+        if self._Profiles(name):
+            profiler = _StartProfiler(self.profile)
+        started = time.localtime()
+        memory = StageMemory()
+        wallStart = time.time()
+        cpuStart = CpuSeconds()
+        try:
+            func(*args)
+        finally:
+            wall = time.time() - wallStart
+            cpu = CpuSeconds() - cpuStart
+            peak = memory.Stop()
+            if profiler is not None:
+                _SaveProfile(self.profile, profiler, os.path.join(self.profileDir, name))
+        rowsOut = self._Count(outputs)
+        rows = rowsIn if rowsIn else rowsOut
+        return collections.OrderedDict([
+            ("stage", name), ("start", time.strftime("%Y-%m-%dT%H:%M:%S", started)), ("pid", os.getpid()),
+            ("wallSeconds", round(wall, 3)), ("cpuSeconds", round(cpu, 3)),
+            ("peakRssMB", _Round(peak, 1)), ("rowsIn", rowsIn), ("rowsOut", rowsOut),
+            ("rowsPerSecond", round(rows / wall, 1) if rows and wall > 0 else None)])
+
+    # Process: Keep a finished span and append it to the trace file.  Called
+    # in the main process only, so the file has a single writer.
+    def Record(self, span):
+        self.spans.append(span)
+        if self.path:
+            _MakeFolder(os.path.dirname(self.path))
+            with open(self.path, "a") as trace:
+                trace.write(json.dumps(span) + "\n")
+
+    # Process: Table of every span, slowest first.
+    def SummaryLines(self):
+        header = "%-24s %9s %9s %9s %10s %10s %10s" % ("Stage", "Wall s", "CPU s", "Peak MB", "Rows in",
+                                                       "Rows out", "Rows/s")
+        lines = [header, "-" * len(header)]
+        show = lambda value, format: "-" if value is None else format % value
+        for span in sorted(self.spans, key=lambda span: -span["wallSeconds"]):
+            lines.append("%-24s %9.2f %9.2f %9s %10s %10s %10s" % (
+                span["stage"], span["wallSeconds"], span["cpuSeconds"], show(span["peakRssMB"], "%.1f"),
+                show(span["rowsIn"], "%d"), show(span["rowsOut"], "%d"), show(span["rowsPerSecond"], "%.0f")))
+        return lines
+
+
+def _MakeFolder(folder):
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+
+
+def _StartProfiler(profile):
+    if profile == "pyinstrument":
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def _SaveProfile(profile, profiler, basePath):
+    _MakeFolder(os.path.dirname(basePath))
+    if profile == "pyinstrument":
+        profiler.stop()
+        with open(basePath + ".html", "w") as output:
+            output.write(profiler.output_html())
+    else:
+        profiler.disable()
+        profiler.dump_stats(basePath + ".prof")
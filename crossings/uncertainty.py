@@ -0,0 +1,195 @@
+#
+# -----------------------------------------------------------------------------
+#                                 uncertainty.py
+#
+# PURPOSE:
+#
+# How sure the vertical separation at a storm/sewer crossing is.  VertSep is
+# worked out from surveyed inverts of mixed quality, a straight-line
+# interpolation along each pipe and nominal diameters, so a "No" in PipeInter
+# can be a near thing.  Here each crossing is recomputed for many random
+# perturbations of its inputs at once, as a (crossings x samples) array:
+#
+# 1. Each pipe's upstream and downstream inverts are off by a normal error of
+#    invertFeet, and the crossing's position along the pipe by locationFeet.
+#    For the straight-line interpolation these add up to one normal error of
+#    the invert at the crossing, with variance
+#        invertFeet^2 * ((1 - w)^2 + w^2) + (slope * locationFeet)^2
+#    where w is how far along the pipe the crossing is (0-1).  The errors of
+#    the two pipes are independent, so SW_Invert - SS_Invert gets one normal
+#    draw per sample with the sum of their variances.
+# 2. The diameter of the lower pipe is off by a normal error of
+#    diameterInches (never below 0).  Only the lower pipe's diameter enters
+#    VertSep, so one draw per sample is enough.
+# 3. VertSep is taken as in vertsep.py for every sample.  PConflict is the
+#    share of samples where it is negative (the pipes intersect), and
+#    VertSepLo/VertSepHi bound the middle "confidence" of the samples.
+#
+# Crossings without both inverts at the crossing or a diameter are left NULL.
+# The crossings are done in chunks sized to memoryMB, and the draws of each
+# crossing do not depend on the chunk size, so the result only depends on the
+# seed.
+#
+#   AddVertSepUncertainty(swssIntersect, samples=1000)
+#
+# "python -m crossings.uncertainty --crossings 100000 --samples 1000" times
+# the estimate on random crossings.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import json
+import time
+
+import numpy as np
+
+from crossings.geometry import MakeField
+
+# Standard errors of the inputs: inverts and crossing position in feet,
+# diameters in inches.
+Uncertainty = collections.namedtuple("Uncertainty", "invertFeet diameterInches locationFeet")
+
+DEFAULT_UNCERTAINTY = Uncertainty(0.1, 0.5, 1.0)
+
+# Fields read from SWSSIntersect once vertsep.py has run.
+INPUT_FIELDS = ("SS_Invert", "SW_Invert", "Snslope", "SWslope", "SS_Length", "SW_Length", "SnLength",
+                "SWLength", "SnDiam", "SWDiam")
+
+UNCERTAINTY_FIELDS = [MakeField("PConflict", "DOUBLE", None, "Probability Pipes Intersect"),
+                      MakeField("VertSepLo", "DOUBLE", None, "Vertical Separation Lower Bound"),
+                      MakeField("VertSepHi", "DOUBLE", None, "Vertical Separation Upper Bound")]
+
+# Normal draws per crossing and sample: the invert difference and the lower
+# pipe's diameter.
+DRAWS = 2
+
+
+def _Generator(seed):
+    if hasattr(np.random, "default_rng"):
+        return np.random.default_rng(seed)
+    return np.random.RandomState(seed)
+
+
+def _Normal(rng, shape):
+    if hasattr(rng, "integers"):
+        return rng.standard_normal(shape, dtype=np.float32)
+    return rng.standard_normal(shape).astype(np.float32)
+
+
+# Process: Standard error of the invert at each crossing of one pipe, from
+# the distance along the pipe, the pipe length and slope (%).
+def InvertSigma(along, length, slope, uncertainty=DEFAULT_UNCERTAINTY):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w = np.where(length > 0, np.clip(along / length, 0, 1), 0.0)
+    variance = uncertainty.invertFeet ** 2 * ((1 - w) ** 2 + w ** 2) + (slope / 100 * uncertainty.locationFeet) ** 2
+    return np.sqrt(variance)
+
+
+# Process: Rows per chunk that keep the sample arrays of a chunk within
+# about memoryMB.
+def ChunkRows(samples, memoryMB):
+    bytesPerRow = samples * 4 * (DRAWS + 3)
+    return max(1, int(memoryMB * 1024 * 1024 // bytesPerRow))
+
+
+def _Chunk(rng, difference, sigma, snDiam, swDiam, samples, uncertainty, bounds):
+    draws = _Normal(rng, (len(difference), DRAWS, samples))
+    # SW_Invert - SS_Invert of every sample; storm is over sewer where it is
+    # positive.
+    separation = draws[:, 0]
+    separation *= sigma[:, None]
+    separation += difference[:, None]
+    stormOver = separation > 0
+    diameter = np.where(stormOver, snDiam[:, None], swDiam[:, None])
+    diameter += uncertainty.diameterInches * draws[:, 1]
+    np.maximum(diameter, 0, out=diameter)
+    diameter /= 12
+    np.abs(separation, out=separation)
+    vertSep = separation
+    vertSep -= diameter
+    conflict = np.count_nonzero(vertSep < 0, axis=1) / samples
+    ordered = np.partition(vertSep, bounds, axis=1)
+    return conflict, ordered[:, bounds[0]], ordered[:, bounds[1]]
+
+
+# Process: PConflict, VertSepLo and VertSepHi of every crossing.  "columns"
+# maps each name in INPUT_FIELDS to an array.  Returns an ordered dict of the
+# arrays for UNCERTAINTY_FIELDS.
+def VertSepUncertainty(columns, samples=1000, uncertainty=DEFAULT_UNCERTAINTY, confidence=0.9, seed=1,
+                       memoryMB=256):
+    get = lambda name: np.asarray(columns[name], dtype=np.float64)
+    uncertainty = Uncertainty(*uncertainty)
+    count = len(get("SS_Invert"))
+    sigma = np.hypot(InvertSigma(get("SS_Length"), get("SnLength"), get("Snslope"), uncertainty),
+                     InvertSigma(get("SW_Length"), get("SWLength"), get("SWslope"), uncertainty))
+    difference = get("SW_Invert") - get("SS_Invert")
+    snDiam = get("SnDiam")
+    swDiam = get("SWDiam")
+    valid = np.nonzero(np.isfinite(difference) & np.isfinite(sigma) & np.isfinite(snDiam) & np.isfinite(swDiam))[0]
+
+    tail = (1 - confidence) / 2
+    bounds = [int(np.floor(tail * (samples - 1))), int(np.ceil((1 - tail) * (samples - 1)))]
+    results = [np.full(count, np.nan) for field in UNCERTAINTY_FIELDS]
+    rng = _Generator(seed)
+    step = ChunkRows(samples, memoryMB)
+    for start in range(0, len(valid), step):
+        rows = valid[start:start + step]
+        chunk = _Chunk(rng, difference[rows].astype(np.float32), sigma[rows].astype(np.float32),
+                       snDiam[rows].astype(np.float32), swDiam[rows].astype(np.float32), samples, uncertainty,
+                       bounds)
+        for result, values in zip(results, chunk):
+            result[rows] = values
+    return collections.OrderedDict(zip([field.name for field in UNCERTAINTY_FIELDS], results))
+
+
+# Process: Apply VertSepUncertainty to a native SWSSIntersect PointLayer that
+# already has the vertsep.py fields.
+def AddVertSepUncertainty(layer, samples=1000, uncertainty=DEFAULT_UNCERTAINTY, confidence=0.9, seed=1,
+                          memoryMB=256):
+    columns = dict((name, layer.columns[name]) for name in INPUT_FIELDS)
+    derived = VertSepUncertainty(columns, samples, uncertainty, confidence, seed, memoryMB)
+    for field in UNCERTAINTY_FIELDS:
+        if field.name in layer.columns:
+            layer.columns[field.name] = derived[field.name]
+        else:
+            layer.AddColumn(field, derived[field.name])
+    return layer
+
+
+# Process: Random crossings with every INPUT_FIELDS column, for timing.
+def RandomCrossings(count, seed=1):
+    rng = np.random.RandomState(seed)
+    columns = {"SS_Invert": rng.uniform(90, 100, count), "SW_Invert": rng.uniform(90, 100, count),
+               "Snslope": rng.uniform(0, 2, count), "SWslope": rng.uniform(0, 2, count),
+               "SnLength": rng.uniform(50, 400, count), "SWLength": rng.uniform(50, 400, count),
+               "SnDiam": rng.choice([6.0, 8.0, 12.0], count), "SWDiam": rng.choice([15.0, 24.0, 36.0], count)}
+    columns["SS_Length"] = columns["SnLength"] * rng.random_sample(count)
+    columns["SW_Length"] = columns["SWLength"] * rng.random_sample(count)
+    return columns
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the VertSep uncertainty estimate on random crossings.")
+    parser.add_argument("--crossings", type=int, default=100000)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--memory-mb", type=float, default=256)
+    args = parser.parse_args(argv)
+    columns = RandomCrossings(args.crossings)
+    start = time.time()
+    derived = VertSepUncertainty(columns, args.samples, memoryMB=args.memory_mb)
+    seconds = time.time() - start
+    print(json.dumps({"crossings": args.crossings, "samples": args.samples, "seconds": round(seconds, 3),
+                      "meanPConflict": round(float(np.nanmean(derived["PConflict"])), 4)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#
+# -----------------------------------------------------------------------------
+#                                 vertsep.py
+#
+# PURPOSE:
+#
+# Vertical separation at the storm/sewer crossings (SWSSIntersect) computed in
+# one columnar pass.  Each rule below used to be its own SelectLayerByAttribute
+# and CalculateField_management over the whole table; here every derived field
+# is computed from NumPy arrays and the rows are written back once.
+#
+# The rules are the same as before:
+#
+# 1. Sewer inverts of 0 and storm inverts of 0 or -9999 are placeholders and
+#    become NULL.  Storm diameters of -9999 become 0.  When the crossings
+#    carry the pipes' QA flags (SnQAFlags, SWQAFlags, see quality.py) these
+#    rows are picked out by the flag bits instead of testing each value again.
+# 2. Slope (%) of each pipe = (upstream invert - downstream invert) / length * 100.
+# 3. Distance from the upstream end of each pipe to the crossing (SS_Length,
+#    SW_Length) and the invert at the crossing (SS_Invert, SW_Invert).  The
+#    distance is measured along the pipe: the crossings from engine.py carry
+#    it (Chainage_snPipes, Chainage_swPipes); for crossings without it the
+#    segment each crossing lies on is found through the grid index and
+#    measured with the pipe's chainage index (see PipeLayer.Chainage).  With
+#    neither it is the straight line from SSUpX,SSUpY or SWUpX,SWUpY.
+# 4. VertSep is the distance from the top of the lower pipe (diameter / 12 to
+#    get feet) to the invert of the upper pipe.
+# 5. CrossTy says which pipe is on top, "Bad Data?" when VertSep is over 20 ft,
+#    and which data is missing when an invert could not be estimated.
+# 6. PipeInter is "Yes" when VertSep is negative and "No" when positive.
+#
+# The arithmetic of rules 2 to 4 is the CalculateField expressions SSSWVertSep
+# used, kept as they were written (CALCULATIONS) and compiled to one NumPy
+# function by expressions.py.
+#
+# NULL is NaN for numeric fields and None for text fields.  Comparisons with
+# NULL are false, the same as in the attribute queries they replace.
+#
+# -----------------------------------------------------------------------------
+# DEPENDENCIES:
+#
+# 1).  NumPy.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+
+import numpy as np
+
+from crossings import quality
+from crossings.engine import CHAINAGE_PREFIX, XY_TOLERANCE
+from crossings.expressions import FieldCalculator
+from crossings.geometry import MakeField
+from crossings.spatialindex import OverlappingPairs
+
+# Fields read from SWSSIntersect.  The crossing location is passed in as well,
+# as POINT_X/POINT_Y.
+INPUT_FIELDS = ("SnUpinvert", "SnDninvert", "SnLength", "SnDiam", "SSUpX", "SSUpY",
+                "SWUpinvert", "SWDninvert", "SWLength", "SWDiam", "SWUpX", "SWUpY")
+
+# Object IDs of the sewer and storm pipe at each crossing.
+PIPE_ID_FIELDS = ("FID_snPipes", "FID_swPipes")
+
+# QA flags of the sewer and storm pipe at each crossing, read when present.
+QA_FIELDS = ("SnQAFlags", "SWQAFlags")
+
+# Distance along the sewer and storm pipe to each crossing, read when present.
+CHAINAGE_FIELDS = (CHAINAGE_PREFIX + "snPipes", CHAINAGE_PREFIX + "swPipes")
+
+# Farthest a crossing without chainage (from gp.Intersect_analysis) may lie
+# from its pipe: the XY tolerance, with room for both pipes being snapped.
+LOCATE_TOLERANCE = 10 * XY_TOLERANCE
+
+# Input fields rewritten by the placeholder cleanup.
+CLEANED_FIELDS = [MakeField("SnUpinvert", "DOUBLE", None, "Sewer Upstream Invert"),
+                  MakeField("SnDninvert", "DOUBLE", None, "Sewer Downstream Invert"),
+                  MakeField("SWUpinvert", "DOUBLE", None, "Stormwater Upstream Invert"),
+                  MakeField("SWDninvert", "DOUBLE", None, "Stormwater Downstream Invert"),
+                  MakeField("SWDiam", "SHORT", None, "Stormwater Diameter")]
+
+# Fields added to SWSSIntersect, in the order they were added by SSSWVertSep.
+DERIVED_FIELDS = [MakeField("POINT_X", "DOUBLE"),
+                  MakeField("POINT_Y", "DOUBLE"),
+                  MakeField("Snslope", "DOUBLE", None, "Sewer Slope Calculated(%)"),
+                  MakeField("SWslope", "DOUBLE", None, "Stormwater Slope Calculated(%)"),
+                  MakeField("SS_Length", "DOUBLE", None, "Sewer Pipe Length"),
+                  MakeField("SW_Length", "DOUBLE", None, "Storm Pipe Length"),
+                  MakeField("SS_Invert", "DOUBLE", None, "Sewer Invert"),
+                  MakeField("SW_Invert", "DOUBLE", None, "Storm Invert"),
+                  MakeField("CrossTy", "TEXT", 30, "Crossing Type"),
+                  MakeField("VertSep", "DOUBLE", None, "Vertical Separation"),
+                  MakeField("PipeInter", "TEXT", 20, "Do Pipes Intersect")]
+
+OUTPUT_FIELDS = CLEANED_FIELDS + DERIVED_FIELDS
+
+# VertSep above this many feet is flagged as "Bad Data?".
+BAD_DATA_FEET = 20
+
+# The field calculations of SSSWVertSep.  VertSep was calculated with the
+# first expression where storm is over sewer and the second where sewer is
+# over storm; they are StormOverSep and SewerOverSep here.
+CALCULATIONS = [
+    ("Snslope", "(([SnUpinvert]-[SnDninvert])/[SnLength])*100"),
+    ("SWslope", "(([SWUpinvert]-[SWDninvert])/[SWLength])*100"),
+    ("SS_Length", "Sqr (( [SSUpX]- [POINT_X])^2+( [SSUpY]- [POINT_Y])^2  )"),
+    ("SW_Length", "Sqr (( [SWUpX]- [POINT_X])^2+( [SWUpY]- [POINT_Y])^2  )"),
+    ("SS_Invert", "[SnUpinvert]-( [Snslope]/100* [SS_Length])"),
+    ("SW_Invert", "[SWUpinvert]-( [SWslope]/100* [SW_Length])"),
+    ("StormOverSep", "[SW_Invert]- ([SS_Invert]+([SnDiam]/12))"),
+    ("SewerOverSep", "[SS_Invert]- ([SW_Invert]+([SWDiam]/12))")]
+
+CALCULATOR = FieldCalculator(CALCULATIONS)
+
+CALCULATED = ("Snslope", "SWslope", "SS_Length", "SW_Length", "SS_Invert", "SW_Invert", "StormOverSep",
+              "SewerOverSep")
+
+
+def _Nulled(values, placeholders):
+    values = np.array(values, dtype=np.float64)
+    for placeholder in placeholders:
+        values[values == placeholder] = np.nan
+    return values
+
+
+def _Masked(values, mask):
+    values = np.array(values, dtype=np.float64)
+    values[mask] = np.nan
+    return values
+
+
+def _Labels(count):
+    return np.empty(count, dtype=object)
+
+
+# Process: Segment of pipe "pipes" of "layer" that each point x, y lies on,
+# and the position (0-1) along it.  The points are matched to the segments
+# near them through the grid index, so a pipe with many crossings is not
+# walked again for each one.  Returns (vertex, t); vertex is -1 for pipe
+# index -1 and for points farther than "tolerance" from their pipe.
+def LocateOnPipes(layer, pipes, x, y, tolerance=LOCATE_TOLERANCE):
+    pipes = np.asarray(pipes, dtype=np.int64)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    vertex = np.full(len(pipes), -1, dtype=np.int64)
+    position = np.full(len(pipes), np.nan)
+    start, segmentPipes = layer.Segments()
+    valid = np.nonzero((pipes >= 0) & np.isfinite(x) & np.isfinite(y))[0]
+    if not len(valid) or not len(start):
+        return vertex, position
+    px, py = x[valid], y[valid]
+    boxes = np.column_stack((px - tolerance, py - tolerance, px + tolerance, py + tolerance))
+    points, segments = OverlappingPairs(boxes, layer.SegmentBoxes())
+    own = segmentPipes[segments] == pipes[valid][points]
+    points, segments = points[own], segments[own]
+    p0 = layer.coords[start[segments]]
+    delta = layer.coords[start[segments] + 1] - p0
+    dx = px[points] - p0[:, 0]
+    dy = py[points] - p0[:, 1]
+    lengthSquared = delta[:, 0] ** 2 + delta[:, 1] ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.clip((dx * delta[:, 0] + dy * delta[:, 1]) / lengthSquared, 0.0, 1.0)
+    t[lengthSquared == 0] = 0.0
+    distance = (dx - t * delta[:, 0]) ** 2 + (dy - t * delta[:, 1]) ** 2
+    near = distance <= tolerance ** 2
+    points, segments, t, distance = points[near], segments[near], t[near], distance[near]
+    order = np.lexsort((distance, points))
+    best = order[np.concatenate(([True], points[order][1:] != points[order][:-1]))] if len(order) else order
+    vertex[valid[points[best]]] = start[segments[best]]
+    position[valid[points[best]]] = t[best]
+    return vertex, position
+
+
+# Process: Distance along the sewer and storm pipe from its upstream end to
+# each crossing, for crossings that do not carry CHAINAGE_FIELDS.  "columns"
+# holds PIPE_ID_FIELDS, POINT_X and POINT_Y; "sewer" and "storm" are the
+# snPipes and swPipes layers.
+def AlongPipeLengths(columns, sewer, storm):
+    lengths = []
+    for layer, name in zip((sewer, storm), PIPE_ID_FIELDS):
+        located = LocateOnPipes(layer, layer.OIDIndex(columns[name]), columns["POINT_X"], columns["POINT_Y"])
+        lengths.append(layer.Measure(*located))
+    return tuple(lengths)
+
+
+# Process: Compute every derived field from the input columns.  "columns" maps
+# each name in INPUT_FIELDS, POINT_X and POINT_Y (and optionally QA_FIELDS) to
+# an array; "lengths" is
+# optionally the (SS_Length, SW_Length) pair from AlongPipeLengths.  Returns an
+# ordered dict of the arrays for OUTPUT_FIELDS.
+def VerticalSeparation(columns, lengths=None):
+    get = lambda name: np.asarray(columns[name], dtype=np.float64)
+    count = len(get("POINT_X"))
+
+    swDiam = get("SWDiam").copy()
+    if all(name in columns for name in QA_FIELDS):
+        snFlags, swFlags = [quality.Flags(columns[name]) for name in QA_FIELDS]
+        snUp = _Masked(get("SnUpinvert"), quality.Mask(snFlags, quality.UP_SENTINEL))
+        snDn = _Masked(get("SnDninvert"), quality.Mask(snFlags, quality.DN_SENTINEL))
+        swUp = _Masked(get("SWUpinvert"), quality.Mask(swFlags, quality.UP_SENTINEL))
+        swDn = _Masked(get("SWDninvert"), quality.Mask(swFlags, quality.DN_SENTINEL))
+        swDiam[quality.Mask(swFlags, quality.DIAMETER_SENTINEL)] = 0
+    else:
+        snUp = _Nulled(get("SnUpinvert"), [0])
+        snDn = _Nulled(get("SnDninvert"), [0])
+        swUp = _Nulled(get("SWUpinvert"), [0, -9999])
+        swDn = _Nulled(get("SWDninvert"), [0, -9999])
+        swDiam[swDiam == -9999] = 0
+    pointX = get("POINT_X")
+    pointY = get("POINT_Y")
+
+    inputs = dict(columns)
+    inputs.update(SnUpinvert=snUp, SnDninvert=snDn, SWUpinvert=swUp, SWDninvert=swDn, SWDiam=swDiam)
+    given = ()
+    if lengths is not None:
+        inputs["SS_Length"], inputs["SW_Length"] = [np.asarray(length, dtype=np.float64) for length in lengths]
+        given = ("SS_Length", "SW_Length")
+    (snSlope, swSlope, ssLength, swLength, ssInvert, swInvert, stormOverSep,
+     sewerOverSep) = CALCULATOR.Evaluate(inputs, CALCULATED, given).values()
+
+    stormOver = swInvert > ssInvert
+    sewerOver = ssInvert > swInvert
+    vertSep = np.full(count, np.nan)
+    vertSep[stormOver] = stormOverSep[stormOver]
+    vertSep[sewerOver] = sewerOverSep[sewerOver]
+
+    crossTy = _Labels(count)
+    crossTy[stormOver] = "Storm over Sewer"
+    crossTy[sewerOver] = "Sewer over Storm"
+    crossTy[vertSep > BAD_DATA_FEET] = "Bad Data?"
+    ssMissing = np.isnan(ssInvert)
+    swMissing = np.isnan(swInvert)
+    unset = np.equal(crossTy, None)
+    crossTy[unset & ssMissing & swMissing] = "Sewer and Storm Missing"
+    crossTy[unset & ssMissing & ~swMissing] = "Sewer Data Missing"
+    crossTy[unset & swMissing & ~ssMissing] = "Storm Data Missing"
+
+    pipeInter = _Labels(count)
+    pipeInter[vertSep < 0] = "Yes"
+    pipeInter[vertSep > 0] = "No"
+
+    values = (snUp, snDn, swUp, swDn, swDiam, pointX, pointY, snSlope, swSlope, ssLength, swLength,
+              ssInvert, swInvert, crossTy, vertSep, pipeInter)
+    return collections.OrderedDict(zip([field.name for field in OUTPUT_FIELDS], values))
+
+
+# Process: Apply VerticalSeparation to a native SWSSIntersect PointLayer.  The
+# crossing location becomes POINT_X/POINT_Y, like gp.AddXY_management.  The
+# lengths along the pipes are "lengths" when given, else the layer's
+# CHAINAGE_FIELDS, else measured on the sewer and storm pipe layers when
+# those are given.
+def AddVerticalSeparation(layer, sewer=None, storm=None, lengths=None):
+    columns = dict((name, layer.columns[name]) for name in INPUT_FIELDS + QA_FIELDS if name in layer.columns)
+    columns["POINT_X"] = layer.x
+    columns["POINT_Y"] = layer.y
+    if lengths is None and all(name in layer.columns for name in CHAINAGE_FIELDS):
+        lengths = tuple(layer.columns[name] for name in CHAINAGE_FIELDS)
+    if lengths is None and sewer is not None and storm is not None:
+        for name in PIPE_ID_FIELDS:
+            columns[name] = layer.columns[name]
+        lengths = AlongPipeLengths(columns, sewer, storm)
+    derived = VerticalSeparation(columns, lengths)
+    for field in OUTPUT_FIELDS:
+        if field.name in layer.columns:
+            layer.columns[field.name] = derived[field.name]
+        else:
+            layer.AddColumn(field, derived[field.name])
+    return layer
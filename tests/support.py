@@ -0,0 +1,53 @@
+#
+# -----------------------------------------------------------------------------
+#                                 support.py
+#
+# PURPOSE:
+#
+# Shared helpers for the tests: puts the repository on the path (so the tests
+# can import the crossings package and the script) and builds small pipe
+# networks.
+#
+# ==============================================================================
+#
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from crossings import benchmark, synthetic  # noqa: E402
+
+PIPE_LAYERS = ("swPipes", "snPipes", "wnPipes")
+
+
+# Process: The merged swPipes, snPipes and wnPipes layers (and the seven field
+# mapped classes) of a synthetic network, as the script has them after
+# loading the pipes.
+def PipeNetwork(pipes=2000, seed=1):
+    data = {"sources": synthetic.SyntheticNetwork(pipes, seed=seed)}
+    benchmark.Ingest(data)
+    benchmark.Merge(data)
+    return data
+
+
+# Process: The network with every stage of the benchmark run, up to the
+# AllIntersections layer.
+def CrossingNetwork(pipes=2000, seed=1):
+    data = PipeNetwork(pipes, seed)
+    for name, stage in benchmark.STAGES[2:]:
+        stage(data)
+    return data
+
+
+# Process: A temporary folder removed when the test case finishes.
+def TemporaryFolder(testCase):
+    folder = tempfile.mkdtemp(prefix="crossings")
+    testCase.addCleanup(shutil.rmtree, folder, True)
+    return folder
@@ -0,0 +1,53 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+
+from support import PipeNetwork
+
+from crossings import allpairs
+from crossings.engine import CROSSING_ARRAYS, FindCrossings, IntersectLayers
+from crossings.geometry import PipeLayer
+
+
+class AllPairsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        data = PipeNetwork(3000)
+        cls.layers = dict((name, data[name]) for name in ("swPipes", "snPipes", "wnPipes"))
+        # A fourth utility: the water mains moved over, standing in for gas.
+        water = data["wnPipes"]
+        cls.layers["gnPipes"] = PipeLayer("gnPipes", water.coords + (35.0, -20.0), water.partOffsets,
+                                          water.pipeParts, water.fields, water.columns, water.oids)
+        cls.pairs = list(allpairs.DEFAULT_PAIRS) + [("gnPipes", "swPipes", "SWGIntersect", "Gas-Storm"),
+                                                    ("snPipes", "gnPipes", "SSGIntersect", "Sewer-Gas")]
+
+    # Each pair from the shared index is the crossings of its two layers.
+    def test_matches_find_crossings(self):
+        found = allpairs.FindAllCrossings(self.layers, self.pairs)
+        self.assertEqual(len(found), 5)
+        for crossings, pair in zip(found, self.pairs):
+            expected = FindCrossings(self.layers[pair[0]], self.layers[pair[1]])
+            self.assertGreater(len(expected), 0)
+            for name in CROSSING_ARRAYS:
+                np.testing.assert_array_equal(getattr(crossings, name), getattr(expected, name), name)
+
+    def test_layers(self):
+        points = allpairs.IntersectAllPairs(self.layers, self.pairs[3:])
+        self.assertEqual([layer.name for layer in points], ["SWGIntersect", "SSGIntersect"])
+        expected = IntersectLayers(self.layers["gnPipes"], self.layers["swPipes"], "SWGIntersect")
+        self.assertEqual([field.name for field in points[0].fields],
+                         [field.name for field in expected.fields] + ["InterType"])
+        self.assertEqual(set(points[0].columns["InterType"]), set(["Gas-Storm"]))
+        np.testing.assert_array_equal(points[0].x, expected.x)
+
+    def test_pair_layers(self):
+        self.assertEqual(allpairs.PairLayers(self.pairs), ["snPipes", "swPipes", "wnPipes", "gnPipes"])
+        self.assertRaises(ValueError, allpairs.FindAllCrossings, self.layers,
+                          [("snPipes", "snPipes", "Self", "Sewer-Sewer")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+from support import PipeNetwork
+
+from crossings import benchmark
+from crossings.allpairs import DEFAULT_PAIRS
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    # Each utility pair is its own stage, counting its own crossings.
+    def test_intersect_stages(self):
+        data = PipeNetwork(1500)
+        stages = benchmark.RunStages(data, benchmark.STAGES[2:])
+        self.assertEqual([stage["stage"] for stage in stages],
+                         ["xy", "validate", "intersect SWSS", "intersect SWW", "intersect SSW", "vertsep",
+                          "final write"])
+        records = dict((stage["stage"], stage["records"]) for stage in stages)
+        for pair in DEFAULT_PAIRS:
+            count = records["intersect " + pair.output.replace("Intersect", "")]
+            self.assertEqual(count, len(data[pair.output]))
+            self.assertGreater(count, 0)
+        self.assertEqual(records["final write"], sum(len(data[pair.output]) for pair in DEFAULT_PAIRS))
+
+    def test_crossing_counts(self):
+        run = benchmark.Benchmark(1000)
+        stages = dict((stage["stage"], stage["records"]) for stage in run["stages"])
+        self.assertEqual(stages["intersect SWSS"], run["crossings"]["SWSSIntersect"])
+        self.assertEqual(stages["ingest"], run["pipes"])
+
+
+if __name__ == "__main__":
+    unittest.main()
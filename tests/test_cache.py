@@ -0,0 +1,104 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import unittest
+
+from support import TemporaryFolder
+
+from crossings import cache
+from crossings.scheduler import Scheduler, Stage, StageError
+
+
+# Process: A stage that writes "text" after the contents of its inputs, and
+# notes that it ran in the "runs" file.  It fails while "failFile" exists.
+def _Append(runs, name, inputs, output, text, failFile=None):
+    with open(runs, "a") as log:
+        log.write(name + "\n")
+    if failFile and os.path.exists(failFile):
+        raise ValueError("%s failed" % name)
+    contents = []
+    for path in inputs:
+        with open(path) as source:
+            contents.append(source.read())
+    with open(output, "w") as target:
+        target.write("".join(contents) + text)
+
+
+class StageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = TemporaryFolder(self)
+        self.runs = os.path.join(self.folder, "runs.txt")
+        self.failFile = os.path.join(self.folder, "fail")
+        self.cache = cache.StageCache(os.path.join(self.folder, "cache"), cache.SaveFiles, cache.RestoreFiles,
+                                      ("20240102",))
+
+    def Path(self, name):
+        return os.path.join(self.folder, name)
+
+    def Stages(self, storm="storm;"):
+        def Step(name, inputs, output, text, failFile=None):
+            inputs = [self.Path(dataset) for dataset in inputs]
+            return Stage(_Append, inputs, [self.Path(output)], (self.runs, name, inputs, self.Path(output), text,
+                                                                failFile), name)
+        return [Step("CopyStorm", [], "swPipes", storm),
+                Step("CopySewer", [], "snPipes", "sewer;"),
+                Step("IntersectSWSS", ["snPipes", "swPipes"], "SWSSIntersect", "crossings;", self.failFile),
+                Step("AllIntersections", ["SWSSIntersect"], "AllIntersections", "all;")]
+
+    def Run(self, stages):
+        if os.path.exists(self.runs):
+            os.remove(self.runs)
+        Scheduler(stages, cache=self.cache).Run()
+        ran = []
+        if os.path.exists(self.runs):
+            with open(self.runs) as log:
+                ran = log.read().split()
+        with open(self.Path("AllIntersections")) as output:
+            return ran, output.read()
+
+    # A run that failed resumes at the failed stage; a finished run is
+    # restored from the cache without running anything.
+    def test_skip_and_restore(self):
+        open(self.failFile, "w").close()
+        self.assertRaises(StageError, Scheduler(self.Stages(), cache=self.cache).Run)
+        os.remove(self.failFile)
+        ran, output = self.Run(self.Stages())
+        self.assertEqual(ran, ["IntersectSWSS", "AllIntersections"])
+        self.assertEqual(output, "sewer;storm;crossings;all;")
+
+        for name in ("swPipes", "snPipes", "SWSSIntersect", "AllIntersections"):
+            os.remove(self.Path(name))
+        plan = self.cache.Plan(self.Stages(), Scheduler(self.Stages()).depends)
+        self.assertEqual([plan[stage.name][0] for stage in self.Stages()],
+                         [cache.RESTORE, cache.RESTORE, cache.RESTORE, cache.RESTORE])
+        self.assertEqual(self.Run(self.Stages()), ([], "sewer;storm;crossings;all;"))
+        for name in ("swPipes", "snPipes", "SWSSIntersect"):
+            self.assertTrue(os.path.exists(self.Path(name)))
+
+    # Changing a stage runs it again with everything downstream of it.
+    def test_changed_stage(self):
+        self.Run(self.Stages())
+        ran, output = self.Run(self.Stages(storm="storm v2;"))
+        self.assertEqual(ran, ["CopyStorm", "IntersectSWSS", "AllIntersections"])
+        self.assertEqual(output, "sewer;storm v2;crossings;all;")
+        self.cache.params = ("20240103",)
+        self.assertEqual(len(self.Run(self.Stages())[0]), 4)
+
+    def test_evict(self):
+        self.Run(self.Stages())
+        entries = self.cache.Entries()
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(self.cache.Evict(), [])
+        self.cache.maxSizeMB = 0
+        removed = self.cache.Evict()
+        self.assertEqual(removed, [entry["key"] for entry in entries])
+        self.assertEqual(self.cache.Entries(), [])
+        self.Run(self.Stages())
+        self.cache.maxSizeMB = None
+        self.assertEqual(len(self.cache.Evict(now=time.time() + 8 * 86400)), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+from __future__ import absolute_import, division, print_function
+
+import datetime
+import os
+import unittest
+
+import numpy as np
+
+from support import TemporaryFolder
+
+from crossings import columnar
+from crossings.geometry import MakeField, PipeLayer, PointLayer
+
+FIELDS = [MakeField("Diam", "DOUBLE"), MakeField("FID_snPipes", "LONG"), MakeField("Label", "TEXT", 30),
+          MakeField("MODIFYDATE", "DATE")]
+
+DATES = [datetime.datetime(2020, 1, 2, 3, 4, 5, 6), None, datetime.datetime(1969, 12, 31, 23, 59, 59)]
+
+
+def _Columns():
+    return {"Diam": np.array([8.0, np.nan, 24.5]), "FID_snPipes": np.array([7, 9, 2 ** 40], dtype=np.int64),
+            "Label": np.array([u"Storm", None, u"\u00e9gout \u2013 \u4e0b\u6c34"], dtype=object),
+            "MODIFYDATE": np.array(DATES, dtype=object)}
+
+
+def _Pipes():
+    lines = [[(0, 0), (10, 0)], [[(1, 1), (2, 2)], [(3, 3), (4, 4), (5, 4)]], [(7.5, -1), (7.5, 1)]]
+    pipes = PipeLayer.FromLines("snPipes", lines, oids=[3, 5, 8])
+    for field in FIELDS:
+        pipes.AddColumn(field, _Columns()[field.name])
+    return pipes
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = TemporaryFolder(self)
+
+    def AssertColumns(self, layer, rows=slice(None)):
+        expected = _Columns()
+        self.assertEqual([field.name for field in layer.fields], [field.name for field in FIELDS])
+        np.testing.assert_array_equal(layer.columns["Diam"], expected["Diam"][rows])
+        self.assertEqual(layer.columns["FID_snPipes"].dtype, np.int64)
+        self.assertEqual(layer.columns["FID_snPipes"].tolist(), expected["FID_snPipes"][rows].tolist())
+        self.assertEqual(list(layer.columns["Label"]), list(expected["Label"][rows]))
+        self.assertEqual(list(layer.columns["MODIFYDATE"]), list(expected["MODIFYDATE"][rows]))
+
+    def test_pipe_layer(self):
+        pipes = _Pipes()
+        path = columnar.WriteColumnar(os.path.join(self.folder, "snPipes"), pipes)
+        layer = columnar.ReadColumnar(path)
+        self.assertIsInstance(layer, PipeLayer)
+        self.assertEqual(layer.name, "snPipes")
+        np.testing.assert_array_equal(layer.coords, pipes.coords)
+        np.testing.assert_array_equal(layer.partOffsets, pipes.partOffsets)
+        np.testing.assert_array_equal(layer.pipeParts, pipes.pipeParts)
+        self.assertEqual(layer.oids.tolist(), [3, 5, 8])
+        self.assertEqual(layer.Lengths().tolist(), pipes.Lengths().tolist())
+        self.AssertColumns(layer)
+
+    def test_point_layer(self):
+        points = PointLayer("AllIntersections", [1.0, 2.0, 3.0], [4.0, 5.0, 6.0], FIELDS, _Columns())
+        store = columnar.ColumnarStore(os.path.join(self.folder, "store"))
+        store.Write(points)
+        self.assertEqual(store.Names(), ["AllIntersections"])
+        self.assertEqual(store.Count("AllIntersections"), 3)
+        self.assertEqual(store.Fields("AllIntersections"), FIELDS)
+        layer = store.Read("AllIntersections")
+        self.assertIsInstance(layer, PointLayer)
+        self.assertEqual(layer.x.tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(layer.y.tolist(), [4.0, 5.0, 6.0])
+        self.AssertColumns(layer)
+        self.assertEqual([field.name for field in store.Read("AllIntersections", ["Label"]).fields], ["Label"])
+        store.Delete("AllIntersections")
+        self.assertEqual(store.Names(), [])
+
+    # Dates held as text (or mixed with text) stay text.
+    def test_text_dates(self):
+        field = MakeField("MODIFYDATE", "DATE")
+        values = np.array([u"2020-01-02", DATES[0], None], dtype=object)
+        points = PointLayer("points", [0.0, 1.0, 2.0], [0.0, 1.0, 2.0], [field], {"MODIFYDATE": values})
+        layer = columnar.ReadColumnar(columnar.WriteColumnar(os.path.join(self.folder, "points"), points))
+        self.assertEqual(list(layer.columns["MODIFYDATE"]), [u"2020-01-02", DATES[0].isoformat(), None])
+
+    def test_write_and_drop_columns(self):
+        path = columnar.WriteColumnar(os.path.join(self.folder, "snPipes"), _Pipes())
+        added = MakeField("VertSep", "DOUBLE")
+        columnar.WriteColumns(path, [added, MakeField("Label", "TEXT", 30)],
+                              {"VertSep": np.array([1.0, 2.0, 3.0]),
+                               "Label": np.array([u"a", u"b", None], dtype=object)})
+        layer = columnar.ReadColumnar(path)
+        self.assertEqual([field.name for field in layer.fields], ["Diam", "FID_snPipes", "Label", "MODIFYDATE",
+                                                                   "VertSep"])
+        self.assertEqual(list(layer.columns["Label"]), [u"a", u"b", None])
+        self.assertEqual(layer.columns["VertSep"].tolist(), [1.0, 2.0, 3.0])
+        # The replaced column's files are gone.
+        self.assertFalse(os.path.exists(os.path.join(path, "Label.0.npy")))
+        self.assertTrue(os.path.exists(os.path.join(path, "Label.1.npy")))
+        self.assertRaises(ValueError, columnar.WriteColumns, path, [added], {"VertSep": np.zeros(2)})
+
+        columnar.DropColumns(path, ["Diam", "VertSep"])
+        layer = columnar.ReadColumnar(path)
+        self.assertEqual([field.name for field in layer.fields], ["FID_snPipes", "Label", "MODIFYDATE"])
+        self.assertFalse(os.path.exists(os.path.join(path, "Diam.0.npy")))
+
+    def test_read_rows(self):
+        path = columnar.WriteColumnar(os.path.join(self.folder, "snPipes"), _Pipes())
+        rows = np.array([2, 0])
+        table = columnar.ReadRows(path, rows)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.oids.tolist(), [8, 3])
+        self.AssertColumns(table, rows)
+        self.assertEqual(columnar.ReadArrayRange(os.path.join(path, "coords.npy"), 1, 3).tolist(),
+                         [[10.0, 0.0], [1.0, 1.0]])
+
+    def test_empty_layer(self):
+        points = PointLayer("empty", [], [], FIELDS, dict((name, values[:0]) for name, values in _Columns().items()))
+        layer = columnar.ReadColumnar(columnar.WriteColumnar(os.path.join(self.folder, "empty"), points))
+        self.assertEqual(len(layer), 0)
+        self.assertEqual([field.name for field in layer.fields], [field.name for field in FIELDS])
+
+
+if __name__ == "__main__":
+    unittest.main()
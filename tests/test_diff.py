@@ -0,0 +1,69 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+
+from support import CrossingNetwork
+
+from crossings import diff
+from crossings.geometry import MergeLayers
+
+
+def _ByKey(layer):
+    rows = {}
+    for i, key in enumerate(diff.CrossingKeys(layer)):
+        rows[key] = (layer.x[i], layer.y[i]) + tuple(diff._Text(layer.columns[name][i])
+                                                       for name in diff.COMPARED_FIELDS)
+    return rows
+
+
+class DiffCrossingsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.old = CrossingNetwork(2000)["AllIntersections"]
+
+    # The next run: some crossings gone, some moved well away (removed and
+    # added) and some with a different VertSep.
+    def NextRun(self):
+        count = len(self.old)
+        rng = np.random.RandomState(3)
+        order = rng.permutation(count)
+        removed, moved, edited = order[:7], order[7:12], order[12:16]
+        kept = self.old.Take(np.setdiff1d(np.arange(count), np.concatenate([removed, moved])))
+        edits = np.isin(np.setdiff1d(np.arange(count), np.concatenate([removed, moved])), edited)
+        kept.columns["VertSep"] = np.where(edits, np.nan_to_num(kept.columns["VertSep"]) + 1.5,
+                                           kept.columns["VertSep"])
+        shifted = self.old.Take(moved)
+        shifted.x = shifted.x + 50.0
+        return MergeLayers("AllIntersections", [kept, shifted])
+
+    def test_round_trip(self):
+        self.assertGreater(len(self.old), 100)
+        new = self.NextRun()
+        changes, summary = diff.DiffCrossings(self.old, new)
+        self.assertEqual((summary["old"], summary["new"]), (len(self.old), len(new)))
+        self.assertEqual((summary["added"], summary["removed"], summary["changed"]), (5, 12, 4))
+        self.assertEqual(summary["changedFields"]["VertSep"], 4)
+        self.assertEqual(len(changes), 21)
+
+        applied = diff.ApplyChangeset(self.old, changes)
+        self.assertEqual(len(applied), len(new))
+        self.assertEqual(_ByKey(applied), _ByKey(new))
+
+    def test_no_changes(self):
+        changes, summary = diff.DiffCrossings(self.old, self.old.Take(np.arange(len(self.old))[::-1]))
+        self.assertEqual(len(changes), 0)
+        self.assertEqual((summary["added"], summary["removed"], summary["changed"]), (0, 0, 0))
+
+    # A crossing that moved less than a grid cell still matches.
+    def test_small_moves_match(self):
+        new = self.old.Take(np.arange(len(self.old)))
+        new.x = new.x + diff.QUANTUM_FEET * 0.6
+        summary = diff.DiffCrossings(self.old, new)[1]
+        self.assertEqual((summary["added"], summary["removed"]), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+
+from support import PipeNetwork
+
+from crossings.engine import (CROSSING_ARRAYS, Crossings, FindCrossings, IntersectLayers, IntersectSegments,
+                              UniqueCrossings)
+from crossings.geometry import MakeField, PipeLayer
+
+
+def _Sewer():
+    fields = [MakeField("SnFID", "TEXT", 20), MakeField("SnDiam", "DOUBLE")]
+    lines = [[(0, 0), (10, 0)],
+             [(20, -5), (20, 5), (30, 5)],
+             [[(40, -5), (40, 0)], [(40, 0), (40, 5)]]]
+    rows = [{"SnFID": "S1", "SnDiam": 8}, {"SnFID": "S2", "SnDiam": 12}, {"SnFID": "S3", "SnDiam": None}]
+    return PipeLayer.FromLines("snPipes", lines, fields, rows, oids=[11, 12, 13])
+
+
+def _Storm():
+    fields = [MakeField("SWFID", "TEXT", 20), MakeField("SnDiam", "DOUBLE")]
+    lines = [[(5, -5), (5, 5)],
+             [(15, 2), (45, 2)],
+             [(0, 0), (10, 0)]]
+    rows = [{"SWFID": "W1", "SnDiam": 15}, {"SWFID": "W2", "SnDiam": 18}, {"SWFID": "W3", "SnDiam": 24}]
+    return PipeLayer.FromLines("swPipes", lines, fields, rows, oids=[21, 22, 23])
+
+
+class FindCrossingsTest(unittest.TestCase):
+
+    def test_points_and_segments(self):
+        crossings = FindCrossings(_Sewer(), _Storm())
+        points = sorted(zip(crossings.x.tolist(), crossings.y.tolist(), crossings.first.tolist(),
+                            crossings.second.tolist()))
+        # W3 lies along S1, which is an overlap and not a crossing.
+        self.assertEqual(points, [(5.0, 0.0, 0, 0), (20.0, 2.0, 1, 1), (40.0, 2.0, 2, 1)])
+        row = int(np.nonzero(crossings.first == 1)[0][0])
+        self.assertEqual(crossings.firstVertex[row], 2)
+        self.assertAlmostEqual(crossings.firstT[row], 0.7)
+        self.assertAlmostEqual(crossings.secondT[row], 5.0 / 30.0)
+
+    def test_crossing_at_a_vertex_is_reported_once(self):
+        sewer = PipeLayer.FromLines("snPipes", [[(0, 0), (5, 5), (10, 0)]])
+        storm = PipeLayer.FromLines("swPipes", [[(5, 0), (5, 10)]])
+        crossings = FindCrossings(sewer, storm)
+        self.assertEqual(len(crossings), 1)
+        self.assertAlmostEqual(crossings.x[0], 5.0)
+        self.assertAlmostEqual(crossings.y[0], 5.0)
+
+    def test_no_candidates(self):
+        sewer = PipeLayer.FromLines("snPipes", [[(0, 0), (1, 1)]])
+        storm = PipeLayer.FromLines("swPipes", [[(100, 100), (101, 100)]])
+        self.assertEqual(len(FindCrossings(sewer, storm)), 0)
+
+
+class IntersectLayersTest(unittest.TestCase):
+
+    # The attributes come out like Intersect "ALL": FID_<layer> then the
+    # layer's fields, with a suffix for names the first layer already used.
+    def test_schema_and_attributes(self):
+        layer = IntersectLayers(_Sewer(), _Storm(), "SWSSIntersect")
+        self.assertEqual([field.name for field in layer.fields],
+                         ["FID_snPipes", "SnFID", "SnDiam", "FID_swPipes", "SWFID", "SnDiam_1", "Chainage_snPipes",
+                          "Chainage_swPipes"])
+        self.assertEqual(layer.columns["FID_snPipes"].dtype, np.int64)
+        self.assertEqual(layer.columns["FID_snPipes"].tolist(), [11, 12, 13])
+        self.assertEqual(layer.columns["FID_swPipes"].tolist(), [21, 22, 22])
+        self.assertEqual(list(layer.columns["SWFID"]), ["W1", "W2", "W2"])
+        self.assertEqual(layer.columns["SnDiam"][:2].tolist(), [8.0, 12.0])
+        self.assertTrue(np.isnan(layer.columns["SnDiam"][2]))
+        self.assertEqual(layer.columns["SnDiam_1"].tolist(), [15.0, 18.0, 18.0])
+
+    def test_excluded_fields(self):
+        layer = IntersectLayers(_Sewer(), _Storm(), "SWSSIntersect", exclude=("SnDiam",))
+        self.assertEqual([field.name for field in layer.fields], ["FID_snPipes", "SnFID", "FID_swPipes", "SWFID",
+                                                                   "Chainage_snPipes", "Chainage_swPipes"])
+        layer = IntersectLayers(_Sewer(), _Storm(), "SWSSIntersect", exclude=("Chainage_swPipes",))
+        self.assertEqual(layer.fields[-1].name, "Chainage_snPipes")
+
+
+class ChainageTest(unittest.TestCase):
+
+    def test_lengths_and_chainage(self):
+        sewer = _Sewer()
+        self.assertEqual(sewer.Lengths().tolist(), [10.0, 20.0, 10.0])
+        self.assertEqual(sewer.Chainage().tolist(), [0.0, 10.0, 0.0, 10.0, 20.0, 0.0, 5.0, 5.0, 10.0])
+
+    def test_measure(self):
+        measures = _Sewer().Measure([0, 2, 3, 5, 7, -1], [0.5, 0.7, 0.5, 0.6, 1.0, 0.5])
+        self.assertEqual(measures[:5].tolist(), [5.0, 7.0, 15.0, 3.0, 10.0])
+        self.assertTrue(np.isnan(measures[5]))
+
+    # Each crossing carries its distance along both pipes, from the segment it
+    # was found on.
+    def test_crossing_chainage(self):
+        layer = IntersectLayers(_Sewer(), _Storm(), "SWSSIntersect")
+        np.testing.assert_allclose(layer.columns["Chainage_snPipes"], [5.0, 7.0, 7.0])
+        np.testing.assert_allclose(layer.columns["Chainage_swPipes"], [5.0, 5.0, 25.0])
+
+
+class NetworkTest(unittest.TestCase):
+
+    # The grid only skips segment pairs that cannot cross: the result is the
+    # same as testing every pair.
+    def test_matches_every_segment_pair(self):
+        data = PipeNetwork(400)
+        first, second = data["snPipes"], data["swPipes"]
+        startA, pipesA = first.Segments()
+        startB, pipesB = second.Segments()
+        candA = np.repeat(np.arange(len(startA)), len(startB))
+        candB = np.tile(np.arange(len(startB)), len(startA))
+        a, b = startA[candA], startB[candB]
+        hit, x, y, t, u = IntersectSegments(first.coords, a, second.coords, b)
+        expected = UniqueCrossings(Crossings(x, y, pipesA[candA][hit], pipesB[candB][hit], a[hit], b[hit], t, u))
+        found = FindCrossings(first, second)
+        self.assertGreater(len(found), 0)
+        for name in CROSSING_ARRAYS:
+            np.testing.assert_array_equal(getattr(found, name), getattr(expected, name))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+
+from support import PipeNetwork
+
+from crossings.expressions import ExpressionError, FieldCalculator, ParseExpression, TreeFields
+
+
+def _Calculate(expression, **columns):
+    columns = dict((name, np.asarray(values, dtype=np.float64)) for name, values in columns.items())
+    if not columns:
+        columns = {"unused": np.zeros(1)}
+    return FieldCalculator([("result", expression)]).Evaluate(columns)["result"]
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_tree(self):
+        self.assertEqual(ParseExpression("[A] + 2 * [B ]"),
+                         ("binary", "+", ("field", "A"), ("binary", "*", ("number", 2.0), ("field", "B"))))
+        self.assertEqual(ParseExpression('"Storm over Sewer"'), ("text", "Storm over Sewer"))
+        self.assertEqual(ParseExpression("Null"), ("null",))
+
+    def test_fields(self):
+        tree = ParseExpression("Sqr (( [SSUpX]- [POINT_X])^2+( [SSUpY]- [POINT_Y])^2  )")
+        self.assertEqual(TreeFields(tree), ["SSUpX", "POINT_X", "SSUpY", "POINT_Y"])
+
+    def test_errors(self):
+        for text in ("[A] +", "([A]", "[A] [B]", "Foo([A])", "[A] # 2", '"text" + 1', ""):
+            self.assertRaises(ExpressionError, FieldCalculator, [("result", text)])
+
+
+class EvaluateTest(unittest.TestCase):
+
+    # ^ binds tighter than unary minus and groups left to right, as in VB.
+    def test_precedence(self):
+        self.assertEqual(_Calculate("-2^2").tolist(), [-4.0])
+        self.assertEqual(_Calculate("2^3^2").tolist(), [64.0])
+        self.assertEqual(_Calculate("2^-1").tolist(), [0.5])
+        self.assertEqual(_Calculate("1 - 2 - 3").tolist(), [-4.0])
+        self.assertEqual(_Calculate("8 / 4 / 2").tolist(), [1.0])
+        self.assertEqual(_Calculate("(1 + 2) * 3").tolist(), [9.0])
+
+    def test_functions(self):
+        values = _Calculate("Sqr([A]) + Abs([B]) + Int([C]) + Fix([C]) + Sgn([B])", A=[4.0], B=[-3.0], C=[-1.5])
+        self.assertEqual(values.tolist(), [2.0 + 3.0 - 2.0 - 1.0 - 1.0])
+
+    # NULL carries through, and a result that is not a number is NULL.
+    def test_null(self):
+        self.assertTrue(np.isnan(_Calculate("[A] + 1", A=[np.nan])[0]))
+        self.assertTrue(np.isnan(_Calculate("Null * 2")[0]))
+        values = _Calculate("[A] / [B]", A=[1.0, 0.0, 6.0], B=[0.0, 0.0, 3.0])
+        self.assertTrue(np.all(np.isnan(values[:2])))
+        self.assertEqual(values[2], 2.0)
+        self.assertTrue(np.isnan(_Calculate("Sqr([A])", A=[-1.0])[0]))
+        self.assertTrue(np.isnan(_Calculate("Log(0)")[0]))
+
+    def test_text(self):
+        values = FieldCalculator([("CrossTy", '"Bad Data?"')]).Evaluate({"A": np.zeros(3)})["CrossTy"]
+        self.assertEqual(values.dtype, object)
+        self.assertEqual(list(values), ["Bad Data?"] * 3)
+
+    def test_integer_and_text_inputs(self):
+        values = _Calculate("[A] * 2", A=np.array([1, 2]))
+        self.assertEqual(values.tolist(), [2.0, 4.0])
+        calculator = FieldCalculator([("result", "[A] + 1")])
+        values = calculator.Evaluate({"A": np.array(["1.5", None], dtype=object)})["result"]
+        self.assertEqual(values[0], 2.5)
+        self.assertTrue(np.isnan(values[1]))
+
+
+    # Over a whole pipe layer: text and date columns alongside, NULL inverts
+    # and zero lengths.
+    def test_layer_columns(self):
+        pipes = PipeNetwork(400)["snPipes"]
+        pipes.columns["SnLength"][:5] = 0
+        values = FieldCalculator([("Snslope", "(([SnUpinvert]-[SnDninvert])/[SnLength])*100")]).Evaluate(
+            pipes.columns)["Snslope"]
+        with np.errstate(all="ignore"):
+            expected = (pipes.columns["SnUpinvert"] - pipes.columns["SnDninvert"]) / pipes.columns["SnLength"] * 100
+        expected[~np.isfinite(expected)] = np.nan
+        np.testing.assert_array_equal(values, expected)
+        self.assertTrue(np.all(np.isnan(values[:5])))
+
+
+class FieldCalculatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calculator = FieldCalculator([
+            ("Snslope", "(([SnUpinvert]-[SnDninvert])/[SnLength])*100"),
+            ("SS_Length", "Sqr (( [SSUpX]- [POINT_X])^2+( [SSUpY]- [POINT_Y])^2  )"),
+            ("SS_Invert", "[SnUpinvert]-( [Snslope]/100* [SS_Length])"),
+            ("Unused", "[Other] * 2"),
+            ("Snslope", "[Snslope] * 2")])
+        self.columns = {"SnUpinvert": np.array([100.0, 50.0]), "SnDninvert": np.array([98.0, 49.0]),
+                        "SnLength": np.array([200.0, 100.0]), "SSUpX": np.array([0.0, 0.0]),
+                        "SSUpY": np.array([0.0, 0.0]), "POINT_X": np.array([30.0, 6.0]),
+                        "POINT_Y": np.array([40.0, 8.0]), "Other": np.array([1.0, 2.0])}
+
+    def test_chained_calculations(self):
+        values = self.calculator.Evaluate(self.columns, ["SS_Invert"])
+        np.testing.assert_allclose(values["SS_Invert"], [99.5, 49.9])
+
+    # Only what the outputs depend on is planned; a target calculated twice
+    # is seen at its first value by the calculations in between.
+    def test_plan(self):
+        needed, sources, latest = self.calculator.Plan(["SS_Invert"])
+        self.assertEqual(needed, [0, 1, 2])
+        self.assertEqual(sources[2], {"SnUpinvert": None, "Snslope": 0, "SS_Length": 1})
+        self.assertEqual(latest["Snslope"], 4)
+        values = self.calculator.Evaluate(self.columns)
+        self.assertEqual(list(values), ["Snslope", "SS_Length", "SS_Invert", "Unused"])
+        np.testing.assert_allclose(values["Snslope"], [2.0, 2.0])
+        np.testing.assert_allclose(values["SS_Invert"], [99.5, 49.9])
+
+    # A given field is read from the columns instead of being calculated.
+    def test_given(self):
+        columns = dict(self.columns, Snslope=np.array([10.0, 10.0]))
+        values = self.calculator.Evaluate(columns, ["SS_Invert"], given=("Snslope",))
+        np.testing.assert_allclose(values["SS_Invert"], [95.0, 49.0])
+        needed = self.calculator.Plan(["SS_Invert"], given=("Snslope",))[0]
+        self.assertEqual(needed, [1, 2])
+
+    def test_kernel_is_kept(self):
+        first = self.calculator.Kernel(["SS_Invert"])
+        self.assertIs(self.calculator.Kernel(["SS_Invert"]), first)
+        self.assertIsNot(self.calculator.Kernel(["SS_Invert"], given=("Snslope",)), first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+from __future__ import absolute_import, division, print_function
+
+import datetime
+import os
+import unittest
+
+import numpy as np
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from support import PIPE_LAYERS, PipeNetwork, TemporaryFolder
+
+import CalculatingUtilityCrossings as script
+from crossings import columnar, incremental
+from crossings.allpairs import DEFAULT_PAIRS, IntersectAllPairs
+from crossings.geometry import PipeLayer
+
+
+# Process: A copy of "layer" with pipe "i" moved by (dx, dy) and its
+# MODIFYDATE set to "modified".
+def _EditPipe(layer, i, dx, dy, modified):
+    coords = np.array(layer.coords)
+    start, end = layer.partOffsets[layer.pipeParts[i]], layer.partOffsets[layer.pipeParts[i + 1]]
+    coords[start:end] += (dx, dy)
+    columns = dict((name, np.array(column)) for name, column in layer.columns.items())
+    columns["MODIFYDATE"][i] = modified
+    return PipeLayer(layer.name, coords, layer.partOffsets, layer.pipeParts, layer.fields, columns, layer.oids)
+
+
+def _Rows(points):
+    firstField, secondField = [field.name for field in points.fields if field.name.startswith("FID_")]
+    return sorted(zip(np.round(points.x, 6).tolist(), np.round(points.y, 6).tolist(),
+                      points.columns[firstField].tolist(), points.columns[secondField].tolist()))
+
+
+class UpdateCrossingsTest(unittest.TestCase):
+
+    # After one pipe is moved the stored crossings are brought up to date and
+    # match a full rebuild.
+    def test_edited_pipe(self):
+        folder = TemporaryFolder(self)
+        data = PipeNetwork(1500)
+        store = incremental.CrossingStore(os.path.join(folder, "CrossingStore.gpkg"))
+        layers = dict((name, data[name]) for name in PIPE_LAYERS)
+        results, counts = incremental.UpdateCrossings(store, layers)
+        self.assertEqual(counts["snPipes"]["added"], len(data["snPipes"]))
+
+        crossed = results["SWSSIntersect"].columns["FID_snPipes"]
+        edited = int(np.nonzero(data["snPipes"].oids == crossed[0])[0][0])
+        layers["snPipes"] = data["snPipes"] = _EditPipe(data["snPipes"], edited, 30.0, 20.0,
+                                                        datetime.datetime(2030, 1, 1))
+        results, counts = incremental.UpdateCrossings(store, layers)
+        self.assertEqual(counts["snPipes"], {"added": 0, "modified": 1, "deleted": 0, "untracked": 0})
+        self.assertEqual(counts["swPipes"]["modified"], 0)
+
+        expected = IntersectAllPairs(data, DEFAULT_PAIRS, exclude=incremental.DATE_FIELDS)
+        self.assertEqual(sorted(results), sorted(points.name for points in expected))
+        for points in expected:
+            self.assertEqual(_Rows(results[points.name]), _Rows(points))
+            self.assertEqual([field.name for field in results[points.name].fields],
+                             [field.name for field in points.fields if field.name != "InterType"])
+
+
+class IncrementalIntersectsTest(unittest.TestCase):
+
+    # The script's incremental step with the default columnar intermediates:
+    # the crossing layers go to the ColumnarStore, the pipe state and stored
+    # crossings to the CrossingStore.
+    def test_columnar_intermediates(self):
+        folder = TemporaryFolder(self)
+        data = PipeNetwork(1500)
+        columnStore = columnar.ColumnarStore(os.path.join(folder, "columns"))
+        for name in PIPE_LAYERS:
+            columnStore.Write(data[name])
+        expected = dict((points.name, len(points))
+                        for points in IntersectAllPairs(data, DEFAULT_PAIRS, exclude=incremental.DATE_FIELDS))
+
+        storePath = os.path.join(folder, "CrossingStore.gpkg")
+        with mock.patch.object(script, "Columnar", True), mock.patch.object(script, "store", columnStore), \
+                mock.patch.object(script, "CrossingStorePath", storePath), \
+                mock.patch.object(script, "LogMessage", lambda message: None):
+            for run in range(2):
+                script.IncrementalIntersects()
+                for name, count in expected.items():
+                    self.assertEqual(columnStore.Count(name), count)
+        self.assertTrue(os.path.exists(storePath))
+
+    # The pairs come from UtilityPairs: only the listed pairs are intersected
+    # and only their layers are read.
+    def test_utility_pairs(self):
+        folder = TemporaryFolder(self)
+        data = PipeNetwork(1500)
+        columnStore = columnar.ColumnarStore(os.path.join(folder, "columns"))
+        for name in ("snPipes", "wnPipes"):
+            columnStore.Write(data[name])
+        pairs = [("wnPipes", "snPipes", "WaterSewer", "Water-Sewer")]
+        expected = IntersectAllPairs(data, pairs, exclude=incremental.DATE_FIELDS)[0]
+
+        with mock.patch.object(script, "Columnar", True), mock.patch.object(script, "store", columnStore), \
+                mock.patch.object(script, "UtilityPairs", pairs), \
+                mock.patch.object(script, "CrossingStorePath", os.path.join(folder, "CrossingStore.gpkg")), \
+                mock.patch.object(script, "LogMessage", lambda message: None):
+            script.IncrementalIntersects()
+        self.assertEqual(sorted(columnStore.Names()), ["WaterSewer", "snPipes", "wnPipes"])
+        self.assertEqual(_Rows(columnStore.Read("WaterSewer")), _Rows(expected))
+
+    def test_layer_without_keys(self):
+        folder = TemporaryFolder(self)
+        data = PipeNetwork(200)
+        store = incremental.CrossingStore(os.path.join(folder, "CrossingStore.gpkg"))
+        layers = {"snPipes": data["snPipes"], "gnPipes": data["wnPipes"]}
+        self.assertRaises(ValueError, incremental.UpdateCrossings, store, layers,
+                          [("snPipes", "gnPipes", "GasSewer")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+
+from support import PipeNetwork
+
+from crossings import nearmiss, vertsep
+from crossings.engine import XY_TOLERANCE
+from crossings.geometry import PipeLayer
+
+
+def _PointSegment(points, start, end):
+    along = end - start
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.clip(np.sum((points - start) * along, axis=1) / np.sum(along * along, axis=1), 0, 1)
+    t[~np.isfinite(t)] = 0
+    return np.hypot(*(points - start - t[:, None] * along).T)
+
+
+class SegmentDistancesTest(unittest.TestCase):
+
+    # Segments that do not cross are closest at an end of one of them.
+    def test_against_the_endpoints(self):
+        rng = np.random.RandomState(6)
+        coordsA = rng.uniform(0, 100, (4000, 2))
+        coordsB = rng.uniform(0, 100, (4000, 2))
+        a = np.arange(0, 4000, 2)
+        t, u, gap = nearmiss.SegmentDistances(coordsA, a, coordsB, a)
+        p, r, q, s = coordsA[a], coordsA[a + 1], coordsB[a], coordsB[a + 1]
+        cross = lambda o, x, y: (x[:, 0] - o[:, 0]) * (y[:, 1] - o[:, 1]) - (x[:, 1] - o[:, 1]) * (y[:, 0] - o[:, 0])
+        crossing = (np.sign(cross(p, r, q)) != np.sign(cross(p, r, s))) & \
+                   (np.sign(cross(q, s, p)) != np.sign(cross(q, s, r)))
+        expected = np.min([_PointSegment(p, q, s), _PointSegment(r, q, s), _PointSegment(q, p, r),
+                           _PointSegment(s, p, r)], axis=0)
+        self.assertGreater(np.count_nonzero(~crossing), 1000)
+        np.testing.assert_allclose(gap[~crossing], expected[~crossing], atol=1e-9)
+        np.testing.assert_allclose(gap[crossing], 0, atol=1e-9)
+        self.assertTrue(np.all((t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)))
+
+
+class FindNearMissesTest(unittest.TestCase):
+
+    # A storm line running 2 ft beside a sewer is a near miss; one crossing
+    # it is not, and one 10 ft away is too far.
+    def test_parallel_pipes(self):
+        sewer = PipeLayer.FromLines("snPipes", [[(0, 0), (50, 0), (100, 0)]])
+        storm = PipeLayer.FromLines("swPipes", [[(10, 2), (90, 2)], [(40, -5), (40, 5)], [(0, 10), (100, 10)]])
+        found = nearmiss.FindNearMisses(sewer, storm, 3.0)
+        self.assertEqual(sorted(set(found.second.tolist())), [0])
+        np.testing.assert_allclose(found.distance, 2.0)
+        closest = nearmiss.ClosestPerPipePair(found)
+        self.assertEqual(len(closest), 1)
+        self.assertEqual(len(nearmiss.FindNearMisses(sewer, storm, 3.0, crossings=True)), len(found) + 1)
+
+    # On a network the closest approach of each pipe pair matches a scan of
+    # every segment pair.
+    def test_matches_a_scan(self):
+        data = PipeNetwork(400)
+        first, second = data["snPipes"], data["swPipes"]
+        distance = 40.0
+        startA, pipesA = first.Segments()
+        startB, pipesB = second.Segments()
+        a = np.repeat(np.arange(len(startA)), len(startB))
+        b = np.tile(np.arange(len(startB)), len(startA))
+        gap = nearmiss.SegmentDistances(first.coords, startA[a], second.coords, startB[b])[2]
+        keep = (gap <= distance) & (gap > XY_TOLERANCE)
+        expected = {}
+        for pipeA, pipeB, value in zip(pipesA[a[keep]], pipesB[b[keep]], gap[keep]):
+            expected[pipeA, pipeB] = min(value, expected.get((pipeA, pipeB), np.inf))
+
+        closest = nearmiss.ClosestPerPipePair(nearmiss.FindNearMisses(first, second, distance))
+        self.assertGreater(len(closest), 20)
+        found = dict(((pipeA, pipeB), value) for pipeA, pipeB, value in
+                     zip(closest.first, closest.second, closest.distance))
+        self.assertEqual(sorted(found), sorted(expected))
+        for key, value in expected.items():
+            self.assertAlmostEqual(found[key], value, 9)
+
+    def test_table(self):
+        data = PipeNetwork(1000)
+        layer = nearmiss.NearMissTable(data["snPipes"], data["swPipes"], "SWSSNearMiss", 20.0, sewer="first")
+        names = [field.name for field in layer.fields]
+        for name in ("HorizDist", "X_snPipes", "Y_swPipes") + tuple(field.name for field in vertsep.OUTPUT_FIELDS):
+            self.assertIn(name, names)
+        self.assertGreater(len(layer), 0)
+        self.assertTrue(np.all(layer.columns["HorizDist"] <= 20.0))
+        np.testing.assert_allclose(layer.x, (layer.columns["X_snPipes"] + layer.columns["X_swPipes"]) / 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+from __future__ import absolute_import, division, print_function
+
+import collections
+import os
+import unittest
+
+import numpy as np
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from support import PipeNetwork, TemporaryFolder
+
+from crossings import columnar, outofcore
+from crossings.engine import IntersectLayers
+
+Stream = collections.namedtuple("Stream", "count vertices")
+
+
+def _Touching(boxes, tile, tolerance):
+    return np.count_nonzero((boxes[:, 0] <= tile[2] + tolerance) & (boxes[:, 2] >= tile[0] - tolerance) &
+                            (boxes[:, 1] <= tile[3] + tolerance) & (boxes[:, 3] >= tile[1] - tolerance))
+
+
+class OutOfCoreTest(unittest.TestCase):
+
+    # With a window far smaller than the layers the crossings come from many
+    # tiles and are the same as intersecting the whole layers.
+    def test_matches_intersect_layers(self):
+        folder = TemporaryFolder(self)
+        data = PipeNetwork(3000)
+        paths = [columnar.WriteColumnar(os.path.join(folder, name), data[name]) for name in ("snPipes", "swPipes")]
+        with mock.patch.object(outofcore, "WindowPipes", lambda streams, budgetMB, baselineMB=None, log=None: 150):
+            points, stats = outofcore.OutOfCoreIntersect(paths[0], paths[1], "SWSSIntersect", 100,
+                                                         os.path.join(folder, "spill"))
+        expected = IntersectLayers(data["snPipes"], data["swPipes"], "SWSSIntersect")
+        self.assertGreater(stats["tiles"], 10)
+        self.assertLessEqual(stats["largestTilePipes"], 150)
+        self.assertEqual(len(points), len(expected))
+        self.assertGreater(len(points), 0)
+        np.testing.assert_array_equal(points.x, expected.x)
+        np.testing.assert_array_equal(points.y, expected.y)
+        self.assertEqual([field.name for field in points.fields], [field.name for field in expected.fields])
+        for field in expected.fields:
+            values, wanted = points.columns[field.name], expected.columns[field.name]
+            if field.type == "DOUBLE":
+                # The chainage is summed along a tile's copy of the pipe.
+                np.testing.assert_allclose(values, wanted, rtol=1e-12, atol=1e-9, err_msg=field.name)
+            else:
+                self.assertEqual(list(values), list(wanted), field.name)
+
+
+class MortonTilesTest(unittest.TestCase):
+
+    # Every pipe whose box touches a tile counts against it, not just the
+    # pipes centred in it.
+    def test_tiles_count_touching_pipes(self):
+        rng = np.random.RandomState(2)
+        corners = rng.uniform(0, 1000, (3000, 2))
+        boxes = np.column_stack((corners, corners + rng.uniform(0, 60, (3000, 2))))
+        square = outofcore._Square([boxes], 0.5)
+        tiles, counts = outofcore.MortonTiles(boxes, square, 200, 0.5)
+        self.assertGreater(len(tiles), 20)
+        self.assertEqual(counts.tolist(), [_Touching(boxes, tile, 0.5) for tile in tiles])
+        self.assertLessEqual(counts.max(), 200)
+        self.assertAlmostEqual(np.sum((tiles[:, 2] - tiles[:, 0]) * (tiles[:, 3] - tiles[:, 1])), square[2] ** 2)
+
+    # Pipes crossing the whole area cannot be split apart; the tiles stop
+    # splitting instead of going down to the deepest level.
+    def test_overlapping_pipes(self):
+        boxes = np.array([[0.0, 0.0, 100.0, 100.0]] * 5 + [[10.0, 10.0, 11.0, 11.0], [80.0, 80.0, 81.0, 81.0]])
+        tiles, counts = outofcore.MortonTiles(boxes, (0.0, 0.0, 100.0), 3)
+        self.assertLessEqual(len(tiles), 16)
+        self.assertEqual(counts.min(), 5)
+
+
+class WindowPipesTest(unittest.TestCase):
+
+    def test_minimum_window_warns(self):
+        streams = [Stream(100000, 1000000)]
+        messages = []
+        self.assertEqual(outofcore.WindowPipes(streams, 8, 0, messages.append), outofcore.MIN_WINDOW_PIPES)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].startswith("Warning"))
+        self.assertRaises(MemoryError, outofcore.WindowPipes, streams, 5, 0)
+        messages = []
+        self.assertGreater(outofcore.WindowPipes(streams, 2000, 0, messages.append), outofcore.MIN_WINDOW_PIPES)
+        self.assertEqual(messages, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
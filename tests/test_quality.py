@@ -0,0 +1,74 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+
+from support import PipeNetwork
+
+from crossings import quality
+from crossings.geometry import MakeField, PipeLayer
+
+FIELDS = [MakeField("UtilType", "TEXT", 20), MakeField("SnUpinvert", "DOUBLE"), MakeField("SnDninvert", "DOUBLE"),
+          MakeField("SnDiam", "DOUBLE")]
+
+# UtilType, up invert, down invert, diameter, geometry and the flags expected.
+ROWS = [("snGravity", 100.0, 98.0, 8.0, [(0, 0), (10, 0)], 0),
+        ("snGravity", 0.0, 98.0, 8.0, [(0, 0), (10, 0)], quality.UP_SENTINEL),
+        ("snGravity", 100.0, None, 8.0, [(0, 0), (10, 0)], quality.DN_MISSING),
+        ("snGravity", 98.0, 100.0, 8.0, [(0, 0), (10, 0)], quality.INVERSE_SLOPE),
+        ("snForce", 98.0, 100.0, 8.0, [(0, 0), (10, 0)], 0),
+        ("snGravity", 100.0, 98.0, -9999.0, [(0, 0), (10, 0)], quality.DIAMETER_SENTINEL),
+        ("snGravity", 100.0, 98.0, 0.0, [(0, 0), (10, 0)], quality.DIAMETER_MISSING),
+        ("snGravity", 100.0, 98.0, None, [(5, 5), (5, 5)], quality.DIAMETER_MISSING | quality.ZERO_LENGTH),
+        ("snLateral", None, 0.0, 6.0, [(5, 5)], quality.UP_MISSING | quality.DN_SENTINEL | quality.NO_GEOMETRY)]
+
+
+def _Layer(rows):
+    layer = PipeLayer.FromLines("snPipes", [row[4] for row in rows])
+    layer.AddColumn(FIELDS[0], np.array([row[0] for row in rows], dtype=object))
+    for i, field in enumerate(FIELDS[1:]):
+        layer.AddColumn(field, np.array([np.nan if row[i + 1] is None else row[i + 1] for row in rows]))
+    return layer
+
+
+class ValidateLayerTest(unittest.TestCase):
+
+    def test_rules(self):
+        flags = quality.ValidateLayer(_Layer(ROWS), "snPipes")
+        self.assertEqual(flags.tolist(), [row[5] for row in ROWS])
+        self.assertTrue(quality.Mask(flags, quality.UP_SENTINEL | quality.UP_MISSING)[[1, 8]].all())
+        self.assertEqual(np.count_nonzero(quality.Mask(flags, quality.UP_SENTINEL | quality.UP_MISSING)), 2)
+
+    # Flags stored as float (column files) or with NULLs read back the same.
+    def test_stored_flags(self):
+        flags = quality.ValidateLayer(_Layer(ROWS), "snPipes")
+        self.assertEqual(quality.Flags(flags.astype(np.float64)).tolist(), flags.tolist())
+        self.assertEqual(quality.Flags(np.array([None, 3], dtype=object)).tolist(), [0, 3])
+        self.assertEqual(quality.Flags(np.array([np.nan, 16.0])).tolist(), [0, 16])
+
+    def test_summary(self):
+        summary = quality.Summary(quality.ValidateLayer(_Layer(ROWS), "snPipes"), "snPipes")
+        self.assertEqual((summary["utility"], summary["pipes"], summary["flagged"]), ("sewer", 9, 7))
+        self.assertEqual(summary["rules"]["inverse_slope"], {"pipes": 1, "percent": round(100.0 / 9, 3)})
+        self.assertEqual(list(summary["rules"]), list(quality.RULES.values()))
+        line = quality.SummaryLine(summary)
+        self.assertTrue(line.startswith("sewer: 7 of 9 pipes flagged; "))
+        self.assertNotIn("up_invert_missing 0", line)
+
+    # On a network each rule flags the pipes a row-by-row check picks out.
+    def test_network(self):
+        data = PipeNetwork(2000)
+        for name, utility in quality.UTILITIES.items():
+            layer = data[name]
+            flags = quality.ValidateLayer(layer, name)
+            up = np.asarray(layer.columns[utility.upInvert], dtype=np.float64)
+            expected = [value in utility.invertPlaceholders for value in up]
+            self.assertEqual(quality.Mask(flags, quality.UP_SENTINEL).tolist(), expected)
+            self.assertEqual(quality.Mask(flags, quality.UP_MISSING).tolist(), np.isnan(up).tolist())
+            self.assertGreater(np.count_nonzero(flags), 0)
+            self.assertEqual(quality.Summary(flags, name)["pipes"], len(layer))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import threading
+import unittest
+
+try:
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import HTTPError, urlopen
+
+import numpy as np
+
+from support import CrossingNetwork
+
+from crossings.geometry import MakeField, PointLayer
+from crossings.query import CrossingIndex, CrossingService, Serve
+
+
+def _Crossings():
+    fields = [MakeField("SnFID", "TEXT", 20), MakeField("VertSep", "DOUBLE")]
+    columns = {"SnFID": ["SGM1", "SGM2", "SGM2", None], "VertSep": [1.5, -0.2, 3.0, None]}
+    return PointLayer("AllIntersections", [0.0, 10.0, 20.0, 500.0], [0.0, 0.0, 5.0, 500.0], fields, columns)
+
+
+class QueryServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = CrossingService(_Crossings())
+        self.server = Serve(self.service, port=0)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def Get(self, path):
+        url = "http://127.0.0.1:%d%s" % (self.server.server_address[1], path)
+        try:
+            response = urlopen(url)
+            return response.getcode(), json.loads(response.read().decode("utf-8"))
+        except HTTPError as error:
+            return error.code, json.loads(error.read().decode("utf-8"))
+
+    def test_queries(self):
+        status, body = self.Get("/radius?x=0&y=0&r=15")
+        self.assertEqual(status, 200)
+        self.assertEqual(body["count"], 2)
+        status, body = self.Get("/facility?field=SnFID&value=SGM2&limit=1")
+        self.assertEqual((body["count"], body["returned"]), (2, 1))
+
+    def test_bad_limit_is_a_bad_query(self):
+        status, body = self.Get("/radius?x=0&y=0&r=15&limit=abc")
+        self.assertEqual(status, 400)
+        self.assertIn("error", body)
+
+    # The version answered is the one of the index the query ran on.
+    def test_version_follows_the_index(self):
+        index = self.service.Index()
+        self.service.Load()
+        self.assertEqual(self.service.BBox(-1, -1, 1, 1)["version"], 2)
+        self.assertEqual(self.service._Answer(index, index.BBox(-1, -1, 1, 1), None, None)["version"], 1)
+
+
+class CrossingIndexTest(unittest.TestCase):
+
+    # The grid finds the same crossings as looking at every one.
+    def test_matches_a_scan(self):
+        layer = CrossingNetwork(1500)["AllIntersections"]
+        index = CrossingIndex(layer)
+        rng = np.random.RandomState(2)
+        xmin, ymin, xmax, ymax = index.extent
+        for x, y in zip(rng.uniform(xmin, xmax, 20), rng.uniform(ymin, ymax, 20)):
+            size = rng.uniform(10, 2000)
+            inside = (layer.x >= x) & (layer.x <= x + size) & (layer.y >= y) & (layer.y <= y + size)
+            self.assertEqual(index.BBox(x, y, x + size, y + size).tolist(), np.nonzero(inside)[0].tolist())
+            distance = np.hypot(layer.x - x, layer.y - y)
+            rows, found = index.Nearest(x, y, 5)
+            np.testing.assert_allclose(found, np.sort(distance)[:5])
+            rows, found = index.Radius(x, y, size)
+            self.assertEqual(sorted(rows.tolist()), np.nonzero(distance <= size)[0].tolist())
+        value = layer.columns["SnFID"][np.nonzero(np.not_equal(layer.columns["SnFID"], None))[0][0]]
+        self.assertEqual(index.Facility("SnFID", value).tolist(),
+                         [row for row, other in enumerate(layer.columns["SnFID"]) if other == value])
+
+
+if __name__ == "__main__":
+    unittest.main()
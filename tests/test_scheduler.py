@@ -0,0 +1,105 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import unittest
+
+from support import TemporaryFolder
+
+from crossings.scheduler import CriticalPath, Dependencies, Scheduler, Stage, StageError
+
+
+# Process: A stage that needs its input files and writes its output files.
+def _Write(folder, inputs, outputs, seconds=0.0):
+    for name in inputs:
+        if not os.path.exists(os.path.join(folder, name)):
+            raise IOError("%s has not been written" % name)
+    time.sleep(seconds)
+    for name in outputs:
+        with open(os.path.join(folder, name), "w") as output:
+            output.write(str(os.getpid()))
+
+
+def _Fail():
+    raise ValueError("bad pipe")
+
+
+def _Stages(folder, seconds=0.0):
+    def Step(name, inputs, outputs, wait=seconds):
+        return Stage(_Write, inputs, outputs, (folder, inputs, outputs, wait), name)
+    return [Step("CopyStorm", [], ["swPipes"]),
+            Step("CopySewer", [], ["snPipes"]),
+            Step("StormXY", ["swPipes"], ["swPipes"]),
+            Step("IntersectSWSS", ["snPipes", "swPipes"], ["SWSSIntersect"], 3 * seconds),
+            Step("SewerXY", ["snPipes"], ["snPipes"]),
+            Step("AllIntersections", ["SWSSIntersect"], ["AllIntersections"])]
+
+
+class DependenciesTest(unittest.TestCase):
+
+    # A stage waits for the writer of what it reads, and a stage that
+    # rewrites a dataset waits for the stages still reading the old one.
+    def test_dependencies(self):
+        depends = Dependencies(_Stages("unused"))
+        self.assertEqual(depends["CopyStorm"], set())
+        self.assertEqual(depends["StormXY"], set(["CopyStorm"]))
+        self.assertEqual(depends["IntersectSWSS"], set(["CopySewer", "StormXY"]))
+        self.assertEqual(depends["SewerXY"], set(["CopySewer", "IntersectSWSS"]))
+        self.assertEqual(depends["AllIntersections"], set(["IntersectSWSS"]))
+
+    def test_unique_names(self):
+        stages = _Stages("unused")
+        self.assertRaises(StageError, Dependencies, stages + stages[:1])
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = TemporaryFolder(self)
+
+    def test_workers(self):
+        stages = _Stages(self.folder, 0.1)
+        scheduler = Scheduler(stages, workers=3)
+        results = scheduler.Run()
+        self.assertEqual(sorted(results), sorted(stage.name for stage in stages))
+        for stage in stages:
+            for name in scheduler.depends[stage.name]:
+                self.assertGreaterEqual(results[stage.name].start, results[name].end)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "AllIntersections")))
+        # The two copies run at the same time in different processes.
+        self.assertLess(results["CopySewer"].start, results["CopyStorm"].end)
+        self.assertNotEqual(results["CopySewer"].pid, results["CopyStorm"].pid)
+        self.assertEqual(scheduler.criticalPath[1:3], ["StormXY", "IntersectSWSS"])
+        self.assertTrue(scheduler.Report()[-1].startswith(" Critical path"))
+
+    def test_failed_stage(self):
+        stages = _Stages(self.folder)
+        stages.insert(3, Stage(_Fail, ["swPipes"], ["swPipes"], name="ValidateStorm"))
+        for workers in (1, 2):
+            with self.assertRaises(StageError) as raised:
+                Scheduler(stages, workers=workers).Run()
+            self.assertIn("ValidateStorm", str(raised.exception))
+            self.assertIn("bad pipe", str(raised.exception))
+            self.assertFalse(os.path.exists(os.path.join(self.folder, "AllIntersections")))
+
+
+class CriticalPathTest(unittest.TestCase):
+
+    def test_longest_chain(self):
+        stages = _Stages("unused")
+        durations = {"CopyStorm": 5.0, "CopySewer": 1.0, "StormXY": 1.0, "IntersectSWSS": 2.0, "SewerXY": 1.0,
+                     "AllIntersections": 1.0}
+        results = dict((name, Result(seconds)) for name, seconds in durations.items())
+        path, seconds = CriticalPath(stages, Dependencies(stages), results)
+        self.assertEqual(path, ["CopyStorm", "StormXY", "IntersectSWSS", "SewerXY"])
+        self.assertEqual(seconds, 9.0)
+
+
+class Result(object):
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+if __name__ == "__main__":
+    unittest.main()
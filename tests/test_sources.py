@@ -0,0 +1,114 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import threading
+import unittest
+
+import numpy as np
+
+from support import TemporaryFolder
+
+from crossings import fieldmap, sources, synthetic
+from crossings.geometry import MergeLayers
+
+
+# A GeoPackage reader that claims, like ArcSource, that its cursors cannot be
+# shared between threads, and notes the threads it was read on.
+class SerialSource(sources.GeoPackageSource):
+
+    threadSafe = False
+
+    def _Rows(self, className, sourceNames, keyRange=None):
+        self.threads.add(threading.current_thread().name)
+        return sources.GeoPackageSource._Rows(self, className, sourceNames, keyRange)
+
+
+def _Extract(reader, className, workers):
+    return MergeLayers(className, list(sources.Extract(reader, className, batchSize=50, workers=workers)))
+
+
+class ExtractTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(TemporaryFolder(self), "standin.gpkg")
+        synthetic.WriteSyntheticNetwork(self.path, synthetic.SyntheticNetwork(4000, seed=5))
+
+    def AssertSame(self, layer, expected):
+        self.assertEqual(layer.oids.tolist(), expected.oids.tolist())
+        np.testing.assert_array_equal(layer.coords, expected.coords)
+        np.testing.assert_array_equal(layer.partOffsets, expected.partOffsets)
+        self.assertEqual([field.name for field in layer.fields], [field.name for field in expected.fields])
+        for name, values in expected.columns.items():
+            if values.dtype == object:
+                self.assertEqual(list(layer.columns[name]), list(values), name)
+            else:
+                np.testing.assert_array_equal(layer.columns[name], values, name)
+
+    # Pages fetched on four threads come back in the order of a serial read.
+    def test_concurrent_pages(self):
+        reader = sources.GeoPackageSource(self.path, poolSize=4, latency=0.001)
+        self.addCleanup(reader.Close)
+        for className in fieldmap.FIELD_MAPS:
+            serial = _Extract(reader, className, 1)
+            self.assertGreater(len(serial), 50)
+            self.AssertSame(_Extract(reader, className, 4), serial)
+
+    # A reader that is not thread-safe reads every page on the caller's
+    # thread, whatever the worker count.
+    def test_serial_reader(self):
+        reader = SerialSource(self.path, poolSize=4)
+        reader.threads = set()
+        self.addCleanup(reader.Close)
+        pages = list(reader.Pages("swPipes", None, 300, workers=4))
+        self.assertGreater(len(pages), 1)
+        self.assertEqual(reader.threads, set([threading.current_thread().name]))
+        self.AssertSame(MergeLayers("swPipes", pages), reader.Read("swPipes"))
+
+
+class SourceReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.network = synthetic.SyntheticNetwork(2000, seed=7)
+        self.path = os.path.join(TemporaryFolder(self), "standin.gpkg")
+        synthetic.WriteSyntheticNetwork(self.path, self.network)
+        self.reader = sources.GeoPackageSource(self.path, batchSize=100)
+        self.addCleanup(self.reader.Close)
+
+    # Only the fields asked for are fetched, matched without regard to case,
+    # under the names asked for; fields the class does not have are skipped.
+    def test_projection(self):
+        names = ["facilityid", "DIAMETER", "NOSUCHFIELD", "ModifyDate"]
+        batches = list(self.reader.Batches("snGravity", names))
+        self.assertGreater(len(batches), 2)
+        self.assertTrue(all(len(batch) <= 100 for batch in batches))
+        layer = MergeLayers("snGravity", batches)
+        self.assertEqual([field.name for field in layer.fields], ["facilityid", "DIAMETER", "ModifyDate"])
+        source = self.network["snGravity"]
+        self.assertEqual(list(layer.columns["facilityid"]), list(source.columns["FACILITYID"]))
+        self.assertEqual(list(layer.columns["ModifyDate"]), list(source.columns["MODIFYDATE"]))
+        np.testing.assert_array_equal(layer.coords, source.coords)
+
+    # Extracting with a field map gives the field-mapped synthetic class.
+    def test_extract(self):
+        for className in ("swPipes", "snForce"):
+            expected = fieldmap.ApplyFieldMap(self.network[className], fieldmap.FIELD_MAPS[className])
+            layer = MergeLayers(className, list(sources.Extract(self.reader, className)))
+            self.assertEqual([field.name for field in layer.fields], [field.name for field in expected.fields])
+            np.testing.assert_array_equal(layer.pipeParts, expected.pipeParts)
+            for name, values in expected.columns.items():
+                if values.dtype == object:
+                    self.assertEqual(list(layer.columns[name]), list(values), name)
+                else:
+                    np.testing.assert_allclose(layer.columns[name], values, err_msg=name)
+
+    def test_fingerprint(self):
+        count, highest, latest = self.reader.Fingerprint("wnLateral")
+        source = self.network["wnLateral"]
+        self.assertEqual((count, highest), (len(source), source.oids.max()))
+        # As stored: GeoPackage dates are text.
+        self.assertEqual(latest, max(date for date in source.columns["MODIFYDATE"] if date is not None).isoformat())
+        self.assertRaises(IOError, sources.GeoPackageSource, self.path + ".missing")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import unittest
+
+import numpy as np
+
+from support import PIPE_LAYERS, PipeNetwork, TemporaryFolder
+
+from crossings import columnar, tiling
+from crossings.allpairs import DEFAULT_PAIRS
+from crossings.engine import CROSSING_ARRAYS, FindCrossings, IntersectLayers
+from crossings.geometry import PipeLayer
+
+PAIRS = [(pair.first, pair.second) for pair in DEFAULT_PAIRS]
+
+
+class TiledCrossingsTest(unittest.TestCase):
+
+    def AssertSame(self, crossings, expected):
+        self.assertEqual(len(crossings), len(expected))
+        for name in CROSSING_ARRAYS:
+            np.testing.assert_array_equal(getattr(crossings, name), getattr(expected, name), name)
+
+    # Quadtree and grid tiles, in one process and on a pool, give the
+    # crossings of the whole layers.
+    def test_matches_find_crossings(self):
+        data = PipeNetwork(3000)
+        expected = [FindCrossings(data[first], data[second]) for first, second in PAIRS]
+        self.assertGreater(len(tiling.LayerTiles([data["snPipes"], data["swPipes"]], maxPipes=100)), 10)
+        for maxPipes, across, workers in ((100, None, 1), (None, 5, 2)):
+            found = tiling.TiledCrossings(dict((name, data[name]) for name in PIPE_LAYERS), PAIRS, maxPipes, across,
+                                          workers)
+            for crossings, wanted in zip(found, expected):
+                self.assertGreater(len(wanted), 0)
+                self.AssertSame(crossings, wanted)
+
+    # A crossing on a tile border, and a pipe touching every tile, are found
+    # once.
+    def test_tile_borders(self):
+        first = PipeLayer.FromLines("snPipes", [[(0, 0), (10, 10)], [(5, 0), (5, 10)], [(0, 2), (10, 2)]])
+        second = PipeLayer.FromLines("swPipes", [[(0, 5), (10, 5)], [(0, 10), (10, 0)]])
+        extent = tiling.Extent([first.PipeBoxes(), second.PipeBoxes()])
+        self.assertEqual(len(tiling.GridTiles(extent, 2)), 4)
+        found = tiling.TiledCrossings({"snPipes": first, "swPipes": second}, [("snPipes", "swPipes")], across=2,
+                                      workers=1)[0]
+        self.AssertSame(found, FindCrossings(first, second))
+        self.assertEqual(len(found), 5)
+
+    # The layers can be columnar folders; the point layers are those of
+    # IntersectLayers.
+    def test_columnar_layers(self):
+        folder = TemporaryFolder(self)
+        data = PipeNetwork(1500)
+        layers = dict((name, columnar.WriteColumnar(os.path.join(folder, name), data[name]))
+                      for name in ("snPipes", "swPipes"))
+        points = tiling.TiledIntersectLayers(layers, [("snPipes", "swPipes", "SWSSIntersect")], maxPipes=80,
+                                             workers=1)[0]
+        expected = IntersectLayers(data["snPipes"], data["swPipes"], "SWSSIntersect")
+        np.testing.assert_array_equal(points.x, expected.x)
+        self.assertEqual([field.name for field in points.fields], [field.name for field in expected.fields])
+        np.testing.assert_array_equal(points.columns["FID_swPipes"], expected.columns["FID_swPipes"])
+
+
+if __name__ == "__main__":
+    unittest.main()
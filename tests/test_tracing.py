@@ -0,0 +1,82 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import time
+import unittest
+
+import numpy as np
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from support import TemporaryFolder
+
+from crossings import tracing
+
+ROWS = {"pipes": 400, "crossings": 20}
+
+
+def _Allocate(megabytes, seconds=0.0):
+    values = np.ones(int(megabytes * 1024 * 1024 / 8))
+    time.sleep(seconds)
+    return float(values.sum())
+
+
+def _Count(name):
+    return ROWS.get(name)
+
+
+@unittest.skipIf(tracing.RssMB() is None, "resident memory is not known on this platform")
+class StageMemoryTest(unittest.TestCase):
+
+    # A small stage after a large one reports its own peak, not the peak of
+    # the process so far.
+    def test_peak_is_per_stage(self):
+        tracer = tracing.Tracer()
+        large = tracer.Trace("large", _Allocate, (200,))
+        small = tracer.Trace("small", _Allocate, (1,))
+        self.assertGreater(large["peakRssMB"], small["peakRssMB"] + 150)
+
+    # Where the peak cannot be reset it is sampled during the stage.
+    def test_sampled_peak(self):
+        with mock.patch.object(tracing, "ResetPeakRss", lambda: False):
+            memory = tracing.StageMemory(interval=0.01)
+            before = tracing.RssMB()
+            _Allocate(200, 0.2)
+            peak = memory.Stop()
+        self.assertFalse(memory.reset)
+        self.assertGreater(peak, before + 150)
+
+
+class TracerTest(unittest.TestCase):
+
+    def test_span(self):
+        folder = TemporaryFolder(self)
+        path = os.path.join(folder, "trace", "run_trace.jsonl")
+        tracer = tracing.Tracer(path, _Count)
+        span = tracer.Trace("IntersectSWSS", _Allocate, (1,), ["pipes", "missing"], ["crossings"])
+        self.assertEqual((span["stage"], span["rowsIn"], span["rowsOut"]), ("IntersectSWSS", 400, 20))
+        self.assertGreaterEqual(span["cpuSeconds"], 0)
+        tracer.Record(span)
+        tracer.Record(tracer.Trace("empty", _Allocate, (0,), [], ["missing"]))
+        with open(path) as trace:
+            spans = [json.loads(line) for line in trace]
+        self.assertEqual([span["stage"] for span in spans], ["IntersectSWSS", "empty"])
+        self.assertIsNone(spans[1]["rowsOut"])
+        lines = tracer.SummaryLines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith("Stage"))
+
+    def test_stage_errors_are_passed_on(self):
+        tracer = tracing.Tracer()
+        self.assertRaises(ZeroDivisionError, tracer.Trace, "fails", lambda: 1 / 0)
+
+    def test_unknown_profiler(self):
+        self.assertRaises(ValueError, tracing.Tracer, profile="gprof")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+
+from support import CrossingNetwork
+
+from crossings import uncertainty
+
+
+class VertSepUncertaintyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.columns = uncertainty.RandomCrossings(500, seed=4)
+        self.columns["SS_Invert"][:3] = np.nan
+        self.columns["SWDiam"][3] = np.nan
+
+    # The draws of a crossing do not depend on the chunk it falls in.
+    def test_chunk_size_independent(self):
+        whole = uncertainty.VertSepUncertainty(self.columns, samples=400, memoryMB=256)
+        for memoryMB in (0.001, 0.01, 0.07):
+            self.assertLess(uncertainty.ChunkRows(400, memoryMB), len(self.columns["SS_Invert"]))
+            chunked = uncertainty.VertSepUncertainty(self.columns, samples=400, memoryMB=memoryMB)
+            for name, values in whole.items():
+                np.testing.assert_array_equal(chunked[name], values)
+
+    def test_values(self):
+        derived = uncertainty.VertSepUncertainty(self.columns, samples=400)
+        self.assertEqual(list(derived), [field.name for field in uncertainty.UNCERTAINTY_FIELDS])
+        for values in derived.values():
+            self.assertTrue(np.all(np.isnan(values[:4])))
+            self.assertFalse(np.any(np.isnan(values[4:])))
+        conflict = derived["PConflict"][4:]
+        self.assertTrue(np.all((conflict >= 0) & (conflict <= 1)))
+        self.assertTrue(np.all(derived["VertSepLo"][4:] <= derived["VertSepHi"][4:]))
+        other = uncertainty.VertSepUncertainty(self.columns, samples=400, seed=2)
+        self.assertFalse(np.array_equal(other["VertSepLo"][4:], derived["VertSepLo"][4:]))
+
+    # Far apart pipes never conflict and pipes at the same invert nearly
+    # always do.
+    def test_sure_crossings(self):
+        columns = dict((name, np.array([values[0], values[0]])) for name, values in self.columns.items())
+        columns["SS_Invert"] = np.array([90.0, 95.0])
+        columns["SW_Invert"] = np.array([100.0, 95.0])
+        derived = uncertainty.VertSepUncertainty(columns, samples=2000)
+        self.assertEqual(derived["PConflict"][0], 0.0)
+        self.assertGreater(derived["PConflict"][1], 0.95)
+
+    def test_layer(self):
+        layer = CrossingNetwork(1500)["SWSSIntersect"]
+        uncertainty.AddVertSepUncertainty(layer, samples=200, memoryMB=0.01)
+        known = np.isfinite(layer.columns["VertSep"])
+        self.assertGreater(np.count_nonzero(known), 0)
+        self.assertFalse(np.any(np.isnan(layer.columns["PConflict"][known])))
+        uncertainty.AddVertSepUncertainty(layer, samples=200)
+        self.assertEqual([field.name for field in layer.fields].count("PConflict"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,213 @@
+from __future__ import absolute_import, division, print_function
+
+import math
+import time
+import unittest
+
+import numpy as np
+
+from support import PipeNetwork
+
+from crossings import benchmark, quality, vertsep
+from crossings.engine import IntersectLayers
+from crossings.geometry import PipeLayer
+
+
+# The steps of the original SSSWVertSep, one row at a time: the placeholder
+# selections set to NULL, each CalculateField expression (a result that is not
+# a number leaves the field NULL) and the selections for CrossTy, PipeInter and
+# the missing-data labels.  None is NULL.
+def _Number(value):
+    return None if value is None or isinstance(value, float) and not math.isfinite(value) else value
+
+
+def _Calculate(expression, *values):
+    if any(value is None for value in values):
+        return None
+    try:
+        return _Number(expression(*values))
+    except (ZeroDivisionError, ValueError):
+        return None
+
+
+def ReferenceRow(row):
+    row = dict(row)
+    for name, placeholders in (("SnUpinvert", (0,)), ("SnDninvert", (0,)), ("SWUpinvert", (0, -9999)),
+                               ("SWDninvert", (0, -9999))):
+        if row[name] in placeholders:
+            row[name] = None
+    if row["SWDiam"] == -9999:
+        row["SWDiam"] = 0
+    slope = lambda up, down, length: ((up - down) / length) * 100
+    distance = lambda upX, x, upY, y: math.sqrt((upX - x) ** 2 + (upY - y) ** 2)
+    invert = lambda up, pipeSlope, length: up - (pipeSlope / 100 * length)
+    row["Snslope"] = _Calculate(slope, row["SnUpinvert"], row["SnDninvert"], row["SnLength"])
+    row["SWslope"] = _Calculate(slope, row["SWUpinvert"], row["SWDninvert"], row["SWLength"])
+    row["SS_Length"] = _Calculate(distance, row["SSUpX"], row["POINT_X"], row["SSUpY"], row["POINT_Y"])
+    row["SW_Length"] = _Calculate(distance, row["SWUpX"], row["POINT_X"], row["SWUpY"], row["POINT_Y"])
+    row["SS_Invert"] = _Calculate(invert, row["SnUpinvert"], row["Snslope"], row["SS_Length"])
+    row["SW_Invert"] = _Calculate(invert, row["SWUpinvert"], row["SWslope"], row["SW_Length"])
+    ss, sw = row["SS_Invert"], row["SW_Invert"]
+    row["VertSep"] = row["CrossTy"] = row["PipeInter"] = None
+    if ss is not None and sw is not None:
+        if sw > ss:
+            row["VertSep"] = _Calculate(lambda a, b, d: a - (b + d / 12), sw, ss, row["SnDiam"])
+            row["CrossTy"] = "Storm over Sewer"
+        elif ss > sw:
+            row["VertSep"] = _Calculate(lambda a, b, d: a - (b + d / 12), ss, sw, row["SWDiam"])
+            row["CrossTy"] = "Sewer over Storm"
+    if row["VertSep"] is not None:
+        if row["VertSep"] > 20:
+            row["CrossTy"] = "Bad Data?"
+        if row["VertSep"] < 0:
+            row["PipeInter"] = "Yes"
+        elif row["VertSep"] > 0:
+            row["PipeInter"] = "No"
+    if row["CrossTy"] is None:
+        if ss is None and sw is None:
+            row["CrossTy"] = "Sewer and Storm Missing"
+        elif ss is None:
+            row["CrossTy"] = "Sewer Data Missing"
+        elif sw is None:
+            row["CrossTy"] = "Storm Data Missing"
+    return row
+
+
+BASE = {"SnUpinvert": 100.0, "SnDninvert": 98.0, "SnLength": 200.0, "SnDiam": 8.0, "SSUpX": 0.0, "SSUpY": 0.0,
+        "SWUpinvert": 105.0, "SWDninvert": 104.0, "SWLength": 100.0, "SWDiam": 24.0, "SWUpX": 50.0,
+        "SWUpY": -50.0, "POINT_X": 50.0, "POINT_Y": 0.0}
+
+CASES = [{},                                                          # storm over sewer
+         {"SWUpinvert": 95.0, "SWDninvert": 94.0},                    # sewer over storm
+         {"SWUpinvert": 100.2, "SWDninvert": 99.0},                   # the pipes intersect
+         {"SWUpinvert": 130.0, "SWDninvert": 129.0},                  # Bad Data?
+         {"SnUpinvert": 0.0},                                         # sewer placeholder
+         {"SnDninvert": 0.0, "SWUpinvert": -9999.0},                  # both missing
+         {"SWDninvert": 0.0},                                         # storm placeholder
+         {"SWUpinvert": -9999.0},                                     # storm placeholder
+         {"SWUpinvert": 95.0, "SWDninvert": 94.0, "SWDiam": -9999.0},  # diameter placeholder
+         {"SnLength": 0.0},                                           # slope divides by zero
+         {"SnUpinvert": None, "SWDiam": None},                        # NULL inputs
+         {"SWUpinvert": 99.5, "SWDninvert": 99.0, "SWUpY": 0.0, "SWUpX": 0.0}]  # equal inverts
+
+
+def _Columns(rows):
+    columns = {}
+    for name in BASE:
+        columns[name] = np.array([np.nan if row[name] is None else row[name] for row in rows], dtype=np.float64)
+    return columns
+
+
+def _Same(value, expected):
+    if expected is None:
+        return value is None or isinstance(value, float) and math.isnan(value)
+    if isinstance(expected, str):
+        return value == expected
+    return value is not None and abs(value - expected) < 1e-9
+
+
+class VerticalSeparationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = []
+        for case in CASES:
+            row = dict(BASE)
+            row.update(case)
+            self.rows.append(row)
+
+    def Check(self, derived):
+        for i, row in enumerate(self.rows):
+            expected = ReferenceRow(row)
+            for field in vertsep.OUTPUT_FIELDS:
+                value = derived[field.name][i]
+                value = float(value) if isinstance(value, np.floating) else value
+                self.assertTrue(_Same(value, expected[field.name]),
+                                "case %d %s: %r, expected %r" % (i, field.name, value, expected[field.name]))
+
+    def test_matches_the_original_steps(self):
+        derived = vertsep.VerticalSeparation(_Columns(self.rows))
+        self.Check(derived)
+        self.assertEqual(list(derived["CrossTy"][:6]), ["Storm over Sewer", "Sewer over Storm", "Storm over Sewer",
+                                                        "Bad Data?", "Sewer Data Missing",
+                                                        "Sewer and Storm Missing"])
+        self.assertEqual(derived["PipeInter"][2], "Yes")
+
+    # The QA flag bits pick out the same placeholders as testing the values.
+    def test_qa_flags(self):
+        columns = _Columns(self.rows)
+        rules = (("SnQAFlags", "SnUpinvert", "SnDninvert", None, (0,)),
+                 ("SWQAFlags", "SWUpinvert", "SWDninvert", "SWDiam", (0, -9999)))
+        for flagField, up, down, diameter, placeholders in rules:
+            flags = np.zeros(len(self.rows), dtype=np.int64)
+            flags[np.isin(columns[up], placeholders)] |= quality.UP_SENTINEL
+            flags[np.isin(columns[down], placeholders)] |= quality.DN_SENTINEL
+            if diameter:
+                flags[columns[diameter] == -9999] |= quality.DIAMETER_SENTINEL
+            columns[flagField] = flags
+        self.Check(vertsep.VerticalSeparation(columns))
+
+    def test_along_pipe_lengths_on_a_network(self):
+        data = PipeNetwork(3000)
+        for name, stage in benchmark.STAGES[2:]:
+            if name == "vertsep":
+                break
+            stage(data)
+        flagged = data["SWSSIntersect"]
+        unflagged = flagged.Take(np.arange(len(flagged)))
+        for name in vertsep.QA_FIELDS:
+            del unflagged.columns[name]
+        unflagged.fields = [field for field in unflagged.fields if field.name not in vertsep.QA_FIELDS]
+        vertsep.AddVerticalSeparation(flagged, data["snPipes"], data["swPipes"])
+        vertsep.AddVerticalSeparation(unflagged, data["snPipes"], data["swPipes"])
+        self.assertGreater(len(flagged), 0)
+        for field in vertsep.OUTPUT_FIELDS:
+            first, second = flagged.columns[field.name], unflagged.columns[field.name]
+            if first.dtype == object:
+                self.assertEqual(list(first), list(second))
+            else:
+                np.testing.assert_array_equal(first, second)
+        # Crossings without their chainage are located on the pipes, with the
+        # same result.
+        columns = dict((name, flagged.columns[name]) for name in vertsep.PIPE_ID_FIELDS)
+        columns["POINT_X"], columns["POINT_Y"] = flagged.x, flagged.y
+        for length, name in zip(vertsep.AlongPipeLengths(columns, data["snPipes"], data["swPipes"]),
+                                vertsep.CHAINAGE_FIELDS):
+            np.testing.assert_allclose(length, flagged.columns[name], atol=1e-6)
+        # Along the pipe a crossing is never nearer the upstream end than in a
+        # straight line.
+        straight = np.hypot(flagged.columns["SSUpX"] - flagged.x, flagged.columns["SSUpY"] - flagged.y)
+        along = flagged.columns["SS_Length"]
+        known = ~np.isnan(along)
+        self.assertTrue(np.all(along[known] >= straight[known] - 1e-6))
+
+
+
+class AlongPipeLengthsTest(unittest.TestCase):
+
+    # One long main crossed thousands of times: each crossing only looks at
+    # the segments near it.
+    def test_long_pipe(self):
+        vertices = 20000
+        x = np.arange(vertices, dtype=np.float64)
+        sewer = PipeLayer.FromLines("snPipes", [list(zip(x, np.where(np.arange(vertices) % 2, 0.5, 0.0)))])
+        storm = PipeLayer.FromLines("swPipes", [[(i * 5 + 0.25, -1.0), (i * 5 + 0.25, 2.0)] for i in range(3999)])
+        layer = IntersectLayers(sewer, storm, "SWSSIntersect")
+        self.assertEqual(len(layer), 3999)
+        columns = dict((name, layer.columns[name]) for name in vertsep.PIPE_ID_FIELDS)
+        columns["POINT_X"], columns["POINT_Y"] = layer.x, layer.y
+        started = time.time()
+        lengths = vertsep.AlongPipeLengths(columns, sewer, storm)
+        self.assertLess(time.time() - started, 2.0)
+        for length, name in zip(lengths, vertsep.CHAINAGE_FIELDS):
+            np.testing.assert_allclose(length, layer.columns[name], atol=1e-9)
+
+    def test_points_off_the_pipe(self):
+        sewer = PipeLayer.FromLines("snPipes", [[(0, 0), (10, 0)], [(0, 5), (10, 5)]])
+        vertex, t = vertsep.LocateOnPipes(sewer, [0, 0, 1, -1], [4.0, 4.0, 10.0, 1.0], [0.0, 1.0, 5.0, 0.0])
+        self.assertEqual(vertex.tolist(), [0, -1, 2, -1])
+        self.assertEqual(t[[0, 2]].tolist(), [0.4, 1.0])
+        self.assertTrue(np.all(np.isnan(t[[1, 3]])))
+
+
+if __name__ == "__main__":
+    unittest.main()